@@ -0,0 +1,111 @@
+"""
+event loop ที่รันอยู่ใน thread ของตัวเอง สำหรับงาน async ที่ถูกสั่งจากโค้ดแบบ thread (handler ใน event_executor)
+
+ใช้กับงานที่ใช้เวลารอ upstream นาน (เช่น วิเคราะห์รูปด้วย Gemini 10-30 วินาที):
+handler ส่ง coroutine เข้ามาแล้วคืน thread ทันที งานหลายร้อยงานรอ Gemini พร้อมกันได้ใน thread เดียว
+client แบบ async (เช่น grpc.aio ของ SDK Gemini) ผูกกับ loop ที่สร้างมัน จึงต้องใช้ loop เดียวตลอดอายุ process
+"""
+
+import asyncio
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Coroutine, Dict, Optional
+
+# เวลาที่ให้งานที่ถูก cancel ตอน stop เก็บกวาด (เช่น ลบไฟล์ที่อัพโหลด) ก่อนปิด loop
+CANCEL_GRACE_S = 5.0
+
+
+class BackgroundLoop:
+    """
+    asyncio event loop ใน daemon thread (สร้าง thread เมื่อส่งงานครั้งแรก)
+    """
+
+    def __init__(self, name: str = "background-loop", max_threads: int = 32):
+        self.name = name
+        # thread pool ของ asyncio.to_thread ใน loop นี้ (ค่าเริ่มต้นของ asyncio มีแค่ CPU + 4 thread
+        # ซึ่งไม่พอเมื่องานหลายสิบงานอัพโหลด/ลบไฟล์/ดาวน์โหลดรูปพร้อมกัน)
+        self.max_threads = max_threads
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._thread: Optional[threading.Thread] = None
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._lock = threading.Lock()
+        self._in_flight = 0
+        self._completed = 0
+
+    def _ensure_started(self) -> asyncio.AbstractEventLoop:
+        with self._lock:
+            if self._loop is None:
+                loop = asyncio.new_event_loop()
+                self._executor = ThreadPoolExecutor(self.max_threads, thread_name_prefix=f"{self.name}-io")
+                loop.set_default_executor(self._executor)
+                ready = threading.Event()
+
+                def run():
+                    asyncio.set_event_loop(loop)
+                    loop.call_soon(ready.set)
+                    loop.run_forever()
+
+                self._thread = threading.Thread(target=run, name=self.name, daemon=True)
+                self._thread.start()
+                ready.wait()
+                self._loop = loop
+            return self._loop
+
+    def submit(self, coro: Coroutine) -> Future:
+        """
+        ส่ง coroutine ไปรันใน loop คืน concurrent.futures.Future (ไม่บล็อกผู้เรียก)
+        """
+        loop = self._ensure_started()
+        with self._lock:
+            self._in_flight += 1
+        future = asyncio.run_coroutine_threadsafe(coro, loop)
+        future.add_done_callback(self._on_done)
+        return future
+
+    def run(self, coro: Coroutine, timeout: Optional[float] = None):
+        """
+        รัน coroutine ใน loop แล้วรอผล (สำหรับผู้เรียกที่เป็น thread ธรรมดา)
+        """
+        return self.submit(coro).result(timeout)
+
+    def _on_done(self, future: Future):
+        with self._lock:
+            self._in_flight -= 1
+            self._completed += 1
+        # ไม่มีใครรอผลของงานที่ submit แล้วปล่อย จึงต้อง log error เอง
+        if not future.cancelled() and future.exception() is not None:
+            print(f"❌ งานใน {self.name} ล้มเหลว: {future.exception()!r}")
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {"in_flight": self._in_flight, "completed": self._completed, "running": self._loop is not None}
+
+    def stop(self, timeout: float = 30.0):
+        """
+        รอให้งานที่ค้างอยู่จบ (ไม่เกิน timeout วินาที) แล้วปิด loop
+        งานที่ไม่จบในเวลาถูก cancel (finally ของงานได้เก็บกวาด และ Future ของผู้ส่งงานจบเป็น cancelled)
+        """
+        with self._lock:
+            loop, thread, executor = self._loop, self._thread, self._executor
+            self._loop = self._thread = self._executor = None
+        if loop is None:
+            return
+
+        async def drain():
+            tasks = [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+            if not tasks:
+                return
+            _, pending = await asyncio.wait(tasks, timeout=timeout)
+            for task in pending:
+                task.cancel()
+            if pending:
+                await asyncio.wait(pending, timeout=CANCEL_GRACE_S)
+
+        try:
+            asyncio.run_coroutine_threadsafe(drain(), loop).result(timeout + CANCEL_GRACE_S + 1)
+        finally:
+            loop.call_soon_threadsafe(loop.stop)
+            thread.join(timeout=5)
+            loop.close()
+            # thread ที่ยังค้าง (งานที่ถูก cancel แล้ว) ไม่รอ
+            executor.shutdown(wait=False)
@@ -0,0 +1,4 @@
+"""
+ชุดเครื่องมือ Benchmark / Load Test สำหรับ LINE Insurance Claim Bot
+รันแบบ offline ได้ทั้งหมด (ใช้ server จำลองแทน LINE และ Gemini)
+"""
@@ -0,0 +1,423 @@
+"""
+Server จำลองสำหรับ LINE Messaging API และ Gemini API
+
+ใช้เฉพาะ standard library (http.server) เพื่อให้รันได้บนเครื่อง Linux เปล่าๆ
+แต่ละ server กำหนด latency distribution และอัตรา error ได้ และนับจำนวน request ต่อ route
+
+รูปแบบ latency spec:
+    const:50            - หน่วงคงที่ 50 ms
+    uniform:20,80       - สุ่มสม่ำเสมอระหว่าง 20-80 ms
+    lognormal:200,0.5   - log-normal ค่ากลาง (median) 200 ms, sigma 0.5
+    exp:100             - exponential ค่าเฉลี่ย 100 ms
+"""
+
+import io
+import json
+import math
+import random
+import re
+import threading
+import time
+import uuid
+from collections import defaultdict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional, Tuple
+
+import httpx
+
+
+class LatencyModel:
+    """
+    สุ่มค่า latency (วินาที) ตาม spec ที่กำหนด
+    """
+
+    def __init__(self, spec: str = "const:0", seed: Optional[int] = None):
+        self.spec = spec
+        self._random = random.Random(seed)
+        kind, _, args = spec.partition(":")
+        values = [float(v) for v in args.split(",") if v.strip()] if args else []
+
+        if kind == "const":
+            ms = values[0] if values else 0.0
+            self._sample = lambda: ms
+        elif kind == "uniform":
+            low, high = values
+            self._sample = lambda: self._random.uniform(low, high)
+        elif kind == "lognormal":
+            median, sigma = values
+            mu = math.log(median)
+            self._sample = lambda: self._random.lognormvariate(mu, sigma)
+        elif kind == "exp":
+            mean = values[0]
+            self._sample = lambda: self._random.expovariate(1.0 / mean)
+        else:
+            raise ValueError(f"ไม่รู้จัก latency spec: {spec}")
+
+    def sample(self) -> float:
+        return max(0.0, self._sample()) / 1000.0
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def _dispatch(self, method: str):
+        owner = self.server.owner
+        length = int(self.headers.get("Content-Length") or 0)
+        body = self.rfile.read(length) if length else b""
+        route, status, content_type, payload = owner.route(method, self.path, self.headers, body)
+
+        try:
+            self.send_response(status)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+        except (BrokenPipeError, ConnectionResetError):
+            # client ยกเลิก request ไปแล้ว (เช่น งานถูก cancel ตอนปิดระบบ)
+            self.close_connection = True
+
+    def do_GET(self):
+        self._dispatch("GET")
+
+    def do_POST(self):
+        self._dispatch("POST")
+
+    def do_DELETE(self):
+        self._dispatch("DELETE")
+
+
+class FakeUpstream:
+    """
+    Base class ของ server จำลอง: รันใน daemon thread บน 127.0.0.1 (port สุ่ม)
+    """
+
+    name = "upstream"
+
+    def __init__(self, latency: str = "const:0", error_rate: float = 0.0, seed: Optional[int] = None):
+        self.latency = LatencyModel(latency, seed)
+        self.error_rate = error_rate
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self.stats: Dict[str, Dict[str, int]] = defaultdict(lambda: {"requests": 0, "errors": 0})
+        self._server: Optional[ThreadingHTTPServer] = None
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def url(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self) -> "FakeUpstream":
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), _Handler)
+        self._server.daemon_threads = True
+        self._server.owner = self
+        self._thread = threading.Thread(target=self._server.serve_forever, name=f"fake-{self.name}", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        if self._server:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def route(self, method: str, path: str, headers, body: bytes) -> Tuple[str, int, str, bytes]:
+        """
+        หน่วงเวลาตาม latency model, สุ่ม error แล้วส่งต่อให้ handler ของ route
+        """
+        route_name, handler = self.resolve(method, path)
+        time.sleep(self.latency.sample())
+
+        with self._lock:
+            self.stats[route_name]["requests"] += 1
+            failed = route_name != "not_found" and self._random.random() < self.error_rate
+            if failed:
+                self.stats[route_name]["errors"] += 1
+
+        if handler is None:
+            return route_name, 404, "application/json", b'{"message": "Not found"}'
+        if failed:
+            return route_name, 500, "application/json", b'{"message": "Injected upstream error"}'
+
+        status, content_type, payload = handler(path, headers, body)
+        return route_name, status, content_type, payload
+
+    def resolve(self, method: str, path: str):
+        raise NotImplementedError
+
+    def snapshot_stats(self) -> Dict[str, Dict[str, int]]:
+        with self._lock:
+            return {k: dict(v) for k, v in self.stats.items()}
+
+
+def _make_test_image() -> bytes:
+    """
+    สร้างรูป JPEG ขนาดเล็กสำหรับตอบ endpoint ดาวน์โหลดรูปจาก LINE
+    """
+    from PIL import Image
+
+    buffer = io.BytesIO()
+    Image.new("RGB", (64, 64), (200, 30, 30)).save(buffer, format="JPEG")
+    return buffer.getvalue()
+
+
+class FakeLineServer(FakeUpstream):
+    """
+    จำลอง api.line.me (reply/push) และ api-data.line.me (ดาวน์โหลดเนื้อหาข้อความ)
+    """
+
+    name = "line"
+    _content_re = re.compile(r"^/v2/bot/message/[^/]+/content$")
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.image_bytes = _make_test_image()
+        # ข้อความ push ที่ส่งถึงผู้ใช้แต่ละคน: (time.monotonic(), ข้อความหรือ altText)
+        self.pushes: Dict[str, List[Tuple[float, str]]] = defaultdict(list)
+
+    def resolve(self, method: str, path: str):
+        path = path.split("?", 1)[0]
+        if method == "POST" and path == "/v2/bot/message/reply":
+            return "reply", self._send
+        if method == "POST" and path == "/v2/bot/message/push":
+            return "push", self._send
+        if method == "GET" and self._content_re.match(path):
+            return "content", self._content
+        return "not_found", None
+
+    def _send(self, path, headers, body):
+        request = json.loads(body or b"{}")
+        messages = request.get("messages", [])
+        if path.startswith("/v2/bot/message/push"):
+            with self._lock:
+                self.pushes[request.get("to")].extend(
+                    (time.monotonic(), message.get("text") or message.get("altText", "")) for message in messages
+                )
+        sent = [{"id": str(random.randint(10**17, 10**18 - 1)), "quoteToken": uuid.uuid4().hex} for _ in messages]
+        return 200, "application/json", json.dumps({"sentMessages": sent}).encode("utf-8")
+
+    def _content(self, path, headers, body):
+        return 200, "image/jpeg", self.image_bytes
+
+
+class FakeGeminiServer(FakeUpstream):
+    """
+    จำลอง Gemini REST API: generateContent, upload, get (สถานะ PROCESSING/ACTIVE) และ delete file
+
+    ถ้า prompt เป็นงาน OCR (ขอ JSON type/value) จะตอบ JSON ทะเบียนรถ (ocr_plate)
+    งานอื่นจะตอบข้อความผลวิเคราะห์ที่มีเบอร์แจ้งเหตุ เพื่อให้ flow สร้างปุ่มโทรออก
+    """
+
+    name = "gemini"
+    _generate_re = re.compile(r"^/v1beta/models/[^/:]+:generateContent$")
+    _file_re = re.compile(r"^/v1beta/files/[^/]+$")
+
+    ANALYSIS_TEXT = (
+        "สวัสดีครับ สรุปผลการเช็คสิทธิ์เคลมด่วนดังนี้ครับ:\n"
+        "📄 ประเภท: ประกันชั้น 1 [หน้า 1]\n"
+        "⚖️ 🟢 ได้รับสิทธิ์เคลม (แนะนำ)\n"
+        "📋 แจ้งเหตุทันที: โทร 1557"
+    )
+
+    def __init__(self, *args, ocr_plate: str = "1กข1234", file_ready_delay: float = 0.0,
+                 analysis_latency: Optional[str] = None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.ocr_plate = ocr_plate
+        # หน่วงเพิ่มเฉพาะงานวิเคราะห์ (ของจริงช้ากว่า OCR หลายเท่า) ไม่ตั้ง = เท่ากับ OCR
+        self.analysis_latency = LatencyModel(analysis_latency, kwargs.get("seed")) if analysis_latency else None
+        # ไฟล์ที่อัพโหลดอยู่ในสถานะ PROCESSING นานเท่านี้ (วินาที) ก่อนเป็น ACTIVE
+        self.file_ready_delay = file_ready_delay
+        self._uploaded_at: Dict[str, float] = {}
+
+    def resolve(self, method: str, path: str):
+        path = path.split("?", 1)[0]
+        if method == "POST" and self._generate_re.match(path):
+            return "generate_content", self._generate
+        if method == "POST" and path == "/upload/v1beta/files":
+            return "upload_file", self._upload
+        if method == "GET" and self._file_re.match(path):
+            return "get_file", self._get_file
+        if method == "DELETE" and self._file_re.match(path):
+            return "delete_file", self._delete
+        if method == "GET" and path == "/v1beta/models":
+            return "list_models", self._list_models
+        return "not_found", None
+
+    def _generate(self, path, headers, body):
+        request = json.loads(body or b"{}")
+        prompt = " ".join(
+            part.get("text", "")
+            for content in request.get("contents", [])
+            for part in content.get("parts", [])
+        )
+        if '"type": "id_card"' in prompt:
+            text = json.dumps({"type": "license_plate", "value": self.ocr_plate}, ensure_ascii=False)
+        else:
+            text = self.ANALYSIS_TEXT
+            if self.analysis_latency is not None:
+                time.sleep(self.analysis_latency.sample())
+
+        prompt_tokens = max(1, len(prompt) // 4)
+        output_tokens = max(1, len(text) // 4)
+        response = {
+            "candidates": [{"content": {"role": "model", "parts": [{"text": text}]}, "finishReason": "STOP"}],
+            "usageMetadata": {
+                "promptTokenCount": prompt_tokens,
+                "candidatesTokenCount": output_tokens,
+                "totalTokenCount": prompt_tokens + output_tokens,
+            },
+        }
+        return 200, "application/json", json.dumps(response, ensure_ascii=False).encode("utf-8")
+
+    def _file_payload(self, name: str) -> Dict:
+        uploaded_at = self._uploaded_at.get(name)
+        if uploaded_at is None:
+            return {"name": name, "state": "FAILED"}
+        ready = time.monotonic() - uploaded_at >= self.file_ready_delay
+        return {"name": name, "state": "ACTIVE" if ready else "PROCESSING"}
+
+    def _upload(self, path, headers, body):
+        name = f"files/{uuid.uuid4().hex[:12]}"
+        with self._lock:
+            self._uploaded_at[name] = time.monotonic()
+        payload = {"file": {**self._file_payload(name), "mimeType": headers.get("Content-Type"), "sizeBytes": str(len(body))}}
+        return 200, "application/json", json.dumps(payload).encode("utf-8")
+
+    def _get_file(self, path, headers, body):
+        name = path.split("?", 1)[0][len("/v1beta/"):]
+        if name not in self._uploaded_at:
+            return 404, "application/json", b'{"message": "File not found"}'
+        return 200, "application/json", json.dumps(self._file_payload(name)).encode("utf-8")
+
+    def _delete(self, path, headers, body):
+        with self._lock:
+            self._uploaded_at.pop(path.split("?", 1)[0][len("/v1beta/"):], None)
+        return 200, "application/json", b"{}"
+
+    def remaining_files(self) -> int:
+        """
+        จำนวนไฟล์ที่อัพโหลดแล้วยังไม่ถูกลบ
+        """
+        with self._lock:
+            return len(self._uploaded_at)
+
+    def _list_models(self, path, headers, body):
+        return 200, "application/json", b'{"models": [{"name": "models/gemini-2.5-flash"}]}'
+
+
+# ==================== Gemini Stand-in ====================
+class _StandInResponse:
+    def __init__(self, data: Dict):
+        self._data = data
+        self.text = "".join(
+            part.get("text", "")
+            for part in data["candidates"][0]["content"]["parts"]
+        )
+        # ชื่อ field แบบเดียวกับ usage_metadata ของ SDK
+        usage = data.get("usageMetadata", {})
+        self.usage_metadata = {
+            "prompt_token_count": usage.get("promptTokenCount", 0),
+            "cached_content_token_count": usage.get("cachedContentTokenCount", 0),
+            "candidates_token_count": usage.get("candidatesTokenCount", 0),
+            "total_token_count": usage.get("totalTokenCount", 0),
+        }
+
+
+class _StandInFile:
+    def __init__(self, name: str, state: Optional[str] = None):
+        self.name = name
+        self.state = state
+
+
+class GeminiStandIn:
+    """
+    ตัวแทนของ `genai.GenerativeModel` และโมดูล `genai` ที่คุยกับ FakeGeminiServer ผ่าน HTTP
+
+    SDK ของ google-generativeai ผูก discovery URL ของ File API ไว้กับ googleapis.com
+    จึงชี้ SDK ไปยัง server จำลองตรงๆ ไม่ได้ ตัวนี้ส่ง request ไปที่ server จำลองแทน
+    (latency และ error ยังมาจาก server จริงบน socket)
+    """
+
+    def __init__(self, base_url: str, model_name: str = "models/gemini-2.5-flash", timeout: float = 60.0):
+        self.base_url = base_url
+        self.model_name = model_name
+        self.timeout = timeout
+        self._client = httpx.Client(base_url=base_url, timeout=timeout)
+        # สร้างเมื่อเรียกแบบ async ครั้งแรก (ผูกกับ event loop ที่เรียก)
+        self._async_client: Optional[httpx.AsyncClient] = None
+
+    def close(self):
+        self._client.close()
+
+    async def aclose(self):
+        if self._async_client is not None:
+            await self._async_client.aclose()
+            self._async_client = None
+
+    def _generate_request(self, contents, kwargs) -> Dict:
+        parts = []
+        for item in contents if isinstance(contents, (list, tuple)) else [contents]:
+            if isinstance(item, str):
+                parts.append({"text": item})
+            elif isinstance(item, _StandInFile):
+                parts.append({"fileData": {"fileUri": item.name}})
+            else:
+                parts.append({"inlineData": {"mimeType": "image/jpeg"}})
+
+        # timeout ต่อ request แบบเดียวกับ request_options ของ SDK
+        timeout = (kwargs.get("request_options") or {}).get("timeout")
+        return {
+            "url": f"/v1beta/{self.model_name}:generateContent",
+            "json": {"contents": [{"role": "user", "parts": parts}]},
+            "timeout": timeout if timeout is not None else httpx.USE_CLIENT_DEFAULT,
+        }
+
+    # --- GenerativeModel ---
+    def generate_content(self, contents, **kwargs):
+        response = self._client.post(**self._generate_request(contents, kwargs))
+        response.raise_for_status()
+        return _StandInResponse(response.json())
+
+    async def generate_content_async(self, contents, **kwargs):
+        if self._async_client is None:
+            self._async_client = httpx.AsyncClient(base_url=self.base_url, timeout=self.timeout)
+        response = await self._async_client.post(**self._generate_request(contents, kwargs))
+        response.raise_for_status()
+        return _StandInResponse(response.json())
+
+    # --- genai module functions ---
+    def upload_file(self, path, mime_type: Optional[str] = None, **kwargs):
+        with open(path, "rb") as f:
+            data = f.read()
+        response = self._client.post(
+            "/upload/v1beta/files",
+            content=data,
+            headers={"Content-Type": mime_type or "application/octet-stream"},
+        )
+        response.raise_for_status()
+        file = response.json()["file"]
+        return _StandInFile(file["name"], file.get("state"))
+
+    def get_file(self, name: str):
+        response = self._client.get(f"/v1beta/{name}")
+        response.raise_for_status()
+        file = response.json()
+        return _StandInFile(file["name"], file.get("state"))
+
+    def delete_file(self, name: str):
+        response = self._client.delete(f"/v1beta/{name}")
+        response.raise_for_status()
+
+    def list_models(self):
+        response = self._client.get("/v1beta/models")
+        response.raise_for_status()
+        return [_StandInFile(model["name"]) for model in response.json()["models"]]
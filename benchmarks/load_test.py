@@ -0,0 +1,615 @@
+"""
+Load Test แบบ end-to-end สำหรับ FastAPI `app` ใน main.py
+
+ส่ง webhook ที่เซ็น X-Line-Signature จริงเข้า `/webhook` (ผ่าน ASGI transport ในโปรเซสเดียวกัน)
+ให้ผู้ใช้จำลองแต่ละคนเดิน conversation ครบทุก state ของ `user_sessions`
+โดย LINE API และ Gemini เป็น server จำลองบนเครื่อง (benchmarks/fake_upstreams.py)
+
+ตัวอย่าง:
+    python -m benchmarks.load_test --users 200 --concurrency 20 \\
+        --gemini-latency lognormal:800,0.6 --gemini-error-rate 0.02
+
+รายงาน: throughput, p50/p95/p99 ต่อ step, จำนวน request ไปยัง upstream และการเติบโตของหน่วยความจำ
+จบด้วย exit code 1 ถ้า session ใหญ่สุดหลัง step ใดเกิน --session-budget-bytes (ค่าเริ่มต้น 1 KB)
+
+ตรวจ deploy แบบไม่ทิ้งงาน (ปิดระบบกลาง load แล้วนับเคลมที่หาย):
+    python -m benchmarks.load_test --users 100 --gemini-latency const:2000 --shutdown-after 3 --shutdown-grace 5
+
+เทียบ latency ของ step ที่ผู้ใช้รอคำตอบ ระหว่างที่งานวิเคราะห์ค้างเต็ม thread (เพิ่ม --no-priority = คิว FIFO เดิม):
+    python -m benchmarks.load_test --users 40 --webhook-workers 4 --gemini-analysis-latency const:2000
+"""
+
+import argparse
+import asyncio
+import base64
+import gc
+import hashlib
+import hmac
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+import uuid
+from collections import defaultdict
+from typing import Callable, Dict, List, Optional, Tuple
+
+import httpx
+
+from benchmarks.fake_upstreams import FakeGeminiServer, FakeLineServer, GeminiStandIn
+
+CHANNEL_SECRET = "loadtest-channel-secret"
+
+# แต่ละ scenario ครอบคลุม state ใน user_sessions ต่างกัน
+# (step, ชนิดข้อความ, ข้อความ) ชนิด "image_set" = ส่งหลายรูปพร้อมกัน (ข้อความ = จำนวนรูป)
+SCENARIOS: Dict[str, List[Tuple[str, str, Optional[str]]]] = {
+    # waiting_for_info -> waiting_for_counterpart -> ... -> completed
+    "plate_text": [
+        ("start", "text", "เช็คสิทธิ์เคลมด่วน"),
+        ("info_text", "text", "1กข1234"),
+        ("counterpart", "text", "มีคู่กรณี"),
+        ("additional_info", "text", "ชนท้ายที่สี่แยก"),
+        ("damage_image", "image", None),
+    ],
+    # OCR รูปทะเบียนรถใน waiting_for_info
+    "ocr_image": [
+        ("start", "text", "เช็คสิทธิ์เคลมด่วน"),
+        ("info_image", "image", None),
+        ("counterpart", "text", "ไม่มีคู่กรณี"),
+        ("additional_info", "text", "ข้าม"),
+        ("damage_image", "image", None),
+    ],
+    # ค้นหาด้วยชื่อบางส่วน -> waiting_for_vehicle_selection
+    "name_select": [
+        ("start", "text", "เช็คสิทธิ์เคลมด่วน"),
+        ("info_text", "text", "สม"),
+        ("select_vehicle", "text", "เลือกทะเบียน 3กท5678"),
+        ("counterpart", "text", "มีคู่กรณี"),
+        ("additional_info", "text", "ข้าม"),
+        ("damage_image", "image", None),
+    ],
+    # ส่งรูปความเสียหายหลายมุมพร้อมกัน -> วิเคราะห์รวมครั้งเดียว
+    "multi_photo": [
+        ("start", "text", "เช็คสิทธิ์เคลมด่วน"),
+        ("info_text", "text", "4กก9999"),
+        ("counterpart", "text", "มีคู่กรณี"),
+        ("additional_info", "text", "ชนท้าย"),
+        ("damage_photos", "image_set", "3"),
+    ],
+}
+
+
+# ผู้ใช้ที่ส่งคำขอซ้ำรัว ๆ (ทดสอบ rate limit ต่อผู้ใช้ ไม่อยู่ใน --scenarios) แต่ละ step เป็น webhook แยกกันติดกัน
+ABUSE_BURST = 20
+ABUSE_SCENARIOS: Dict[str, List[Tuple[str, str, Optional[str]]]] = {
+    # ค้นหาชื่อที่ไม่มีในระบบซ้ำ ๆ (state ค้างที่ waiting_for_info ทุกครั้งจึงค้นหาใหม่ทุกข้อความ)
+    "spam_lookup": [("start", "text", "เช็คสิทธิ์เคลมด่วน")] + [("spam_lookup", "text", "ไม่มีชื่อนี้ในระบบ")] * ABUSE_BURST,
+    # ส่งรูปให้ OCR ซ้ำ ๆ ก่อนผลแรกจะกลับมา
+    "spam_ocr": [("start", "text", "เช็คสิทธิ์เคลมด่วน")] + [("spam_ocr", "image", None)] * ABUSE_BURST,
+}
+
+
+# ==================== Webhook Generator ====================
+def sign_body(body: bytes, channel_secret: str = CHANNEL_SECRET) -> str:
+    """
+    สร้าง X-Line-Signature (HMAC-SHA256 แบบ Base64) ให้ body
+    """
+    digest = hmac.new(channel_secret.encode("utf-8"), body, hashlib.sha256).digest()
+    return base64.b64encode(digest).decode("utf-8")
+
+
+def build_message_event(user_id: str, kind: str, text: Optional[str] = None,
+                        image_set: Optional[Dict] = None) -> Dict:
+    """
+    สร้าง MessageEvent ตามรูปแบบ LINE webhook (text หรือ image)
+    image_set = {"id", "index", "total"} ถ้ารูปนี้เป็นส่วนหนึ่งของการส่งหลายรูปพร้อมกัน
+    """
+    message_id = str(random.randint(10**17, 10**18 - 1))
+    if kind == "text":
+        message = {"type": "text", "id": message_id, "quoteToken": uuid.uuid4().hex, "text": text}
+    else:
+        message = {"type": "image", "id": message_id, "quoteToken": uuid.uuid4().hex,
+                   "contentProvider": {"type": "line"}}
+        if image_set:
+            message["imageSet"] = image_set
+
+    return {
+        "type": "message",
+        "mode": "active",
+        "timestamp": int(time.time() * 1000),
+        "source": {"type": "user", "userId": user_id},
+        "webhookEventId": uuid.uuid4().hex.upper()[:26],
+        "deliveryContext": {"isRedelivery": False},
+        "replyToken": uuid.uuid4().hex,
+        "message": message,
+    }
+
+
+def build_step_events(user_id: str, kind: str, text: Optional[str]) -> List[Dict]:
+    if kind != "image_set":
+        return [build_message_event(user_id, kind, text)]
+    total = int(text)
+    set_id = uuid.uuid4().hex
+    return [
+        build_message_event(user_id, "image", image_set={"id": set_id, "index": index, "total": total})
+        for index in range(1, total + 1)
+    ]
+
+
+def build_webhook_body(events: List[Dict], destination: str = "Ubot0000000000000000000000000000") -> bytes:
+    return json.dumps({"destination": destination, "events": events}, ensure_ascii=False).encode("utf-8")
+
+
+# ==================== Metrics ====================
+def percentile(values: List[float], pct: float) -> float:
+    """
+    percentile แบบ nearest-rank (values ต้องไม่ว่าง)
+    """
+    ordered = sorted(values)
+    index = max(0, min(len(ordered) - 1, int(round(pct / 100.0 * len(ordered) + 0.5)) - 1))
+    return ordered[index]
+
+
+def current_rss_bytes() -> int:
+    """
+    RSS ปัจจุบันของโปรเซส (Linux: /proc/self/statm)
+    """
+    try:
+        with open("/proc/self/statm") as f:
+            pages = int(f.read().split()[1])
+        return pages * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def deep_sizeof(obj, seen: Optional[set] = None) -> int:
+    """
+    ขนาดหน่วยความจำของ object รวม dict/list/str ที่อยู่ข้างใน (ไม่นับ object ที่แชร์ซ้ำ)
+    """
+    seen = set() if seen is None else seen
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        size += sum(deep_sizeof(k, seen) + deep_sizeof(v, seen) for k, v in obj.items())
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        size += sum(deep_sizeof(item, seen) for item in obj)
+    return size
+
+
+class StepRecorder:
+    def __init__(self):
+        self.latencies: Dict[str, List[float]] = defaultdict(list)
+        self.errors: Dict[str, int] = defaultdict(int)
+        self.session_bytes: Dict[str, List[int]] = defaultdict(list)
+        # ผู้ใช้ที่ webhook ส่งรูปความเสียหายสำเร็จ -> เวลา (time.monotonic) ที่ระบบรับงาน
+        self.claims_accepted: Dict[str, float] = {}
+
+    def record(self, step: str, seconds: float, ok: bool):
+        self.latencies[step].append(seconds)
+        if not ok:
+            self.errors[step] += 1
+
+    def record_session(self, step: str, session: Optional[Dict]):
+        if session is not None:
+            self.session_bytes[step].append(deep_sizeof(session))
+
+    def summary(self) -> Dict[str, Dict]:
+        result = {}
+        for step, values in self.latencies.items():
+            sizes = self.session_bytes.get(step)
+            result[step] = {
+                "count": len(values),
+                "errors": self.errors.get(step, 0),
+                "p50_ms": percentile(values, 50) * 1000,
+                "p95_ms": percentile(values, 95) * 1000,
+                "p99_ms": percentile(values, 99) * 1000,
+                "max_ms": max(values) * 1000,
+                "session_max_bytes": max(sizes) if sizes else 0,
+            }
+        return result
+
+
+# ==================== Runner ====================
+def configure_environment(line_url: str):
+    """
+    ตั้งค่า env ก่อน import main เพื่อไม่ให้ยิงไปยัง LINE/Gemini จริง
+    """
+    os.environ["LINE_CHANNEL_ACCESS_TOKEN"] = "loadtest-access-token"
+    os.environ["LINE_CHANNEL_SECRET"] = CHANNEL_SECRET
+    os.environ["GEMINI_API_KEY"] = "loadtest-gemini-key"
+    os.environ["LINE_API_ENDPOINT"] = line_url
+    os.environ["LINE_DATA_API_ENDPOINT"] = line_url
+    # ไม่เขียน session ของผู้ใช้จำลองลง data/sessions ของเครื่องจริง
+    os.environ.setdefault("SESSION_STORE_DIR", "")
+    os.environ.setdefault("POLICY_TEXT_CACHE_DIR", "")
+    os.environ.setdefault("PHOTO_AGGREGATION_WINDOW_S", "0.3")
+
+
+def install_gemini_stand_in(main_module, gemini_url: str, llm_mode: str) -> GeminiStandIn:
+    """
+    ให้ llm_provider ของ main ใช้ server จำลองแทน Gemini จริง
+    โหมด record/replay ใช้ cassette ตาม LLM_CASSETTE_DIR เหมือนตอนรัน production
+    """
+    from llm_provider import Cassette, GeminiProvider, RecordingProvider, ReplayProvider
+
+    stand_in = GeminiStandIn(gemini_url)
+    live = GeminiProvider(stand_in, stand_in, file_poll_interval=main_module.GEMINI_FILE_POLL_S,
+                          file_ready_timeout=main_module.GEMINI_FILE_READY_TIMEOUT_S)
+    if llm_mode == "live":
+        main_module.llm_provider = live
+    else:
+        cassette = Cassette(os.getenv("LLM_CASSETTE_DIR", "cassettes"))
+        if llm_mode == "record":
+            main_module.llm_provider = RecordingProvider(live, cassette)
+        else:
+            main_module.llm_provider = ReplayProvider(cassette, preserve_latency=True)
+    return stand_in
+
+
+async def run_cohort(client: httpx.AsyncClient, user_ids: List[str], scenario: str, recorder: StepRecorder,
+                     sessions: Optional[Dict[str, Dict]] = None, job_queue=None, gemini_loop=None,
+                     draining: Callable[[], bool] = lambda: False):
+    """
+    เดิน scenario ให้ผู้ใช้กลุ่มหนึ่งพร้อมกัน: แต่ละ step ส่ง body เดียวที่มี 1 event ต่อผู้ใช้
+    (กลุ่มละ 1 คน = webhook ปกติ, หลายคน = จำลอง burst จากกลุ่มแชท)
+    ถ้าส่ง sessions (user_sessions ของ main) จะวัดขนาด session หลังแต่ละ step ด้วย
+    draining() = ระบบเริ่มปิดแล้ว (ไม่รอผล OCR ที่ค้างในคิว เพราะ web ตัวใหม่เป็นคนดึง)
+    """
+    for step, kind, text in SCENARIOS.get(scenario) or ABUSE_SCENARIOS[scenario]:
+        body = build_webhook_body([event for user_id in user_ids for event in build_step_events(user_id, kind, text)])
+        headers = {"X-Line-Signature": sign_body(body), "Content-Type": "application/json"}
+
+        started = time.perf_counter()
+        try:
+            response = await client.post("/webhook", content=body, headers=headers)
+            status = response.status_code
+        except Exception:
+            status = None
+        recorder.record(step, time.perf_counter() - started, status == 200)
+        if status == 503:
+            # ระบบกำลังปิด: LINE จะส่ง webhook นี้ซ้ำให้ instance ใหม่ ผู้ใช้ไม่ได้ส่งต่อที่นี่
+            return
+        if status == 200 and step.startswith("damage_"):
+            for user_id in user_ids:
+                recorder.claims_accepted[user_id] = time.monotonic()
+        if sessions is not None:
+            # OCR ผ่าน job queue หรือ gemini_loop จบหลัง webhook ตอบไปแล้ว รอผลก่อนส่ง step ถัดไปเหมือนผู้ใช้จริงที่รอคำตอบ
+            while (kind == "image" and (job_queue is not None or gemini_loop is not None)
+                   and any(sessions.get(user_id, {}).get("state") == "waiting_for_info" for user_id in user_ids)
+                   and await asyncio.to_thread(work_pending, job_queue, gemini_loop, not draining())):
+                await asyncio.sleep(0.02)
+            for user_id in user_ids:
+                recorder.record_session(step, sessions.get(user_id))
+
+
+def count_temp_pdfs(prefix: str) -> int:
+    return sum(1 for name in os.listdir(tempfile.gettempdir()) if name.startswith(prefix))
+
+
+# งานที่ web ต้องนำผลลัพธ์มาใช้ต่อ (ดู _collect_job_results ใน main.py)
+RESULT_JOB_KINDS = ["ocr_lookup"]
+
+
+def jobs_pending(job_queue, include_results: bool = True) -> bool:
+    if job_queue is None:
+        return False
+    stats = job_queue.stats()
+    return bool(stats["ready"] or stats["running"]
+                or (include_results and job_queue.results(RESULT_JOB_KINDS, limit=1)))
+
+
+def work_pending(job_queue, gemini_loop, include_results: bool = True) -> bool:
+    """
+    ยังมีงานที่ทำต่อหลัง webhook ตอบไปแล้ว (ในคิว หรือใน gemini_loop ของ GEMINI_ASYNC)
+    include_results=False = ไม่นับผลลัพธ์ที่รอ web ดึงไปใช้
+    """
+    return (jobs_pending(job_queue, include_results)
+            or (gemini_loop is not None and gemini_loop.stats()["in_flight"] > 0))
+
+
+async def shutdown_mid_run(main_module, after_s: float, grace_s: float,
+                           on_shutdown: Optional[Callable] = None) -> Dict:
+    """
+    จำลอง SIGTERM ระหว่าง load: หยุดรับ webhook แล้วรัน drain เดียวกับ lifespan shutdown ของ main
+    on_shutdown = ขั้นที่ lifespan ทำก่อน drain (เช่น หยุด thread ดึงผลลัพธ์จาก job queue)
+    """
+    await asyncio.sleep(after_s)
+    main_module.shutdown_coordinator.begin_drain()
+    if on_shutdown is not None:
+        on_shutdown()
+    started = time.perf_counter()
+    summary = await asyncio.to_thread(main_module.drain_in_flight_work, grace_s)
+    summary["drain_s"] = time.perf_counter() - started
+    return summary
+
+
+def claim_delivery(recorder: StepRecorder, line_server: FakeLineServer, notice: str) -> Dict[str, int]:
+    """
+    ผู้ใช้ที่ระบบรับรูปความเสียหายแล้ว ได้อะไรกลับไป: ผลวิเคราะห์ (delivered), ข้อความให้เริ่มใหม่ (notified)
+    หรือไม่ได้อะไรเลย (lost)
+    """
+    result = {"accepted": len(recorder.claims_accepted), "delivered": 0, "notified": 0, "lost": 0}
+    for user_id, accepted_at in recorder.claims_accepted.items():
+        texts = [text for sent_at, text in line_server.pushes.get(user_id, []) if sent_at >= accepted_at]
+        if notice in texts:
+            result["notified"] += 1
+        elif texts:
+            result["delivered"] += 1
+        else:
+            result["lost"] += 1
+    return result
+
+
+async def run_load(main_module, users: int, concurrency: int, scenarios: List[str], seed: int,
+                   events_per_body: int = 1, shutdown_after: Optional[float] = None,
+                   shutdown_grace: float = 5.0, on_shutdown: Optional[Callable] = None,
+                   abusive_users: int = 0) -> Dict:
+    rng = random.Random(seed)
+    recorder = StepRecorder()
+    abuse_recorder = StepRecorder()
+    semaphore = asyncio.Semaphore(concurrency)
+    transport = httpx.ASGITransport(app=main_module.app)
+
+    def draining() -> bool:
+        return main_module.shutdown_coordinator.draining
+
+    async with httpx.AsyncClient(transport=transport, base_url="http://loadtest", timeout=None) as client:
+        # warm-up หนึ่ง conversation เพื่อไม่ให้ต้นทุน import/JIT ปนกับผลวัด
+        await run_cohort(client, ["Uwarmup"], scenarios[0], StepRecorder(), main_module.user_sessions,
+                         main_module.job_queue, main_module.gemini_loop)
+
+        async def guarded(first: int):
+            async with semaphore:
+                user_ids = [f"U{i:032x}" for i in range(first, min(first + events_per_body, users))]
+                await run_cohort(client, user_ids, rng.choice(scenarios), recorder, main_module.user_sessions,
+                                 main_module.job_queue, main_module.gemini_loop, draining)
+
+        async def abuse(index: int):
+            # ไม่ใช้ semaphore และไม่รอผล OCR: ยิงซ้ำให้เร็วที่สุดเพิ่มจากผู้ใช้ปกติ
+            await run_cohort(client, [f"Uabuse{index:027d}"], list(ABUSE_SCENARIOS)[index % len(ABUSE_SCENARIOS)],
+                             abuse_recorder)
+
+        started = time.perf_counter()
+        shutdown = (asyncio.create_task(shutdown_mid_run(main_module, shutdown_after, shutdown_grace, on_shutdown))
+                    if shutdown_after is not None else None)
+        await asyncio.gather(*(guarded(i) for i in range(0, users, events_per_body)),
+                             *(abuse(i) for i in range(abusive_users)))
+        shutdown_summary = await shutdown if shutdown is not None else None
+        # รูปความเสียหายถูกวิเคราะห์หลังหมด aggregation window จึงรอให้งานที่ค้างเสร็จก่อนหยุดจับเวลา
+        while (main_module.photo_batcher.pending() or not main_module.event_executor.idle()
+               or await asyncio.to_thread(work_pending, main_module.job_queue, main_module.gemini_loop,
+                                          not draining())):
+            await asyncio.sleep(0.02)
+        elapsed = time.perf_counter() - started
+
+    total_requests = sum(len(v) for v in recorder.latencies.values())
+    report = {
+        "elapsed_s": elapsed,
+        "webhook_requests": total_requests,
+        "throughput_rps": total_requests / elapsed if elapsed else 0.0,
+        "conversations_per_s": users / elapsed if elapsed else 0.0,
+        "steps": recorder.summary(),
+        "recorder": recorder,
+    }
+    if shutdown_summary is not None:
+        report["shutdown"] = shutdown_summary
+    if abusive_users:
+        report["abuse"] = {"users": abusive_users, "steps": abuse_recorder.summary()}
+    return report
+
+
+def print_report(report: Dict):
+    print("=" * 78)
+    print(f"⏱️  เวลา {report['elapsed_s']:.2f}s | webhook {report['webhook_requests']} ครั้ง | "
+          f"{report['throughput_rps']:.1f} req/s | {report['conversations_per_s']:.2f} conv/s")
+    print(f"✅ จบ flow ครบ: {report['completed_users']}/{report['users']} ผู้ใช้")
+    print("-" * 78)
+    print(f"{'step':<18}{'count':>7}{'err':>6}{'p50 ms':>11}{'p95 ms':>11}{'p99 ms':>11}{'max ms':>11}"
+          f"{'session B':>11}")
+    for step, s in report["steps"].items():
+        print(f"{step:<18}{s['count']:>7}{s['errors']:>6}{s['p50_ms']:>11.1f}{s['p95_ms']:>11.1f}"
+              f"{s['p99_ms']:>11.1f}{s['max_ms']:>11.1f}{s['session_max_bytes']:>11}")
+    print("-" * 78)
+    for upstream, routes in report["upstreams"].items():
+        for route, s in sorted(routes.items()):
+            print(f"🌐 {upstream}.{route}: {s['requests']} requests, {s['errors']} injected errors")
+    if "jobs" in report:
+        print(f"📦 job queue: {report['jobs']}")
+    if "abuse" in report:
+        spam = {step: s for step, s in report["abuse"]["steps"].items() if step.startswith("spam_")}
+        print(f"😈 ผู้ใช้ที่ส่งรัว {report['abuse']['users']} คน: "
+              + ", ".join(f"{step} {s['count']} ครั้ง p95 {s['p95_ms']:.0f} ms" for step, s in spam.items()))
+    for kind, s in report["rate_limits"]["limits"].items():
+        if s["rejected"]:
+            print(f"🚦 rate limit {kind} ({s['per_minute']:g}/นาที burst {s['burst']:g}): "
+                  f"ผ่าน {s['allowed']}, ปฏิเสธ {s['rejected']}")
+    if "shutdown" in report:
+        shutdown, claims = report["shutdown"], report["claims"]
+        print(f"🛑 shutdown กลาง load: drain {shutdown['drain_s']:.2f}s, ครบทุกงาน={shutdown['drained']}, "
+              f"แจ้งผู้ใช้ให้เริ่มใหม่ {shutdown['abandoned_users']} คน")
+        print(f"🛑 เคลมที่รับแล้ว {claims['accepted']}: ได้ผล {claims['delivered']}, แจ้งเริ่มใหม่ {claims['notified']}, "
+              f"หาย {claims['lost']} | PDF ชั่วคราวค้าง {report['leftovers']['temp_pdfs']}, "
+              f"ไฟล์ใน Gemini ค้าง {report['leftovers']['gemini_files']}")
+    for row in report["usage"]["by_task"]:
+        print(f"🧮 {row['task']}: {row['calls']} calls, {row['total_tokens'] / max(1, row['calls']):,.0f} tokens/call "
+              f"(prompt {row['prompt_tokens'] / max(1, row['calls']):,.0f}), ${row['cost_usd']:.4f}")
+    for row in report.get("prompt_variants", []):
+        print(f"📝 {row['prompt']}/{row['variant']}@{row['version']}: {row['calls']} calls, "
+              f"prompt {row['avg_prompt_tokens']:,.0f} + output {row['avg_output_tokens']:,.0f} tokens/call, "
+              f"p50 {row['latency_p50_s'] * 1000:.0f} ms, p95 {row['latency_p95_s'] * 1000:.0f} ms")
+    for name, stats in report.get("hedging", {}).items():
+        print(f"🏇 hedge {name}: {stats['hedged']}/{stats['requests']} requests ({stats['hedge_rate']:.1%}), "
+              f"ชนะ {stats['hedge_wins']}, token ที่ทิ้ง {stats['wasted_tokens']}, delay {stats['hedge_delay_s']}s")
+    memory = report["memory"]
+    print("-" * 78)
+    print(f"🧠 session สูงสุดระหว่าง flow: {memory['session_max_bytes']} bytes "
+          f"(budget {memory['session_budget_bytes']} bytes)")
+    print(f"🧠 RSS {memory['rss_before_mb']:.1f} MB -> {memory['rss_after_mb']:.1f} MB "
+          f"(+{memory['rss_growth_mb']:.1f} MB), sessions={memory['sessions']}")
+    if "traced_growth_kb" in memory:
+        print(f"🧠 tracemalloc growth: {memory['traced_growth_kb']:.1f} KB "
+              f"({memory['traced_growth_kb'] / max(1, memory['sessions']):.2f} KB/session)")
+    print("=" * 78)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Load test webhook ของ LINE Insurance Claim Bot (offline)")
+    parser.add_argument("--users", type=int, default=100, help="จำนวนผู้ใช้จำลอง")
+    parser.add_argument("--concurrency", type=int, default=10, help="จำนวน webhook ที่ส่งพร้อมกัน")
+    parser.add_argument("--events-per-body", type=int, default=1, help="จำนวนผู้ใช้ (event) ต่อ webhook body")
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS), help="scenario ที่ใช้ (คั่นด้วย ,)")
+    parser.add_argument("--line-latency", default="const:5", help="latency spec ของ LINE API")
+    parser.add_argument("--line-error-rate", type=float, default=0.0)
+    parser.add_argument("--gemini-latency", default="lognormal:300,0.5", help="latency spec ของ Gemini")
+    parser.add_argument("--gemini-error-rate", type=float, default=0.0)
+    parser.add_argument("--gemini-analysis-latency",
+                        help="latency spec ที่หน่วงเพิ่มเฉพาะงานวิเคราะห์ความเสียหาย (เช่น const:3000)")
+    parser.add_argument("--file-ready-delay", type=float, default=2.0,
+                        help="เวลาที่ PDF ที่อัพโหลดอยู่ในสถานะ PROCESSING (วินาที)")
+    parser.add_argument("--llm-mode", choices=["live", "record", "replay"], default="live",
+                        help="live = ใช้ Gemini จำลอง, record/replay = ผ่าน cassette ของ llm_provider")
+    parser.add_argument("--job-queue", action="store_true",
+                        help="ส่งงาน Gemini ผ่าน job_queue (SQLite ชั่วคราว) ให้ worker ใน process เดียวกันทำ")
+    parser.add_argument("--job-workers", type=int, default=4, help="จำนวน thread ของ worker เมื่อใช้ --job-queue")
+    parser.add_argument("--prompt-splits", default="",
+                        help='แบ่ง traffic ไป prompt variant เช่น "damage_analysis:compact=50" (ดู prompts.py)')
+    parser.add_argument("--gemini-async", action="store_true",
+                        help="วิเคราะห์รูป/OCR ด้วย Gemini แบบ async บน event loop เดียว (GEMINI_ASYNC)")
+    parser.add_argument("--line-sender", choices=["sdk", "fast"], default="sdk",
+                        help="วิธีส่ง reply/push: sdk = MessagingApi, fast = JSON ที่ serialize เอง (line_sender.py)")
+    parser.add_argument("--webhook-workers", type=int, help="WEBHOOK_WORKERS (thread ของ event_executor)")
+    parser.add_argument("--no-priority", action="store_true",
+                        help="ปิดการแบ่ง thread ตาม priority class (ใช้เทียบกับคิว FIFO เดิม)")
+    parser.add_argument("--abusive-users", type=int, default=0,
+                        help=f"ผู้ใช้เพิ่มที่ส่งค้นหา/รูป OCR ซ้ำ {ABUSE_BURST} ครั้งติดกัน (ไม่นับในตาราง step)")
+    parser.add_argument("--rate-limits", default="",
+                        help='rate limit ต่อผู้ใช้ เช่น "ocr=6:3,lookup=0" (ดู rate_limit.py, 0 = ไม่จำกัด)')
+    parser.add_argument("--shutdown-after", type=float,
+                        help="จำลอง SIGTERM หลังเริ่ม load กี่วินาที แล้วตรวจว่าเคลมที่รับแล้วไม่หาย (zero-loss deploy)")
+    parser.add_argument("--shutdown-grace", type=float, default=5.0, help="SHUTDOWN_GRACE_S ของการปิดกลาง load")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--tracemalloc", action="store_true", help="วัดการเติบโตของหน่วยความจำด้วย tracemalloc")
+    parser.add_argument("--session-budget-bytes", type=int, default=1024,
+                        help="ขนาดสูงสุดของ session (deep sizeof) หลังทุก step เกินนี้ถือว่า load test ไม่ผ่าน")
+    parser.add_argument("--json", dest="json_path", help="บันทึกรายงานเป็น JSON")
+    args = parser.parse_args(argv)
+
+    scenarios = [s.strip() for s in args.scenarios.split(",") if s.strip()]
+    unknown = [s for s in scenarios if s not in SCENARIOS]
+    if unknown:
+        parser.error(f"ไม่รู้จัก scenario: {', '.join(unknown)}")
+
+    line_server = FakeLineServer(args.line_latency, args.line_error_rate, seed=args.seed).start()
+    gemini_server = FakeGeminiServer(args.gemini_latency, args.gemini_error_rate, seed=args.seed + 1,
+                                     file_ready_delay=args.file_ready_delay,
+                                     analysis_latency=args.gemini_analysis_latency).start()
+    configure_environment(line_server.url)
+    os.environ["LINE_SENDER"] = args.line_sender
+    os.environ["PROMPT_VARIANT_SPLITS"] = args.prompt_splits
+    os.environ["RATE_LIMITS"] = args.rate_limits
+    os.environ["GEMINI_ASYNC"] = "true" if args.gemini_async else "false"
+    if args.webhook_workers:
+        os.environ["WEBHOOK_WORKERS"] = str(args.webhook_workers)
+    if args.no_priority:
+        # ไม่กัน thread และทุกงาน "รอนานเกิน" ทันที = คิวเดียวตามลำดับที่เข้ามา (FIFO)
+        for name in ("WEBHOOK_RESERVED_INTERACTIVE", "WEBHOOK_RESERVED_BULK",
+                     "WORKER_RESERVED_INTERACTIVE", "WORKER_RESERVED_BULK"):
+            os.environ[name] = "0"
+        os.environ["WEBHOOK_PRIORITY_AGING_S"] = "0"
+    job_dir = tempfile.mkdtemp(prefix="jobs-") if args.job_queue else None
+    if job_dir:
+        os.environ["JOB_QUEUE_PATH"] = os.path.join(job_dir, "jobs.db")
+        os.environ.setdefault("JOB_RESULT_POLL_S", "0.05")
+
+    import main as main_module
+    stand_in = install_gemini_stand_in(main_module, gemini_server.url, args.llm_mode)
+    worker = job_results_stop = None
+    if job_dir:
+        from worker import Worker, reserved_threads
+
+        worker = Worker(main_module.job_queue, main_module.JOB_HANDLERS, on_dead=main_module.notify_job_failed,
+                        concurrency=args.job_workers, poll_interval=0.05, priorities=main_module.JOB_PRIORITIES,
+                        reserved=reserved_threads(args.job_workers)).start()
+        # ASGITransport ไม่รัน lifespan จึงเริ่ม thread ดึงผลลัพธ์เอง
+        job_results_stop = threading.Event()
+        threading.Thread(target=main_module._collect_job_results, args=(job_results_stop,), daemon=True).start()
+
+    try:
+        gc.collect()
+        rss_before = current_rss_bytes()
+        if args.tracemalloc:
+            tracemalloc.start()
+            traced_before = tracemalloc.get_traced_memory()[0]
+
+        pdfs_before = count_temp_pdfs(main_module.TEMP_PDF_PREFIX)
+        report = asyncio.run(run_load(main_module, args.users, args.concurrency, scenarios, args.seed,
+                                      args.events_per_body, args.shutdown_after, args.shutdown_grace,
+                                      job_results_stop.set if job_results_stop else None, args.abusive_users))
+        recorder = report.pop("recorder")
+        if "shutdown" in report:
+            report["claims"] = claim_delivery(recorder, line_server, main_module.SHUTDOWN_ABANDONED_TEXT)
+            report["leftovers"] = {
+                "temp_pdfs": count_temp_pdfs(main_module.TEMP_PDF_PREFIX) - pdfs_before,
+                "gemini_files": gemini_server.remaining_files(),
+            }
+
+        gc.collect()
+        sessions = {uid: s for uid, s in main_module.user_sessions.items() if uid != "Uwarmup" and not uid.startswith("Uabuse")}
+        report["users"] = args.users
+        report["completed_users"] = sum(1 for s in sessions.values() if s.get("state") == "completed")
+        report["memory"] = {
+            "rss_before_mb": rss_before / 2**20,
+            "rss_after_mb": current_rss_bytes() / 2**20,
+            "rss_growth_mb": (current_rss_bytes() - rss_before) / 2**20,
+            "sessions": len(sessions),
+            "session_max_bytes": max((s["session_max_bytes"] for s in report["steps"].values()), default=0),
+            "session_budget_bytes": args.session_budget_bytes,
+        }
+        if args.tracemalloc:
+            report["memory"]["traced_growth_kb"] = (tracemalloc.get_traced_memory()[0] - traced_before) / 1024
+            tracemalloc.stop()
+        report["upstreams"] = {"line": line_server.snapshot_stats(), "gemini": gemini_server.snapshot_stats()}
+        if job_dir:
+            report["jobs"] = main_module.job_queue.stats()
+        report["usage"] = main_module.usage_meter.snapshot(top_users=0)
+        report["prompt_variants"] = main_module.prompt_registry.snapshot()["variants"]
+        report["rate_limits"] = main_module.rate_limiter.snapshot()
+        if main_module.gemini_hedgers:
+            report["hedging"] = {name: h.stats() for name, h in main_module.gemini_hedgers.items()}
+    finally:
+        if worker:
+            job_results_stop.set()
+            worker.stop()
+            shutil.rmtree(job_dir, ignore_errors=True)
+        if main_module.gemini_loop is not None and main_module.gemini_loop.stats()["running"]:
+            main_module.gemini_loop.run(stand_in.aclose())
+            main_module.gemini_loop.stop()
+        stand_in.close()
+        if main_module.fast_line_sender is not None:
+            main_module.fast_line_sender.close()
+        line_server.stop()
+        gemini_server.stop()
+
+    print_report(report)
+    if args.json_path:
+        with open(args.json_path, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+
+    over_budget = {step: s["session_max_bytes"] for step, s in report["steps"].items()
+                   if s["session_max_bytes"] > args.session_budget_bytes}
+    if over_budget:
+        print(f"❌ session เกิน budget {args.session_budget_bytes} bytes: "
+              + ", ".join(f"{step} {size} bytes" for step, size in over_budget.items()))
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
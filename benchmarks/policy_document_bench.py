@@ -0,0 +1,152 @@
+"""
+เปรียบเทียบการส่งเอกสารกรมธรรม์ให้ Gemini แบบ PDF (อัพโหลด + รอไฟล์) กับแบบข้อความแยกหน้า (policy_text.py)
+
+วัด:
+- เวลาแปลง PDF เป็นข้อความ: ครั้งแรก, อ่านจาก cache บนดิสก์, อ่านจาก cache ในหน่วยความจำ
+- ขนาดข้อมูลที่ส่ง (bytes ของ PDF vs ข้อความ)
+- latency ของ analyze_damage_with_gemini ทั้งสองแบบผ่าน Gemini จำลอง (benchmarks/fake_upstreams.py)
+- จำนวน token จริงของแต่ละแบบ (ใช้ --count-tokens ต้องมี GEMINI_API_KEY และ network)
+
+ตัวอย่าง:
+    python -m benchmarks.policy_document_bench --iterations 20 --gemini-latency lognormal:800,0.5
+    python -m benchmarks.policy_document_bench --count-tokens
+"""
+
+import argparse
+import base64
+import os
+import shutil
+import sys
+import tempfile
+import time
+from typing import Dict, List, Optional
+
+from benchmarks.fake_upstreams import FakeGeminiServer, _make_test_image
+from benchmarks.load_test import configure_environment, install_gemini_stand_in, percentile
+
+
+def measure_extraction(policies: Dict[str, Dict]) -> List[Dict]:
+    from mock_data import policy_document_version
+    from policy_text import PolicyTextCache
+
+    rows = []
+    directory = tempfile.mkdtemp(prefix="policy-text-")
+    try:
+        for policy in policies.values():
+            document = policy.get('policy_document_base64')
+            if not document:
+                continue
+            # ตรวจค่าที่รู้อยู่แล้วเหมือน main.load_policy_text (text=None = ไม่ผ่าน ระบบจะส่ง PDF)
+            args = (policy['policy_number'], policy_document_version(policy), document,
+                    (policy.get('plate', ''), policy.get('insurance_type', '')))
+
+            cold_cache = PolicyTextCache(directory)
+            started = time.perf_counter()
+            text = cold_cache.get(*args)
+            cold_ms = (time.perf_counter() - started) * 1000
+
+            started = time.perf_counter()
+            PolicyTextCache(directory).get(*args)
+            disk_ms = (time.perf_counter() - started) * 1000
+
+            started = time.perf_counter()
+            cold_cache.get(*args)
+            memory_us = (time.perf_counter() - started) * 1e6
+
+            rows.append({
+                "policy_number": policy['policy_number'],
+                "pdf_bytes": len(base64.b64decode(document)),
+                "text_chars": len(text) if text else 0,
+                "text_bytes": len(text.encode("utf-8")) if text else 0,
+                "pages": text.count("[หน้า ") if text else 0,
+                "cold_ms": cold_ms,
+                "disk_ms": disk_ms,
+                "memory_us": memory_us,
+                "text": text,
+            })
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+    return rows
+
+
+def count_tokens(rows: List[Dict], policies: Dict[str, Dict], api_key: str, model_name: str):
+    """
+    นับ token จริงของ PDF และข้อความด้วย count_tokens ของ Gemini
+    """
+    import google.generativeai as genai
+
+    genai.configure(api_key=api_key)
+    model = genai.GenerativeModel(model_name)
+    documents = {p['policy_number']: p['policy_document_base64'] for p in policies.values()}
+    for row in rows:
+        pdf_bytes = base64.b64decode(documents[row["policy_number"]])
+        row["pdf_tokens"] = model.count_tokens([{"mime_type": "application/pdf", "data": pdf_bytes}]).total_tokens
+        if row["text"]:
+            row["text_tokens"] = model.count_tokens([row["text"]]).total_tokens
+
+
+def measure_analysis(main_module, policy: Dict, mode: str, iterations: int) -> List[float]:
+    main_module.POLICY_DOCUMENT_MODE = mode
+    image_bytes = _make_test_image()
+    latencies = []
+    for _ in range(iterations):
+        started = time.perf_counter()
+        main_module.analyze_damage_with_gemini([image_bytes], policy, None, "มีคู่กรณี")
+        latencies.append(time.perf_counter() - started)
+    return latencies
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="เปรียบเทียบการส่งเอกสารกรมธรรม์แบบ PDF กับข้อความ")
+    parser.add_argument("--iterations", type=int, default=10, help="จำนวนครั้งที่เรียก analyze ต่อแบบ")
+    parser.add_argument("--gemini-latency", default="lognormal:800,0.5", help="latency spec ของ Gemini จำลอง")
+    parser.add_argument("--file-ready-delay", type=float, default=2.0, help="เวลารอไฟล์ PDF พร้อม (วินาที)")
+    parser.add_argument("--count-tokens", action="store_true", help="นับ token จริงด้วย Gemini API")
+    args = parser.parse_args(argv)
+
+    # ต้องอ่าน key จริงก่อน configure_environment เขียนทับด้วย key จำลอง
+    api_key: Optional[str] = os.getenv("GEMINI_API_KEY")
+    if args.count_tokens and not api_key:
+        parser.error("--count-tokens ต้องตั้ง GEMINI_API_KEY")
+
+    gemini_server = FakeGeminiServer(args.gemini_latency, seed=42).start()
+    configure_environment("http://127.0.0.1:9")
+
+    import main as main_module
+    from mock_data import get_all_policies
+
+    stand_in = install_gemini_stand_in(main_module, gemini_server.url, "live", args.file_ready_delay)
+    try:
+        policies = get_all_policies()
+        rows = measure_extraction(policies)
+        if args.count_tokens:
+            count_tokens(rows, policies, api_key, main_module.GEMINI_MODEL_NAME)
+
+        policy = next(iter(policies.values()))
+        main_module.load_policy_text(policy)  # ไม่นับเวลาแปลงครั้งแรกใน latency ของ analyze
+        results = {mode: measure_analysis(main_module, policy, mode, args.iterations) for mode in ("pdf", "text")}
+        upstream = gemini_server.snapshot_stats()
+    finally:
+        stand_in.close()
+        gemini_server.stop()
+
+    print("=" * 78)
+    print(f"{'policy':<18}{'pages':>6}{'PDF KB':>9}{'text KB':>9}{'cold ms':>9}{'disk ms':>9}{'mem µs':>8}"
+          f"{'PDF tok':>9}{'text tok':>9}")
+    for row in rows:
+        print(f"{row['policy_number']:<18}{row['pages']:>6}{row['pdf_bytes'] / 1024:>9.1f}"
+              f"{row['text_bytes'] / 1024:>9.1f}{row['cold_ms']:>9.1f}{row['disk_ms']:>9.2f}{row['memory_us']:>8.1f}"
+              f"{row.get('pdf_tokens', '-'):>9}{row.get('text_tokens', '-'):>9}")
+    print("-" * 78)
+    for mode, latencies in results.items():
+        print(f"⏱️  analyze ({mode:<4}) p50 {percentile(latencies, 50) * 1000:8.1f} ms | "
+              f"p95 {percentile(latencies, 95) * 1000:8.1f} ms | n={len(latencies)}")
+    for route, stats in sorted(upstream.items()):
+        print(f"🌐 gemini.{route}: {stats['requests']} requests")
+    if not args.count_tokens:
+        print("ℹ️  จำนวน token: รันด้วย --count-tokens เพื่อนับจาก Gemini API จริง")
+    print("=" * 78)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,210 @@
+"""
+วัดการค้นหากรมธรรม์ใน mock_data กับสมุดกรมธรรม์จำลองขนาดใหญ่ (benchmarks/synthetic_policies.py)
+
+ต่อขนาดข้อมูลแต่ละชุด วัด:
+- เวลาและหน่วยความจำ (RSS ที่เพิ่มขึ้น) ของการสร้างข้อมูลและดัชนีแต่ละตัว (ชื่อ, ทะเบียน, เลขกรมธรรม์)
+- latency p50/p95/p99 ของทุกฟังก์ชันค้นหา แยกตาม backend:
+  index = ฟังก์ชันใน mock_data (ผ่านดัชนี)  scan = ไล่ทุกรายการแบบไม่มีดัชนี (baseline)
+  ฟังก์ชันที่ใน mock_data ยังไล่ทุกรายการอยู่ (get_policy_info กรณีไม่ตรง key, search_policies_by_cid) แสดงเป็น scan
+- สัดส่วนคำค้นที่พบผลลัพธ์ (ตรวจว่าคำค้นสมเหตุสมผล)
+
+คำค้นสุ่มจากข้อมูลจริงในชุด: ชื่อเต็ม/มีคำนำหน้า/บางส่วน/พิมพ์ผิด, ทะเบียนตรง/มีจังหวัดและขีด/OCR สับสนพยัญชนะ,
+เลขบัตรแบบมีขีด และคำค้นที่ไม่มีในข้อมูล ฟังก์ชันที่ช้าจะหยุดวัดเมื่อเกิน --max-seconds (วัดอย่างน้อย 3 ครั้ง)
+
+ตัวอย่าง:
+    python -m benchmarks.policy_lookup_bench
+    python -m benchmarks.policy_lookup_bench --sizes 1m,10m --max-seconds 10 --json lookup.json   # 10m ใช้ RAM หลาย GB
+"""
+
+import argparse
+import gc
+import json
+import random
+import time
+from typing import Callable, Dict, List, Tuple
+
+from benchmarks.load_test import current_rss_bytes, percentile
+from benchmarks.synthetic_policies import PROVINCES, generate_policy_book
+
+
+def parse_size(text: str) -> int:
+    text = text.strip().lower()
+    multiplier = {"k": 1_000, "m": 1_000_000}.get(text[-1:], 1)
+    return int(float(text.rstrip("km")) * multiplier)
+
+
+def _typo(rng: random.Random, text: str) -> str:
+    # ลบตัวอักษรหนึ่งตัว (ไม่ใช่ตัวแรก) แบบที่พิมพ์ตก
+    index = rng.randint(1, len(text) - 1)
+    return text[:index] + text[index + 1:]
+
+
+def _confusable_plate(rng: random.Random, plate: str) -> str:
+    from plate_index import CONFUSABLE_GROUPS
+
+    for index, char in enumerate(plate):
+        for group in CONFUSABLE_GROUPS:
+            if char in group:
+                other = rng.choice([c for c in group if c != char])
+                return plate[:index] + other + plate[index + 1:]
+    return plate
+
+
+def build_queries(book: Dict[str, Dict], count: int, seed: int) -> Dict[str, List]:
+    """
+    คำค้นของแต่ละฟังก์ชัน (สุ่มจากกรมธรรม์ในชุด + คำค้นที่ไม่มีอยู่จริง)
+    """
+    rng = random.Random(seed)
+    keys = list(book)
+    sample = [book[keys[rng.randrange(len(keys))]] for _ in range(count)]
+    queries: Dict[str, List] = {"name": [], "plate": [], "cid": [], "policy_info": [], "policy_number": []}
+    for index, policy in enumerate(sample):
+        full_name = f"{policy['first_name']} {policy['last_name']}"
+        kind = index % 4
+        queries["name"].append([
+            full_name,
+            f"{policy['title_name']}{full_name}",
+            policy["first_name"][:4],
+            f"{policy['first_name']} {_typo(rng, policy['last_name'])}",
+        ][kind])
+        queries["plate"].append([
+            policy["plate"],
+            f"{policy['plate'][:-4]}-{policy['plate'][-4:]} {rng.choice(PROVINCES)}",
+            _confusable_plate(rng, policy["plate"]),
+            "9ฮฮ0",
+        ][kind])
+        cid = policy["cid"]
+        queries["cid"].append(f"{cid[0]}-{cid[1:5]}-{cid[5:10]}-{cid[10:12]}-{cid[12]}" if kind % 2 else cid)
+        # get_policy_info: ตรง key (มีคำนำหน้า) หรือไม่มีคำนำหน้า (ต้องไล่ทุกรายการ)
+        queries["policy_info"].append((f"{policy['title_name']}{full_name}" if kind % 2 else full_name,
+                                       policy["plate"]))
+        queries["policy_number"].append(policy["policy_number"])
+    return queries
+
+
+def scan_by_name(book: Dict[str, Dict], query: str) -> List[Dict]:
+    from name_index import normalize_name
+
+    needle = normalize_name(query)
+    return [policy for policy in book.values()
+            if needle in normalize_name(f"{policy['first_name']} {policy['last_name']}")][:20]
+
+
+def scan_by_plate(book: Dict[str, Dict], query: str) -> List[Dict]:
+    from plate_index import canonicalize_plate
+
+    plate = canonicalize_plate(query)
+    return [policy for policy in book.values() if policy["plate"] == plate]
+
+
+def measure(fn: Callable, queries: List, max_seconds: float) -> Dict:
+    samples, found = [], 0
+    deadline = time.perf_counter() + max_seconds
+    for query in queries:
+        started = time.perf_counter()
+        result = fn(*query) if isinstance(query, tuple) else fn(query)
+        samples.append((time.perf_counter() - started) * 1000)
+        found += bool(result)
+        if len(samples) >= 3 and time.perf_counter() > deadline:
+            break
+    return {
+        "queries": len(samples),
+        "found": found / len(samples),
+        "p50_ms": percentile(samples, 50),
+        "p95_ms": percentile(samples, 95),
+        "p99_ms": percentile(samples, 99),
+        "max_ms": max(samples),
+    }
+
+
+def timed_build(fn: Callable) -> Dict:
+    gc.collect()
+    rss_before = current_rss_bytes()
+    started = time.perf_counter()
+    fn()
+    seconds = time.perf_counter() - started
+    gc.collect()
+    return {"seconds": seconds, "rss_mb": (current_rss_bytes() - rss_before) / 2**20}
+
+
+def run_size(size: int, query_count: int, max_seconds: float, seed: int) -> Dict:
+    import mock_data
+
+    holder: Dict[str, Dict] = {}
+    result = {"size": size, "build": {}, "lookups": []}
+    result["build"]["generate"] = timed_build(lambda: holder.update(book=generate_policy_book(size, seed)))
+    book = holder.pop("book")
+    mock_data.replace_policies(book)
+    result["build"]["name_index"] = timed_build(mock_data._get_name_index)
+    # BK-tree ถูกสร้างใน background หลัง _get_name_index: วัดเวลาที่เหลือจนเสร็จ (ก่อนวัด query พิมพ์ผิด)
+    result["build"]["name_fuzzy"] = timed_build(lambda: mock_data._get_name_index().build_fuzzy())
+    result["build"]["plate_index"] = timed_build(mock_data._get_plate_index)
+    result["build"]["number_index"] = timed_build(mock_data._get_number_index)
+
+    queries = build_queries(book, query_count, seed + size)
+    functions: List[Tuple[str, str, Callable, List]] = [
+        ("get_policy_info", "scan", mock_data.get_policy_info, queries["policy_info"]),
+        ("get_policy_by_number", "index", mock_data.get_policy_by_number, queries["policy_number"]),
+        ("search_policies_by_name", "index", mock_data.search_policies_by_name, queries["name"]),
+        ("search_policies_by_name", "scan", lambda q: scan_by_name(book, q), queries["name"]),
+        ("search_plate_candidates", "index", lambda q: mock_data.search_plate_candidates(q)[0], queries["plate"]),
+        ("search_policies_by_plate", "index", mock_data.search_policies_by_plate, queries["plate"]),
+        ("search_policies_by_plate", "scan", lambda q: scan_by_plate(book, q), queries["plate"]),
+        ("search_policies_by_cid", "scan", mock_data.search_policies_by_cid, queries["cid"]),
+    ]
+    for name, backend, fn, function_queries in functions:
+        row = measure(fn, function_queries, max_seconds)
+        row.update(function=name, backend=backend)
+        result["lookups"].append(row)
+    return result
+
+
+def print_report(results: List[Dict]):
+    print("=" * 86)
+    print(f"{'records':>10}  {'step':<14}{'seconds':>10}{'RSS MB':>10}")
+    for result in results:
+        for step, build in result["build"].items():
+            print(f"{result['size']:>10,}  {step:<14}{build['seconds']:>10.2f}{build['rss_mb']:>10.1f}")
+    print("-" * 86)
+    print(f"{'records':>10}  {'function':<26}{'backend':<8}{'n':>5}{'found':>7}"
+          f"{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}{'max ms':>9}")
+    for result in results:
+        for row in result["lookups"]:
+            print(f"{result['size']:>10,}  {row['function']:<26}{row['backend']:<8}{row['queries']:>5}"
+                  f"{row['found']:>7.0%}{row['p50_ms']:>9.3f}{row['p95_ms']:>9.3f}{row['p99_ms']:>9.3f}"
+                  f"{row['max_ms']:>9.2f}")
+    print("=" * 86)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark ฟังก์ชันค้นหากรมธรรม์กับข้อมูลจำลองขนาดใหญ่")
+    parser.add_argument("--sizes", default="10k,100k", help="จำนวนกรมธรรม์ต่อชุด (คั่นด้วย , รองรับ k/m)")
+    parser.add_argument("--queries", type=int, default=200, help="จำนวนคำค้นต่อฟังก์ชัน")
+    parser.add_argument("--max-seconds", type=float, default=3.0, help="เวลาวัดสูงสุดต่อฟังก์ชัน")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--json", dest="json_path", help="บันทึกผลเป็น JSON")
+    args = parser.parse_args(argv)
+
+    import mock_data
+
+    original = mock_data.get_all_policies()
+    results = []
+    try:
+        for size in [parse_size(value) for value in args.sizes.split(",") if value.strip()]:
+            print(f"📚 สร้างกรมธรรม์จำลอง {size:,} รายการ...")
+            results.append(run_size(size, args.queries, args.max_seconds, args.seed))
+            # ปล่อยข้อมูลชุดก่อนหน้าก่อนสร้างชุดถัดไป
+            mock_data.replace_policies({})
+            gc.collect()
+    finally:
+        mock_data.replace_policies(original)
+
+    print_report(results)
+    if args.json_path:
+        with open(args.json_path, "w", encoding="utf-8") as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
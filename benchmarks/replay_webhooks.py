@@ -0,0 +1,169 @@
+"""
+Replay webhook ที่บันทึกด้วย WEBHOOK_CAPTURE_DIR (webhook_capture.py) ไปยัง instance บนเครื่อง
+
+เซ็น X-Line-Signature ใหม่ด้วย channel secret ของ instance ปลายทาง แล้วส่ง body เดิมทุก byte
+ตามจังหวะเวลาเดิม (--speed 1) เร่งเป็น N เท่า (--speed N) หรือเร็วที่สุดเท่าที่ส่งได้ (--speed max)
+ไฟล์จากหลาย instance รวมกันได้ (เรียงตาม received_at)
+
+ควรชี้ LINE_API_ENDPOINT/LINE_DATA_API_ENDPOINT ของ instance ปลายทางไปที่ server จำลอง
+(benchmarks/fake_upstreams.py) ไม่อย่างนั้น reply token เก่าจะถูกส่งไป LINE จริง
+
+ตัวอย่าง:
+    LINE_CHANNEL_SECRET=... python -m benchmarks.replay_webhooks data/webhooks --speed 10
+    python -m benchmarks.replay_webhooks data/webhooks/webhooks-20240101-*.jsonl --speed max --concurrency 50
+
+รายงาน: throughput, status ที่ได้, latency p50/p95/p99 เทียบกับ duration_ms ตอนบันทึก
+และความช้ากว่ากำหนด (lag) ถ้า lag สูงแปลว่าตัว replay หรือ --concurrency เป็นคอขวด ไม่ใช่ server
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+from collections import Counter
+from typing import Dict, List, Optional
+
+import httpx
+
+from benchmarks.load_test import percentile, sign_body
+from webhook_capture import capture_files
+
+
+def load_records(paths: List[str], limit: Optional[int] = None) -> List[Dict]:
+    """
+    อ่านบันทึกจากไฟล์/โฟลเดอร์ เรียงตามเวลาที่ได้รับ (บรรทัดที่เสีย เช่น บรรทัดสุดท้ายที่เขียนไม่จบ ถูกข้าม)
+    """
+    files = []
+    for path in paths:
+        files.extend(capture_files(path) if os.path.isdir(path) else [path])
+    records = []
+    for path in files:
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue
+                if "body" in record and "received_at" in record:
+                    records.append(record)
+    records.sort(key=lambda record: record["received_at"])
+    return records[:limit] if limit else records
+
+
+def parse_speed(text: str) -> Optional[float]:
+    """
+    "max" = ไม่รอตามเวลาเดิม (None), ตัวเลข = เร่งกี่เท่า
+    """
+    if text.lower() == "max":
+        return None
+    speed = float(text.rstrip("xX"))
+    if speed <= 0:
+        raise argparse.ArgumentTypeError("speed ต้องมากกว่า 0 หรือเป็น max")
+    return speed
+
+
+async def replay(records: List[Dict], url: str, channel_secret: str, speed: Optional[float],
+                 concurrency: int = 100, timeout: float = 60.0) -> Dict:
+    """
+    ส่ง records ตามจังหวะเวลา (speed=None = เร็วที่สุด ไม่เกิน concurrency request พร้อมกัน)
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+    statuses: Counter = Counter()
+    latencies: List[float] = []
+    lags: List[float] = []
+    loop = asyncio.get_running_loop()
+
+    async with httpx.AsyncClient(timeout=timeout, limits=httpx.Limits(max_connections=concurrency)) as client:
+        async def send(record: Dict):
+            body = record["body"].encode("utf-8")
+            headers = {
+                "Content-Type": record.get("headers", {}).get("content-type", "application/json; charset=utf-8"),
+                "User-Agent": record.get("headers", {}).get("user-agent", "LineBotWebhook/2.0"),
+                "X-Line-Signature": sign_body(body, channel_secret),
+            }
+            started = time.perf_counter()
+            try:
+                response = await client.post(url, content=body, headers=headers)
+                statuses[str(response.status_code)] += 1
+            except httpx.HTTPError as e:
+                statuses[type(e).__name__] += 1
+            finally:
+                latencies.append(time.perf_counter() - started)
+                semaphore.release()
+
+        first = records[0]["received_at"]
+        start = loop.time()
+        tasks = []
+        for record in records:
+            due = start + (record["received_at"] - first) / speed if speed else loop.time()
+            delay = due - loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            await semaphore.acquire()
+            lags.append(max(0.0, loop.time() - due))
+            tasks.append(asyncio.create_task(send(record)))
+        await asyncio.gather(*tasks)
+        elapsed = loop.time() - start
+
+    span = records[-1]["received_at"] - first
+    recorded = [record["duration_ms"] / 1000 for record in records if "duration_ms" in record]
+    return {
+        "requests": len(records),
+        "elapsed_s": elapsed,
+        "original_span_s": span,
+        "speed": speed,
+        "throughput_rps": len(records) / elapsed if elapsed else 0.0,
+        "statuses": dict(statuses),
+        "latency_s": {f"p{pct}": percentile(latencies, pct) for pct in (50, 95, 99)},
+        "recorded_latency_s": {f"p{pct}": percentile(recorded, pct) for pct in (50, 95, 99)} if recorded else None,
+        "lag_s": {"p95": percentile(lags, 95), "max": max(lags)},
+    }
+
+
+def print_report(report: Dict):
+    speed = "max" if report["speed"] is None else f"{report['speed']:g}x"
+    print(f"⏱️  replay {report['requests']} webhook ({speed}) ใน {report['elapsed_s']:.2f}s "
+          f"(เดิม {report['original_span_s']:.2f}s) | {report['throughput_rps']:.1f} req/s")
+    print(f"📬 status: {', '.join(f'{status}={count}' for status, count in sorted(report['statuses'].items()))}")
+    latency = report["latency_s"]
+    print(f"📈 latency p50 {latency['p50'] * 1000:.1f} ms, p95 {latency['p95'] * 1000:.1f} ms, "
+          f"p99 {latency['p99'] * 1000:.1f} ms")
+    if report["recorded_latency_s"]:
+        recorded = report["recorded_latency_s"]
+        print(f"📼 ตอนบันทึก p50 {recorded['p50'] * 1000:.1f} ms, p95 {recorded['p95'] * 1000:.1f} ms, "
+              f"p99 {recorded['p99'] * 1000:.1f} ms")
+    print(f"🐢 ช้ากว่ากำหนด p95 {report['lag_s']['p95'] * 1000:.1f} ms, สูงสุด {report['lag_s']['max'] * 1000:.1f} ms")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Replay webhook ที่บันทึกไว้ไปยัง instance บนเครื่อง")
+    parser.add_argument("paths", nargs="+", help="ไฟล์ .jsonl หรือโฟลเดอร์ WEBHOOK_CAPTURE_DIR")
+    parser.add_argument("--url", default="http://localhost:8000/webhook", help="webhook ของ instance ปลายทาง")
+    parser.add_argument("--secret", default=os.getenv("LINE_CHANNEL_SECRET"),
+                        help="channel secret ของ instance ปลายทาง (ค่าเริ่มต้นจาก LINE_CHANNEL_SECRET)")
+    parser.add_argument("--speed", type=parse_speed, default=1.0, help="1 = จังหวะเดิม, N = เร็วขึ้น N เท่า, max")
+    parser.add_argument("--concurrency", type=int, default=100, help="request ที่ส่งค้างพร้อมกันได้สูงสุด")
+    parser.add_argument("--timeout", type=float, default=60.0, help="timeout ต่อ request (วินาที)")
+    parser.add_argument("--limit", type=int, help="replay แค่ N request แรก")
+    parser.add_argument("--json", dest="json_path", help="บันทึกรายงานเป็น JSON")
+    args = parser.parse_args(argv)
+
+    if not args.secret:
+        parser.error("กรุณาระบุ --secret หรือตั้ง LINE_CHANNEL_SECRET")
+    records = load_records(args.paths, args.limit)
+    if not records:
+        print("❌ ไม่พบ webhook ที่บันทึกไว้")
+        return 1
+
+    report = asyncio.run(replay(records, args.url, args.secret, args.speed, args.concurrency, args.timeout))
+    print_report(report)
+    if args.json_path:
+        with open(args.json_path, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
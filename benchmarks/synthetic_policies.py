@@ -0,0 +1,144 @@
+"""
+สร้างสมุดกรมธรรม์จำลองขนาดใหญ่ (10k - 10M รายการ) สำหรับ benchmark การค้นหาใน mock_data
+
+แต่ละรายการมีรูปแบบเดียวกับ MOCK_POLICIES (ไม่มีเอกสาร PDF):
+- คำนำหน้า ชื่อ นามสกุล ภาษาไทย ประกอบจากพยางค์ที่ใช้ในชื่อจริง (ชื่อซ้ำกันได้เหมือนข้อมูลจริง)
+- ทะเบียนรถ (เลขนำหน้า + หมวดอักษร + เลข) และจังหวัด
+- เลขบัตรประชาชน 13 หลักที่ checksum ถูกต้อง
+- เลขกรมธรรม์ไม่ซ้ำ
+
+ผลลัพธ์กำหนดได้ด้วย seed (seed เดียวกัน = ข้อมูลชุดเดียวกัน) และสร้างแบบ generator
+ค่าที่มีไม่กี่แบบ (รุ่นรถ บริษัท จังหวัด) ใช้ string object เดียวกันเพื่อประหยัดหน่วยความจำ
+
+ตัวอย่าง:
+    python -m benchmarks.synthetic_policies --count 5
+"""
+
+import argparse
+import random
+from typing import Dict, Iterator, Tuple
+
+TITLES = [("นาย", 0.48), ("นาง", 0.27), ("นางสาว", 0.25)]
+
+FIRST_NAME_SYLLABLES = [
+    "สม", "วิ", "ชัย", "ศักดิ์", "ประ", "เสริฐ", "สุ", "นันท์", "กิตติ", "พงษ์", "อรุณ", "รัตน์",
+    "ณัฐ", "ธนา", "พร", "ศรี", "มณี", "กาญ", "จนา", "จันทร์", "วัฒน์", "ทอง", "สุข", "เพ็ญ",
+    "อนุ", "ชา", "ปรีชา", "วรา", "ภรณ์", "นิ", "ภา", "ธีร", "ยุทธ", "อำ", "ไพ", "บูรณ์",
+]
+LAST_NAME_SYLLABLES = [
+    "เข็ม", "กลัด", "ใจ", "ดี", "รักษ์", "ศรี", "สุข", "วงศ์", "ทอง", "คำ", "แก้ว", "บุญ",
+    "มี", "เจริญ", "พันธ์", "ชัย", "ประเสริฐ", "สกุล", "รุ่ง", "เรือง", "นาค", "สวัสดิ์", "ภักดี", "วัฒนา",
+    "กุล", "ธรรม", "พงศ์", "สิทธิ์", "อินทร์", "จันทร์", "เพชร", "ทิพย์", "มงคล", "ศิริ", "โชค", "ยิ่ง",
+]
+
+# หมวดอักษรทะเบียนรถใช้พยัญชนะไทย (ยกเว้นตัวที่ไม่ใช้ในทะเบียน)
+PLATE_LETTERS = "กขคฆงจฉชซฌญฎฏฐฑฒณดตถทธนบปผพฟภมยรลวศษสหฬอฮ"
+
+PROVINCES = [
+    "กรุงเทพมหานคร", "นนทบุรี", "ปทุมธานี", "สมุทรปราการ", "ชลบุรี", "ระยอง", "เชียงใหม่", "เชียงราย",
+    "ขอนแก่น", "นครราชสีมา", "อุดรธานี", "อุบลราชธานี", "ภูเก็ต", "สงขลา", "สุราษฎร์ธานี", "พิษณุโลก",
+    "นครปฐม", "พระนครศรีอยุธยา", "ราชบุรี", "ลำปาง",
+]
+
+CAR_MODELS = [
+    "Toyota Camry 2.5 Hybrid", "Toyota Yaris Ativ", "Toyota Hilux Revo", "Honda Civic RS", "Honda City e:HEV",
+    "Honda HR-V", "Mazda CX-5 2.5 Turbo", "Mazda 2", "Isuzu D-Max", "Nissan Almera", "MG ZS EV",
+    "BYD Atto 3", "Mitsubishi Pajero Sport", "Ford Ranger Raptor",
+]
+
+INSURANCE_TYPES = ["ชั้น 1", "ชั้น 2+", "ชั้น 2", "ชั้น 3+", "ชั้น 3"]
+
+INSURANCE_COMPANIES = [
+    "บริษัท กรุงเทพประกันภัย จำกัด (มหาชน)", "บริษัท วิริยะประกันภัย จำกัด (มหาชน)",
+    "บริษัท ทิพยประกันภัย จำกัด (มหาชน)", "บริษัท ธนชาตประกันภัย จำกัด (มหาชน)",
+    "บริษัท เมืองไทยประกันภัย จำกัด (มหาชน)",
+]
+
+
+def cid_check_digit(first12: str) -> int:
+    """
+    หลักตรวจสอบของเลขบัตรประชาชน: (11 - (ผลรวมหลักที่ i คูณ 13-i) mod 11) mod 10
+    """
+    total = sum(int(digit) * (13 - index) for index, digit in enumerate(first12))
+    return (11 - total % 11) % 10
+
+
+def is_valid_cid(cid: str) -> bool:
+    return len(cid) == 13 and cid.isdigit() and cid_check_digit(cid[:12]) == int(cid[12])
+
+
+def random_cid(rng: random.Random) -> str:
+    # หลักแรก 1-8 ตามประเภทบุคคล
+    first12 = str(rng.randint(1, 8)) + "".join(str(rng.randint(0, 9)) for _ in range(11))
+    return first12 + str(cid_check_digit(first12))
+
+
+def random_plate(rng: random.Random) -> str:
+    prefix = str(rng.randint(1, 9)) if rng.random() < 0.7 else ""
+    letters = rng.choice(PLATE_LETTERS) + rng.choice(PLATE_LETTERS)
+    return f"{prefix}{letters}{rng.randint(1, 9999)}"
+
+
+def _compose(rng: random.Random, syllables, low: int, high: int) -> str:
+    return "".join(rng.choice(syllables) for _ in range(rng.randint(low, high)))
+
+
+def generate_policies(count: int, seed: int = 42) -> Iterator[Tuple[str, Dict]]:
+    """
+    สร้าง (key, policy) ทีละรายการ key รูปแบบเดียวกับ MOCK_POLICIES ("<คำนำหน้า><ชื่อ> <นามสกุล>_<ทะเบียน>")
+    """
+    rng = random.Random(seed)
+    titles = [title for title, _ in TITLES]
+    weights = [weight for _, weight in TITLES]
+    for index in range(count):
+        title = rng.choices(titles, weights)[0]
+        first_name = _compose(rng, FIRST_NAME_SYLLABLES, 2, 3)
+        last_name = _compose(rng, LAST_NAME_SYLLABLES, 2, 4)
+        plate = random_plate(rng)
+        start_year = rng.randint(2023, 2025)
+        start_day, start_month = rng.randint(1, 28), rng.randint(1, 12)
+        policy = {
+            "policy_number": f"POL-{start_year}-{index:07d}",
+            "title_name": title,
+            "first_name": first_name,
+            "last_name": last_name,
+            "cid": random_cid(rng),
+            "plate": plate,
+            "province": rng.choice(PROVINCES),
+            "car_model": rng.choice(CAR_MODELS),
+            "car_year": str(rng.randint(2010, 2025)),
+            "insurance_type": rng.choice(INSURANCE_TYPES),
+            "insurance_company": rng.choice(INSURANCE_COMPANIES),
+            "policy_start": f"{start_day:02d}/{start_month:02d}/{start_year}",
+            "policy_end": f"{start_day:02d}/{start_month:02d}/{start_year + 1}",
+            "status": "active",
+        }
+        yield f"{title}{first_name} {last_name}_{plate}", policy
+
+
+def generate_policy_book(count: int, seed: int = 42) -> Dict[str, Dict]:
+    """
+    สมุดกรมธรรม์ในรูปแบบ MOCK_POLICIES (key ซ้ำจะถูกเติมเลขกรมธรรม์ต่อท้ายให้ไม่ทับกัน)
+    """
+    book: Dict[str, Dict] = {}
+    for key, policy in generate_policies(count, seed):
+        if key in book:
+            key = f"{key}_{policy['policy_number']}"
+        book[key] = policy
+    return book
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="แสดงตัวอย่างกรมธรรม์จำลอง")
+    parser.add_argument("--count", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args(argv)
+
+    for key, policy in generate_policies(args.count, args.seed):
+        assert is_valid_cid(policy["cid"])
+        print(f"{key:<40} {policy['policy_number']}  CID {policy['cid']}  {policy['province']}")
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,125 @@
+"""
+เปรียบเทียบการรับ webhook แบบเดิม (WebhookParser ของ SDK) กับ ConcurrentWebhookHandler.parse_events
+
+body หนึ่งมีหลาย event ปนกันระหว่าง event ที่บอทตอบ (ข้อความ text/image) กับ event ที่ไม่มี handler
+(follow, unfollow, sticker, postback, ...) วัดต่อ body:
+- sdk         : decode เป็น str + ตรวจ signature + สร้าง model ทุก event + resolve handler (เดิมทำใน event loop)
+- fast        : ตรวจ signature บน bytes + parse ครั้งเดียว + ทิ้ง event ที่ไม่มี handler (ส่วนที่ทำใน event loop)
+- fast+models : fast + สร้าง model ของ event ที่เหลือ (ส่วนนี้ย้ายไปทำใน thread ของ executor)
+
+ตัวอย่าง:
+    python -m benchmarks.webhook_parse_bench --events 10,100,500 --ignored-ratio 0.5
+"""
+
+import argparse
+import random
+import time
+import uuid
+from typing import Callable, Dict, List
+
+from benchmarks.load_test import CHANNEL_SECRET, build_message_event, build_webhook_body, percentile, sign_body
+
+
+def build_ignored_event(user_id: str) -> Dict:
+    """
+    event ที่บอทไม่มี handler (สุ่มชนิด)
+    """
+    event = build_message_event(user_id, "text", "")
+    kind = random.choice(["follow", "unfollow", "sticker", "postback", "unsend"])
+    if kind == "sticker":
+        event["message"] = {"type": "sticker", "id": event["message"]["id"], "quoteToken": uuid.uuid4().hex,
+                            "packageId": "446", "stickerId": "1988", "stickerResourceType": "STATIC"}
+        return event
+    event["type"] = kind
+    del event["message"]
+    if kind == "unfollow":
+        del event["replyToken"]
+    elif kind == "postback":
+        event["postback"] = {"data": "action=noop"}
+    elif kind == "unsend":
+        del event["replyToken"]
+        event["unsend"] = {"messageId": str(random.randint(10**17, 10**18 - 1))}
+    elif kind == "follow":
+        event["follow"] = {"isUnblocked": False}
+    return event
+
+
+def build_body(events: int, ignored_ratio: float) -> bytes:
+    raw_events = []
+    for index in range(events):
+        user_id = f"Ubench{index:026d}"
+        if random.random() < ignored_ratio:
+            raw_events.append(build_ignored_event(user_id))
+        else:
+            kind = random.choice(["text", "image"])
+            raw_events.append(build_message_event(user_id, kind, "เช็คสิทธิ์เคลมด่วน" if kind == "text" else None))
+    return build_webhook_body(raw_events)
+
+
+def create_handler():
+    from linebot.v3.webhooks import ImageMessageContent, MessageEvent, TextMessageContent
+
+    from event_dispatcher import ConcurrentWebhookHandler, KeyedSerialExecutor
+
+    # handler ชุดเดียวกับ main.py (ข้อความ text และ image เท่านั้น)
+    handler = ConcurrentWebhookHandler(CHANNEL_SECRET, KeyedSerialExecutor(max_workers=1))
+    handler.add(MessageEvent, message=TextMessageContent)(lambda event: None)
+    handler.add(MessageEvent, message=ImageMessageContent)(lambda event: None)
+    return handler
+
+
+def measure(fn: Callable, iterations: int) -> List[float]:
+    fn()
+    samples = []
+    for _ in range(iterations):
+        started = time.perf_counter()
+        fn()
+        samples.append((time.perf_counter() - started) * 1000)
+    return samples
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="เปรียบเทียบการ parse webhook แบบ SDK กับแบบ fast path")
+    parser.add_argument("--events", default="10,100,500", help="จำนวน event ต่อ body (คั่นด้วย ,)")
+    parser.add_argument("--ignored-ratio", type=float, default=0.5, help="สัดส่วน event ที่ไม่มี handler")
+    parser.add_argument("--iterations", type=int, default=50)
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args(argv)
+
+    from event_dispatcher import materialize_event
+
+    random.seed(args.seed)
+    handler = create_handler()
+
+    print("=" * 78)
+    print(f"{'events':>7}{'KB':>8}{'kept':>6}  {'sdk p50':>10}{'fast p50':>10}{'+models p50':>13}{'speedup':>9}")
+    for count in [int(value) for value in args.events.split(",") if value.strip()]:
+        body = build_body(count, args.ignored_ratio)
+        signature = sign_body(body)
+
+        def sdk():
+            payload = handler.parser.parse(body.decode("utf-8"), signature, as_payload=True)
+            return [event for event in payload.events if handler.resolve(event) is not None]
+
+        def fast():
+            return handler.parse_events(body, signature)
+
+        def fast_with_models():
+            return [materialize_event(raw_event) for _, _, raw_event in handler.parse_events(body, signature)]
+
+        # ทั้งสองแบบต้องเลือก event ชุดเดียวกัน
+        kept = fast()
+        assert [raw["webhookEventId"] for _, _, raw in kept] == [event.webhook_event_id for event in sdk()]
+
+        sdk_ms = percentile(measure(sdk, args.iterations), 50)
+        fast_ms = percentile(measure(fast, args.iterations), 50)
+        models_ms = percentile(measure(fast_with_models, args.iterations), 50)
+        print(f"{count:>7}{len(body) / 1024:>8.1f}{len(kept):>6}  {sdk_ms:>8.2f}ms{fast_ms:>8.2f}ms"
+              f"{models_ms:>11.2f}ms{sdk_ms / fast_ms:>8.1f}x")
+    print("=" * 78)
+    print("sdk/fast = เวลาที่ event loop ใช้ต่อ body, +models = รวมเวลาสร้าง model ของ event ที่เหลือ (ใน executor)")
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,159 @@
+"""
+Router ของบทสนทนาแบบตาราง (state machine) สำหรับข้อความตัวอักษร
+
+แทนการไล่ if ตาม state ทีละขั้น: ลงทะเบียน handler ตาม state + ข้อความที่ normalise แล้ว
+การหา handler เป็น dict lookup (O(1)) ไม่ว่าจะมีกี่ขั้นตอน ยกเว้น prefix ของ state นั้นๆ
+ที่ไล่เฉพาะรายการของ state ปัจจุบัน
+
+ลำดับการจับคู่:
+1. command (ใช้ได้ทุก state) เช่น "เช็คสิทธิ์เคลมด่วน"
+2. ข้อความตรงตัวของ state
+3. prefix ของ state เช่น "เลือกทะเบียน "
+4. fallback ของ state
+5. default (ข้อความทั่วไปที่ไม่อยู่ใน flow)
+"""
+
+import re
+import threading
+import time
+from typing import Callable, Dict, List, Optional, Tuple
+
+_WHITESPACE_RE = re.compile(r"\s+")
+
+
+def normalize_input(text: str) -> str:
+    """
+    ตัดช่องว่างหัวท้ายและยุบช่องว่างซ้อนให้เหลือช่องเดียว
+    """
+    return _WHITESPACE_RE.sub(" ", text).strip()
+
+
+class Route:
+    def __init__(self, name: str, handler: Callable):
+        self.name = name
+        self.handler = handler
+
+
+class ConversationRouter:
+    """
+    จับคู่ (state, ข้อความ) กับ handler และจับเวลาแต่ละ transition
+
+    ctx ที่ส่งเข้า dispatch ต้องมี .text และ .state (อ่าน state ปัจจุบันของผู้ใช้)
+    ถ้าจับคู่ด้วย prefix จะตั้ง ctx.argument เป็นข้อความส่วนที่เหลือ
+    เวลาของแต่ละ transition ดูได้จาก transition_stats() และ prometheus() (/metrics)
+    """
+
+    def __init__(self):
+        self._commands: Dict[str, Route] = {}
+        self._exact: Dict[Tuple[Optional[str], str], Route] = {}
+        self._prefixes: Dict[Optional[str], List[Tuple[str, Route]]] = {}
+        self._fallbacks: Dict[Optional[str], Route] = {}
+        self._default: Optional[Route] = None
+        self._stats: Dict[Tuple[str, Optional[str], Optional[str]], List[float]] = {}
+        self._stats_lock = threading.Lock()
+
+    # ---------- การลงทะเบียน ----------
+    def command(self, text: str):
+        def decorator(func):
+            self._commands[normalize_input(text)] = Route(func.__name__, func)
+            return func
+        return decorator
+
+    def on(self, state: Optional[str], text: str):
+        def decorator(func):
+            self._exact[(state, normalize_input(text))] = Route(func.__name__, func)
+            return func
+        return decorator
+
+    def on_prefix(self, state: Optional[str], prefix: str):
+        def decorator(func):
+            self._prefixes.setdefault(state, []).append((prefix, Route(func.__name__, func)))
+            return func
+        return decorator
+
+    def fallback(self, state: Optional[str]):
+        def decorator(func):
+            self._fallbacks[state] = Route(func.__name__, func)
+            return func
+        return decorator
+
+    def default(self):
+        def decorator(func):
+            self._default = Route(func.__name__, func)
+            return func
+        return decorator
+
+    # ---------- การจับคู่ ----------
+    def resolve(self, state: Optional[str], text: str) -> Tuple[Optional[Route], Optional[str]]:
+        """
+        คืน (route, argument) สำหรับ state และข้อความที่ normalise แล้ว
+        """
+        route = self._commands.get(text) or self._exact.get((state, text))
+        if route is not None:
+            return route, None
+
+        for prefix, prefix_route in self._prefixes.get(state, ()):
+            if text.startswith(prefix):
+                return prefix_route, text[len(prefix):].strip()
+
+        return self._fallbacks.get(state, self._default), None
+
+    def dispatch(self, ctx):
+        from_state = ctx.state
+        route, argument = self.resolve(from_state, normalize_input(ctx.text))
+        if route is None:
+            return None
+        ctx.argument = argument
+
+        started = time.perf_counter()
+        try:
+            return route.handler(ctx)
+        finally:
+            self._record(route.name, from_state, ctx.state, time.perf_counter() - started)
+
+    # ---------- สถิติ ----------
+    def _record(self, route_name: str, from_state: Optional[str], to_state: Optional[str], seconds: float):
+        key = (route_name, from_state, to_state)
+        with self._stats_lock:
+            stats = self._stats.setdefault(key, [0, 0.0, 0.0])
+            stats[0] += 1
+            stats[1] += seconds
+            stats[2] = max(stats[2], seconds)
+
+    def transition_stats(self) -> List[Dict]:
+        """
+        สรุปจำนวนครั้งและเวลาเฉลี่ย/สูงสุด (ms) ของแต่ละ transition
+        """
+        with self._stats_lock:
+            items = list(self._stats.items())
+        return [
+            {
+                "route": route_name,
+                "from": from_state,
+                "to": to_state,
+                "count": count,
+                "avg_ms": round(total / count * 1000, 2),
+                "max_ms": round(maximum * 1000, 2),
+            }
+            for (route_name, from_state, to_state), (count, total, maximum) in items
+        ]
+
+    def prometheus(self) -> str:
+        """
+        จำนวนครั้งและเวลารวมของแต่ละ transition รูปแบบ Prometheus text
+        (label มีแค่ชื่อ handler และ state จำนวน series จึงคงที่ตามขนาดของ flow)
+        """
+        with self._stats_lock:
+            items = [(key, list(stats)) for key, stats in self._stats.items()]
+        series = [
+            ("conversation_transitions_total", "counter", "จำนวนข้อความที่ผ่านแต่ละ transition", 0, "{}"),
+            ("conversation_transition_seconds_total", "counter", "เวลารวมที่ handler ของแต่ละ transition ใช้", 1, "{:.6f}"),
+            ("conversation_transition_max_seconds", "gauge", "เวลานานสุดของแต่ละ transition", 2, "{:.6f}"),
+        ]
+        lines = []
+        for name, kind, help_text, index, value_format in series:
+            lines += [f"# HELP {name} {help_text}", f"# TYPE {name} {kind}"]
+            for (route_name, from_state, to_state), stats in items:
+                labels = f'route="{route_name}",from="{from_state or ""}",to="{to_state or ""}"'
+                lines.append(f"{name}{{{labels}}} {value_format.format(stats[index])}")
+        return "\n".join(lines) + "\n"
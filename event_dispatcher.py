@@ -0,0 +1,314 @@
+"""
+กระจาย event จาก LINE webhook ไปประมวลผลพร้อมกันตามผู้ใช้
+
+- event ของผู้ใช้คนละคน (source.user_id) รันพร้อมกันบน thread pool
+- event ของผู้ใช้คนเดียวกันรันตามลำดับที่เข้ามาเสมอ (ทั้งใน body เดียวกันและข้าม request)
+  จึงไม่มี handler สองตัวแก้ user_sessions[user_id] ของคนเดียวกันพร้อมกัน
+- thread ว่างถูกแบ่งตาม priority class: งานตอบผู้ใช้ทันทีไม่ต้องรอหลังงานวิเคราะห์ที่ค้างอยู่
+
+ฝั่งรับ webhook ไม่ผ่าน WebhookParser ของ SDK:
+- ตรวจ HMAC บน bytes ของ body โดยตรง (ไม่ต้อง decode เป็น str)
+- parse JSON ครั้งเดียว (orjson ถ้ามี) แล้วเลือก handler จาก "type" ของ dict
+- event ที่ไม่มี handler (follow, unfollow, sticker ฯลฯ) ถูกทิ้งก่อนสร้าง pydantic model
+- event ที่เหลือสร้าง model ใน thread ของ executor ไม่ใช่ใน event loop
+"""
+
+import base64
+import hashlib
+import hmac
+import json
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable, Deque, Dict, List, Optional, Tuple, Union
+
+from linebot.v3 import WebhookHandler
+from linebot.v3.exceptions import InvalidSignatureError
+from linebot.v3.models.events import UnknownEvent
+from linebot.v3.webhooks import Event, MessageContent, MessageEvent
+
+from work_priority import INTERACTIVE, PRIORITY_CLASSES, class_limits
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def _discriminator_map(model: type) -> Dict[str, str]:
+    """
+    ตาราง "type" ใน JSON -> ชื่อ class ของ SDK (ตารางเดียวกับที่ from_dict ใช้เลือก model)
+
+    เป็น attribute ภายในของ SDK (code generator ของ OpenAPI) ถ้าอัปเกรด linebot แล้วหายไปหรือว่าง
+    ให้ล้มตั้งแต่ import แทนการทิ้ง event ทุกตัวเงียบ ๆ
+    """
+    attribute = f"_{model.__name__}__discriminator_value_class_map"
+    mapping = getattr(model, attribute, None)
+    if not isinstance(mapping, dict) or not mapping:
+        raise ImportError(f"linebot.v3 {model.__name__} ไม่มี {attribute} (เวอร์ชัน SDK ไม่รองรับ) "
+                          f"ต้องปรับ event_dispatcher ให้ตรงกับ SDK")
+    return mapping
+
+
+_EVENT_CLASS_NAMES: Dict[str, str] = _discriminator_map(Event)
+_MESSAGE_CLASS_NAMES: Dict[str, str] = _discriminator_map(MessageContent)
+
+
+def _loads(body: bytes):
+    return orjson.loads(body) if orjson is not None else json.loads(body)
+
+
+class KeyedSerialExecutor:
+    """
+    Executor ที่รับประกันลำดับต่อ key: งานของ key เดียวกันรันทีละงานตามลำดับ submit
+    งานของ key ต่างกันรันขนานกันได้สูงสุด max_workers งาน
+
+    งานแต่ละงานมี priority class (work_priority.py) เมื่อ thread ว่างจะเลือก key ที่งานถัดไปเร่งด่วนที่สุดก่อน
+    - reserved: thread ที่กันไว้ให้แต่ละ class (class อื่นใช้ไม่ได้)
+    - aging_s: งานที่รอ thread นานเกินนี้ถูกเลือกก่อนตามเวลาที่รอ ไม่ว่าจะอยู่ class ไหน (bulk ไม่อดตาย)
+    หลังงานแต่ละงานจบ thread คืนให้ scheduler เลือกใหม่ key ที่ยังมีงานต่อคิวตาม class ของงานถัดไป
+    """
+
+    def __init__(self, max_workers: int = 16, thread_name_prefix: str = "event",
+                 reserved: Optional[Dict[str, int]] = None, aging_s: float = 10.0):
+        self.max_workers = max_workers
+        self.aging_s = aging_s
+        self._limits = class_limits(max_workers, reserved)
+        self._pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=thread_name_prefix)
+        # key -> งานที่ยังไม่เริ่ม (fn, args, future, priority, เวลาที่ submit)
+        self._queues: Dict[str, Deque[Tuple[Callable, tuple, Future, str, float]]] = {}
+        # key ที่รอ thread แยกตาม class ของงานถัดไป (เวลาที่งานนั้น submit, key)
+        self._ready: Dict[str, Deque[Tuple[float, str]]] = {name: deque() for name in PRIORITY_CLASSES}
+        self._running: Dict[str, int] = dict.fromkeys(PRIORITY_CLASSES, 0)
+        self._aged = 0
+        self._closed = False
+        self._lock = threading.Lock()
+
+    def submit(self, key: str, fn: Callable, *args, priority: str = INTERACTIVE) -> Future:
+        if priority not in self._ready:
+            raise ValueError(f"ไม่รู้จัก priority class: {priority}")
+        future: Future = Future()
+        submitted_at = time.monotonic()
+        with self._lock:
+            queue = self._queues.get(key)
+            if queue is not None:
+                # key นี้มีงานรันหรือรอ thread อยู่แล้ว ต่อคิวไว้ตามลำดับ
+                queue.append((fn, args, future, priority, submitted_at))
+                return future
+            if self._closed:
+                raise RuntimeError("cannot schedule new futures after shutdown")
+            self._queues[key] = deque([(fn, args, future, priority, submitted_at)])
+            self._ready[priority].append((submitted_at, key))
+            self._dispatch()
+        return future
+
+    def _pick(self) -> Optional[Tuple[str, str]]:
+        # เรียกขณะถือ _lock: เลือก (class, key) ถัดไปที่จะได้ thread
+        if sum(self._running.values()) >= self.max_workers:
+            return None
+        candidates = [name for name in PRIORITY_CLASSES
+                      if self._ready[name] and self._running[name] < self._limits[name]]
+        if not candidates:
+            return None
+        now = time.monotonic()
+        aged = [name for name in candidates if now - self._ready[name][0][0] >= self.aging_s]
+        if aged:
+            # รอนานเกิน aging_s แล้ว: ใครรอนานสุดได้ก่อน
+            chosen = min(aged, key=lambda name: self._ready[name][0][0])
+            if chosen != candidates[0]:
+                self._aged += 1
+        else:
+            chosen = candidates[0]
+        return chosen, self._ready[chosen].popleft()[1]
+
+    def _dispatch(self):
+        # เรียกขณะถือ _lock
+        while not self._closed:
+            picked = self._pick()
+            if picked is None:
+                return
+            priority, key = picked
+            self._running[priority] += 1
+            self._pool.submit(self._drain, key, priority)
+
+    def _drain(self, key: str, priority: str):
+        ran = False
+        while True:
+            with self._lock:
+                queue = self._queues[key]
+                if not queue or (ran and not self._closed):
+                    # คืน thread ให้ scheduler (ตอนปิดระบบทำงานที่เหลือของ key นี้ต่อใน thread เดิม)
+                    self._running[priority] -= 1
+                    if queue:
+                        self._ready[queue[0][3]].append((queue[0][4], key))
+                    else:
+                        del self._queues[key]
+                    self._dispatch()
+                    return
+                fn, args, future, _, _ = queue.popleft()
+
+            if not future.set_running_or_notify_cancel():
+                continue
+            ran = True
+            try:
+                future.set_result(fn(*args))
+            except BaseException as e:
+                future.set_exception(e)
+
+    def pending(self) -> int:
+        """จำนวนงานที่รอคิวอยู่ (ไม่รวมงานที่กำลังรัน)"""
+        with self._lock:
+            return sum(len(queue) for queue in self._queues.values())
+
+    def idle(self) -> bool:
+        """ไม่มีงานรันหรือรอคิวอยู่เลย"""
+        with self._lock:
+            return not self._queues
+
+    def stats(self) -> Dict:
+        """thread ที่ใช้อยู่/จำนวนสูงสุด และ key ที่รอ thread แยกตาม class"""
+        with self._lock:
+            stats = {
+                name: {"running": self._running[name], "limit": self._limits[name], "waiting": len(self._ready[name])}
+                for name in PRIORITY_CLASSES
+            }
+            stats["aged"] = self._aged
+            return stats
+
+    def cancel_pending(self) -> List[str]:
+        """
+        ยกเลิกงานที่ยังรอคิวอยู่ (งานที่กำลังรันไม่ถูกยกเลิก) คืน key ที่มีงานถูกยกเลิก
+        """
+        cancelled = []
+        with self._lock:
+            for key, queue in self._queues.items():
+                # งานที่กำลังรันถูก drain หยิบออกจากคิวไปแล้ว งานที่เหลือในคิวจึงยังไม่เริ่มทั้งหมด
+                if [future for _, _, future, _, _ in queue if future.cancel()]:
+                    cancelled.append(key)
+        return cancelled
+
+    def shutdown(self, wait: bool = True):
+        with self._lock:
+            self._closed = True
+            # key ที่ยังรอ thread: ส่งเข้า pool ทั้งหมดให้ทำจนจบ (เหมือน ThreadPoolExecutor.shutdown)
+            for priority, ready in self._ready.items():
+                while ready:
+                    self._running[priority] += 1
+                    self._pool.submit(self._drain, ready.popleft()[1], priority)
+        self._pool.shutdown(wait=wait)
+
+
+def event_ordering_key(event) -> str:
+    """
+    key สำหรับรักษาลำดับ: user_id ถ้ามี, ไม่งั้นใช้ group/room ที่ event มาจาก
+    """
+    source = getattr(event, "source", None)
+    for attr in ("user_id", "group_id", "room_id"):
+        value = getattr(source, attr, None)
+        if value:
+            return value
+    return "_unknown"
+
+
+def raw_event_ordering_key(raw_event: Dict) -> str:
+    """
+    event_ordering_key ของ event ที่ยังเป็น dict (ชื่อ field แบบ JSON)
+    """
+    source = raw_event.get("source") or {}
+    for field in ("userId", "groupId", "roomId"):
+        value = source.get(field)
+        if value:
+            return value
+    return "_unknown"
+
+
+def materialize_event(raw_event: Dict):
+    """
+    สร้าง model ของ SDK จาก dict (event ที่ SDK ไม่รู้จักเป็น UnknownEvent เหมือน WebhookParser)
+    """
+    try:
+        return Event.from_dict(raw_event)
+    except ValueError:
+        return UnknownEvent.new_from_json_dict(raw_event)
+
+
+class ConcurrentWebhookHandler(WebhookHandler):
+    """
+    WebhookHandler ที่ส่ง event เข้า KeyedSerialExecutor แทนการรันทีละ event ใน thread เดียว
+    ลงทะเบียน handler ด้วย @handler.add(...) เหมือน WebhookHandler เดิม
+    """
+
+    def __init__(self, channel_secret: str, executor: KeyedSerialExecutor):
+        super().__init__(channel_secret)
+        self.executor = executor
+        self._channel_secret = channel_secret.encode("utf-8")
+
+    def resolve(self, event) -> Optional[Callable]:
+        """
+        หา handler ของ event ตามกติกาเดียวกับ WebhookHandler.handle
+        """
+        func = None
+        if isinstance(event, MessageEvent):
+            func = self._handlers.get(f"{event.__class__.__name__}_{event.message.__class__.__name__}")
+        if func is None:
+            func = self._handlers.get(event.__class__.__name__)
+        return func or self._default
+
+    def resolve_raw(self, raw_event: Dict) -> Optional[Callable]:
+        """
+        resolve() จาก dict โดยไม่ต้องสร้าง model
+        """
+        event_class = _EVENT_CLASS_NAMES.get(raw_event.get("type"))
+        if event_class is None:
+            return self._default
+        func = None
+        if event_class == "MessageEvent":
+            message_class = _MESSAGE_CLASS_NAMES.get((raw_event.get("message") or {}).get("type"))
+            func = self._handlers.get(f"{event_class}_{message_class}")
+        if func is None:
+            func = self._handlers.get(event_class)
+        return func or self._default
+
+    def verify(self, body: bytes, signature: str):
+        """
+        ตรวจ X-Line-Signature (HMAC-SHA256 ของ body แบบ Base64) raise InvalidSignatureError ถ้าไม่ตรง
+        """
+        expected = base64.b64encode(hmac.new(self._channel_secret, body, hashlib.sha256).digest())
+        if not hmac.compare_digest(expected, signature.encode("utf-8")):
+            raise InvalidSignatureError(f"Invalid signature. signature={signature}")
+
+    def parse_events(self, body: Union[bytes, str], signature: str) -> List[Tuple[str, Callable, Dict]]:
+        """
+        ตรวจ signature, parse body แล้วคืน (key ลำดับ, handler, event dict) เฉพาะ event ที่มี handler
+        """
+        if isinstance(body, str):
+            body = body.encode("utf-8")
+        self.verify(body, signature)
+        planned = []
+        for raw_event in _loads(body).get("events", []):
+            func = self.resolve_raw(raw_event)
+            if func is not None:
+                planned.append((raw_event_ordering_key(raw_event), func, raw_event))
+        return planned
+
+    def dispatch(self, body: Union[bytes, str], signature: str) -> List[Future]:
+        """
+        ตรวจ signature, parse body แล้ว submit ทุก event ที่มี handler
+        คืน Future ของแต่ละ event (raise InvalidSignatureError ถ้า signature ไม่ถูก)
+        """
+        return [
+            self.executor.submit(key, self._run, func, raw_event)
+            for key, func, raw_event in self.parse_events(body, signature)
+        ]
+
+    @staticmethod
+    def _run(func: Callable, raw_event: Dict):
+        return func(materialize_event(raw_event))
+
+    def handle(self, body: Union[bytes, str], signature: str):
+        """
+        เวอร์ชัน sync (ใช้แทน WebhookHandler.handle ได้): รอทุก event เสร็จ
+        """
+        for future in self.dispatch(body, signature):
+            future.result()
@@ -1,18 +1,20 @@
 """
 Flex Message Templates สำหรับ LINE Bot
 ใช้สำหรับสร้าง UI ที่สวยงามบน LINE Chat
+
+ทุกฟังก์ชันคืน dict ของ container (bubble/carousel) ตามรูปแบบ JSON ของ LINE
+ใช้คู่กับ line_sender.flex_message() ได้ทั้งตัวส่งแบบ fast และแบบ SDK
 """
 
 from typing import Dict
-from linebot.v3.messaging import FlexContainer
 
 
-def create_request_info_flex() -> FlexContainer:
+def create_request_info_flex() -> Dict:
     """
     สร้าง Flex Message สำหรับขอข้อมูลชื่อและทะเบียนรถ
 
     Returns:
-        FlexContainer: Flex Message พร้อมส่งผ่าน LINE API
+        Dict: Flex container พร้อมส่งผ่าน LINE API
     """
     flex_message = {
         "type": "bubble",
@@ -124,9 +126,9 @@ def create_request_info_flex() -> FlexContainer:
         }
     }
 
-    return FlexContainer.from_dict(flex_message)
+    return flex_message
 
-def create_vehicle_selection_flex(policies: list) -> FlexContainer:
+def create_vehicle_selection_flex(policies: list) -> Dict:
     """
     สร้าง Flex Message สำหรับเลือกข้อมูลรถเมื่อพบหลายคัน
     """
@@ -250,9 +252,9 @@ def create_vehicle_selection_flex(policies: list) -> FlexContainer:
         "contents": bubbles
     }
     
-    return FlexContainer.from_dict(flex_message)
+    return flex_message
 
-def create_policy_info_flex(policy_info: Dict) -> FlexContainer:
+def create_policy_info_flex(policy_info: Dict) -> Dict:
     """
     สร้าง Flex Message แสดงข้อมูลกรมธรรม์
 
@@ -267,7 +269,7 @@ def create_policy_info_flex(policy_info: Dict) -> FlexContainer:
             - insurance_type: ประเภทประกัน
 
     Returns:
-        FlexContainer: Flex Message พร้อมส่งผ่าน LINE API
+        Dict: Flex container พร้อมส่งผ่าน LINE API
     """
     # รวมชื่อ-นามสกุล (ไม่รวมคำนำหน้า)
     full_name = f"{policy_info['first_name'].strip()} {policy_info['last_name']}"
@@ -410,10 +412,10 @@ def create_policy_info_flex(policy_info: Dict) -> FlexContainer:
         }
     }
 
-    return FlexContainer.from_dict(flex_message)
+    return flex_message
 
 
-def create_error_flex(error_message: str) -> FlexContainer:
+def create_error_flex(error_message: str) -> Dict:
     """
     สร้าง Flex Message สำหรับแสดง Error
 
@@ -421,7 +423,7 @@ def create_error_flex(error_message: str) -> FlexContainer:
         error_message: ข้อความ error ที่ต้องการแสดง
 
     Returns:
-        FlexContainer: Flex Message พร้อมส่งผ่าน LINE API
+        Dict: Flex container พร้อมส่งผ่าน LINE API
     """
     flex_message = {
         "type": "bubble",
@@ -470,15 +472,15 @@ def create_error_flex(error_message: str) -> FlexContainer:
         }
     }
 
-    return FlexContainer.from_dict(flex_message)
+    return flex_message
 
 
-def create_welcome_flex() -> FlexContainer:
+def create_welcome_flex() -> Dict:
     """
     สร้าง Flex Message สำหรับต้อนรับ
 
     Returns:
-        FlexContainer: Flex Message พร้อมส่งผ่าน LINE API
+        Dict: Flex container พร้อมส่งผ่าน LINE API
     """
     flex_message = {
         "type": "bubble",
@@ -562,7 +564,7 @@ def create_welcome_flex() -> FlexContainer:
         }
     }
 
-    return FlexContainer.from_dict(flex_message)
+    return flex_message
 
 
 def create_analysis_result_flex(
@@ -570,7 +572,7 @@ def create_analysis_result_flex(
     phone_number: str = None,
     insurance_company: str = "",
     claim_status: str = "unknown"
-) -> FlexContainer:
+) -> Dict:
     """
     สร้าง Flex Message แสดงผลการวิเคราะห์พร้อมปุ่มโทรออก
 
@@ -581,7 +583,7 @@ def create_analysis_result_flex(
         claim_status: สถานะการเคลม (approved/rejected/conditional/unknown)
 
     Returns:
-        FlexContainer: Flex Message พร้อมส่งผ่าน LINE API
+        Dict: Flex container พร้อมส่งผ่าน LINE API
     """
     # กำหนดสีปุ่มตามสถานะ
     button_colors = {
@@ -661,10 +663,10 @@ def create_analysis_result_flex(
         }
     }
 
-    return FlexContainer.from_dict(flex_message)
+    return flex_message
 
 
-def create_input_method_flex() -> FlexContainer:
+def create_input_method_flex() -> Dict:
     """
     สร้าง Flex Message สำหรับให้ผู้ใช้เลือกวิธีการค้นหาข้อมูลกรมธรรม์
 
@@ -675,7 +677,7 @@ def create_input_method_flex() -> FlexContainer:
     4. พิมพ์เลขทะเบียนรถ
 
     Returns:
-        FlexContainer: Flex Message พร้อมส่งผ่าน LINE API
+        Dict: Flex container พร้อมส่งผ่าน LINE API
     """
     flex_message = {
         "type": "bubble",
@@ -769,19 +771,20 @@ def create_input_method_flex() -> FlexContainer:
         }
     }
 
-    return FlexContainer.from_dict(flex_message)
+    return flex_message
 
 
-def create_vehicle_selection_flex(policies: list) -> FlexContainer:
+def create_vehicle_selection_flex(policies: list, approximate: bool = False) -> Dict:
     """
     สร้าง Flex Message แสดงรายการรถหลายคันให้ผู้ใช้เลือก
     (ใช้เมื่อค้นหาด้วยชื่อหรือบัตรประชาชนแล้วพบหลายกรมธรรม์)
 
     Args:
         policies: List ของ Dict ข้อมูลกรมธรรม์ที่พบ
+        approximate: ผลมาจากทะเบียนหรือชื่อที่ไม่ตรงตัว (ให้ผู้ใช้ยืนยันแม้พบคันเดียว)
 
     Returns:
-        FlexContainer: Flex Message พร้อมส่งผ่าน LINE API
+        Dict: Flex container พร้อมส่งผ่าน LINE API
     """
     vehicle_buttons = []
 
@@ -815,14 +818,15 @@ def create_vehicle_selection_flex(policies: list) -> FlexContainer:
             "contents": [
                 {
                     "type": "text",
-                    "text": "🚗 พบรถหลายคัน",
+                    "text": "🚗 ยืนยันทะเบียนรถ" if approximate else "🚗 พบรถหลายคัน",
                     "weight": "bold",
                     "size": "xl",
                     "color": "#FFFFFF"
                 },
                 {
                     "type": "text",
-                    "text": f"พบ {len(policies)} รายการ กรุณาเลือกรถของท่าน",
+                    "text": (f"ไม่พบข้อมูลที่ตรงทุกตัว พบใกล้เคียง {len(policies)} รายการ กรุณาเลือกรถของท่าน"
+                             if approximate else f"พบ {len(policies)} รายการ กรุณาเลือกรถของท่าน"),
                     "size": "sm",
                     "color": "#DDEEFF",
                     "margin": "sm"
@@ -855,10 +859,10 @@ def create_vehicle_selection_flex(policies: list) -> FlexContainer:
         }
     }
 
-    return FlexContainer.from_dict(flex_message)
+    return flex_message
 
 
-def create_additional_info_prompt_flex() -> FlexContainer:
+def create_additional_info_prompt_flex() -> Dict:
     """
     สร้าง Flex Message สำหรับขอข้อมูลเพิ่มเติม (Optional)
     """
@@ -912,5 +916,5 @@ def create_additional_info_prompt_flex() -> FlexContainer:
             "paddingAll": "10px"
         }
     }
-    return FlexContainer.from_dict(flex_message)
+    return flex_message
 
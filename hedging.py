@@ -0,0 +1,142 @@
+"""
+Hedged request: ลด tail latency ของ Gemini โดยยิง request ซ้ำเมื่อครั้งแรกช้าผิดปกติ
+
+ถ้า request แรกยังไม่ตอบภายใน percentile ที่กำหนดของ latency ล่าสุด (เช่น p95) จะยิง request
+ที่สองด้วย input เดิม แล้วใช้คำตอบที่มาก่อน อีกตัวถูกยกเลิก (ถ้ายังไม่เริ่ม) หรือปล่อยให้จบแล้วทิ้งผล
+
+ค่าใช้จ่ายถูกคุมด้วย max_rate: สัดส่วน request ที่ถูก hedge ใน window ล่าสุดต้องไม่เกินค่านี้
+(เช่น 0.1 = ยิงเพิ่มไม่เกิน 10%) และนับ token ของคำตอบที่ถูกทิ้งไว้ใน stats()
+ผู้เรียกส่ง on_discard ให้ call เพื่อบันทึกคำตอบที่ถูกทิ้งลงที่นับค่าใช้จ่ายของตัวเองได้ (เช่น usage_meter)
+"""
+
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from typing import Any, Callable, Deque, Dict, Optional
+
+
+def _percentile(values, pct: float) -> float:
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, int(round(pct / 100 * len(ordered))) - 1))
+    return ordered[index]
+
+
+def _response_tokens(response) -> int:
+    usage = getattr(response, "usage_metadata", None)
+    if isinstance(usage, dict):
+        return int(usage.get("total_token_count", 0) or 0)
+    return int(getattr(usage, "total_token_count", 0) or 0)
+
+
+class Hedger:
+    """
+    ยิง request ซ้ำเมื่อ request แรกช้ากว่า percentile ของ latency ล่าสุด (ต่อประเภทงาน)
+
+    ยังไม่ hedge จนกว่าจะมี latency ครบ min_samples (ยังไม่รู้ว่าช้าแค่ไหนถึงผิดปกติ)
+    """
+
+    def __init__(self, name: str, percentile: float = 95.0, max_rate: float = 0.1, min_delay_s: float = 1.0,
+                 window: int = 200, min_samples: int = 20, max_workers: int = 32):
+        self.name = name
+        self.percentile = percentile
+        self.max_rate = max_rate
+        self.min_delay_s = min_delay_s
+        self.min_samples = min_samples
+        self._latencies: Deque[float] = deque(maxlen=window)
+        # True = request นั้นถูก hedge (ใช้คุม max_rate)
+        self._hedged: Deque[bool] = deque(maxlen=window)
+        self._stats = {"requests": 0, "hedged": 0, "hedge_wins": 0, "wasted_tokens": 0}
+        self._lock = threading.Lock()
+        self._pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=f"hedge-{name}")
+
+    def hedge_delay(self) -> Optional[float]:
+        """
+        เวลาที่รอก่อนยิง request ที่สอง (None = ยังไม่มีข้อมูลพอ)
+        """
+        with self._lock:
+            if len(self._latencies) < self.min_samples:
+                return None
+            return max(self.min_delay_s, _percentile(self._latencies, self.percentile))
+
+    def _take_budget(self) -> bool:
+        with self._lock:
+            if (sum(self._hedged) + 1) / (len(self._hedged) + 1) > self.max_rate:
+                return False
+            self._stats["hedged"] += 1
+            return True
+
+    def _record_hedged(self, hedged: bool):
+        with self._lock:
+            self._hedged.append(hedged)
+
+    def _attempt(self, fn: Callable, *args, **kwargs):
+        started = time.monotonic()
+        result = fn(*args, **kwargs)
+        with self._lock:
+            self._latencies.append(time.monotonic() - started)
+        return result
+
+    def call(self, fn: Callable, *args, on_discard: Optional[Callable[[Any], None]] = None, **kwargs):
+        """
+        เรียก fn และ hedge ถ้าช้าเกิน คืนผลของ attempt ที่สำเร็จก่อน
+        on_discard(response) ถูกเรียก (จาก thread ของ attempt) เมื่อ attempt ที่แพ้ตอบกลับมาแล้วถูกทิ้ง
+        """
+        with self._lock:
+            self._stats["requests"] += 1
+        delay = self.hedge_delay()
+        if delay is None:
+            self._record_hedged(False)
+            return self._attempt(fn, *args, **kwargs)
+
+        primary = self._pool.submit(self._attempt, fn, *args, **kwargs)
+        done, _ = wait([primary], timeout=delay)
+        if done or not self._take_budget():
+            self._record_hedged(False)
+            return primary.result()
+        self._record_hedged(True)
+
+        print(f"🏇 hedge {self.name}: request แรกเกิน {delay:.1f}s ยิงซ้ำ")
+        hedge = self._pool.submit(self._attempt, fn, *args, **kwargs)
+        pending = {primary, hedge}
+        first_error: Optional[BaseException] = None
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is not None:
+                    first_error = first_error or future.exception()
+                    continue
+                for loser in pending:
+                    self._discard(loser, on_discard)
+                if future is hedge:
+                    with self._lock:
+                        self._stats["hedge_wins"] += 1
+                return future.result()
+        raise first_error
+
+    def _discard(self, future: Future, on_discard: Optional[Callable[[Any], None]] = None):
+        # ยกเลิกได้เฉพาะ attempt ที่ยังไม่เริ่ม ตัวที่กำลังรันปล่อยให้จบแล้วนับ token ที่เสียไป
+        if future.cancel():
+            return
+
+        def account(done_future: Future):
+            if done_future.cancelled() or done_future.exception() is not None:
+                return
+            response = done_future.result()
+            with self._lock:
+                self._stats["wasted_tokens"] += _response_tokens(response)
+            if on_discard is not None:
+                try:
+                    on_discard(response)
+                except Exception as e:
+                    print(f"⚠️ hedge {self.name}: บันทึกค่าใช้จ่ายของคำตอบที่ถูกทิ้งไม่สำเร็จ: {e}")
+
+        future.add_done_callback(account)
+
+    def stats(self) -> Dict:
+        delay = self.hedge_delay()
+        with self._lock:
+            stats = dict(self._stats)
+        stats["hedge_rate"] = round(stats["hedged"] / stats["requests"], 4) if stats["requests"] else 0.0
+        stats["hedge_delay_s"] = round(delay, 3) if delay is not None else None
+        return stats
@@ -0,0 +1,313 @@
+"""
+คิวงานแบบถาวร (SQLite WAL) สำหรับงานที่เรียก Gemini: วิเคราะห์ความเสียหายและ OCR
+
+web process แค่ enqueue แล้วตอบ LINE ทันที ส่วน worker.py (แยก process/container
+scale ได้อิสระ) หยิบงานไปทำ งานจึงไม่หายเมื่อ process ใด process หนึ่ง crash หรือ deploy ใหม่
+
+- visibility timeout: งานที่ถูกหยิบจะถูกล็อก (lease) ไว้ visibility_timeout วินาที
+  worker ต้องต่อ lease ระหว่างทำ ถ้า worker ตาย lease หมดอายุแล้ว worker อื่นหยิบต่อได้
+- retry: งานที่ล้มเหลวกลับเข้าคิวโดยรอนานขึ้นแบบ exponential (retry_delay * 2^(ครั้งที่-1))
+- dead letter: ล้มเหลวครบ max_attempts (หรือ error ที่ลองใหม่ไม่ช่วย) จะถูกย้ายเป็นสถานะ dead
+- ลำดับต่อ key (user_id): งานของ key เดียวกันจะไม่ถูกหยิบจนกว่างานก่อนหน้าจะจบ
+- ผลลัพธ์: งานที่ต้องส่งผลกลับ web (เช่น OCR ที่ต้องอัปเดต session) เก็บใน result
+  ให้ web ดึงด้วย results() แล้ว ack_result() หลังนำไปใช้
+
+สถานะ: ready -> running -> done | ready (retry) | dead
+
+จัดการคิวจาก command line (เช่น docker-compose exec worker python job_queue.py dead):
+    python job_queue.py stats
+    python job_queue.py dead --limit 20
+    python job_queue.py requeue 12 15
+    python job_queue.py purge --older-than-h 168
+"""
+
+import argparse
+import json
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, Iterable, List, Optional
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    kind TEXT NOT NULL,
+    key TEXT NOT NULL,
+    payload TEXT NOT NULL,
+    status TEXT NOT NULL DEFAULT 'ready',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    available_at REAL NOT NULL,
+    lease_until REAL,
+    worker TEXT,
+    result TEXT,
+    result_acked INTEGER NOT NULL DEFAULT 0,
+    last_error TEXT,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, available_at);
+CREATE INDEX IF NOT EXISTS jobs_key ON jobs (key, status);
+"""
+
+
+def _row_to_job(row: sqlite3.Row) -> Dict:
+    job = dict(row)
+    job["payload"] = json.loads(job["payload"])
+    if job["result"] is not None:
+        job["result"] = json.loads(job["result"])
+    return job
+
+
+class JobQueue:
+    """
+    คิวงานบนไฟล์ SQLite ไฟล์เดียว ใช้ร่วมกันได้หลาย process บนเครื่องเดียวกัน (WAL)
+    """
+
+    def __init__(self, path: str, visibility_timeout: float = 120.0, max_attempts: int = 3,
+                 retry_delay: float = 5.0):
+        self.path = path
+        self.visibility_timeout = visibility_timeout
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        # sqlite3 connection ใช้ข้าม thread ไม่ได้ จึงเปิดแยกต่อ thread
+        self._local = threading.local()
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._connection().executescript(_SCHEMA)
+
+    def _connection(self) -> sqlite3.Connection:
+        db = getattr(self._local, "db", None)
+        if db is None:
+            db = sqlite3.connect(self.path, timeout=30.0, isolation_level=None)
+            db.row_factory = sqlite3.Row
+            db.execute("PRAGMA journal_mode=WAL")
+            # WAL + NORMAL: commit ไม่ fsync ทุกครั้ง แต่ไฟล์ไม่เสียแม้ process crash
+            db.execute("PRAGMA synchronous=NORMAL")
+            self._local.db = db
+        return db
+
+    @contextmanager
+    def _transaction(self):
+        # BEGIN IMMEDIATE ล็อกการเขียนตั้งแต่ต้น worker สองตัวจึงหยิบงานเดียวกันไม่ได้
+        db = self._connection()
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            yield db
+        except BaseException:
+            db.execute("ROLLBACK")
+            raise
+        db.execute("COMMIT")
+
+    # ---------- ฝั่ง web ----------
+    def enqueue(self, kind: str, payload: Dict, key: str) -> int:
+        """
+        เพิ่มงานเข้าคิว คืน id ของงาน
+        """
+        now = time.time()
+        with self._transaction() as db:
+            cursor = db.execute(
+                "INSERT INTO jobs (kind, key, payload, available_at, created_at, updated_at) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (kind, key, json.dumps(payload, ensure_ascii=False), now, now, now),
+            )
+            return cursor.lastrowid
+
+    def results(self, kinds: Iterable[str], limit: int = 50) -> List[Dict]:
+        """
+        งานที่เสร็จแล้วและมีผลลัพธ์ที่ยังไม่ถูกนำไปใช้ (เรียงตาม id)
+        """
+        kinds = list(kinds)
+        placeholders = ", ".join("?" for _ in kinds)
+        rows = self._connection().execute(
+            f"SELECT * FROM jobs WHERE status = 'done' AND result IS NOT NULL AND result_acked = 0 "
+            f"AND kind IN ({placeholders}) ORDER BY id LIMIT ?",
+            (*kinds, limit),
+        ).fetchall()
+        return [_row_to_job(row) for row in rows]
+
+    def ack_result(self, job_id: int):
+        with self._transaction() as db:
+            db.execute("UPDATE jobs SET result_acked = 1, updated_at = ? WHERE id = ?", (time.time(), job_id))
+
+    # ---------- ฝั่ง worker ----------
+    def claim(self, worker: str, kinds: Optional[Iterable[str]] = None) -> Optional[Dict]:
+        """
+        หยิบงานถัดไปที่พร้อมทำ (รวมงานที่ lease หมดอายุเพราะ worker เดิมตาย) คืน None ถ้าไม่มี
+        """
+        kinds = list(kinds) if kinds else None
+        kind_filter = f"AND j.kind IN ({', '.join('?' for _ in kinds)})" if kinds else ""
+        while True:
+            now = time.time()
+            with self._transaction() as db:
+                row = db.execute(
+                    f"""
+                    SELECT * FROM jobs j
+                    WHERE ((j.status = 'ready' AND j.available_at <= ?)
+                           OR (j.status = 'running' AND j.lease_until <= ?))
+                      {kind_filter}
+                      AND NOT EXISTS (
+                          SELECT 1 FROM jobs o
+                          WHERE o.key = j.key AND o.id < j.id AND o.status IN ('ready', 'running')
+                      )
+                    ORDER BY j.id LIMIT 1
+                    """,
+                    (now, now, *(kinds or ())),
+                ).fetchone()
+                if row is None:
+                    return None
+
+                if row["status"] == "running" and row["attempts"] >= self.max_attempts:
+                    # worker ตายระหว่างทำครบทุกครั้งที่ลอง ไม่หยิบซ้ำอีก
+                    db.execute(
+                        "UPDATE jobs SET status = 'dead', lease_until = NULL, last_error = ?, updated_at = ? "
+                        "WHERE id = ?",
+                        (f"visibility timeout หมดอายุ (worker {row['worker']})", now, row["id"]),
+                    )
+                    print(f"☠️ งาน {row['id']} ({row['kind']}) ย้ายไป dead letter: worker หยุดตอบครบ {row['attempts']} ครั้ง")
+                    continue
+
+                db.execute(
+                    "UPDATE jobs SET status = 'running', attempts = attempts + 1, lease_until = ?, worker = ?, "
+                    "updated_at = ? WHERE id = ?",
+                    (now + self.visibility_timeout, worker, now, row["id"]),
+                )
+                job = _row_to_job(row)
+                job.update(status="running", attempts=row["attempts"] + 1, worker=worker)
+                return job
+
+    def extend_lease(self, job_id: int, worker: str) -> bool:
+        """
+        ต่อ lease ของงานที่กำลังทำ คืน False ถ้างานไม่ได้เป็นของ worker นี้แล้ว
+        """
+        now = time.time()
+        with self._transaction() as db:
+            cursor = db.execute(
+                "UPDATE jobs SET lease_until = ?, updated_at = ? WHERE id = ? AND status = 'running' AND worker = ?",
+                (now + self.visibility_timeout, now, job_id, worker),
+            )
+            return cursor.rowcount == 1
+
+    def complete(self, job_id: int, worker: str, result: Optional[Dict] = None) -> bool:
+        with self._transaction() as db:
+            cursor = db.execute(
+                "UPDATE jobs SET status = 'done', lease_until = NULL, result = ?, updated_at = ? "
+                "WHERE id = ? AND status = 'running' AND worker = ?",
+                (json.dumps(result, ensure_ascii=False) if result is not None else None, time.time(),
+                 job_id, worker),
+            )
+            return cursor.rowcount == 1
+
+    def fail(self, job_id: int, worker: str, error: str, retryable: bool = True) -> str:
+        """
+        บันทึกว่างานล้มเหลว คืนสถานะใหม่: "ready" (จะลองใหม่), "dead" หรือ "lost" (lease ถูกหยิบไปแล้ว)
+        """
+        now = time.time()
+        with self._transaction() as db:
+            row = db.execute(
+                "SELECT attempts FROM jobs WHERE id = ? AND status = 'running' AND worker = ?",
+                (job_id, worker),
+            ).fetchone()
+            if row is None:
+                return "lost"
+            if not retryable or row["attempts"] >= self.max_attempts:
+                status, available_at = "dead", now
+            else:
+                status, available_at = "ready", now + self.retry_delay * 2 ** (row["attempts"] - 1)
+            db.execute(
+                "UPDATE jobs SET status = ?, available_at = ?, lease_until = NULL, last_error = ?, updated_at = ? "
+                "WHERE id = ?",
+                (status, available_at, error[:1000], now, job_id),
+            )
+            return status
+
+    # ---------- ดูแลคิว ----------
+    def dead_letters(self, limit: int = 50) -> List[Dict]:
+        rows = self._connection().execute(
+            "SELECT * FROM jobs WHERE status = 'dead' ORDER BY id DESC LIMIT ?", (limit,)
+        ).fetchall()
+        return [_row_to_job(row) for row in rows]
+
+    def requeue(self, job_id: int) -> bool:
+        """
+        นำงานจาก dead letter กลับเข้าคิว (นับจำนวนครั้งใหม่)
+        """
+        now = time.time()
+        with self._transaction() as db:
+            cursor = db.execute(
+                "UPDATE jobs SET status = 'ready', attempts = 0, available_at = ?, worker = NULL, updated_at = ? "
+                "WHERE id = ? AND status = 'dead'",
+                (now, now, job_id),
+            )
+            return cursor.rowcount == 1
+
+    def purge(self, older_than_s: float = 7 * 24 * 3600) -> int:
+        """
+        ลบงานที่จบแล้ว (done ที่ไม่มีผลค้างส่ง และ dead) ที่เก่ากว่า older_than_s วินาที
+        """
+        cutoff = time.time() - older_than_s
+        with self._transaction() as db:
+            cursor = db.execute(
+                "DELETE FROM jobs WHERE updated_at < ? AND "
+                "(status = 'dead' OR (status = 'done' AND (result IS NULL OR result_acked = 1)))",
+                (cutoff,),
+            )
+            return cursor.rowcount
+
+    def stats(self) -> Dict[str, int]:
+        counts = {status: 0 for status in ("ready", "running", "done", "dead")}
+        for row in self._connection().execute("SELECT status, COUNT(*) AS n FROM jobs GROUP BY status"):
+            counts[row["status"]] = row["n"]
+        return counts
+
+    def close(self):
+        db = getattr(self._local, "db", None)
+        if db is not None:
+            db.close()
+            self._local.db = None
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="ดู/จัดการงานใน job queue (dead letter, ลบงานเก่า)")
+    parser.add_argument("--path", default=os.getenv("JOB_QUEUE_PATH"), help="ไฟล์คิว (ค่าเริ่มต้นจาก JOB_QUEUE_PATH)")
+    commands = parser.add_subparsers(dest="command", required=True)
+    commands.add_parser("stats", help="จำนวนงานแยกตามสถานะ")
+    dead = commands.add_parser("dead", help="งานที่เข้า dead letter ล่าสุด")
+    dead.add_argument("--limit", type=int, default=50)
+    requeue = commands.add_parser("requeue", help="นำงานจาก dead letter กลับเข้าคิว (ผู้ใช้ได้รับแจ้งว่าล้มเหลวไปแล้ว)")
+    requeue.add_argument("job_ids", type=int, nargs="+")
+    purge = commands.add_parser("purge", help="ลบงานที่จบแล้วที่เก่ากว่าที่กำหนด")
+    purge.add_argument("--older-than-h", type=float, default=7 * 24)
+    args = parser.parse_args(argv)
+
+    if not args.path:
+        parser.error("กรุณาระบุ --path หรือตั้ง JOB_QUEUE_PATH")
+    if not os.path.exists(args.path):
+        parser.error(f"ไม่พบไฟล์คิว {args.path}")
+    queue = JobQueue(args.path)
+
+    if args.command == "stats":
+        print(json.dumps(queue.stats(), ensure_ascii=False))
+    elif args.command == "dead":
+        jobs = queue.dead_letters(args.limit)
+        for job in jobs:
+            updated = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(job["updated_at"]))
+            print(f"#{job['id']} {job['kind']} key={job['key']} attempts={job['attempts']} {updated} "
+                  f"error={job['last_error']}")
+        print(f"💀 dead letter {len(jobs)} รายการ")
+    elif args.command == "requeue":
+        failed = [job_id for job_id in args.job_ids if not queue.requeue(job_id)]
+        print(f"🔁 นำกลับเข้าคิว {len(args.job_ids) - len(failed)} งาน")
+        if failed:
+            print(f"⚠️ ไม่พบงาน dead: {', '.join(map(str, failed))}")
+            return 1
+    elif args.command == "purge":
+        print(f"🧹 ลบงานเก่า {queue.purge(args.older_than_h * 3600)} รายการ")
+    queue.close()
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,177 @@
+"""
+ส่งข้อความ reply/push ไปยัง LINE Messaging API
+
+ข้อความทั้งหมดในระบบเป็น dict ตามรูปแบบ JSON ของ LINE (camelCase เช่น altText, quickReply)
+มีตัวส่งสองแบบที่ใช้แทนกันได้ (method เดียวกัน: reply, push):
+- LineSender    : serialize dict เป็น JSON เอง (orjson ถ้าติดตั้งไว้) แล้ว POST ผ่าน httpx.Client แบบ pooled
+                  ไม่สร้าง pydantic model ของ SDK ทุกข้อความ (validate ด้วย model ของ SDK เฉพาะตอน validate=True)
+- SdkLineSender : แปลง dict เป็น ReplyMessageRequest/PushMessageRequest แล้วส่งผ่าน MessagingApi (แบบเดิม)
+
+ข้อความที่ไม่เปลี่ยน (เช่น ข้อความตอน upstream ล่ม) ห่อด้วย PrerenderedMessage ครั้งเดียว
+LineSender จะนำ JSON bytes ที่ render ไว้แล้วต่อเข้า body ได้ทันที
+error จาก LINE ของทั้งสองแบบเป็น LineApiError ที่มี status เหมือน ApiException ของ SDK
+"""
+
+import json
+from typing import Dict, Iterable, List, Optional, Union
+
+import httpx
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def dumps(value) -> bytes:
+    """
+    JSON bytes (UTF-8 ไม่ escape ภาษาไทย) ใช้ orjson ถ้ามี
+    """
+    if orjson is not None:
+        return orjson.dumps(value)
+    return json.dumps(value, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+class LineApiError(RuntimeError):
+    """LINE API ตอบ error (status = HTTP status code)"""
+
+    def __init__(self, status: int, body: str = ""):
+        super().__init__(f"LINE API {status}: {body[:200]}")
+        self.status = status
+        self.body = body
+
+
+class PrerenderedMessage:
+    """
+    ข้อความที่ serialize เป็น JSON ไว้ล่วงหน้า (สำหรับข้อความคงที่ที่ส่งซ้ำบ่อย)
+    """
+
+    __slots__ = ("message", "json")
+
+    def __init__(self, message: Dict):
+        self.message = message
+        self.json = dumps(message)
+
+
+Message = Union[Dict, PrerenderedMessage]
+
+
+def text_message(text: str, quick_reply: Optional[Dict] = None) -> Dict:
+    message = {"type": "text", "text": text}
+    if quick_reply is not None:
+        message["quickReply"] = quick_reply
+    return message
+
+
+def flex_message(alt_text: str, contents: Dict) -> Dict:
+    return {"type": "flex", "altText": alt_text, "contents": contents}
+
+
+def message_quick_reply(*choices) -> Dict:
+    """
+    ปุ่มตอบด่วนแบบส่งข้อความ choices = (label, text), ...
+    """
+    return {"items": [
+        {"type": "action", "action": {"type": "message", "label": label, "text": text}}
+        for label, text in choices
+    ]}
+
+
+def _as_dicts(messages: Iterable[Message]) -> List[Dict]:
+    return [m.message if isinstance(m, PrerenderedMessage) else m for m in messages]
+
+
+def _encode_request(fields: Dict, messages: Iterable[Message]) -> bytes:
+    # {"to": ..., "messages": [...]} โดยต่อ bytes ของข้อความที่ render ไว้แล้วได้ตรงๆ
+    head = b"".join(dumps(key) + b":" + dumps(value) + b"," for key, value in fields.items())
+    parts = [m.json if isinstance(m, PrerenderedMessage) else dumps(m) for m in messages]
+    return b"{" + head + b'"messages":[' + b",".join(parts) + b"]}"
+
+
+class LineSender:
+    """
+    ส่งข้อความเป็น JSON ที่ serialize เอง ผ่าน connection pool เดียวทั้ง process (thread-safe)
+
+    breaker: CircuitBreaker ของ LINE (ถ้ามี) ครอบทุก request
+    validate: ตรวจข้อความด้วย model ของ SDK ก่อนส่ง (เปิดตอน debug/ทดสอบ ช้ากว่าแต่เจอข้อความผิดรูปแบบก่อนถึง LINE)
+    """
+
+    def __init__(self, access_token: str, endpoint: str = "https://api.line.me", timeout: float = 10.0,
+                 breaker=None, validate: bool = False, max_connections: int = 32):
+        self.breaker = breaker
+        self.validate = validate
+        self._client = httpx.Client(
+            base_url=endpoint,
+            timeout=timeout,
+            headers={"Authorization": f"Bearer {access_token}", "Content-Type": "application/json"},
+            limits=httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections),
+        )
+
+    def reply(self, reply_token: str, messages: List[Message]):
+        self._post("/v2/bot/message/reply", {"replyToken": reply_token}, messages)
+
+    def push(self, to: str, messages: List[Message], retry_key: Optional[str] = None):
+        """
+        retry_key = X-Line-Retry-Key (ส่งซ้ำด้วย key เดิมได้ 409 แทนข้อความซ้ำ)
+        """
+        headers = {"X-Line-Retry-Key": retry_key} if retry_key else None
+        self._post("/v2/bot/message/push", {"to": to}, messages, headers)
+
+    def warm_up(self):
+        # เปิด connection ล่วงหน้า (status อะไรก็ได้ ขอแค่ต่อได้)
+        self._client.get("/")
+
+    def close(self):
+        self._client.close()
+
+    def _post(self, path: str, fields: Dict, messages: List[Message], headers: Optional[Dict] = None):
+        if self.validate:
+            _validate_request(fields, messages)
+        body = _encode_request(fields, messages)
+
+        def send():
+            response = self._client.post(path, content=body, headers=headers)
+            if response.status_code >= 400:
+                raise LineApiError(response.status_code, response.text)
+
+        if self.breaker is None:
+            send()
+        else:
+            self.breaker.call(send)
+
+
+def _validate_request(fields: Dict, messages: List[Message]):
+    from linebot.v3.messaging import PushMessageRequest, ReplyMessageRequest
+
+    model = ReplyMessageRequest if "replyToken" in fields else PushMessageRequest
+    model.from_dict({**fields, "messages": _as_dicts(messages)})
+
+
+class SdkLineSender:
+    """
+    ส่งข้อความ (dict) ผ่าน MessagingApi ของ line-bot-sdk
+    """
+
+    def __init__(self, line_bot_api):
+        self.line_bot_api = line_bot_api
+
+    def reply(self, reply_token: str, messages: List[Message]):
+        from linebot.v3.messaging import ReplyMessageRequest
+
+        request = ReplyMessageRequest.from_dict({"replyToken": reply_token, "messages": _as_dicts(messages)})
+        self._call(self.line_bot_api.reply_message, request)
+
+    def push(self, to: str, messages: List[Message], retry_key: Optional[str] = None):
+        from linebot.v3.messaging import PushMessageRequest
+
+        request = PushMessageRequest.from_dict({"to": to, "messages": _as_dicts(messages)})
+        self._call(self.line_bot_api.push_message, request, x_line_retry_key=retry_key)
+
+    @staticmethod
+    def _call(fn, *args, **kwargs):
+        from linebot.v3.messaging import ApiException
+
+        try:
+            fn(*args, **kwargs)
+        except ApiException as e:
+            raise LineApiError(e.status, str(e.body or e.reason or "")) from e
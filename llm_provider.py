@@ -0,0 +1,382 @@
+"""
+LLM Provider สำหรับเรียก Gemini แบบสลับโหมดได้
+ใช้ใต้ extract_info_from_image_with_gemini และ analyze_damage_with_gemini
+
+โหมด (ตั้งผ่าน LLM_PROVIDER_MODE):
+- live   : เรียก Gemini จริง (ค่าเริ่มต้น)
+- record : เรียก Gemini จริง และบันทึก request/response/latency ลงดิสก์ (cassette)
+- replay : ตอบจาก cassette โดยไม่ใช้ network (เลือกจำลอง latency เดิมได้)
+
+Request ถูกระบุด้วย SHA-256 ของข้อความ prompt, bytes ของรูปภาพ และเนื้อหาไฟล์ที่อัพโหลด
+ดังนั้น input เดิมจะได้ response เดิมเสมอในโหมด replay
+
+ทุก provider มี method แบบ async คู่กัน (generate_content_async, upload_file_async, wait_for_file_async,
+delete_file_async) สำหรับเรียกจาก event loop โดยไม่ต้องกัน thread ไว้ระหว่างรอ Gemini
+"""
+
+import asyncio
+import hashlib
+import json
+import os
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from resilience import UpstreamTimeoutError, call_with_timeout, call_with_timeout_async
+
+
+class CassetteMissError(LookupError):
+    """ไม่พบ request นี้ใน cassette (โหมด replay)"""
+
+
+class ReplayResponse:
+    """
+    Response ที่เล่นซ้ำจาก cassette (มี .text และ .usage_metadata เหมือน response ของ SDK)
+    """
+
+    def __init__(self, text: str, usage_metadata: Optional[Dict] = None):
+        self.text = text
+        self.usage_metadata = usage_metadata or {}
+
+
+class ReplayFile:
+    """
+    ไฟล์ที่ "อัพโหลด" ในโหมด replay (มี .name เหมือน File ของ SDK)
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+
+
+# ==================== Fingerprint ====================
+def _sha256_file(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _image_bytes(image) -> bytes:
+    """
+    ดึง bytes ของรูป PIL โดยใช้ข้อมูลต้นฉบับถ้ามี (เร็วกว่า decode ทั้งรูป)
+    """
+    fp = getattr(image, "fp", None)
+    if fp is not None and hasattr(fp, "getvalue"):
+        return fp.getvalue()
+    return image.tobytes()
+
+
+def fingerprint_contents(contents: List[Any], file_digests: Dict[str, str]) -> str:
+    """
+    สร้าง key ของ request generate_content จาก parts ทั้งหมด
+    """
+    digest = hashlib.sha256()
+    for part in contents:
+        if isinstance(part, str):
+            digest.update(b"text:")
+            digest.update(part.encode("utf-8"))
+        elif isinstance(part, (bytes, bytearray)):
+            digest.update(b"bytes:")
+            digest.update(part)
+        elif hasattr(part, "tobytes") and hasattr(part, "mode"):
+            digest.update(b"image:")
+            digest.update(_image_bytes(part))
+        else:
+            name = getattr(part, "name", repr(part))
+            digest.update(b"file:")
+            digest.update(file_digests.get(name, name).encode("utf-8"))
+        digest.update(b"\x00")
+    return digest.hexdigest()
+
+
+def usage_to_dict(usage) -> Dict[str, int]:
+    """
+    แปลง usage_metadata (proto ของ SDK หรือ dict) เป็น dict ธรรมดา
+    """
+    if not usage:
+        return {}
+    if isinstance(usage, dict):
+        return dict(usage)
+    fields = ("prompt_token_count", "cached_content_token_count", "candidates_token_count", "total_token_count")
+    return {field: int(getattr(usage, field, 0) or 0) for field in fields}
+
+
+# ==================== Cassette ====================
+class Cassette:
+    """
+    ที่เก็บ interaction บนดิสก์: 1 ไฟล์ JSON ต่อ key, แต่ละไฟล์เก็บ entries ตามลำดับที่บันทึก
+    """
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, f"{key}.json")
+
+    def load(self, key: str) -> List[Dict]:
+        try:
+            with open(self._path(key), encoding="utf-8") as f:
+                return json.load(f)["entries"]
+        except FileNotFoundError:
+            return []
+
+    def append(self, key: str, entry: Dict):
+        with self._lock:
+            entries = self.load(key)
+            entries.append(entry)
+            temp_path = self._path(key) + ".tmp"
+            with open(temp_path, "w", encoding="utf-8") as f:
+                json.dump({"entries": entries}, f, ensure_ascii=False, indent=2)
+            os.replace(temp_path, self._path(key))
+
+
+# ==================== Providers ====================
+class GeminiProvider:
+    """
+    เรียก Gemini จริงผ่าน GenerativeModel และ File API ของ SDK
+
+    request_timeout = เวลาสูงสุดของ generate_content (ส่งให้ SDK ผ่าน request_options)
+    file_timeout = เวลาสูงสุดของ upload/get/delete ไฟล์ (SDK ไม่มี timeout ของตัวเอง)
+    file_poll_interval, file_ready_timeout = ถามสถานะไฟล์ที่อัพโหลดทุกกี่วินาที และรอให้ ACTIVE นานสุดเท่าไร
+    """
+
+    mode = "live"
+
+    def __init__(self, model, files_api, file_poll_interval: float = 0.5, file_ready_timeout: float = 60.0,
+                 request_timeout: Optional[float] = None, file_timeout: Optional[float] = None):
+        self.model = model
+        self.files_api = files_api
+        self.file_poll_interval = file_poll_interval
+        self.file_ready_timeout = file_ready_timeout
+        self.request_timeout = request_timeout
+        self.file_timeout = file_timeout
+
+    def _request_options(self) -> Dict:
+        if self.request_timeout is None:
+            return {}
+        return {"request_options": {"timeout": self.request_timeout}}
+
+    def _file_ready(self, file, deadline: float) -> bool:
+        # ไฟล์ที่ไม่มี state (เช่น SDK รุ่นเก่า) ถือว่าพร้อมใช้
+        state = getattr(file, "state", None)
+        state = getattr(state, "name", state)
+        if state in (None, "ACTIVE"):
+            return True
+        if state == "FAILED":
+            raise RuntimeError(f"Gemini ประมวลผลไฟล์ {file.name} ไม่สำเร็จ")
+        if time.monotonic() > deadline:
+            raise UpstreamTimeoutError(f"ไฟล์ {file.name} ยังไม่พร้อมใช้ภายใน {self.file_ready_timeout:g} วินาที")
+        return False
+
+    def generate_content(self, contents: List[Any]):
+        return self.model.generate_content(contents, **self._request_options())
+
+    def upload_file(self, path: str, mime_type: str):
+        return call_with_timeout(self.files_api.upload_file, self.file_timeout, path, mime_type=mime_type)
+
+    def wait_for_file(self, uploaded_file):
+        # ถามสถานะจนกว่า Gemini จะประมวลผลไฟล์เสร็จ (ไฟล์ที่พร้อมแล้วไม่ต้องรอ)
+        deadline = time.monotonic() + self.file_ready_timeout
+        current = uploaded_file
+        while not self._file_ready(current, deadline):
+            time.sleep(self.file_poll_interval)
+            current = call_with_timeout(self.files_api.get_file, self.file_timeout, uploaded_file.name)
+
+    def delete_file(self, name: str):
+        call_with_timeout(self.files_api.delete_file, self.file_timeout, name)
+
+    async def generate_content_async(self, contents: List[Any]):
+        return await self.model.generate_content_async(contents, **self._request_options())
+
+    async def upload_file_async(self, path: str, mime_type: str):
+        # File API ของ SDK ไม่มีแบบ async จึงเรียกใน thread เฉพาะช่วงอัพโหลด
+        return await call_with_timeout_async(self.files_api.upload_file, self.file_timeout, path, mime_type=mime_type)
+
+    async def wait_for_file_async(self, uploaded_file):
+        deadline = time.monotonic() + self.file_ready_timeout
+        current = uploaded_file
+        while not self._file_ready(current, deadline):
+            await asyncio.sleep(self.file_poll_interval)
+            current = await call_with_timeout_async(self.files_api.get_file, self.file_timeout, uploaded_file.name)
+
+    async def delete_file_async(self, name: str):
+        await call_with_timeout_async(self.files_api.delete_file, self.file_timeout, name)
+
+
+class RecordingProvider:
+    """
+    ส่งต่อทุก call ไปยัง provider จริง แล้วบันทึกผลและ latency ลง cassette
+    """
+
+    mode = "record"
+
+    def __init__(self, inner: GeminiProvider, cassette: Cassette):
+        self.inner = inner
+        self.cassette = cassette
+        self._file_digests: Dict[str, str] = {}
+
+    def generate_content(self, contents: List[Any]):
+        key = "generate-" + fingerprint_contents(contents, self._file_digests)
+        started = time.perf_counter()
+        response = self.inner.generate_content(contents)
+        self.cassette.append(key, {
+            "text": response.text,
+            "usage_metadata": usage_to_dict(getattr(response, "usage_metadata", None)),
+            "latency_s": time.perf_counter() - started,
+        })
+        return response
+
+    def upload_file(self, path: str, mime_type: str):
+        digest = _sha256_file(path)
+        started = time.perf_counter()
+        uploaded = self.inner.upload_file(path, mime_type)
+        self.cassette.append(f"upload-{digest}", {"latency_s": time.perf_counter() - started})
+        self._file_digests[uploaded.name] = digest
+        return uploaded
+
+    def wait_for_file(self, uploaded_file):
+        started = time.perf_counter()
+        self.inner.wait_for_file(uploaded_file)
+        digest = self._file_digests.get(uploaded_file.name, uploaded_file.name)
+        self.cassette.append(f"wait-{digest}", {"latency_s": time.perf_counter() - started})
+
+    def delete_file(self, name: str):
+        self.inner.delete_file(name)
+        self._file_digests.pop(name, None)
+
+    async def generate_content_async(self, contents: List[Any]):
+        key = "generate-" + fingerprint_contents(contents, self._file_digests)
+        started = time.perf_counter()
+        response = await self.inner.generate_content_async(contents)
+        self.cassette.append(key, {
+            "text": response.text,
+            "usage_metadata": usage_to_dict(getattr(response, "usage_metadata", None)),
+            "latency_s": time.perf_counter() - started,
+        })
+        return response
+
+    async def upload_file_async(self, path: str, mime_type: str):
+        digest = _sha256_file(path)
+        started = time.perf_counter()
+        uploaded = await self.inner.upload_file_async(path, mime_type)
+        self.cassette.append(f"upload-{digest}", {"latency_s": time.perf_counter() - started})
+        self._file_digests[uploaded.name] = digest
+        return uploaded
+
+    async def wait_for_file_async(self, uploaded_file):
+        started = time.perf_counter()
+        await self.inner.wait_for_file_async(uploaded_file)
+        digest = self._file_digests.get(uploaded_file.name, uploaded_file.name)
+        self.cassette.append(f"wait-{digest}", {"latency_s": time.perf_counter() - started})
+
+    async def delete_file_async(self, name: str):
+        await self.inner.delete_file_async(name)
+        self._file_digests.pop(name, None)
+
+
+class ReplayProvider:
+    """
+    ตอบจาก cassette โดยไม่ใช้ network
+    ถ้า preserve_latency=True จะหน่วงเวลาตาม latency ที่บันทึกไว้ (คูณด้วย latency_scale)
+    """
+
+    mode = "replay"
+
+    def __init__(self, cassette: Cassette, preserve_latency: bool = False, latency_scale: float = 1.0):
+        self.cassette = cassette
+        self.preserve_latency = preserve_latency
+        self.latency_scale = latency_scale
+        self._file_digests: Dict[str, str] = {}
+        self._cursors: Dict[str, int] = {}
+        self._lock = threading.Lock()
+
+    def _next_entry(self, key: str) -> Optional[Dict]:
+        """
+        คืน entry ถัดไปของ key (วนซ้ำเมื่อเล่นครบ) เพื่อให้ request เดิมหลายครั้งได้ลำดับเดิม
+        """
+        entries = self.cassette.load(key)
+        if not entries:
+            return None
+        with self._lock:
+            index = self._cursors.get(key, 0)
+            self._cursors[key] = index + 1
+        return entries[index % len(entries)]
+
+    def _delay_s(self, entry: Optional[Dict]) -> float:
+        if self.preserve_latency and entry:
+            return entry.get("latency_s", 0.0) * self.latency_scale
+        return 0.0
+
+    def _generate_entry(self, contents: List[Any]) -> Dict:
+        key = "generate-" + fingerprint_contents(contents, self._file_digests)
+        entry = self._next_entry(key)
+        if entry is None:
+            raise CassetteMissError(f"ไม่พบ request ใน cassette: {key}")
+        return entry
+
+    def _replay_upload(self, path: str) -> Tuple[ReplayFile, Optional[Dict]]:
+        digest = _sha256_file(path)
+        entry = self._next_entry(f"upload-{digest}")
+        uploaded = ReplayFile(f"files/replay-{digest[:16]}")
+        self._file_digests[uploaded.name] = digest
+        return uploaded, entry
+
+    def _wait_entry(self, uploaded_file) -> Optional[Dict]:
+        digest = self._file_digests.get(uploaded_file.name, uploaded_file.name)
+        return self._next_entry(f"wait-{digest}")
+
+    def generate_content(self, contents: List[Any]):
+        entry = self._generate_entry(contents)
+        time.sleep(self._delay_s(entry))
+        return ReplayResponse(entry["text"], entry.get("usage_metadata"))
+
+    def upload_file(self, path: str, mime_type: str):
+        uploaded, entry = self._replay_upload(path)
+        time.sleep(self._delay_s(entry))
+        return uploaded
+
+    def wait_for_file(self, uploaded_file):
+        time.sleep(self._delay_s(self._wait_entry(uploaded_file)))
+
+    def delete_file(self, name: str):
+        pass
+
+    async def generate_content_async(self, contents: List[Any]):
+        entry = self._generate_entry(contents)
+        await asyncio.sleep(self._delay_s(entry))
+        return ReplayResponse(entry["text"], entry.get("usage_metadata"))
+
+    async def upload_file_async(self, path: str, mime_type: str):
+        uploaded, entry = self._replay_upload(path)
+        await asyncio.sleep(self._delay_s(entry))
+        return uploaded
+
+    async def wait_for_file_async(self, uploaded_file):
+        await asyncio.sleep(self._delay_s(self._wait_entry(uploaded_file)))
+
+    async def delete_file_async(self, name: str):
+        pass
+
+
+def create_llm_provider(live_factory: Callable[[], GeminiProvider], mode: Optional[str] = None):
+    """
+    สร้าง provider ตาม LLM_PROVIDER_MODE / LLM_CASSETTE_DIR / LLM_REPLAY_PRESERVE_LATENCY
+
+    live_factory ถูกเรียกเฉพาะโหมดที่ต้องเรียก Gemini จริง (replay ไม่ต้อง import SDK)
+    """
+    mode = (mode or os.getenv("LLM_PROVIDER_MODE", "live")).lower()
+    if mode == "live":
+        return live_factory()
+
+    cassette = Cassette(os.getenv("LLM_CASSETTE_DIR", "cassettes"))
+    if mode == "record":
+        return RecordingProvider(live_factory(), cassette)
+    if mode == "replay":
+        preserve = os.getenv("LLM_REPLAY_PRESERVE_LATENCY", "false").lower() in ("1", "true", "yes")
+        scale = float(os.getenv("LLM_REPLAY_LATENCY_SCALE", "1.0"))
+        return ReplayProvider(cassette, preserve_latency=preserve, latency_scale=scale)
+
+    raise ValueError(f"LLM_PROVIDER_MODE ไม่ถูกต้อง: {mode} (ใช้ live, record หรือ replay)")
@@ -3,43 +3,70 @@ LINE Bot สำหรับวิเคราะห์การเคลมป
 ใช้ FastAPI + LINE Messaging API + Google Gemini AI
 """
 
+import time
+
+# จับเวลา import ของโมดูลนี้ (รายงานใน /ready)
+_MODULE_IMPORT_STARTED = time.perf_counter()
+
 import os
 import io
 import json
 import base64
 import tempfile
-import time
+import importlib
 import re
-from typing import Dict, Optional
+import threading
+import asyncio
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager, contextmanager
+from functools import lru_cache, wraps
+from typing import TYPE_CHECKING, Callable, Dict, List, Optional
 from dotenv import load_dotenv
 from fastapi import FastAPI, Request, HTTPException
-from fastapi.responses import JSONResponse
-from linebot.v3 import WebhookHandler
+from fastapi.responses import JSONResponse, PlainTextResponse
+# linebot.v3.webhooks จำเป็นสำหรับลงทะเบียน handler จึง import ทันที
+# ส่วน linebot.v3.messaging, google.generativeai และ mock_data เป็น import ที่หนัก
+# จะถูกโหลดเมื่อใช้ครั้งแรก หรือโดย warm-up thread หลัง server เริ่มรับ request
 from linebot.v3.exceptions import InvalidSignatureError
-from linebot.v3.messaging import (
-    Configuration,
-    ApiClient,
-    MessagingApi,
-    ReplyMessageRequest,
-    PushMessageRequest,
-    TextMessage,
-    ImageMessage,
-    FlexMessage,
-    FlexContainer,
-    QuickReply,        # เพิ่มสำหรับปุ่มตัวเลือก
-    QuickReplyItem,    # เพิ่มสำหรับปุ่มตัวเลือก
-    MessageAction      # เพิ่มสำหรับปุ่มตัวเลือก
-)
 from linebot.v3.webhooks import (
     MessageEvent,
     TextMessageContent,
     ImageMessageContent
 )
-import google.generativeai as genai
 import httpx
 
-# Import Mock Data
-from mock_data import search_policies_by_cid, search_policies_by_name, search_policies_by_plate
+# Import LLM Provider (live / record / replay)
+from llm_provider import GeminiProvider, create_llm_provider
+
+# Import Event Dispatcher (ประมวลผล event ของผู้ใช้ต่างคนพร้อมกัน)
+from event_dispatcher import ConcurrentWebhookHandler, KeyedSerialExecutor
+
+# Import Conversation Router (state machine ของข้อความตัวอักษร)
+from conversation_router import ConversationRouter
+
+# Import Readiness (สถานะ warm-up สำหรับ /ready)
+from readiness import Readiness
+from session_store import SessionStore
+from photo_batcher import PhotoBatcher
+from job_queue import JobQueue
+from resilience import CircuitBreaker, CircuitOpenError
+from hedging import Hedger
+from background_loop import BackgroundLoop
+from usage_meter import BudgetExceededError, UsageMeter
+from usage_store import open_usage_store
+from prompts import (DAMAGE_ANALYSIS, POLICY_OCR, PromptTemplate, parse_splits, prompt_registry,
+                     render_damage_prompt, render_ocr_prompt)
+from line_sender import (LineApiError, LineSender, PrerenderedMessage, SdkLineSender, flex_message,
+                         message_quick_reply, text_message)
+from policy_text import PolicyTextCache
+from policy_facts import PolicyFactsEnricher
+from shutdown import ShutdownCoordinator, sweep_stale_files
+from rate_limit import UserRateLimiter, parse_limits
+from work_priority import BULK, INTERACTIVE
+from name_index import SCORE_TOKEN as NAME_SCORE_TOKEN
+from plate_index import SCORE_EXACT
+from webhook_capture import WebhookCapture
 
 # Import Flex Messages
 from flex_messages import (
@@ -50,6 +77,9 @@ from flex_messages import (
     create_additional_info_prompt_flex
 )
 
+if TYPE_CHECKING:
+    from linebot.v3.messaging import ApiClient, Configuration, MessagingApi
+
 # โหลด environment variables
 load_dotenv()
 
@@ -58,29 +88,469 @@ LINE_CHANNEL_ACCESS_TOKEN = os.getenv('LINE_CHANNEL_ACCESS_TOKEN') #
 LINE_CHANNEL_SECRET = os.getenv('LINE_CHANNEL_SECRET') #
 GEMINI_API_KEY = os.getenv('GEMINI_API_KEY') #
 
+# Endpoint ของ LINE API (เปลี่ยนได้เพื่อชี้ไปยัง server จำลองตอนทดสอบโหลด)
+LINE_API_ENDPOINT = os.getenv('LINE_API_ENDPOINT', 'https://api.line.me')
+LINE_DATA_API_ENDPOINT = os.getenv('LINE_DATA_API_ENDPOINT', 'https://api-data.line.me')
+
 # 3. ตรวจสอบค่า
 if not all([LINE_CHANNEL_ACCESS_TOKEN, LINE_CHANNEL_SECRET, GEMINI_API_KEY]):
     raise ValueError("กรุณาตั้งค่า Environment Variables ให้ครบถ้วน")
 
+# จำนวน thread สำหรับประมวลผล event (event ของผู้ใช้คนเดียวกันยังรันตามลำดับ)
+WEBHOOK_WORKERS = int(os.getenv('WEBHOOK_WORKERS', 16))
+# thread ที่กันไว้ให้งานตอบผู้ใช้ทันที (ค้นหา, OCR, ตอบ Flex) และให้งานวิเคราะห์ความเสียหาย (bulk)
+# งานที่รอ thread นานเกิน WEBHOOK_PRIORITY_AGING_S วินาทีได้คิวก่อนตามเวลาที่รอ ไม่ว่าจะเป็น class ไหน
+WEBHOOK_RESERVED_INTERACTIVE = int(os.getenv('WEBHOOK_RESERVED_INTERACTIVE', WEBHOOK_WORKERS // 4))
+WEBHOOK_RESERVED_BULK = int(os.getenv('WEBHOOK_RESERVED_BULK', 1 if WEBHOOK_WORKERS > 1 else 0))
+WEBHOOK_PRIORITY_AGING_S = float(os.getenv('WEBHOOK_PRIORITY_AGING_S', '10'))
+
 # ตั้งค่า LINE Bot
-configuration = Configuration(access_token=LINE_CHANNEL_ACCESS_TOKEN)
-handler = WebhookHandler(LINE_CHANNEL_SECRET)
+event_executor = KeyedSerialExecutor(
+    max_workers=WEBHOOK_WORKERS,
+    reserved={INTERACTIVE: WEBHOOK_RESERVED_INTERACTIVE, BULK: WEBHOOK_RESERVED_BULK},
+    aging_s=WEBHOOK_PRIORITY_AGING_S,
+)
+handler = ConcurrentWebhookHandler(LINE_CHANNEL_SECRET, event_executor)
+_line_configuration: Optional["Configuration"] = None
 
 # ตั้งค่า Gemini AI
-genai.configure(api_key=GEMINI_API_KEY)
 # ใช้ชื่อรุ่นมาตรฐานเพื่อให้รองรับกับ API ทุกเวอร์ชัน
-# gemini_model = genai.GenerativeModel(model_name='models/gemini-1.5-flash')
-gemini_model = genai.GenerativeModel(model_name='models/gemini-2.5-flash')
+# GEMINI_MODEL_NAME = 'models/gemini-1.5-flash'
+GEMINI_MODEL_NAME = 'models/gemini-2.5-flash'
+
+# Hedged request: ยิง generate_content ซ้ำเมื่อครั้งแรกช้ากว่า percentile ของ latency ล่าสุด (ปิดไว้เป็นค่าเริ่มต้น)
+# แยกตามประเภทงานเพราะ OCR กับการวิเคราะห์ความเสียหายใช้เวลาต่างกันมาก
+GEMINI_HEDGING = os.getenv("GEMINI_HEDGING", "false").lower() in ("1", "true", "yes")
+gemini_hedgers = {
+    operation: Hedger(
+        operation,
+        percentile=float(os.getenv("GEMINI_HEDGE_PERCENTILE", "95")),
+        max_rate=float(os.getenv("GEMINI_HEDGE_MAX_RATE", "0.1")),
+        min_delay_s=float(os.getenv("GEMINI_HEDGE_MIN_DELAY_S", "1.0")),
+    )
+    for operation in ("ocr", "analysis")
+} if GEMINI_HEDGING else {}
+
+# ตัวนับ token/budget และสถิติ prompt variant: ไฟล์ SQLite ที่ web และ worker ทุกตัวใช้ร่วมกัน
+# ค่าเริ่มต้น = ไฟล์เดียวกับ JOB_QUEUE_PATH (worker ที่เรียก Gemini นับลงที่เดียวกับที่ /metrics ของ web อ่าน)
+# "" และไม่ใช้ job queue = นับในหน่วยความจำของ process
+USAGE_DB_PATH = os.getenv("USAGE_DB_PATH", os.getenv("JOB_QUEUE_PATH", ""))
+usage_store = open_usage_store(USAGE_DB_PATH)
+
+# นับ token/ค่าใช้จ่ายของทุกการเรียก Gemini (ดูได้ที่ /metrics) และ budget token ต่อผู้ใช้ต่อวัน (ไม่ตั้ง = ไม่จำกัด)
+GEMINI_DAILY_TOKEN_BUDGET = os.getenv("GEMINI_DAILY_TOKEN_BUDGET")
+usage_meter = UsageMeter(
+    input_price=float(os.getenv("GEMINI_PRICE_INPUT_PER_M", "0.30")),
+    output_price=float(os.getenv("GEMINI_PRICE_OUTPUT_PER_M", "2.50")),
+    cached_price=float(os.getenv("GEMINI_PRICE_CACHED_PER_M", "0.075")),
+    daily_token_budget=int(GEMINI_DAILY_TOKEN_BUDGET) if GEMINI_DAILY_TOKEN_BUDGET else None,
+    store=usage_store,
+)
+
+# ทดลอง prompt variant: แบ่ง traffic ตามเปอร์เซ็นต์ต่อผู้ใช้ เช่น "damage_analysis:compact=20" (ไม่ตั้ง = default ทั้งหมด)
+# token และ latency ของแต่ละ variant ดูได้ที่ /metrics และ /metrics/usage
+PROMPT_VARIANT_SPLITS = os.getenv("PROMPT_VARIANT_SPLITS", "")
+prompt_registry.configure(parse_splits(PROMPT_VARIANT_SPLITS))
+prompt_registry.use_store(usage_store)
+
+# จำกัดความถี่งานที่แพงต่อผู้ใช้ (OCR, วิเคราะห์ความเสียหาย, พิมพ์ค้นหากรมธรรม์) ด้วย token bucket
+# เช่น "ocr=6:3,analysis=2:2,lookup=20:10" (ครั้งต่อนาที:burst, 0 = ไม่จำกัด) ไม่ตั้ง = ค่าใน rate_limit.DEFAULT_LIMITS
+RATE_LIMITS = os.getenv("RATE_LIMITS", "")
+rate_limiter = UserRateLimiter(parse_limits(RATE_LIMITS))
+
+# Provider ที่ใช้เรียก Gemini (สร้างเมื่อใช้ครั้งแรก เลือกโหมด record/replay ได้ผ่าน LLM_PROVIDER_MODE)
+llm_provider = None
+_llm_provider_lock = threading.Lock()
+
+# เวลาสูงสุดของการเรียก upstream แต่ละแบบ (วินาที) ไม่ให้ upstream ที่ค้างกัน thread ไว้ตลอด
+GEMINI_TIMEOUT_S = float(os.getenv("GEMINI_TIMEOUT_S", "60"))
+GEMINI_FILE_TIMEOUT_S = float(os.getenv("GEMINI_FILE_TIMEOUT_S", "30"))
+LINE_TIMEOUT_S = float(os.getenv("LINE_TIMEOUT_S", "10"))
+LINE_CONTENT_TIMEOUT_S = float(os.getenv("LINE_CONTENT_TIMEOUT_S", "20"))
+# PDF ที่อัพโหลด: ถามสถานะทุก GEMINI_FILE_POLL_S วินาทีจนกว่าจะ ACTIVE (แทนการรอคงที่)
+GEMINI_FILE_POLL_S = float(os.getenv("GEMINI_FILE_POLL_S", "0.5"))
+GEMINI_FILE_READY_TIMEOUT_S = float(os.getenv("GEMINI_FILE_READY_TIMEOUT_S", "60"))
+
+# วิเคราะห์รูป/OCR ใน web process ด้วย Gemini แบบ async บน event loop เดียว (background_loop.py)
+# handler คืน thread ทันทีหลังส่งงาน ระหว่างรอ Gemini จึงไม่กิน thread ของ event_executor (ไม่มีผลเมื่อใช้ job queue)
+GEMINI_ASYNC = os.getenv("GEMINI_ASYNC", "false").lower() in ("1", "true", "yes")
+gemini_loop = BackgroundLoop("gemini-async") if GEMINI_ASYNC else None
+
+# HTTP client แบบ pooled สำหรับดาวน์โหลดรูปจาก LINE (warm-up connection ตอนเริ่มระบบ)
+line_data_client = httpx.Client(timeout=LINE_CONTENT_TIMEOUT_S)
+
+# วิธีส่งข้อความ reply/push
+# "sdk" (ค่าเริ่มต้น) = ผ่าน MessagingApi ของ line-bot-sdk (สร้าง pydantic model ทุกข้อความ)
+# "fast" = serialize dict เป็น JSON เอง (orjson ถ้ามี) แล้ว POST ผ่าน connection pool เดียว (line_sender.py)
+LINE_SENDER = os.getenv("LINE_SENDER", "sdk").lower()
+# ตรวจข้อความด้วย model ของ SDK ก่อนส่งในโหมด fast (เปิดตอน debug/ทดสอบ)
+LINE_VALIDATE_MESSAGES = os.getenv("LINE_VALIDATE_MESSAGES", "false").lower() in ("1", "true", "yes")
+
+
+def _is_line_failure(error: BaseException) -> bool:
+    # 4xx (เช่น reply token หมดอายุ) เป็นปัญหาของ request ไม่ใช่ของ LINE
+    status = getattr(error, "status", None)
+    if status is None and isinstance(error, httpx.HTTPStatusError):
+        status = error.response.status_code
+    return status is None or status >= 500 or status == 429
+
+
+# circuit breaker ต่อ upstream: ถ้า upstream ล่ม/ช้า จะตอบผู้ใช้ทันทีว่าให้ลองใหม่ แทนการรอจน thread หมด
+CIRCUIT_OPEN_S = float(os.getenv("CIRCUIT_OPEN_S", "30"))
+gemini_breaker = CircuitBreaker(
+    "gemini",
+    slow_call_s=float(os.getenv("GEMINI_SLOW_CALL_S", "45")),
+    open_s=CIRCUIT_OPEN_S,
+)
+line_breaker = CircuitBreaker("line", slow_call_s=5.0, open_s=CIRCUIT_OPEN_S, is_failure=_is_line_failure)
+line_content_breaker = CircuitBreaker("line_content", slow_call_s=10.0, open_s=CIRCUIT_OPEN_S,
+                                      is_failure=_is_line_failure)
+
+fast_line_sender = LineSender(
+    LINE_CHANNEL_ACCESS_TOKEN,
+    endpoint=LINE_API_ENDPOINT,
+    timeout=LINE_TIMEOUT_S,
+    breaker=line_breaker,
+    validate=LINE_VALIDATE_MESSAGES,
+) if LINE_SENDER == "fast" else None
+
+# รอรูปมุมอื่นของเคลมเดียวกันกี่วินาทีก่อนวิเคราะห์รวมครั้งเดียว (0 = วิเคราะห์ทันที)
+PHOTO_WINDOW_S = float(os.getenv("PHOTO_AGGREGATION_WINDOW_S", "4.0"))
+PHOTO_MAX_WAIT_S = float(os.getenv("PHOTO_AGGREGATION_MAX_WAIT_S", "15.0"))
+MAX_CLAIM_PHOTOS = int(os.getenv("MAX_CLAIM_PHOTOS", "6"))
+photo_batcher = PhotoBatcher(
+    lambda user_id, message_ids: event_executor.submit(user_id, analyze_claim_photos, user_id, message_ids,
+                                                       priority=claim_analysis_priority()),
+    window_s=PHOTO_WINDOW_S,
+    max_wait_s=PHOTO_MAX_WAIT_S,
+    max_photos=MAX_CLAIM_PHOTOS,
+)
+
+# วิธีส่งเอกสารกรมธรรม์ให้ Gemini
+# "pdf" (ค่าเริ่มต้น) = อัพโหลด PDF ทุกครั้ง
+# "text" = ส่งข้อความที่แปลงจาก PDF แยกตามหน้า (เปิดเองเมื่อตรวจแล้วว่าเอกสารแปลงได้ดี: pypdf ทำสระไทยหาย
+#          และสลับคอลัมน์ได้ ข้อความที่ไม่มีทะเบียน/ประเภทประกันของกรมธรรม์จะถูกทิ้งแล้วส่ง PDF แทน)
+POLICY_DOCUMENT_MODE = os.getenv("POLICY_DOCUMENT_MODE", "pdf").lower()
+policy_text_cache = PolicyTextCache(os.getenv("POLICY_TEXT_CACHE_DIR", "data/policy_text"))
+
+# คิวงานถาวรสำหรับงานที่เรียก Gemini (วิเคราะห์ความเสียหาย, OCR) ให้ worker.py ทำแยก process
+# JOB_QUEUE_PATH="" (ค่าเริ่มต้น) = ทำงานใน web process เหมือนเดิม ไม่ต้องรัน worker
+JOB_QUEUE_PATH = os.getenv("JOB_QUEUE_PATH", "")
+JOB_RESULT_POLL_S = float(os.getenv("JOB_RESULT_POLL_S", "0.5"))
+job_queue = JobQueue(
+    JOB_QUEUE_PATH,
+    visibility_timeout=float(os.getenv("JOB_VISIBILITY_TIMEOUT_S", "120")),
+    max_attempts=int(os.getenv("JOB_MAX_ATTEMPTS", "3")),
+) if JOB_QUEUE_PATH else None
+
+# ปิดระบบแบบไม่ทิ้งงาน: เมื่อได้ SIGTERM หยุดรับ webhook ใหม่ แล้วรองานที่ค้างไม่เกิน SHUTDOWN_GRACE_S วินาที
+# (นับรวมเวลาที่ uvicorn รอ request ที่ค้าง) ต้องน้อยกว่า stop_grace_period ของ docker-compose
+SHUTDOWN_GRACE_S = float(os.getenv("SHUTDOWN_GRACE_S", "45"))
+shutdown_coordinator = ShutdownCoordinator()
+# PDF ชั่วคราวที่ส่งให้ Gemini (ขึ้นต้นด้วย prefix นี้ ไฟล์ที่ค้างจาก process ที่ถูก kill ถูกลบตอนเริ่มระบบ)
+TEMP_PDF_PREFIX = "claim-policy-"
+
+# บันทึก webhook ที่ผ่านการตรวจ signature ลงไฟล์ JSONL (หมุนไฟล์ตามขนาด) ไว้ replay ด้วย benchmarks/replay_webhooks.py
+# WEBHOOK_CAPTURE_DIR="" (ค่าเริ่มต้น) = ไม่บันทึก ไฟล์มีข้อมูลส่วนบุคคลของผู้ใช้ เปิดเฉพาะช่วงที่ต้องเก็บ traffic
+webhook_capture = WebhookCapture(
+    os.getenv("WEBHOOK_CAPTURE_DIR", ""),
+    max_bytes=int(float(os.getenv("WEBHOOK_CAPTURE_MAX_MB", "64")) * 1024 * 1024),
+    keep_files=int(os.getenv("WEBHOOK_CAPTURE_KEEP_FILES", "20")),
+)
+
+# สถานะ warm-up ที่ต้องครบก่อน /ready ตอบ ready
+# (การเปิด connection และทดสอบ API Key รายงานผลอย่างเดียว เพราะ network อาจยังไม่พร้อมตอนเริ่ม)
+readiness = Readiness(required=["sessions", "line_sdk", "policy_data", "llm_provider"])
+
+# เก็บ session ลงดิสก์ (snapshot + append-only log) ให้ผู้ใช้ที่เคลมค้างอยู่ไม่หลุดตอน deploy
+# SESSION_STORE_DIR="" = เก็บในหน่วยความจำอย่างเดียว
+session_store = SessionStore(
+    os.getenv("SESSION_STORE_DIR", "data/sessions"),
+    fsync_interval=float(os.getenv("SESSION_FSYNC_INTERVAL", "1.0")),
+)
+# ลบ session ที่ไม่มีความเคลื่อนไหว (เขียน None ลง log) ไม่ให้หน่วยความจำและ snapshot โตไปเรื่อย ๆ
+# session ที่จบ flow แล้ว (FINISHED_SESSION_STATES) หมดอายุเร็วกว่า session ที่ค้างกลาง flow
+SESSION_IDLE_TTL_S = float(os.getenv("SESSION_IDLE_TTL_S", str(24 * 3600)))
+SESSION_FINISHED_TTL_S = float(os.getenv("SESSION_FINISHED_TTL_S", "900"))
+SESSION_SWEEP_INTERVAL_S = float(os.getenv("SESSION_SWEEP_INTERVAL_S", "60"))
+FINISHED_SESSION_STATES = {"completed"}
+
+
+def _warm_policy_text():
+    # แปลงเอกสารกรมธรรม์ทุกฉบับเป็นข้อความล่วงหน้า (ครั้งแรกของแต่ละ version เท่านั้น ที่เหลืออ่านจาก cache)
+    if POLICY_DOCUMENT_MODE == "text":
+        from mock_data import get_all_policies
+
+        for policy_info in get_all_policies().values():
+            if policy_info.get('policy_document_base64'):
+                load_policy_text(policy_info)
+
+
+def _warm_policy_facts():
+    from mock_data import get_all_policies
+
+    policy_facts_enricher.enrich_all(get_all_policies().values())
+
+
+def _warm_up():
+    """
+    โหลด import ที่หนักและเปิด connection ล่วงหน้า (รันใน background thread)
+    """
+    steps = [
+        ("line_sdk", lambda: get_line_configuration()),
+        ("policy_data", lambda: importlib.import_module("mock_data").build_search_indexes()),
+        ("llm_provider", lambda: get_llm_provider()),
+        ("line_data_connection", lambda: line_data_client.get(LINE_DATA_API_ENDPOINT, timeout=10.0)),
+        ("policy_text", _warm_policy_text),
+        ("policy_facts", _warm_policy_facts),
+    ]
+    if fast_line_sender is not None:
+        steps.append(("line_api_connection", fast_line_sender.warm_up))
+    for name, step in steps:
+        try:
+            with readiness.track(name):
+                step()
+        except Exception as e:
+            print(f"⚠️ warm-up {name} ไม่สำเร็จ: {e}")
+
+    # ทดสอบดึงชื่อโมเดลที่ Key นี้เข้าถึงได้ (ไม่ขวาง readiness, ข้ามในโหมด replay)
+    live_provider = getattr(llm_provider, "inner", llm_provider)
+    if isinstance(live_provider, GeminiProvider):
+        try:
+            with readiness.track("gemini_connectivity"):
+                available_models = [m.name for m in live_provider.files_api.list_models()]
+            print(f"✅ API Key เชื่อมต่อสำเร็จ โมเดลที่ใช้ได้: {available_models[:3]}")
+        except Exception as e:
+            print(f"❌ API Key มีปัญหา: {e}")
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # โหลด session ก่อนรับ webhook (ต้องเสร็จก่อน event แรกจะอ่าน user_sessions)
+    with readiness.track("sessions"):
+        user_sessions.update(session_store.load())
+    print(f"💾 โหลด session {len(user_sessions)} รายการ ({readiness.report()['components']['sessions']['duration_ms']} ms)")
+    threading.Thread(target=_warm_up, name="warm-up", daemon=True).start()
+    # PDF ชั่วคราวที่ค้างจาก process ก่อนหน้าที่ถูก kill กลางการวิเคราะห์
+    stale_pdfs = sweep_stale_files(tempfile.gettempdir(), TEMP_PDF_PREFIX, max_age_s=600)
+    if stale_pdfs:
+        print(f"🧹 ลบ PDF ชั่วคราวที่ค้างอยู่ {stale_pdfs} ไฟล์")
+    job_results_stop = threading.Event()
+    if job_queue is not None:
+        threading.Thread(target=_collect_job_results, args=(job_results_stop,), name="job-results", daemon=True).start()
+    threading.Thread(target=_sweep_idle_sessions, args=(job_results_stop,), name="session-sweep", daemon=True).start()
+    yield
+    # ผล OCR จาก worker ที่ยังไม่ได้ดึงจะอยู่ในคิวให้ web ตัวใหม่ดึงต่อ
+    job_results_stop.set()
+    await asyncio.to_thread(drain_in_flight_work, SHUTDOWN_GRACE_S)
+    policy_facts_enricher.shutdown()
+    webhook_capture.close()
+    session_store.close()
+    line_data_client.close()
+    if fast_line_sender is not None:
+        fast_line_sender.close()
+
+
+def drain_in_flight_work(grace_s: float) -> Dict:
+    """
+    ปิดระบบแบบไม่ทิ้งงาน: หยุดรับงานใหม่ ส่งรูปที่รอรวบรวมไปวิเคราะห์ แล้วรองานที่ค้าง (ไม่เกิน grace_s วินาทีนับจากเริ่มปิด)
+    ผู้ใช้ที่งานไม่เสร็จในเวลาได้รับข้อความให้เริ่มใหม่ จากนั้นลบ PDF ชั่วคราวและไฟล์ที่อัพโหลดไป Gemini ที่ยังค้าง
+    """
+    deadline = shutdown_coordinator.begin_drain() + grace_s
+    # รูปที่ยังรอรวบรวมอยู่ ส่งวิเคราะห์ (หรือเข้าคิว) เลยก่อนปิด executor
+    photo_batcher.flush_all()
+
+    # OCR บน gemini_loop ส่งผลกลับเข้า event_executor จึงต้องรอทั้งสองอย่างพร้อมกัน
+    def idle() -> bool:
+        return event_executor.idle() and (gemini_loop is None or gemini_loop.stats()["in_flight"] == 0)
+
+    drained = shutdown_coordinator.wait_until(idle, deadline)
+    abandoned = set(shutdown_coordinator.abandon_claims())
+    abandoned.update(event_executor.cancel_pending())
+    if abandoned:
+        print(f"⏰ หมดเวลารอ งานของผู้ใช้ {len(abandoned)} คนยังไม่เสร็จ")
+    for user_id in abandoned:
+        try:
+            with open_line_sender() as sender:
+                sender.push(user_id, [text_message(SHUTDOWN_ABANDONED_TEXT)])
+        except Exception as e:
+            print(f"⚠️ แจ้งผู้ใช้ {user_id} ว่างานไม่เสร็จไม่สำเร็จ: {e}")
+
+    if gemini_loop is not None:
+        gemini_loop.stop(timeout=max(0.0, deadline - time.monotonic()))
+    cleaned = shutdown_coordinator.cleanup(lambda name: get_llm_provider().delete_file(name))
+    # งานที่ยังรันอยู่ (ถ้ามี) ไม่รอแล้ว ผลของเคลมที่แจ้งผู้ใช้ไปแล้วจะไม่ถูกส่ง
+    event_executor.shutdown(wait=drained)
+    summary = {"drained": drained, "abandoned_users": len(abandoned), **cleaned}
+    print(f"🛑 ปิดระบบ: {summary}")
+    return summary
+
 
 # สร้าง FastAPI App
-app = FastAPI(title="LINE Insurance Claim Bot")
+app = FastAPI(title="LINE Insurance Claim Bot", lifespan=lifespan)
+
+# Router ของบทสนทนา (state + ข้อความ -> handler)
+conversation_router = ConversationRouter()
+
+# เลขบัตรประชาชน 13 หลัก (หลังตัด - และช่องว่าง)
+CID_PATTERN = re.compile(r'^\d{13}$')
+
+# คำถามเรื่องคู่กรณีหลังเจอกรมธรรม์
+COUNTERPART_FOUND_QUESTION = "🚘 พบข้อมูลรถยนต์ของคุณแล้ว\n\n❓ **มีคู่กรณีหรือไม่?**\n\nกรุณาเลือก:"
+COUNTERPART_QUESTION = "❓ **มีคู่กรณีหรือไม่?**\n\nกรุณาเลือก:"
 
 # Dictionary สำหรับเก็บ Session ของผู้ใช้แต่ละคน
-# Structure: {user_id: {"state": "...", "name": "...", "plate": "...", "policy_info": {...}}}
+# เก็บแค่เลขกรมธรรม์ + version ของเอกสาร (ไม่เก็บ dict กรมธรรม์ที่มีเอกสาร ~500 KB)
+# Structure: {user_id: {"state": "...", "policy_number": "...", "policy_version": "...", "search_results": ["..."]}}
 user_sessions: Dict[str, Dict] = {}
 
 
 # ==================== Helper Functions ====================
+def get_line_configuration() -> "Configuration":
+    """
+    สร้าง Configuration ของ LINE SDK ครั้งแรกที่ใช้ (import linebot.v3.messaging ตอนนั้น)
+    """
+    global _line_configuration
+    if _line_configuration is None:
+        from linebot.v3.messaging import Configuration
+        _line_configuration = Configuration(access_token=LINE_CHANNEL_ACCESS_TOKEN)
+    return _line_configuration
+
+
+def get_llm_provider():
+    """
+    สร้าง llm_provider ครั้งแรกที่ใช้ (import google.generativeai เฉพาะโหมดที่เรียก Gemini จริง)
+    """
+    global llm_provider
+    if llm_provider is None:
+        with _llm_provider_lock:
+            if llm_provider is None:
+                llm_provider = create_llm_provider(_create_gemini_provider)
+    return llm_provider
+
+
+def _create_gemini_provider() -> GeminiProvider:
+    import google.generativeai as genai
+
+    genai.configure(api_key=GEMINI_API_KEY)
+    gemini_model = genai.GenerativeModel(model_name=GEMINI_MODEL_NAME)
+    return GeminiProvider(gemini_model, genai, file_poll_interval=GEMINI_FILE_POLL_S,
+                          file_ready_timeout=GEMINI_FILE_READY_TIMEOUT_S, request_timeout=GEMINI_TIMEOUT_S,
+                          file_timeout=GEMINI_FILE_TIMEOUT_S)
+
+
+def generate_with_gemini(contents: list, operation: str, user_id: Optional[str] = None,
+                         policy_number: Optional[str] = None, prompt: Optional[PromptTemplate] = None):
+    """
+    เรียก generate_content ผ่าน circuit breaker (และ hedge ถ้าเปิด GEMINI_HEDGING)
+    แล้วบันทึก token ลง usage_meter ตามงาน ผู้ใช้ และเลขกรมธรรม์
+    prompt = template ที่ใช้สร้าง contents (บันทึก token และ latency แยกตาม variant)
+    """
+    usage_meter.check_budget(user_id)
+    provider = get_llm_provider()
+    started = time.perf_counter()
+    hedger = gemini_hedgers.get(operation)
+    # record/replay ต้องได้ลำดับ request ที่แน่นอน จึง hedge เฉพาะโหมด live
+    if hedger is None or getattr(provider, "mode", "live") != "live":
+        response = gemini_breaker.call(provider.generate_content, contents)
+    else:
+        # คำตอบของ attempt ที่แพ้ก็เสียเงินจริง: นับเข้า cost และ budget ของผู้ใช้ด้วย (แยก task "<งาน>-hedge")
+        def record_discarded(discarded):
+            usage_meter.record(f"{operation}-hedge", GEMINI_MODEL_NAME, discarded, user_id, policy_number)
+
+        response = hedger.call(gemini_breaker.call, provider.generate_content, contents,
+                               on_discard=record_discarded)
+
+    _record_gemini_usage(response, time.perf_counter() - started, operation, user_id, policy_number, prompt)
+    return response
+
+
+async def generate_with_gemini_async(contents: list, operation: str, user_id: Optional[str] = None,
+                                     policy_number: Optional[str] = None, prompt: Optional[PromptTemplate] = None):
+    """
+    generate_with_gemini แบบ async (generate_content_async ของ SDK) ยังไม่รองรับ hedging
+    """
+    usage_meter.check_budget(user_id)
+    provider = get_llm_provider()
+    started = time.perf_counter()
+    response = await gemini_breaker.call_async(provider.generate_content_async, contents)
+
+    _record_gemini_usage(response, time.perf_counter() - started, operation, user_id, policy_number, prompt)
+    return response
+
+
+def _record_gemini_usage(response, latency_s: float, operation: str, user_id: Optional[str],
+                         policy_number: Optional[str], prompt: Optional[PromptTemplate]):
+    usage = usage_meter.record(operation, GEMINI_MODEL_NAME, response, user_id, policy_number)
+    if prompt is not None:
+        prompt_registry.record(prompt, latency_s, usage)
+    if usage:
+        variant = f" [{prompt.key}]" if prompt is not None else ""
+        print(f"🧮 {operation}{variant}: prompt {usage.get('prompt_token_count', 0)} "
+              f"(cached {usage.get('cached_content_token_count', 0)}) + output {usage.get('candidates_token_count', 0)} "
+              f"= {usage.get('total_token_count', 0)} tokens")
+
+
+def create_messaging_api(api_client: "ApiClient") -> "MessagingApi":
+    """
+    สร้าง MessagingApi ที่ชี้ไปยัง LINE_API_ENDPOINT
+    (SDK ไม่อ่าน host จาก Configuration จึงต้องกำหนด line_base_path เอง)
+    """
+    from linebot.v3.messaging import MessagingApi
+
+    line_bot_api = MessagingApi(api_client)
+    line_bot_api.line_base_path = LINE_API_ENDPOINT
+
+    # ทุก method ของ MessagingApi ผ่าน call_api: ใส่ timeout และ circuit breaker ที่จุดเดียว
+    call_api = api_client.call_api
+
+    def guarded_call_api(*args, **kwargs):
+        if kwargs.get("_request_timeout") is None:
+            kwargs["_request_timeout"] = LINE_TIMEOUT_S
+        return line_breaker.call(call_api, *args, **kwargs)
+
+    api_client.call_api = guarded_call_api
+    return line_bot_api
+
+
+@contextmanager
+def open_line_sender():
+    """
+    ตัวส่งข้อความ LINE สำหรับงานหนึ่งงาน: fast_line_sender (ใช้ร่วมกันทั้ง process)
+    หรือ MessagingApi ของ SDK บน ApiClient ที่ปิดเมื่อจบงาน
+    """
+    if fast_line_sender is not None:
+        yield fast_line_sender
+        return
+
+    from linebot.v3.messaging import ApiClient
+
+    with ApiClient(get_line_configuration()) as api_client:
+        yield SdkLineSender(create_messaging_api(api_client))
+
+
+def document_version(policy_info: Dict) -> str:
+    from mock_data import policy_document_version
+
+    return policy_document_version(policy_info)
+
+
+def load_policy_text(policy_info: Dict) -> Optional[str]:
+    """
+    ข้อความแยกหน้าของเอกสารกรมธรรม์ (จาก cache) หรือ None ถ้าแปลงไม่ได้/ข้อความไม่ตรงกับข้อมูลกรมธรรม์
+    """
+    return policy_text_cache.get(
+        policy_info['policy_number'],
+        document_version(policy_info),
+        policy_info['policy_document_base64'],
+        expected_values=(policy_info.get('plate', ''), policy_info.get('insurance_type', '')),
+    )
+
+
+# ประเภทประกัน / excess / เบอร์แจ้งเหตุ ที่ดึงจากเอกสารล่วงหน้า (เก็บใน policy_info["policy_facts"])
+policy_facts_enricher = PolicyFactsEnricher(load_policy_text, document_version)
+
+
 def extract_phone_from_response(text: str) -> Optional[str]:
     """
     ดึงเบอร์โทรจากข้อความ AI
@@ -111,594 +581,1028 @@ def extract_phone_from_response(text: str) -> Optional[str]:
     return None
 
 
-def process_search_result(line_bot_api, event, user_id, policies, use_push=False):
+@lru_cache(maxsize=None)
+def counterpart_quick_reply() -> Dict:
+    """
+    ปุ่มตัวเลือกคู่กรณี (สร้างครั้งเดียวแล้วใช้ซ้ำทุกข้อความ)
+    """
+    return message_quick_reply(("✅ มีคู่กรณี", "มีคู่กรณี"), ("❌ ไม่มีคู่กรณี", "ไม่มีคู่กรณี"))
+
+
+@lru_cache(maxsize=None)
+def upstream_busy_message() -> PrerenderedMessage:
+    """
+    ข้อความสำเร็จรูปตอน upstream ถูกตัด (circuit breaker เปิด) ตอบได้ทันทีโดยไม่ต้องสร้างใหม่
+    """
+    return PrerenderedMessage(text_message("⏳ ขณะนี้ระบบวิเคราะห์มีผู้ใช้งานหนาแน่น\n\nกรุณาลองใหม่อีกครั้งในอีกสักครู่ค่ะ"))
+
+
+@lru_cache(maxsize=None)
+def budget_exceeded_message() -> PrerenderedMessage:
+    return PrerenderedMessage(text_message("⚠️ วันนี้ท่านใช้งานระบบวิเคราะห์ครบโควต้าแล้ว\n\nกรุณาลองใหม่พรุ่งนี้ หรือติดต่อเจ้าหน้าที่ค่ะ"))
+
+
+@lru_cache(maxsize=None)
+def rate_limited_message() -> PrerenderedMessage:
+    return PrerenderedMessage(text_message("⏳ ท่านส่งคำขอถี่เกินไป\n\nกรุณารอสักครู่แล้วลองใหม่อีกครั้งค่ะ"))
+
+
+@lru_cache(maxsize=None)
+def request_info_message() -> PrerenderedMessage:
+    return PrerenderedMessage(flex_message("กรุณาส่งข้อมูลชื่อและทะเบียนรถ", create_request_info_flex()))
+
+
+@lru_cache(maxsize=None)
+def additional_info_prompt_message() -> PrerenderedMessage:
+    return PrerenderedMessage(flex_message("กรุณาระบุรายละเอียดเพิ่มเติม", create_additional_info_prompt_flex()))
+
+
+def build_policy_found_messages(policy_info: Dict, question_text: str) -> list:
+    """
+    ข้อความหลังเจอกรมธรรม์: รายละเอียดกรมธรรม์ (Step 5) + คำถามเรื่องคู่กรณี (Step 6)
+    """
+    return [
+        flex_message("พบข้อมูลกรมธรรม์", create_policy_info_flex(policy_info)),
+        text_message(question_text, quick_reply=counterpart_quick_reply())
+    ]
+
+
+def policy_reference(policy_info: Dict) -> Dict:
+    """
+    ข้อมูลกรมธรรม์แบบย่อสำหรับเก็บใน session
+    """
+    from mock_data import policy_document_version
+
+    return {
+        "policy_number": policy_info["policy_number"],
+        "policy_version": policy_document_version(policy_info),
+    }
+
+
+def resolve_session_policy(session: Dict) -> Optional[Dict]:
+    """
+    ดึงข้อมูลกรมธรรม์เต็มจากเลขกรมธรรม์ใน session (เตือนถ้าเอกสารเปลี่ยนหลังเลือกกรมธรรม์)
+    """
+    from mock_data import get_policy_by_number, policy_document_version
+
+    policy_number = session.get("policy_number")
+    policy_info = get_policy_by_number(policy_number) if policy_number else None
+    if policy_info and policy_document_version(policy_info) != session.get("policy_version"):
+        print(f"⚠️ เอกสารกรมธรรม์ {policy_number} ถูกอัปเดตหลังเริ่มเคลม ใช้ฉบับล่าสุด")
+    return policy_info
+
+
+def process_search_result(sender, event, user_id, policies, use_push=False, exact=True):
     """
     จัดการผลลัพธ์การค้นหา ส่งข้อความตอบกลับ และอัปเดต state
     """
-    if not policies:
-        msg = TextMessage(text="❌ ไม่พบข้อมูลกรมธรรม์\n\nกรุณาตรวจสอบข้อมูลอีกครั้ง หรือติดต่อเจ้าหน้าที่")
+    def send(messages):
         if use_push:
-            line_bot_api.push_message(PushMessageRequest(to=user_id, messages=[msg]))
+            sender.push(user_id, messages)
         else:
-            line_bot_api.reply_message(ReplyMessageRequest(reply_token=event.reply_token, messages=[msg]))
+            sender.reply(event.reply_token, messages)
+
+    if not policies:
+        send([text_message("❌ ไม่พบข้อมูลกรมธรรม์\n\nกรุณาตรวจสอบข้อมูลอีกครั้ง หรือติดต่อเจ้าหน้าที่")])
         return False
 
-    if len(policies) > 1:
+    # ผลที่ไม่ตรงตัว (ทะเบียนหรือชื่อ prefix/ใกล้เคียง) อาจเป็นรถของคนอื่น: ให้ผู้ใช้ยืนยันก่อนแสดงข้อมูลกรมธรรม์ แม้จะพบคันเดียว
+    if len(policies) > 1 or not exact:
         user_sessions[user_id]["state"] = "waiting_for_vehicle_selection"
-        user_sessions[user_id]["search_results"] = policies
-        flex_message = create_vehicle_selection_flex(policies)
-        msg = FlexMessage(alt_text="กรุณาเลือกรถยนต์", contents=flex_message)
-        if use_push:
-            line_bot_api.push_message(PushMessageRequest(to=user_id, messages=[msg]))
-        else:
-            line_bot_api.reply_message(ReplyMessageRequest(reply_token=event.reply_token, messages=[msg]))
-        return True
-    else:
-        policy_info = policies[0]
-        user_sessions[user_id] = {
-            "state": "waiting_for_counterpart",
-            "policy_info": policy_info
-        }
-        
-        # แสดงรายละเอียดกรมธรรม์ (Step 5)
-        flex_policy = create_policy_info_flex(policy_info)
-        
-        # ถามเรื่องคู่กรณี (Step 6)
-        quick_reply = QuickReply(items=[
-            QuickReplyItem(action=MessageAction(label="✅ มีคู่กรณี", text="มีคู่กรณี")),
-            QuickReplyItem(action=MessageAction(label="❌ ไม่มีคู่กรณี", text="ไม่มีคู่กรณี"))
-        ])
-        msg_counterpart = TextMessage(
-            text="🚘 พบข้อมูลรถยนต์ของคุณแล้ว\n\n❓ **มีคู่กรณีหรือไม่?**\n\nกรุณาเลือก:",
-            quick_reply=quick_reply
-        )
-        
-        messages = [
-            FlexMessage(alt_text="พบข้อมูลกรมธรรม์", contents=flex_policy),
-            msg_counterpart
-        ]
-        
-        if use_push:
-            line_bot_api.push_message(PushMessageRequest(to=user_id, messages=messages))
-        else:
-            line_bot_api.reply_message(ReplyMessageRequest(reply_token=event.reply_token, messages=messages))
+        user_sessions[user_id]["search_results"] = [policy["policy_number"] for policy in policies]
+        send([flex_message("กรุณาเลือกรถยนต์", create_vehicle_selection_flex(policies, approximate=not exact))])
         return True
 
+    policy_info = policies[0]
+    user_sessions[user_id] = {
+        "state": "waiting_for_counterpart",
+        **policy_reference(policy_info)
+    }
+    send(build_policy_found_messages(policy_info, COUNTERPART_FOUND_QUESTION))
+    return True
+
+
+def _ocr_request(image_bytes: bytes, user_id: Optional[str]):
+    from PIL import Image
+    img = Image.open(io.BytesIO(image_bytes))
 
+    prompt = prompt_registry.choose(POLICY_OCR, user_id)
+    return prompt, [render_ocr_prompt(prompt), img]
 
-def extract_info_from_image_with_gemini(image_bytes: bytes) -> Dict:
+
+def _parse_ocr_response(text: str) -> Dict:
+    # ค้นหา JSON ในคำตอบ
+    match = re.search(r'\{.*\}', text, re.DOTALL)
+    if match:
+        return json.loads(match.group(0))
+    return {"type": "unknown", "value": None}
+
+
+def extract_info_from_image_with_gemini(image_bytes: bytes, user_id: Optional[str] = None) -> Dict:
     """
     ใช้ Gemini AI อ่านข้อมูลจากรูปภาพ (บัตรประชาชน หรือ ทะเบียนรถ)
     """
     try:
-        from PIL import Image
-        img = Image.open(io.BytesIO(image_bytes))
-
-        prompt = """
-        วิเคราะห์รูปภาพนี้ว่าเป็น "บัตรประชาชน" หรือ "ทะเบียนรถ" 
-        แล้วสกัดข้อมูลที่สำคัญออกมาในรูปแบบ JSON ดังนี้:
-        {
-          "type": "id_card" หรือ "license_plate" หรือ "unknown",
-          "value": "เลขบัตรประชาชน 13 หลัก" หรือ "เลขทะเบียนรถ (เช่น 1กข1234)" หรือ null
-        }
-        
-        กฎ:
-        1. ถ้าเป็นบัตรประชาชน ให้สกัดเลขบัตร 13 หลัก (เอาแค่ตัวเลข)
-        2. ถ้าเป็นทะเบียนรถ ให้สกัดหมวดอักษรและตัวเลข (เช่น 1กข1234, ฌห55) ไม่ต้องเอาชื่อจังหวัด
-        3. ถ้าไม่แน่ใจให้ตอบ unknown
-        """
-
-        response = gemini_model.generate_content([prompt, img])
-        
-        # ค้นหา JSON ในคำตอบ
-        match = re.search(r'\{.*\}', response.text, re.DOTALL)
-        if match:
-            return json.loads(match.group(0))
-        return {"type": "unknown", "value": None}
+        prompt, contents = _ocr_request(image_bytes, user_id)
+        response = generate_with_gemini(contents, "ocr", user_id=user_id, prompt=prompt)
+        return _parse_ocr_response(response.text)
 
+    except (CircuitOpenError, BudgetExceededError):
+        raise
     except Exception as e:
         print(f"Error in extract_info_from_image_with_gemini: {str(e)}")
         return {"type": "unknown", "value": None}
 
+
+async def extract_info_from_image_with_gemini_async(image_bytes: bytes, user_id: Optional[str] = None) -> Dict:
+    """
+    extract_info_from_image_with_gemini แบบ async (ไม่กัน thread ระหว่างรอ Gemini)
+    """
+    try:
+        prompt, contents = _ocr_request(image_bytes, user_id)
+        response = await generate_with_gemini_async(contents, "ocr", user_id=user_id, prompt=prompt)
+        return _parse_ocr_response(response.text)
+
+    except (CircuitOpenError, BudgetExceededError):
+        raise
+    except Exception as e:
+        print(f"Error in extract_info_from_image_with_gemini_async: {str(e)}")
+        return {"type": "unknown", "value": None}
+
+
+SHUTDOWN_ABANDONED_TEXT = ("⚠️ ระบบกำลังอัปเดต คำขอล่าสุดของคุณยังประมวลผลไม่เสร็จ\n\n"
+                           "กรุณาส่ง \"เช็คสิทธิ์เคลมด่วน\" เพื่อเริ่มใหม่อีกครั้งในอีกสักครู่ค่ะ")
+NO_POLICY_DOCUMENT_TEXT = "❌ ไม่พบเอกสารกรมธรรม์\n\nกรุณาติดต่อเจ้าหน้าที่เพื่ออัพโหลดเอกสารกรมธรรม์ลงระบบก่อนใช้งาน"
+
+
+def _damage_analysis_request(damage_images: List[bytes], policy_info: Dict, additional_info: Optional[str],
+                             has_counterpart: Optional[str], user_id: Optional[str]):
+    """
+    prompt ที่เลือก และ contents ส่วนต้น (System Prompt + รูปความเสียหาย) ของการวิเคราะห์หนึ่งครั้ง
+    """
+    # สร้าง System Prompt ให้ AI อ่านเอกสารจริง (variant ตามการแบ่ง traffic ใน PROMPT_VARIANT_SPLITS)
+    prompt = prompt_registry.choose(DAMAGE_ANALYSIS, user_id)
+    system_prompt = render_damage_prompt(
+        prompt,
+        policy_info,
+        len(damage_images),
+        facts=policy_facts_enricher.current(policy_info),
+        has_counterpart=has_counterpart,
+        additional_info=additional_info,
+    )
+
+    # แปลงรูปภาพความเสียหายเป็น PIL Image
+    from PIL import Image
+
+    damage_image_parts = [Image.open(io.BytesIO(image_bytes)) for image_bytes in damage_images]
+    # รูปความเสียหาย (ภาพที่ 1..N)
+    return prompt, [system_prompt, *damage_image_parts]
+
+
+def _write_policy_pdf(policy_info: Dict) -> str:
+    """
+    บันทึก PDF จาก Base64 ลงไฟล์ชั่วคราว (Gemini ต้องการ file path สำหรับ PDF) ผู้เรียกต้องลบเอง
+    """
+    policy_doc_bytes = base64.b64decode(policy_info['policy_document_base64'])
+    with tempfile.NamedTemporaryFile(delete=False, prefix=TEMP_PDF_PREFIX, suffix='.pdf') as temp_pdf:
+        # ลงทะเบียนก่อนเขียน ถ้า process ถูกปิดระหว่างนี้ไฟล์จะถูกลบตอน drain
+        shutdown_coordinator.track_temp_file(temp_pdf.name)
+        temp_pdf.write(policy_doc_bytes)
+        return temp_pdf.name
+
+
+def _remove_temp_pdf(temp_pdf_path: str):
+    if os.path.exists(temp_pdf_path):
+        os.unlink(temp_pdf_path)
+        print(f"🗑️ ลบไฟล์ชั่วคระแล้ว")
+    shutdown_coordinator.release_temp_file(temp_pdf_path)
+
+
+def _uploaded_pdf(uploaded_pdf):
+    print(f"✅ อัพโหลด PDF สำเร็จ: {uploaded_pdf.name}")
+    # ลบจาก Gemini ตอน drain ถ้าการวิเคราะห์นี้ยังไม่จบ
+    shutdown_coordinator.track_upload(uploaded_pdf.name)
+    return uploaded_pdf
+
+
+def _delete_uploaded_pdf(provider, name: str):
+    """
+    ลบ PDF ที่อัพโหลดออกจาก Gemini (ลบไม่สำเร็จ = log แล้วปล่อยให้ drain ลองอีกครั้ง ไม่ทับ error ของการวิเคราะห์)
+    """
+    try:
+        gemini_breaker.call(provider.delete_file, name)
+    except Exception as e:
+        print(f"⚠️ ลบไฟล์ {name} จาก Gemini ไม่สำเร็จ: {e}")
+        return
+    shutdown_coordinator.release_upload(name)
+    print(f"🗑️ ลบไฟล์ PDF จาก Gemini แล้ว")
+
+
+async def _settled_upload(upload: asyncio.Future):
+    """
+    ไฟล์ที่อัพโหลดสำเร็จของ upload ที่อาจยังไม่จบ (รอไม่เกิน GEMINI_FILE_TIMEOUT_S) หรือ None
+    """
+    if not upload.done():
+        await asyncio.wait([upload], timeout=GEMINI_FILE_TIMEOUT_S)
+    if upload.done() and not upload.cancelled() and upload.exception() is None:
+        return upload.result()
+    return None
+
+
+async def _delete_uploaded_pdf_async(provider, name: str):
+    try:
+        await gemini_breaker.call_async(provider.delete_file_async, name)
+    except Exception as e:
+        print(f"⚠️ ลบไฟล์ {name} จาก Gemini ไม่สำเร็จ: {e}")
+        return
+    shutdown_coordinator.release_upload(name)
+    print(f"🗑️ ลบไฟล์ PDF จาก Gemini แล้ว")
+
+
+def _analysis_error_text(e: Exception) -> str:
+    error_msg = f"เกิดข้อผิดพลาดในการวิเคราะห์รูปภาพ: {str(e)}"
+    print(f"Gemini API Error: {error_msg}")
+    import traceback
+    traceback.print_exc()
+    return f"❌ {error_msg}\n\nกรุณาลองใหม่อีกครั้ง หรือติดต่อเจ้าหน้าที่"
+
+
 def analyze_damage_with_gemini(
-    image_bytes: bytes,
+    damage_images: List[bytes],
     policy_info: Dict,
     additional_info: Optional[str] = None,
-    has_counterpart: Optional[str] = None
+    has_counterpart: Optional[str] = None,
+    user_id: Optional[str] = None
 ) -> str:
     """
     ใช้ Gemini AI วิเคราะห์รูปภาพความเสียหายพร้อมเอกสารกรมธรรม์จริง
+    (หลายรูปของเคลมเดียวกันถูกส่งใน request เดียว และได้ผลสรุปเดียว)
 
     Args:
-        image_bytes: ข้อมูล bytes ของรูปภาพความเสียหาย
+        damage_images: ข้อมูล bytes ของรูปภาพความเสียหาย (1 รูปขึ้นไป)
         policy_info: ข้อมูลกรมธรรม์ (รวมเอกสาร Base64)
         additional_info: รายละเอียดเพิ่มเติมจากลูกค้า (ถ้ามี)
         has_counterpart: สถานะคู่กรณี ("มีคู่กรณี" หรือ "ไม่มีคู่กรณี")
+        user_id: ผู้ใช้ที่ขอวิเคราะห์ (สำหรับนับ token และ budget)
 
     Returns:
         ข้อความผลการวิเคราะห์จาก AI
     """
     try:
-        # ตรวจสอบว่ามีเอกสารกรมธรรม์หรือไม่
-        has_policy_document = policy_info.get('policy_document_base64') is not None
-
-        # สร้าง System Prompt ให้ AI อ่านเอกสารจริง
-        if has_policy_document:
-          system_prompt = f"""
-          คุณคือ "AI ผู้เชี่ยวชาญด้านประกันรถยนต์และประเมินสินไหม" สำหรับบริการ "เช็คสิทธิ์เคลมด่วน"
-          วิเคราะห์ด้วยมาตรฐานระดับมืออาชีพ แม่นยำตามเงื่อนไขกรมธรรม์ และสื่อสารอย่างรวดเร็วเป็นกันเอง
-
-          **ภารกิจของคุณ:**
-          วิเคราะห์ภาพความเสียหาย (ภาพที่ 1) เปรียบเทียบกับเอกสารกรมธรรม์ (ภาพที่ 2/PDF) อย่างละเอียดและรวดเร็ว เพื่อให้คำแนะนำที่ถูกต้องที่สุดแก่ผู้เอาประกันภัย
-
-          **ข้อมูลพื้นฐานลูกค้า:**
-          - ผู้เอาประกัน: คุณ {policy_info['first_name'].strip()} {policy_info['last_name']}
-          - รถยนต์: {policy_info['car_model']} ({policy_info['car_year']}) ทะเบียน {policy_info['plate']}
-          - บริษัทประกัน: {policy_info['insurance_company']}"""
-
-          # เพิ่มข้อมูลสถานะคู่กรณีจากลูกค้า
-          if has_counterpart:
-              if has_counterpart == "มีคู่กรณี":
-                  system_prompt += f"""
-          - สถานะคู่กรณี: ✅ **มีคู่กรณี** (ลูกค้ายืนยัน)
-
-          ⚠️ **คำแนะนำสำหรับ AI:**
-          - ลูกค้ายืนยันว่า "มีคู่กรณี"
-          - ให้ตรวจสอบในรูปภาพว่ามีหลักฐานรถคู่กรณีหรือไม่
-          - ถ้าในรูปไม่เห็นคู่กรณีชัดเจน → แนะนำให้ลูกค้าถ่ายรูปคู่กรณีเพิ่ม
-          - ถ้ามีคู่กรณีจริง → ประกันชั้น 2+/2/3+/3 สามารถเคลมได้
-          - ชั้น 1 → เคลมได้ทุกกรณี (ไม่ว่าจะมีคู่กรณีหรือไม่)"""
-
-              elif has_counterpart == "ไม่มีคู่กรณี":
-                  system_prompt += f"""
-          - สถานะคู่กรณี: ❌ **ไม่มีคู่กรณี** (ลูกค้ายืนยัน - ชนเสา/เฉี่ยวชนเอง)
-
-          ⚠️ **คำแนะนำสำหรับ AI:**
-          - ลูกค้ายืนยันว่า "ไม่มีคู่กรณี" (ชนเสา, เฉี่ยวชนวัตถุ, ชนกำแพง)
-          - ตรวจสอบประเภทประกันจากเอกสาร:
-            • ชั้น 1 → ✅ เคลมได้ (ไม่ต้องมีคู่กรณี)
-            • ชั้น 2+/2/3+/3 → ❌ เคลมไม่ได้ (ต้องมีคู่กรณีเป็นยานพาหนะ)
-          - ถ้าเป็นชั้น 2+ → แจ้งชัดเจนว่า "ไม่มีสิทธิ์เคลม" พร้อมอ้างอิงเงื่อนไขจากเอกสาร"""
-
-          # เพิ่มรายละเอียดเพิ่มเติมจากลูกค้า (ถ้ามี)
-          if additional_info:
-              system_prompt += f"""
-          - รายละเอียดจากลูกค้า: "{additional_info}"
-
-          ⚠️ **หมายเหตุ:** ใช้ข้อมูลนี้ประกอบการพิจารณา แต่ยึดรูปภาพและเอกสารกรมธรรม์เป็นหลัก"""
-
-          system_prompt += """
-
-          ━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━
-          **🎯 กฎการวิเคราะห์เชิงลึก (CRITICAL RULES):**
-          ━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━
-          1. **CITATION (ต้องทำ):** ทุกครั้งที่ระบุเงื่อนไขประกัน ต้องใส่เลขบรรทัดหรือส่วนที่อ้างอิงจากเอกสาร เช่น [หน้า 1: ประเภทประกัน], [หน้า 1: ค่าเสียหายส่วนแรก]
-          2. **AI LOGIC:** - ถ้าเป็นชั้น 2+ หรือ 3+: ตรวจสอบอย่างเข้มงวดว่ารอยในภาพ "เป็นการชนกับยานพาหนะ" หรือไม่
-            - การคำนวณ: เปรียบเทียบ "ค่าซ่อมประเมิน" vs "ค่า Excess" ในเอกสารจริงเสมอ
-
-          ━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━
-          **📦 รูปแบบการตอบ (สำหรับ "เช็คสิทธิ์เคลมด่วน"):**
-          ━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━
-
-          สวัสดีครับ คุณ {policy_info['first_name'].strip()} สรุปผลการเช็คสิทธิ์เคลมด่วนดังนี้ครับ:
-
-          📄 **ข้อมูลกรมธรรม์จากเอกสาร**
-          • ประเภท: [ระบุ เช่น ประกันชั้น 2+] [หน้า 1]
-          • ค่าเสียหายส่วนแรก (Excess): [ระบุ] บาท [หน้า 1]
-          • เบอร์แจ้งเหตุ: [ระบุเบอร์ที่เจอในเอกสาร เช่น 1557] [หน้า 1]
-
-          🔍 **วิเคราะห์ความเสียหายจากภาพ**
-          • พบรอยที่: [ระบุตำแหน่ง เช่น ประตูซ้าย]
-          • ลักษณะ: [เช่น รอยขูดลึกจากการเบียดวัตถุ]
-          • สาเหตุ: [เช่น เฉี่ยวชนไม่มีคู่กรณีเป็นยานพาหนะ]
-
-          ⚖️ **ผลการพิจารณาสินไหม**
-          [เลือกแสดงผลเพียง 1 ข้อความ:]
-
-          • 🟢 **ได้รับสิทธิ์เคลม (แนะนำ)** - อยู่ในเงื่อนไขและค่าซ่อมสูงกว่าค่า Excess
-          • 🟡 **ได้รับสิทธิ์เคลม (มีค่าใช้จ่าย)** - เคลมได้ตามสิทธิ์ แต่ค่าซ่อมประเมินต่ำกว่าค่า Excess ท่านต้องรับผิดชอบเอง
-          • 🔴 **ไม่สามารถเคลมได้** - รอยเสียหายไม่ตรงเงื่อนไข (เช่น ชั้น 2+ ต้องมีคู่กรณีเป็นยานพาหนะ)
-
-          • **เหตุผล:** [อธิบายสั้นๆ โดยอ้างอิงประเภทประกัน [หน้า 1] เทียบกับลักษณะรอยในภาพ]
-
-          💰 **สรุปค่าใช้จ่ายเบื้องต้น**
-          • ประเมินค่าซ่อม: [ช่วงราคา] บาท
-          • คุณจ่ายเอง (Excess): [ระบุ] บาท [หน้า 1]
-          • ประกันรับผิดชอบ: [ระบุ] บาท
-
-          📋 **3 ขั้นตอนดำเนินการด่วน**
-          1. **แจ้งเหตุทันที:** โทร [เบอร์จากเอกสาร]
-          2. **นัดตรวจสภาพ:** เตรียมใบขับขี่และภาพถ่ายนี้ไว้ให้เจ้าหน้าที่
-          3. **เข้าซ่อม:** นำรถเข้าอู่เครือ [ระบุชื่อบริษัทประกัน]
-
-          ⚠️ **ข้อแนะนำเพิ่มเติม:** [เช่น กรณีค่าซ่อมใกล้เคียง Excess แนะนำให้ซ่อมเองเพื่อรักษาประวัติลดเบี้ยปีหน้า]
-
-          *หมายเหตุ: เป็นการประเมินเบื้องต้นโดย AI จากเอกสารที่ระบุ โปรดตรวจสอบกับบริษัทประกันอีกครั้ง*
-          """
-        else:
-            # กรณีไม่มีเอกสาร - ต้องมีเอกสารเท่านั้น
-            return "❌ ไม่พบเอกสารกรมธรรม์\n\nกรุณาติดต่อเจ้าหน้าที่เพื่ออัพโหลดเอกสารกรมธรรม์ลงระบบก่อนใช้งาน"
-
-        # แปลงรูปภาพความเสียหายเป็น PIL Image
-        from PIL import Image
-
-        damage_image = Image.open(io.BytesIO(image_bytes))
-
-        # แปลงเอกสารกรมธรรม์จาก Base64
-        policy_doc_base64 = policy_info['policy_document_base64']
-        policy_doc_bytes = base64.b64decode(policy_doc_base64)
+        # กรณีไม่มีเอกสาร - ต้องมีเอกสารเท่านั้น
+        if policy_info.get('policy_document_base64') is None:
+            return NO_POLICY_DOCUMENT_TEXT
+
+        prompt, contents = _damage_analysis_request(damage_images, policy_info, additional_info, has_counterpart,
+                                                    user_id)
+        provider = get_llm_provider()
+
+        # ส่งเอกสารเป็นข้อความแยกหน้า (ไม่ต้องอัพโหลดและรอ PDF) ถ้าแปลงได้
+        policy_text = load_policy_text(policy_info) if POLICY_DOCUMENT_MODE == "text" else None
+        if policy_text:
+            print(f"📄 ส่งเอกสารกรมธรรม์ (ข้อความ {len(policy_text)} ตัวอักษร) และรูปภาพความเสียหายไปให้ AI วิเคราะห์")
+            response = generate_with_gemini([
+                *contents,
+                f"เอกสารกรมธรรม์ (ข้อความจาก PDF แยกตามหน้า):\n{policy_text}"
+            ], "analysis", user_id=user_id, policy_number=policy_info['policy_number'], prompt=prompt)
+            return response.text
 
         print(f"📄 ส่งเอกสารกรมธรรม์ (PDF) และรูปภาพความเสียหายไปให้ AI วิเคราะห์")
-
-        # บันทึก PDF ลงไฟล์ชั่วคระว (Gemini ต้องการ file path สำหรับ PDF)
-        with tempfile.NamedTemporaryFile(delete=False, suffix='.pdf') as temp_pdf:
-            temp_pdf.write(policy_doc_bytes)
-            temp_pdf_path = temp_pdf.name
+        temp_pdf_path = _write_policy_pdf(policy_info)
+        uploaded_pdf = None
 
         try:
             # อัพโหลด PDF ไปยัง Gemini
-            uploaded_pdf = genai.upload_file(temp_pdf_path, mime_type="application/pdf")
-            print(f"✅ อัพโหลด PDF สำเร็จ: {uploaded_pdf.name}")
+            uploaded_pdf = _uploaded_pdf(
+                gemini_breaker.call(provider.upload_file, temp_pdf_path, mime_type="application/pdf"))
 
             # รอให้ Gemini ประมวลผลไฟล์เสร็จ
-            time.sleep(2)
             print(f"⏳ รอ Gemini ประมวลผล PDF...")
+            provider.wait_for_file(uploaded_pdf)
 
             # เรียกใช้ Gemini API - ส่งทั้งรูปภาพความเสียหายและเอกสารกรมธรรม์
-            response = gemini_model.generate_content([
-                system_prompt,
-                damage_image,      # รูปที่ 1: ความเสียหาย
+            response = generate_with_gemini([
+                *contents,
                 uploaded_pdf       # เอกสารกรมธรรม์ (PDF)
-            ])
+            ], "analysis", user_id=user_id, policy_number=policy_info['policy_number'], prompt=prompt)
+
+        finally:
+            # ลบไฟล์ที่อัพโหลดออกจาก Gemini (รวมกรณีวิเคราะห์ไม่สำเร็จ)
+            if uploaded_pdf is not None:
+                _delete_uploaded_pdf(provider, uploaded_pdf.name)
+            _remove_temp_pdf(temp_pdf_path)
+
+        return response.text
+
+    except (CircuitOpenError, BudgetExceededError):
+        # ให้ผู้เรียกตอบข้อความสำเร็จรูป (หรือให้ job queue ตัดสินใจว่าจะลองใหม่หรือไม่)
+        raise
+    except Exception as e:
+        return _analysis_error_text(e)
+
+
+async def analyze_damage_with_gemini_async(
+    damage_images: List[bytes],
+    policy_info: Dict,
+    additional_info: Optional[str] = None,
+    has_counterpart: Optional[str] = None,
+    user_id: Optional[str] = None
+) -> str:
+    """
+    analyze_damage_with_gemini แบบ async: รอ Gemini (generate, อัพโหลด, รอไฟล์พร้อม) บน event loop
+    งานที่ใช้ CPU/ดิสก์ (แปลงเอกสารเป็นข้อความ, เขียน PDF ชั่วคราว) ทำใน thread
+    """
+    try:
+        if policy_info.get('policy_document_base64') is None:
+            return NO_POLICY_DOCUMENT_TEXT
+
+        prompt, contents = _damage_analysis_request(damage_images, policy_info, additional_info, has_counterpart,
+                                                    user_id)
+        provider = get_llm_provider()
+
+        policy_text = (await asyncio.to_thread(load_policy_text, policy_info)
+                       if POLICY_DOCUMENT_MODE == "text" else None)
+        if policy_text:
+            print(f"📄 ส่งเอกสารกรมธรรม์ (ข้อความ {len(policy_text)} ตัวอักษร) และรูปภาพความเสียหายไปให้ AI วิเคราะห์")
+            response = await generate_with_gemini_async([
+                *contents,
+                f"เอกสารกรมธรรม์ (ข้อความจาก PDF แยกตามหน้า):\n{policy_text}"
+            ], "analysis", user_id=user_id, policy_number=policy_info['policy_number'], prompt=prompt)
+            return response.text
 
-            # ลบไฟล์ที่อัพโหลดออกจาก Gemini
-            genai.delete_file(uploaded_pdf.name)
-            print(f"🗑️ ลบไฟล์ PDF จาก Gemini แล้ว")
+        print(f"📄 ส่งเอกสารกรมธรรม์ (PDF) และรูปภาพความเสียหายไปให้ AI วิเคราะห์")
+        temp_pdf_path = await asyncio.to_thread(_write_policy_pdf, policy_info)
+        upload = uploaded_pdf = None
+
+        try:
+            upload = asyncio.ensure_future(gemini_breaker.call_async(
+                provider.upload_file_async, temp_pdf_path, mime_type="application/pdf"))
+            uploaded_pdf = _uploaded_pdf(await asyncio.shield(upload))
+
+            print(f"⏳ รอ Gemini ประมวลผล PDF...")
+            await provider.wait_for_file_async(uploaded_pdf)
+
+            response = await generate_with_gemini_async([
+                *contents,
+                uploaded_pdf
+            ], "analysis", user_id=user_id, policy_number=policy_info['policy_number'], prompt=prompt)
 
         finally:
-            # ลบไฟล์ชั่วคระ
-            if os.path.exists(temp_pdf_path):
-                os.unlink(temp_pdf_path)
-                print(f"🗑️ ลบไฟล์ชั่วคระแล้ว")
+            if uploaded_pdf is None and upload is not None:
+                # ถูก cancel ระหว่างอัพโหลด (ตอนปิดระบบ): รอให้อัพโหลดจบเพื่อลบไฟล์ ไม่ทิ้งไว้ใน Gemini
+                uploaded_pdf = await _settled_upload(upload)
+                if uploaded_pdf is not None:
+                    _uploaded_pdf(uploaded_pdf)
+            if uploaded_pdf is not None:
+                await _delete_uploaded_pdf_async(provider, uploaded_pdf.name)
+            _remove_temp_pdf(temp_pdf_path)
 
         return response.text
 
+    except (CircuitOpenError, BudgetExceededError):
+        raise
     except Exception as e:
-        error_msg = f"เกิดข้อผิดพลาดในการวิเคราะห์รูปภาพ: {str(e)}"
-        print(f"Gemini API Error: {error_msg}")
-        import traceback
-        traceback.print_exc()
-        return f"❌ {error_msg}\n\nกรุณาลองใหม่อีกครั้ง หรือติดต่อเจ้าหน้าที่"
+        return _analysis_error_text(e)
 
 
 # ==================== LINE Bot Handlers ====================
-@handler.add(MessageEvent, message=TextMessageContent)
-def handle_text_message(event):
+class TextMessageContext:
     """
-    จัดการข้อความที่เป็นตัวอักษรจาก LINE
+    ข้อมูลที่ handler ของ conversation_router ใช้ตอบข้อความหนึ่งข้อความ
     """
-    user_id = event.source.user_id
-    text = event.message.text.strip()
 
-    with ApiClient(configuration) as api_client:
-        line_bot_api = MessagingApi(api_client)
+    def __init__(self, event, sender):
+        self.event = event
+        self.sender = sender
+        self.user_id = event.source.user_id
+        self.text = event.message.text.strip()
+        self.argument = None
 
-        try:
-            # Case 1: เริ่มต้นการตรวจสอบสิทธิ์
-            if text == "เช็คสิทธิ์เคลมด่วน":
-                # รีเซ็ต session
-                user_sessions[user_id] = {"state": "waiting_for_info"}
-
-                # ส่ง Flex Message ขอข้อมูล
-                flex_message = create_request_info_flex()
-                line_bot_api.reply_message(
-                    ReplyMessageRequest(
-                        reply_token=event.reply_token,
-                        messages=[FlexMessage(alt_text="กรุณาส่งข้อมูลชื่อและทะเบียนรถ", contents=flex_message)]
-                    )
-                )
-                return
+    @property
+    def state(self) -> Optional[str]:
+        return user_sessions.get(self.user_id, {}).get("state")
 
-            # Case 2: รับข้อมูลชื่อ ทะเบียนรถ หรือ เลขบัตรประชาชน
-            if user_id in user_sessions and user_sessions[user_id].get("state") == "waiting_for_info":
-                text_clean = text.replace('-', '').replace(' ', '')
-                
-                if re.match(r'^\d{13}$', text_clean):
-                    policies = search_policies_by_cid(text_clean)
-                else:
-                    policy = search_policies_by_plate(text)
-                    if policy:
-                        policies = [policy]
-                    else:
-                        policies = search_policies_by_name(text)
-
-                process_search_result(line_bot_api, event, user_id, policies)
-                return
+    @property
+    def session(self) -> Dict:
+        return user_sessions[self.user_id]
 
-            # Case 2.1: เลือกรถ
-            if user_id in user_sessions and user_sessions[user_id].get("state") == "waiting_for_vehicle_selection":
-                if text.startswith("เลือกทะเบียน "):
-                    plate = text.replace("เลือกทะเบียน ", "")
-                    policies = user_sessions[user_id].get("search_results", [])
-                    policy_info = next((p for p in policies if p["plate"] == plate), None)
-                    if policy_info:
-                        user_sessions[user_id] = {
-                            "state": "waiting_for_counterpart",
-                            "policy_info": policy_info
-                        }
-                        
-                        # แสดงรายละเอียดกรมธรรม์ (Step 5)
-                        flex_policy = create_policy_info_flex(policy_info)
-                        
-                        # ถามเรื่องคู่กรณี (Step 6)
-                        quick_reply = QuickReply(items=[
-                            QuickReplyItem(action=MessageAction(label="✅ มีคู่กรณี", text="มีคู่กรณี")),
-                            QuickReplyItem(action=MessageAction(label="❌ ไม่มีคู่กรณี", text="ไม่มีคู่กรณี"))
-                        ])
-                        
-                        line_bot_api.reply_message(
-                            ReplyMessageRequest(
-                                reply_token=event.reply_token,
-                                messages=[
-                                    FlexMessage(alt_text="พบข้อมูลกรมธรรม์", contents=flex_policy),
-                                    TextMessage(
-                                        text="❓ **มีคู่กรณีหรือไม่?**\n\nกรุณาเลือก:",
-                                        quick_reply=quick_reply
-                                    )
-                                ]
-                            )
-                        )
-                        return
-                    else:
-                        line_bot_api.reply_message(
-                            ReplyMessageRequest(
-                                reply_token=event.reply_token,
-                                messages=[TextMessage(text="❌ ไม่พบรถคันที่ท่านเลือก กรุณาเลือกจากเมนูอีกครั้ง")]
-                            )
-                        )
-                        return
-
-            # Case 2.2: รับเหตุการณ์
-            if user_id in user_sessions and user_sessions[user_id].get("state") == "waiting_for_additional_info":
-                if text.strip() != "ข้าม":
-                    user_sessions[user_id]["additional_info"] = text
-                else:
-                    user_sessions[user_id]["additional_info"] = None
-                
-                user_sessions[user_id]["state"] = "waiting_for_image"
-                
-                line_bot_api.reply_message(
-                    ReplyMessageRequest(
-                        reply_token=event.reply_token,
-                        messages=[
-                            TextMessage(text="📸 ขั้นตอนสุดท้าย: กรุณาส่งรูปภาพความเสียหายของรถค่ะ"),
-                            TextMessage(text="เพื่อให้ AI วิเคราะห์และประเมินสิทธิ์การเคลมให้คุณทันที")
-                        ]
-                    )
-                )
-                return
+    def reply(self, *messages):
+        self.sender.reply(self.event.reply_token, list(messages))
 
-            # Case 2.5: รับคำตอบเรื่องคู่กรณี (Step 6 -> 7)
-            if user_id in user_sessions and user_sessions[user_id].get("state") == "waiting_for_counterpart":
-
-                # ตรวจสอบคำตอบ
-                if text in ["มีคู่กรณี", "ไม่มีคู่กรณี"]:
-                    user_sessions[user_id]["has_counterpart"] = text
-                    user_sessions[user_id]["state"] = "waiting_for_additional_info"
-
-                    # ส่ง Flex Message ขอรายละเอียดเพิ่มเติม (Step 7)
-                    flex_additional = create_additional_info_prompt_flex()
-                    line_bot_api.reply_message(
-                        ReplyMessageRequest(
-                            reply_token=event.reply_token,
-                            messages=[FlexMessage(
-                                alt_text="กรุณาระบุรายละเอียดเพิ่มเติม",
-                                contents=flex_additional
-                            )]
-                        )
-                    )
-                    return
 
-                else:
-                    # คำตอบไม่ถูกต้อง
-                    quick_reply = QuickReply(items=[
-                        QuickReplyItem(action=MessageAction(
-                            label="✅ มีคู่กรณี",
-                            text="มีคู่กรณี"
-                        )),
-                        QuickReplyItem(action=MessageAction(
-                            label="❌ ไม่มีคู่กรณี",
-                            text="ไม่มีคู่กรณี"
-                        ))
-                    ])
-
-                    line_bot_api.reply_message(
-                        ReplyMessageRequest(
-                            reply_token=event.reply_token,
-                            messages=[TextMessage(
-                                text="❌ กรุณาเลือกจากปุ่มด้านล่าง:",
-                                quick_reply=quick_reply
-                            )]
-                        )
-                    )
-                    return
+# Case 1: เริ่มต้นการตรวจสอบสิทธิ์ (ใช้ได้ทุก state)
+@conversation_router.command("เช็คสิทธิ์เคลมด่วน")
+def start_claim_check(ctx: TextMessageContext):
+    # รีเซ็ต session (รวมถึงรูปที่ยังรอวิเคราะห์ของเคลมก่อน)
+    photo_batcher.discard(ctx.user_id)
+    user_sessions[ctx.user_id] = {"state": "waiting_for_info"}
 
-            # Case 3: ข้อความทั่วไป (ไม่อยู่ใน flow)
-            line_bot_api.reply_message(
-                ReplyMessageRequest(
-                    reply_token=event.reply_token,
-                    messages=[TextMessage(text='👋 สวัสดีค่ะ!\n\nส่ง "เช็คสิทธิ์เคลมด่วน" เพื่อเริ่มตรวจสอบสิทธิ์การเคลมประกันรถยนต์')]
-                )
-            )
+    # ส่ง Flex Message ขอข้อมูล
+    ctx.reply(request_info_message())
+
+
+# Case 2: รับข้อมูลชื่อ ทะเบียนรถ หรือ เลขบัตรประชาชน
+@conversation_router.fallback("waiting_for_info")
+def receive_policy_lookup(ctx: TextMessageContext):
+    from mock_data import search_name_candidates, search_plate_candidates, search_policies_by_cid
+
+    if not rate_limiter.allow("lookup", ctx.user_id):
+        print(f"🚦 ข้ามการค้นหาของ user: {ctx.user_id} (เกิน rate limit)")
+        ctx.reply(rate_limited_message())
+        return
+
+    text_clean = ctx.text.replace('-', '').replace(' ', '')
+    exact = True
+    if CID_PATTERN.match(text_clean):
+        policies = search_policies_by_cid(text_clean)
+    else:
+        policies, score = search_plate_candidates(ctx.text)
+        exact = score == SCORE_EXACT
+        if not policies:
+            # ชื่อที่พบจาก prefix/substring/พิมพ์ผิด อาจเป็นคนอื่น (เช่น "สมหมาย" -> สมชาย): ให้ผู้ใช้ยืนยันก่อน
+            policies, score = search_name_candidates(ctx.text)
+            exact = score is not None and score <= NAME_SCORE_TOKEN
+
+    process_search_result(ctx.sender, ctx.event, ctx.user_id, policies, exact=exact)
+
+
+# Case 2.1: เลือกรถ (ปุ่มใน create_vehicle_selection_flex ส่ง "เลือกรถ:<ทะเบียน>")
+@conversation_router.on_prefix("waiting_for_vehicle_selection", "เลือกทะเบียน ")
+@conversation_router.on_prefix("waiting_for_vehicle_selection", "เลือกรถ:")
+def select_vehicle(ctx: TextMessageContext):
+    from mock_data import get_policy_by_number
+
+    plate = ctx.argument
+    policies = (get_policy_by_number(number) for number in ctx.session.get("search_results", []))
+    policy_info = next((p for p in policies if p and p["plate"] == plate), None)
+    if not policy_info:
+        ctx.reply(text_message("❌ ไม่พบรถคันที่ท่านเลือก กรุณาเลือกจากเมนูอีกครั้ง"))
+        return
+
+    user_sessions[ctx.user_id] = {
+        "state": "waiting_for_counterpart",
+        **policy_reference(policy_info)
+    }
+    ctx.reply(*build_policy_found_messages(policy_info, COUNTERPART_QUESTION))
+
+
+# Case 2.2: รับเหตุการณ์ (พิมพ์ "ข้าม" ได้ถ้าไม่ต้องการระบุ)
+@conversation_router.on("waiting_for_additional_info", "ข้าม")
+def skip_additional_info(ctx: TextMessageContext):
+    _request_damage_image(ctx, None)
+
+
+@conversation_router.fallback("waiting_for_additional_info")
+def receive_additional_info(ctx: TextMessageContext):
+    _request_damage_image(ctx, ctx.text)
+
+
+def _request_damage_image(ctx: TextMessageContext, additional_info: Optional[str]):
+    ctx.session["additional_info"] = additional_info
+    ctx.session["state"] = "waiting_for_image"
+    ctx.reply(
+        text_message("📸 ขั้นตอนสุดท้าย: กรุณาส่งรูปภาพความเสียหายของรถค่ะ"),
+        text_message("เพื่อให้ AI วิเคราะห์และประเมินสิทธิ์การเคลมให้คุณทันที")
+    )
+
+
+# Case 2.5: รับคำตอบเรื่องคู่กรณี (Step 6 -> 7)
+@conversation_router.on("waiting_for_counterpart", "มีคู่กรณี")
+@conversation_router.on("waiting_for_counterpart", "ไม่มีคู่กรณี")
+def receive_counterpart(ctx: TextMessageContext):
+    ctx.session["has_counterpart"] = ctx.text
+    ctx.session["state"] = "waiting_for_additional_info"
+
+    # ส่ง Flex Message ขอรายละเอียดเพิ่มเติม (Step 7)
+    ctx.reply(additional_info_prompt_message())
 
+
+@conversation_router.fallback("waiting_for_counterpart")
+def invalid_counterpart_answer(ctx: TextMessageContext):
+    # คำตอบไม่ถูกต้อง
+    ctx.reply(text_message("❌ กรุณาเลือกจากปุ่มด้านล่าง:", quick_reply=counterpart_quick_reply()))
+
+
+# Case 3: ข้อความทั่วไป (ไม่อยู่ใน flow)
+@conversation_router.default()
+def greeting(ctx: TextMessageContext):
+    ctx.reply(text_message('👋 สวัสดีค่ะ!\n\nส่ง "เช็คสิทธิ์เคลมด่วน" เพื่อเริ่มตรวจสอบสิทธิ์การเคลมประกันรถยนต์'))
+
+
+def persist_session(func):
+    """
+    บันทึก session ของผู้ใช้ลง session_store หลัง handler ทำงานเสร็จ (สำเร็จหรือไม่ก็ตาม)
+    handler ของผู้ใช้คนเดียวกันรันทีละตัวอยู่แล้ว จึงบันทึกสถานะล่าสุดได้ตรงลำดับ
+    """
+    @wraps(func)
+    def wrapper(event):
+        try:
+            return func(event)
+        finally:
+            user_id = event.source.user_id
+            session_store.save(user_id, user_sessions.get(user_id))
+    return wrapper
+
+
+@handler.add(MessageEvent, message=TextMessageContent)
+@persist_session
+def handle_text_message(event):
+    """
+    จัดการข้อความที่เป็นตัวอักษรจาก LINE (ส่งต่อให้ conversation_router ตาม state)
+    """
+    with open_line_sender() as sender:
+        ctx = TextMessageContext(event, sender)
+
+        try:
+            conversation_router.dispatch(ctx)
         except Exception as e:
             print(f"Error handling text message: {str(e)}")
-            line_bot_api.reply_message(
-                ReplyMessageRequest(
-                    reply_token=event.reply_token,
-                    messages=[TextMessage(text="❌ เกิดข้อผิดพลาด กรุณาลองใหม่อีกครั้ง")]
-                )
-            )
+            ctx.reply(text_message("❌ เกิดข้อผิดพลาด กรุณาลองใหม่อีกครั้ง"))
 
 
 @handler.add(MessageEvent, message=ImageMessageContent)
+@persist_session
 def handle_image_message(event):
     """
-    จัดการรูปภาพจาก LINE และวิเคราะห์ด้วย Gemini AI
+    จัดการรูปภาพจาก LINE
+    - waiting_for_info: OCR หาข้อมูลรถจากรูปทันที (หรือส่งเข้า job_queue ให้ worker.py ทำ)
+    - waiting_for_image: เก็บรูปเข้า photo_batcher แล้ววิเคราะห์ทุกรูปของเคลมรวมกันใน analyze_claim_photos
     """
     user_id = event.source.user_id
 
-    with ApiClient(configuration) as api_client:
-        line_bot_api = MessagingApi(api_client)
-
+    with open_line_sender() as sender:
         try:
             # ดึงสถานะปัจจุบัน
             current_state = user_sessions.get(user_id, {}).get("state")
 
             # ตรวจสอบว่าผู้ใช้อยู่ในขั้นตอนที่ถูกต้องหรือไม่
             if current_state not in ["waiting_for_info", "waiting_for_image"]:
-                line_bot_api.reply_message(
-                    ReplyMessageRequest(
-                        reply_token=event.reply_token,
-                        messages=[TextMessage(text='⚠️ กรุณาส่ง "เช็คสิทธิ์เคลมด่วน" และกรอกข้อมูลก่อนส่งรูปภาพค่ะ')]
-                    )
+                sender.reply(
+                    event.reply_token,
+                    [text_message('⚠️ กรุณาส่ง "เช็คสิทธิ์เคลมด่วน" และกรอกข้อมูลก่อนส่งรูปภาพค่ะ')]
                 )
                 return
 
-            # แจ้งว่ากำลังประมวลผล
-            if current_state == "waiting_for_info":
-                msg_text = "⏳ กำลังค้นหาข้อมูล...\n\nกรุณารอสักครู่ค่ะ"
-            else:
-                msg_text = "⏳ กำลังวิเคราะห์รูปภาพ...\n\nกรุณารอสักครู่ค่ะ (ประมาณ 10-30 วินาที)"
-
-            line_bot_api.reply_message(
-                ReplyMessageRequest(
-                    reply_token=event.reply_token,
-                    messages=[TextMessage(text=msg_text)]
-                )
-            )
+            # --- CASE 2: รูปความเสียหาย เก็บไว้วิเคราะห์รวมกับรูปมุมอื่นที่ส่งตามมา ---
+            if current_state == "waiting_for_image":
+                image_set = event.message.image_set
+                count = photo_batcher.add(user_id, event.message.id, image_set.total if image_set else None)
+                if count == 0:
+                    print(f"📸 รูปความเสียหายของ user: {user_id} มาหลังส่งวิเคราะห์ครบ {MAX_CLAIM_PHOTOS} รูปแล้ว")
+                    sender.reply(event.reply_token, [text_message(
+                        f"⚠️ รูปนี้มาช้าเกินไป ระบบกำลังวิเคราะห์ {MAX_CLAIM_PHOTOS} รูปที่ส่งก่อนหน้าอยู่ค่ะ\n\n"
+                        "ถ้าต้องการส่งรูปใหม่ กรุณาพิมพ์ 'เช็คสิทธิ์เคลมด่วน' หลังได้รับผลวิเคราะห์ค่ะ"
+                    )])
+                    return
+                print(f"📸 ได้รับรูปความเสียหายรูปที่ {count} ของ user: {user_id}")
 
-            # ดาวน์โหลดรูปภาพจาก LINE
-            message_id = event.message.id
-            image_url = f"https://api-data.line.me/v2/bot/message/{message_id}/content"
-            headers = {"Authorization": f"Bearer {LINE_CHANNEL_ACCESS_TOKEN}"}
+                # รูปแรกของ batch = การวิเคราะห์ใหม่หนึ่งครั้ง (รูปถัดไปใน batch เดียวกันไม่นับซ้ำ)
+                if count == 1 and not rate_limiter.allow("analysis", user_id):
+                    photo_batcher.discard(user_id)
+                    print(f"🚦 ข้ามรูปความเสียหายของ user: {user_id} (เกิน rate limit)")
+                    sender.reply(event.reply_token, [rate_limited_message()])
+                    return
 
-            with httpx.Client() as client:
-                response = client.get(image_url, headers=headers)
-                response.raise_for_status()
-                image_bytes = response.content
+                # แจ้งว่ากำลังประมวลผลเฉพาะรูปแรก (รูปถัดไปไม่ต้องตอบซ้ำ)
+                if count == 1:
+                    msg_text = "⏳ กำลังวิเคราะห์รูปภาพ...\n\nกรุณารอสักครู่ค่ะ (ประมาณ 10-30 วินาที)"
+                    if PHOTO_WINDOW_S > 0:
+                        msg_text += (f"\n\n📸 มีรูปมุมอื่นอีกไหมคะ? ส่งเพิ่มได้ภายใน {PHOTO_WINDOW_S:g} วินาที "
+                                     f"(สูงสุด {MAX_CLAIM_PHOTOS} รูป) ระบบจะวิเคราะห์ทุกรูปรวมกันค่ะ")
+                    sender.reply(event.reply_token, [text_message(msg_text)])
+                return
 
             # --- CASE 1: ส่งรูปเพื่อหาข้อมูลรถ (บัตร ปชช / ทะเบียนรถ) ---
-            if current_state == "waiting_for_info":
-                print(f"🔍 เริ่ม OCR รูปภาพสำหรับหาข้อมูลรถ: {user_id}")
-                info = extract_info_from_image_with_gemini(image_bytes)
-                print(f"🤖 ผลลัพธ์ OCR: {info}")
-
-                if info["type"] == "id_card" and info["value"]:
-                    policies = search_policies_by_cid(info["value"])
-                    process_search_result(line_bot_api, event, user_id, policies, use_push=True)
-                elif info["type"] == "license_plate" and info["value"]:
-                    policy = search_policies_by_plate(info["value"])
-                    policies = [policy] if policy else []
-                    process_search_result(line_bot_api, event, user_id, policies, use_push=True)
-                else:
-                    line_bot_api.push_message(
-                        PushMessageRequest(
-                            to=user_id,
-                            messages=[TextMessage(text="❌ ไม่พบข้อมูลในรูปภาพ\n\nกรุณาส่งรูปบัตรประชาชน หรือรูปทะเบียนรถที่ชัดเจน หรือพิมพ์ข้อมูลด้วยตนเองค่ะ")]
-                        )
-                    )
+            if not rate_limiter.allow("ocr", user_id):
+                print(f"🚦 ข้าม OCR ของ user: {user_id} (เกิน rate limit)")
+                sender.reply(event.reply_token, [rate_limited_message()])
                 return
 
-            # --- CASE 2: ส่งรูปความเสียหายเพื่อวิเคราะห์การเคลม (เดิม) ---
-            print(f"🔍 เริ่มวิเคราะห์รูปความเสียหายสำหรับ user: {user_id}")
+            # แจ้งว่ากำลังประมวลผล
+            sender.reply(event.reply_token, [text_message("⏳ กำลังค้นหาข้อมูล...\n\nกรุณารอสักครู่ค่ะ")])
 
-            # ดึงข้อมูลกรมธรรม์จาก session
-            policy_info = user_sessions[user_id]["policy_info"]
-            additional_info = user_sessions[user_id].get("additional_info")
-            has_counterpart = user_sessions[user_id].get("has_counterpart")
+            if job_queue is not None:
+                job_id = job_queue.enqueue("ocr_lookup", {"user_id": user_id, "message_id": event.message.id}, key=user_id)
+                print(f"📥 ส่งงาน OCR เข้าคิว (งาน {job_id}) ของ user: {user_id}")
+                return
 
-            print(f"📋 ข้อมูลกรมธรรม์: {policy_info['policy_number']}")
-            print(f"📝 รายละเอียดเพิ่มเติม: {additional_info if additional_info else 'ไม่มี'}")
-            print(f"👥 สถานะคู่กรณี: {has_counterpart if has_counterpart else 'ไม่ระบุ'}")
+            if gemini_loop is not None:
+                gemini_loop.submit(ocr_policy_lookup_async(user_id, event.message.id))
+                return
 
-            # วิเคราะห์ด้วย Gemini AI (ส่งข้อมูลเพิ่มเติมและสถานะคู่กรณี)
-            print(f"🤖 กำลังส่งไปยัง Gemini AI...")
+            info = ocr_policy_lookup(event.message.id, user_id)
+            apply_ocr_result(sender, user_id, info)
 
-            analysis_result = analyze_damage_with_gemini(
-                image_bytes,
-                policy_info,
-                additional_info,
-                has_counterpart
-            )
+        except Exception as e:
+            notify_image_error(sender, user_id, e)
 
-            print(f"✅ Gemini AI ตอบกลับแล้ว")
-            print(f"📝 ผลการวิเคราะห์: {analysis_result[:100]}...")
-
-            # ดึงเบอร์โทรจากข้อความ AI
-            phone_number = extract_phone_from_response(analysis_result)
-            print(f"📞 เบอร์โทรที่ดึงได้: {phone_number if phone_number else 'ไม่พบ'}")
-
-            # ส่งผลการวิเคราะห์กลับไปยังผู้ใช้พร้อมปุ่มโทรออก
-            if phone_number:
-                # สร้าง Flex Message พร้อมปุ่มโทรออก
-                flex_message = create_analysis_result_flex(
-                    summary_text=analysis_result,
-                    phone_number=phone_number,
-                    insurance_company=policy_info.get('insurance_company', ''),
-                    claim_status="unknown"  # สามารถปรับให้ AI ส่ง status มาได้
-                )
 
-                line_bot_api.push_message(
-                    PushMessageRequest(
-                        to=user_id,
-                        messages=[FlexMessage(
-                            alt_text="ผลการวิเคราะห์เคลมประกัน",
-                            contents=flex_message
-                        )]
-                    )
+def notify_image_error(sender, user_id: str, error: Exception):
+    """
+    แจ้งผู้ใช้เมื่อประมวลผลรูป (OCR/วิเคราะห์ความเสียหาย) ไม่สำเร็จ
+    """
+    if isinstance(error, CircuitOpenError):
+        print(f"🔌 {error}")
+        sender.push(user_id, [upstream_busy_message()])
+    elif isinstance(error, BudgetExceededError):
+        print(f"💸 {error}")
+        sender.push(user_id, [budget_exceeded_message()])
+    elif isinstance(error, httpx.HTTPStatusError):
+        print(f"❌ Error downloading image: {str(error)}")
+        sender.push(user_id, [text_message("❌ ไม่สามารถดาวน์โหลดรูปภาพได้ กรุณาลองใหม่อีกครั้ง")])
+    else:
+        print(f"❌ Error handling image message: {str(error)}")
+        import traceback
+        traceback.print_exception(error)
+
+        sender.push(
+            user_id,
+            [text_message(f"❌ เกิดข้อผิดพลาด: {str(error)}\n\nกรุณาลองใหม่อีกครั้ง หรือติดต่อเจ้าหน้าที่")]
+        )
+
+
+def with_line_sender(fn: Callable, *args):
+    """
+    เรียก fn(sender, *args) ด้วยตัวส่งข้อความของงานนี้ (สำหรับงานที่ทำนอก handler เช่นใน gemini_loop)
+    """
+    with open_line_sender() as sender:
+        return fn(sender, *args)
+
+
+def download_line_image(message_id: str) -> bytes:
+    """
+    ดาวน์โหลดรูปภาพจาก LINE
+    """
+    image_url = f"{LINE_DATA_API_ENDPOINT}/v2/bot/message/{message_id}/content"
+    headers = {"Authorization": f"Bearer {LINE_CHANNEL_ACCESS_TOKEN}"}
+
+    def fetch():
+        response = line_data_client.get(image_url, headers=headers)
+        response.raise_for_status()
+        return response.content
+
+    return line_content_breaker.call(fetch)
+
+
+def download_line_images(message_ids: List[str]) -> List[bytes]:
+    """
+    ดาวน์โหลดหลายรูปพร้อมกัน (ผลลัพธ์เรียงตาม message_ids)
+    """
+    if len(message_ids) == 1:
+        return [download_line_image(message_ids[0])]
+    with ThreadPoolExecutor(max_workers=min(len(message_ids), 8), thread_name_prefix="download") as pool:
+        return list(pool.map(download_line_image, message_ids))
+
+
+def claim_analysis_priority() -> str:
+    """
+    analyze_claim_photos กิน thread ของ event_executor ตลอดการวิเคราะห์เฉพาะเมื่อรอ Gemini ใน thread นั้นเอง
+    (ถ้าส่งต่อให้ job_queue หรือ gemini_loop จะจบเร็วเท่างานตอบผู้ใช้ทั่วไป)
+    """
+    return BULK if job_queue is None and gemini_loop is None else INTERACTIVE
+
+
+def analyze_claim_photos(user_id: str, message_ids: List[str]):
+    """
+    วิเคราะห์รูปความเสียหายทุกรูปของเคลมใน request เดียว แล้วส่งผลสรุปเดียวให้ผู้ใช้
+    (photo_batcher ส่งงานนี้เข้า event_executor ด้วย key ของผู้ใช้ จึงไม่ชนกับ event อื่นของคนเดียวกัน)
+    ถ้าเปิด job_queue จะส่งงานเข้าคิวให้ worker.py ทำแทน
+    """
+    # รับรูปที่มาถึงหลัง batch ถูกส่ง (ก่อนงานนี้ได้เริ่ม) ไปด้วย; None = batch ถูกยกเลิก (ผู้ใช้เริ่มเคลมใหม่)
+    taken = photo_batcher.take(user_id)
+    if taken is None:
+        print(f"⚠️ ข้ามรูป {len(message_ids)} รูปของ user: {user_id} (batch ถูกยกเลิก)")
+        return
+    message_ids = taken
+
+    # ผู้ใช้อาจเริ่มเคลมใหม่ระหว่างรอรวบรวมรูป
+    current_state = user_sessions.get(user_id, {}).get("state")
+    if current_state != "waiting_for_image":
+        print(f"⚠️ ข้ามรูป {len(message_ids)} รูปของ user: {user_id} (state เปลี่ยนเป็น {current_state})")
+        return
+
+    with shutdown_coordinator.claim(user_id), open_line_sender() as sender:
+        try:
+            print(f"🔍 เริ่มวิเคราะห์รูปความเสียหาย {len(message_ids)} รูปสำหรับ user: {user_id}")
+
+            # ดึงข้อมูลกรมธรรม์จาก session
+            session = user_sessions[user_id]
+            if not resolve_session_policy(session):
+                sender.push(
+                    user_id,
+                    [text_message("❌ ไม่พบข้อมูลกรมธรรม์ของท่าน\n\nกรุณาพิมพ์ 'เช็คสิทธิ์เคลมด่วน' เพื่อเริ่มใหม่ค่ะ")]
                 )
-                print(f"✅ ส่งผลการวิเคราะห์พร้อมปุ่มโทร {phone_number}")
+                return
+
+            # ข้อมูลทุกอย่างที่ต้องใช้วิเคราะห์ (worker ไม่เห็น user_sessions ของ web)
+            payload = {
+                "user_id": user_id,
+                "message_ids": message_ids,
+                "policy_number": session.get("policy_number"),
+                "policy_version": session.get("policy_version"),
+                "additional_info": session.get("additional_info"),
+                "has_counterpart": session.get("has_counterpart"),
+            }
+            if job_queue is not None:
+                job_id = job_queue.enqueue("analyze_claim", payload, key=user_id)
+                print(f"📥 ส่งงานวิเคราะห์ {len(message_ids)} รูปเข้าคิว (งาน {job_id})")
+            elif gemini_loop is not None:
+                gemini_loop.submit(run_claim_analysis_async(payload))
             else:
-                # ถ้าไม่มีเบอร์โทร → ส่งเป็น Text ธรรมดา + ข้อความปิดท้าย
-                line_bot_api.push_message(
-                    PushMessageRequest(
-                        to=user_id,
-                        messages=[TextMessage(text=analysis_result)]
-                    )
-                )
-                print(f"✅ ส่งผลการวิเคราะห์แบบ Text (ไม่พบเบอร์โทร)")
-
-                # ส่งข้อความปิดท้าย
-                line_bot_api.push_message(
-                    PushMessageRequest(
-                        to=user_id,
-                        messages=[TextMessage(text='✅ การวิเคราะห์เสร็จสมบูรณ์\n\nหากต้องการตรวจสอบรถคันอื่น กรุณาส่ง "เช็คสิทธิ์เคลมด่วน" อีกครั้งค่ะ')]
-                    )
-                )
+                run_claim_analysis(sender, payload)
 
-            # รีเซ็ต session หลังจากเสร็จสิ้น
+            # รีเซ็ต session หลังจากเสร็จสิ้น (หรือส่งเข้าคิวแล้ว)
             user_sessions[user_id] = {"state": "completed"}
 
-        except httpx.HTTPStatusError as e:
-            print(f"❌ Error downloading image: {str(e)}")
-            line_bot_api.push_message(
-                PushMessageRequest(
-                    to=user_id,
-                    messages=[TextMessage(text="❌ ไม่สามารถดาวน์โหลดรูปภาพได้ กรุณาลองใหม่อีกครั้ง")]
-                )
-            )
         except Exception as e:
-            print(f"❌ Error handling image message: {str(e)}")
-            import traceback
-            traceback.print_exc()
-
-            line_bot_api.push_message(
-                PushMessageRequest(
-                    to=user_id,
-                    messages=[TextMessage(text=f"❌ เกิดข้อผิดพลาด: {str(e)}\n\nกรุณาลองใหม่อีกครั้ง หรือติดต่อเจ้าหน้าที่")]
-                )
+            notify_image_error(sender, user_id, e)
+
+        finally:
+            session_store.save(user_id, user_sessions.get(user_id))
+
+
+def claim_analysis_policy(payload: Dict) -> Dict:
+    """
+    กรมธรรม์ของงานวิเคราะห์ (ตามเลขและเวอร์ชันใน payload)
+    """
+    policy_info = resolve_session_policy(payload)
+    if not policy_info:
+        raise LookupError(f"ไม่พบกรมธรรม์ {payload.get('policy_number')}")
+
+    print(f"📋 ข้อมูลกรมธรรม์: {policy_info['policy_number']}")
+    print(f"📝 รายละเอียดเพิ่มเติม: {payload.get('additional_info') or 'ไม่มี'}")
+    print(f"👥 สถานะคู่กรณี: {payload.get('has_counterpart') or 'ไม่ระบุ'}")
+    return policy_info
+
+
+def run_claim_analysis(sender, payload: Dict, retry_key: Optional[str] = None):
+    """
+    ดาวน์โหลดรูป วิเคราะห์ด้วย Gemini และ push ผลให้ผู้ใช้ (ใช้ได้ทั้งใน web process และ worker)
+    retry_key = ค่าคงที่ต่องาน เพื่อให้ LINE ไม่ส่งข้อความซ้ำเมื่อ worker ลองงานเดิมใหม่
+    """
+    policy_info = claim_analysis_policy(payload)
+
+    # วิเคราะห์ด้วย Gemini AI (ส่งข้อมูลเพิ่มเติมและสถานะคู่กรณี)
+    print(f"🤖 กำลังส่งไปยัง Gemini AI...")
+
+    # ดาวน์โหลดทุกรูปพร้อมกัน
+    damage_images = download_line_images(payload["message_ids"])
+
+    analysis_result = analyze_damage_with_gemini(
+        damage_images,
+        policy_info,
+        payload.get("additional_info"),
+        payload.get("has_counterpart"),
+        user_id=payload["user_id"]
+    )
+    send_claim_analysis_result(sender, payload, policy_info, analysis_result, retry_key)
+
+
+async def run_claim_analysis_async(payload: Dict):
+    """
+    run_claim_analysis บน gemini_loop: รอ Gemini บน event loop ส่วนดาวน์โหลดรูปและส่งข้อความทำใน thread
+    handler ที่ส่งงานนี้จบไปแล้ว จึงแจ้ง error ให้ผู้ใช้เอง
+    """
+    user_id = payload["user_id"]
+    with shutdown_coordinator.claim(user_id):
+        try:
+            policy_info = claim_analysis_policy(payload)
+            print(f"🤖 กำลังส่งไปยัง Gemini AI (async)...")
+            damage_images = await asyncio.to_thread(download_line_images, payload["message_ids"])
+            analysis_result = await analyze_damage_with_gemini_async(
+                damage_images,
+                policy_info,
+                payload.get("additional_info"),
+                payload.get("has_counterpart"),
+                user_id=user_id
             )
+            await asyncio.to_thread(with_line_sender, send_claim_analysis_result, payload, policy_info,
+                                    analysis_result)
+        except Exception as e:
+            await asyncio.to_thread(with_line_sender, notify_image_error, user_id, e)
+
+
+def send_claim_analysis_result(sender, payload: Dict, policy_info: Dict, analysis_result: str,
+                               retry_key: Optional[str] = None):
+    """
+    push ผลการวิเคราะห์ (พร้อมปุ่มโทรแจ้งเหตุถ้าหาเบอร์ได้)
+    """
+    user_id = payload["user_id"]
+    if shutdown_coordinator.is_abandoned(user_id):
+        # ผู้ใช้ได้รับข้อความให้เริ่มใหม่ตอนปิดระบบไปแล้ว
+        print(f"⚠️ ไม่ส่งผลวิเคราะห์ของ user: {user_id} (แจ้งให้เริ่มใหม่ตอนปิดระบบแล้ว)")
+        return
+
+    def push(messages, index: int):
+        key = str(uuid.uuid5(uuid.NAMESPACE_URL, f"{retry_key}/{index}")) if retry_key else None
+        try:
+            sender.push(user_id, messages, retry_key=key)
+        except LineApiError as e:
+            # 409 = retry key นี้ถูกส่งสำเร็จไปแล้วในครั้งก่อน
+            if key is None or e.status != 409:
+                raise
+            print(f"ℹ️ ข้อความที่ {index} ของ user: {user_id} ถูกส่งไปแล้ว")
+
+    print(f"✅ Gemini AI ตอบกลับแล้ว")
+    print(f"📝 ผลการวิเคราะห์: {analysis_result[:100]}...")
+
+    # เบอร์แจ้งเหตุจาก facts ของเอกสาร (ถ้ายังไม่มี ดึงจากข้อความ AI)
+    facts = policy_facts_enricher.current(policy_info)
+    phone_number = (facts or {}).get("hotline") or extract_phone_from_response(analysis_result)
+    print(f"📞 เบอร์โทรที่ดึงได้: {phone_number if phone_number else 'ไม่พบ'}")
+
+    # ส่งผลการวิเคราะห์กลับไปยังผู้ใช้พร้อมปุ่มโทรออก
+    if phone_number:
+        # สร้าง Flex Message พร้อมปุ่มโทรออก
+        result_flex = create_analysis_result_flex(
+            summary_text=analysis_result,
+            phone_number=phone_number,
+            insurance_company=policy_info.get('insurance_company', ''),
+            claim_status="unknown"  # สามารถปรับให้ AI ส่ง status มาได้
+        )
+
+        push([flex_message("ผลการวิเคราะห์เคลมประกัน", result_flex)], 0)
+        print(f"✅ ส่งผลการวิเคราะห์พร้อมปุ่มโทร {phone_number}")
+    else:
+        # ถ้าไม่มีเบอร์โทร → ส่งเป็น Text ธรรมดา + ข้อความปิดท้าย
+        push([text_message(analysis_result)], 0)
+        print(f"✅ ส่งผลการวิเคราะห์แบบ Text (ไม่พบเบอร์โทร)")
+
+        # ส่งข้อความปิดท้าย
+        push([text_message('✅ การวิเคราะห์เสร็จสมบูรณ์\n\nหากต้องการตรวจสอบรถคันอื่น กรุณาส่ง "เช็คสิทธิ์เคลมด่วน" อีกครั้งค่ะ')], 1)
+
+
+def ocr_policy_lookup(message_id: str, user_id: Optional[str] = None) -> Dict:
+    """
+    ดาวน์โหลดรูปบัตรประชาชน/ทะเบียนรถ แล้วให้ Gemini อ่านข้อมูล
+    """
+    image_bytes = download_line_image(message_id)
+    print(f"🔍 เริ่ม OCR รูปภาพสำหรับหาข้อมูลรถ: {message_id}")
+    info = extract_info_from_image_with_gemini(image_bytes, user_id=user_id)
+    print(f"🤖 ผลลัพธ์ OCR: {info}")
+    return info
+
+
+async def ocr_policy_lookup_async(user_id: str, message_id: str):
+    """
+    ocr_policy_lookup บน gemini_loop แล้วส่งผลกลับไปอัปเดต session ใน event_executor (key ของผู้ใช้)
+    """
+    try:
+        image_bytes = await asyncio.to_thread(download_line_image, message_id)
+        print(f"🔍 เริ่ม OCR รูปภาพสำหรับหาข้อมูลรถ: {message_id}")
+        info = await extract_info_from_image_with_gemini_async(image_bytes, user_id=user_id)
+        print(f"🤖 ผลลัพธ์ OCR: {info}")
+    except Exception as e:
+        await asyncio.to_thread(with_line_sender, notify_image_error, user_id, e)
+        return
+    await asyncio.wrap_future(event_executor.submit(user_id, apply_pending_ocr_result, user_id, info))
+
+
+def apply_ocr_result(sender, user_id: str, info: Dict):
+    """
+    ค้นหากรมธรรม์จากผล OCR แล้วอัปเดต session และแจ้งผู้ใช้ (ทำใน web process เท่านั้น)
+    """
+    from mock_data import search_plate_candidates, search_policies_by_cid
+
+    if info.get("type") == "id_card" and info.get("value"):
+        policies = search_policies_by_cid(info["value"])
+        process_search_result(sender, None, user_id, policies, use_push=True)
+    elif info.get("type") == "license_plate" and info.get("value"):
+        # OCR อ่านผิดได้: ทะเบียนที่ไม่ตรงตัวต้องให้ผู้ใช้ยืนยันก่อน
+        policies, score = search_plate_candidates(info["value"])
+        process_search_result(sender, None, user_id, policies, use_push=True, exact=score == SCORE_EXACT)
+    else:
+        sender.push(
+            user_id,
+            [text_message("❌ ไม่พบข้อมูลในรูปภาพ\n\nกรุณาส่งรูปบัตรประชาชน หรือรูปทะเบียนรถที่ชัดเจน หรือพิมพ์ข้อมูลด้วยตนเองค่ะ")]
+        )
+
+
+# ==================== Job Queue ====================
+def run_claim_analysis_job(job: Dict) -> None:
+    with open_line_sender() as sender:
+        run_claim_analysis(sender, job["payload"], retry_key=f"job-{job['id']}")
+
+
+def run_ocr_job(job: Dict) -> Dict:
+    # ผล OCR ถูกส่งกลับให้ web ผ่าน job_queue.results() เพราะต้องอัปเดต user_sessions
+    return ocr_policy_lookup(job["payload"]["message_id"], job["payload"]["user_id"])
+
+
+# kind ของงาน -> ฟังก์ชันที่ worker.py เรียก (ค่าที่คืนถูกเก็บเป็นผลลัพธ์ของงาน)
+JOB_HANDLERS = {
+    "analyze_claim": run_claim_analysis_job,
+    "ocr_lookup": run_ocr_job,
+}
+
+# priority class ของงานแต่ละ kind ใน worker.py (OCR ผู้ใช้รอคำตอบอยู่ จึงหยิบก่อนงานวิเคราะห์ที่ค้าง)
+JOB_PRIORITIES = {
+    "analyze_claim": BULK,
+    "ocr_lookup": INTERACTIVE,
+}
+
+# ข้อความแจ้งผู้ใช้เมื่องานล้มเหลวจนเข้า dead letter
+JOB_FAILURE_MESSAGES = {
+    "analyze_claim": "❌ วิเคราะห์รูปภาพไม่สำเร็จ\n\nกรุณาส่ง \"เช็คสิทธิ์เคลมด่วน\" เพื่อเริ่มใหม่ หรือติดต่อเจ้าหน้าที่ค่ะ",
+    "ocr_lookup": "❌ อ่านข้อมูลจากรูปภาพไม่สำเร็จ\n\nกรุณาส่งรูปใหม่ หรือพิมพ์ข้อมูลด้วยตนเองค่ะ",
+}
+
+
+def notify_job_failed(job: Dict):
+    with open_line_sender() as sender:
+        sender.push(
+            job["payload"]["user_id"],
+            [text_message(JOB_FAILURE_MESSAGES[job["kind"]])],
+            retry_key=str(uuid.uuid5(uuid.NAMESPACE_URL, f"job-{job['id']}/failed"))
+        )
+
+
+def apply_pending_ocr_result(user_id: str, info: Dict):
+    """
+    นำผล OCR ที่ทำนอก handler (worker หรือ gemini_loop) มาใช้ (รันใน event_executor ด้วย key ของผู้ใช้)
+    """
+    try:
+        # ผู้ใช้อาจพิมพ์ข้อมูลเองหรือเริ่มใหม่ระหว่างรอ OCR
+        current_state = user_sessions.get(user_id, {}).get("state")
+        if current_state != "waiting_for_info":
+            print(f"⚠️ ข้ามผล OCR ของ user: {user_id} (state เปลี่ยนเป็น {current_state})")
+            return
+        with open_line_sender() as sender:
+            apply_ocr_result(sender, user_id, info)
+    finally:
+        session_store.save(user_id, user_sessions.get(user_id))
+
+
+def apply_queued_ocr_result(job: Dict):
+    """
+    นำผล OCR จาก worker มาใช้ แล้ว ack ผลลัพธ์ในคิว
+    """
+    try:
+        apply_pending_ocr_result(job["payload"]["user_id"], job["result"])
+    finally:
+        job_queue.ack_result(job["id"])
+
+
+def _collect_job_results(stop: threading.Event):
+    """
+    ดึงผลลัพธ์ของงานที่ worker ทำเสร็จมาใช้ใน web process (background thread)
+    """
+    from concurrent.futures import wait
+
+    while not stop.wait(JOB_RESULT_POLL_S):
+        try:
+            jobs = job_queue.results(["ocr_lookup"])
+            futures = [
+                event_executor.submit(job["payload"]["user_id"], apply_queued_ocr_result, job)
+                for job in jobs
+            ]
+            # รอให้ใช้ผลเสร็จ (และ ack) ก่อนดึงรอบถัดไป จะได้ไม่หยิบงานเดิมซ้ำ
+            wait(futures)
+        except Exception as e:
+            print(f"⚠️ ดึงผลลัพธ์จาก job queue ไม่สำเร็จ: {e}")
+
+
+def _session_expired(user_id: str, now: float) -> bool:
+    last_active = session_store.last_active(user_id)
+    if last_active is None:
+        return False
+    state = user_sessions.get(user_id, {}).get("state")
+    ttl = SESSION_FINISHED_TTL_S if state is None or state in FINISHED_SESSION_STATES else SESSION_IDLE_TTL_S
+    return now - last_active >= ttl
+
+
+def expire_session(user_id: str, now: Optional[float] = None) -> bool:
+    """
+    ลบ session ของผู้ใช้ถ้าไม่มีความเคลื่อนไหวนานเกิน TTL คืน True ถ้าลบ
+    ต้องรันใน event_executor ตาม key ของผู้ใช้ (ไม่ชนกับ handler ที่กำลังใช้ session เดียวกัน)
+    """
+    if not _session_expired(user_id, now or time.time()):
+        return False
+    user_sessions.pop(user_id, None)
+    session_store.save(user_id, None)
+    return True
+
+
+def _sweep_idle_sessions(stop: threading.Event):
+    """
+    หา session ที่หมดอายุแล้วส่งให้ expire_session ตรวจซ้ำและลบใน executor (background thread)
+    """
+    while not stop.wait(SESSION_SWEEP_INTERVAL_S):
+        try:
+            now = time.time()
+            expired = [user_id for user_id in session_store.idle_users(now - min(SESSION_FINISHED_TTL_S,
+                                                                                 SESSION_IDLE_TTL_S))
+                       if _session_expired(user_id, now)]
+            for user_id in expired:
+                event_executor.submit(user_id, expire_session, user_id)
+            if expired:
+                print(f"🧹 ลบ session ที่ไม่มีความเคลื่อนไหว {len(expired)} รายการ")
+        except Exception as e:
+            print(f"⚠️ ลบ session ที่หมดอายุไม่สำเร็จ: {e}")
+
+
+# เวลาที่ใช้ import main.py (ไม่รวม import ที่เลื่อนไปทำใน warm-up)
+IMPORT_PROFILE_MS = {"main_module": round((time.perf_counter() - _MODULE_IMPORT_STARTED) * 1000, 1)}
 
 
 # ==================== FastAPI Endpoints ====================
@@ -719,25 +1623,37 @@ async def webhook(request: Request):
     """
     Webhook Endpoint สำหรับรับข้อมูลจาก LINE Platform
     """
+    # กำลังปิดระบบ: ไม่รับงานใหม่ (LINE ส่ง webhook ซ้ำให้ instance ใหม่เมื่อเปิด redelivery)
+    if shutdown_coordinator.draining:
+        raise HTTPException(status_code=503, detail="Shutting down")
+
     # ดึง signature จาก header เพื่อ verify ว่าเป็น request จาก LINE จริง
     signature = request.headers.get("X-Line-Signature")
 
     if not signature:
         raise HTTPException(status_code=400, detail="X-Line-Signature header is missing")
 
-    # ดึง body ของ request
+    # ดึง body ของ request (ตรวจ signature และ parse จาก bytes โดยตรง)
+    received_at, started = time.time(), time.perf_counter()
     body = await request.body()
-    body_text = body.decode("utf-8")
 
     try:
-        # ใช้ handler ประมวลผล events
-        handler.handle(body_text, signature)
+        # ส่ง events เข้า executor (ผู้ใช้ต่างคนรันพร้อมกัน ผู้ใช้คนเดียวกันรันตามลำดับ)
+        futures = handler.dispatch(body, signature)
     except InvalidSignatureError:
         raise HTTPException(status_code=400, detail="Invalid signature")
     except Exception as e:
         print(f"Webhook error: {str(e)}")
         raise HTTPException(status_code=500, detail="Internal server error")
 
+    # รอทุก event โดยไม่บล็อก event loop
+    results = await asyncio.gather(*(asyncio.wrap_future(f) for f in futures), return_exceptions=True)
+    errors = [r for r in results if isinstance(r, Exception)]
+    webhook_capture.record(body, request.headers, received_at, time.perf_counter() - started, 500 if errors else 200)
+    if errors:
+        print(f"Webhook error: {str(errors[0])}")
+        raise HTTPException(status_code=500, detail="Internal server error")
+
     return JSONResponse(content={"status": "ok"})
 
 
@@ -746,11 +1662,61 @@ async def health_check():
     """
     Health Check Endpoint สำหรับตรวจสอบสถานะของ API
     """
-    return {
+    status = {
         "status": "healthy",
         "line_configured": bool(LINE_CHANNEL_ACCESS_TOKEN and LINE_CHANNEL_SECRET),
-        "gemini_configured": bool(GEMINI_API_KEY)
+        "gemini_configured": bool(GEMINI_API_KEY),
+        "line_sender": LINE_SENDER,
     }
+    status["circuit_breakers"] = {
+        breaker.name: breaker.snapshot() for breaker in (gemini_breaker, line_breaker, line_content_breaker)
+    }
+    if any(breaker["state"] != "closed" for breaker in status["circuit_breakers"].values()):
+        status["status"] = "degraded"
+    status["event_executor"] = event_executor.stats()
+    if gemini_loop is not None:
+        status["gemini_async"] = gemini_loop.stats()
+    status["shutdown"] = shutdown_coordinator.stats()
+    if gemini_hedgers:
+        status["gemini_hedging"] = {name: hedger.stats() for name, hedger in gemini_hedgers.items()}
+    if job_queue is not None:
+        status["job_queue"] = await asyncio.to_thread(job_queue.stats)
+    if webhook_capture.enabled:
+        status["webhook_capture"] = webhook_capture.stats()
+    return status
+
+
+@app.get("/metrics")
+async def metrics():
+    """
+    token และค่าใช้จ่ายของ Gemini รูปแบบ Prometheus (รวม worker เมื่อใช้ USAGE_DB_PATH ร่วมกัน)
+    """
+    return PlainTextResponse(usage_meter.prometheus() + prompt_registry.prometheus() + rate_limiter.prometheus()
+                             + conversation_router.prometheus(),
+                             media_type="text/plain; version=0.0.4")
+
+
+@app.get("/metrics/usage")
+async def usage_report():
+    """
+    token และค่าใช้จ่ายแยกตามงาน กรมธรรม์ ผู้ใช้ที่ใช้มากที่สุดวันนี้ prompt variant, rate limit ต่อผู้ใช้ และเวลาของแต่ละ transition (JSON)
+    """
+    return {**usage_meter.snapshot(), "prompt_variants": prompt_registry.snapshot(),
+            "rate_limits": rate_limiter.snapshot(), "transitions": conversation_router.transition_stats()}
+
+
+@app.get("/ready")
+async def readiness_check():
+    """
+    Readiness Endpoint: ตอบ 200 เมื่อ import ที่หนัก ข้อมูลกรมธรรม์ และ connection พร้อมแล้ว
+    ระหว่าง warm-up จะตอบ 503 พร้อมรายงานเวลาที่ใช้ในแต่ละขั้น
+    """
+    report = readiness.report()
+    report["import_profile_ms"] = IMPORT_PROFILE_MS
+    if shutdown_coordinator.draining:
+        report["ready"] = False
+        report["draining"] = True
+    return JSONResponse(content=report, status_code=200 if report["ready"] else 503)
 
 
 # ==================== Main ====================
@@ -763,22 +1729,26 @@ if __name__ == "__main__":
     import os
     port = int(os.getenv("PORT", 8000))
 
-    try:
-        # ทดสอบดึงชื่อโมเดลที่ Key นี้เข้าถึงได้
-        available_models = [m.name for m in genai.list_models()]
-        print(f"✅ API Key เชื่อมต่อสำเร็จ โมเดลที่ใช้ได้: {available_models[:3]}")
-    except Exception as e:
-        print(f"❌ API Key มีปัญหา: {e}")
-
+    # การทดสอบ API Key ย้ายไปทำใน warm-up thread (ดูผลได้ที่ /ready) เพื่อไม่ให้ขวางการ bind port
     print("=" * 60)
     print("🚀 LINE Insurance Claim Bot Starting...")
     print("=" * 60)
     print(f"📍 Server: http://localhost:{port}")
     print(f"🔗 Webhook: http://localhost:{port}/webhook")
     print(f"❤️  Health: http://localhost:{port}/health")
+    print(f"🟢 Ready: http://localhost:{port}/ready")
+    print(f"⏱️  Import main.py: {IMPORT_PROFILE_MS['main_module']:.0f} ms")
     print("=" * 60)
 
-    uvicorn.run(app, host="0.0.0.0", port=port)
+    class DrainingServer(uvicorn.Server):
+        # SIGTERM/SIGINT: หยุดรับ webhook ใหม่ทันที แล้วให้ uvicorn รอ request ที่ค้างก่อนเข้า lifespan shutdown
+        def handle_exit(self, sig, frame):
+            shutdown_coordinator.begin_drain()
+            super().handle_exit(sig, frame)
+
+    DrainingServer(uvicorn.Config(
+        app, host="0.0.0.0", port=port, timeout_graceful_shutdown=max(1, int(SHUTDOWN_GRACE_S))
+    )).run()
 
     # uvicorn.run(
     #     "main:app",
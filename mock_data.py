@@ -6,7 +6,12 @@ Mock Data สำหรับข้อมูลกรมธรรม์ประ
 เช่น PostgreSQL, MySQL, MongoDB, หรือ API ภายนอก
 """
 
-from typing import Dict, List, Optional
+import hashlib
+import threading
+from typing import Dict, List, Optional, Tuple
+
+from name_index import NameIndex
+from plate_index import SCORE_EXACT, PlateIndex
 
 
 # ฐานข้อมูล Mock (ในระบบจริงจะเชื่อมต่อกับ Database)
@@ -64,6 +69,59 @@ MOCK_POLICIES = {
 }
 
 
+# ดัชนีค้นหา (สร้างครั้งแรกที่ค้นหา หรือตอน warm-up ผ่าน build_search_indexes)
+_name_index: Optional[NameIndex] = None
+_plate_index: Optional[PlateIndex] = None
+_number_index: Optional[Dict[str, str]] = None
+_index_lock = threading.Lock()
+
+
+def _get_name_index() -> NameIndex:
+    global _name_index
+    if _name_index is None:
+        with _index_lock:
+            if _name_index is None:
+                index = NameIndex()
+                for key, policy in MOCK_POLICIES.items():
+                    index.add(key, policy['first_name'], policy['last_name'])
+                index.prepare()
+                # BK-tree (พิมพ์ผิด) ใช้เวลาหลายวินาทีเมื่อมีชื่อมาก สร้างใน background ไม่ให้ warm-up รอ
+                index.build_fuzzy_in_background()
+                _name_index = index
+    return _name_index
+
+
+def _get_plate_index() -> PlateIndex:
+    global _plate_index
+    if _plate_index is None:
+        with _index_lock:
+            if _plate_index is None:
+                index = PlateIndex()
+                for key, policy in MOCK_POLICIES.items():
+                    index.add(key, policy['plate'])
+                index.prepare()
+                _plate_index = index
+    return _plate_index
+
+
+def _get_number_index() -> Dict[str, str]:
+    global _number_index
+    if _number_index is None:
+        with _index_lock:
+            if _number_index is None:
+                _number_index = {policy['policy_number']: key for key, policy in MOCK_POLICIES.items()}
+    return _number_index
+
+
+def build_search_indexes():
+    """
+    สร้างดัชนีค้นหาล่วงหน้า (เรียกจาก warm-up ตอนเริ่มระบบ)
+    """
+    _get_name_index()
+    _get_plate_index()
+    _get_number_index()
+
+
 def get_policy_info(name: str, plate: str) -> Optional[Dict]:
     """
     จำลองการดึงข้อมูลกรมธรรม์จากฐานข้อมูล (Mock Data)
@@ -106,6 +164,45 @@ def get_policy_info(name: str, plate: str) -> Optional[Dict]:
     return None
 
 
+def get_policy_by_number(policy_number: str) -> Optional[Dict]:
+    """
+    ดึงข้อมูลกรมธรรม์จากเลขกรมธรรม์ (ใช้ resolve ข้อมูลจาก session ที่เก็บแค่เลขกรมธรรม์)
+
+    Args:
+        policy_number: เลขกรมธรรม์ เช่น POL-2024-001234
+
+    Returns:
+        Dict ข้อมูลกรมธรรม์ หรือ None ถ้าไม่พบ
+    """
+    key = _get_number_index().get(policy_number)
+    return MOCK_POLICIES.get(key) if key else None
+
+
+# cache: policy_number -> (เอกสาร, version) เพื่อไม่ต้อง hash เอกสาร ~500 KB ทุกครั้ง
+_document_versions: Dict[str, tuple] = {}
+
+
+def policy_document_version(policy: Dict) -> str:
+    """
+    version ของเอกสารกรมธรรม์ (SHA-256 12 ตัวแรกของเอกสาร) ใช้ตรวจว่าเอกสารเปลี่ยนหลังเก็บลง session หรือไม่
+
+    Args:
+        policy: ข้อมูลกรมธรรม์
+
+    Returns:
+        version ของเอกสาร หรือ "none" ถ้าไม่มีเอกสาร
+    """
+    document = policy.get('policy_document_base64')
+    if not document:
+        return "none"
+    cached = _document_versions.get(policy['policy_number'])
+    if cached and cached[0] is document:
+        return cached[1]
+    version = hashlib.sha256(document.encode("ascii")).hexdigest()[:12]
+    _document_versions[policy['policy_number']] = (document, version)
+    return version
+
+
 def add_policy(name: str, plate: str, policy_data: Dict) -> bool:
     """
     เพิ่มข้อมูลกรมธรรม์ใหม่ (สำหรับการทดสอบ)
@@ -126,9 +223,28 @@ def add_policy(name: str, plate: str, policy_data: Dict) -> bool:
     # สร้าง key สำหรับเพิ่มข้อมูล
     search_key = f"{name}_{plate}"
     MOCK_POLICIES[search_key] = policy_data
+    if _name_index is not None:
+        _name_index.add(search_key, policy_data['first_name'], policy_data['last_name'])
+    if _plate_index is not None:
+        _plate_index.add(search_key, policy_data['plate'])
+    if _number_index is not None:
+        _number_index[policy_data['policy_number']] = search_key
     return True
 
 
+def replace_policies(policies: Dict[str, Dict]):
+    """
+    แทนที่ข้อมูลกรมธรรม์ทั้งหมด (สำหรับการทดสอบและ benchmark) ดัชนีจะถูกสร้างใหม่เมื่อค้นหาครั้งถัดไป
+
+    Args:
+        policies: Dict รูปแบบเดียวกับ MOCK_POLICIES
+    """
+    global MOCK_POLICIES, _name_index, _plate_index, _number_index
+    with _index_lock:
+        MOCK_POLICIES = policies
+        _name_index = _plate_index = _number_index = None
+
+
 def get_all_policies() -> Dict:
     """
     ดึงข้อมูลกรมธรรม์ทั้งหมด
@@ -139,45 +255,65 @@ def get_all_policies() -> Dict:
     return MOCK_POLICIES
 
 
-def search_policies_by_name(name: str) -> list:
+def search_policies_by_name(name: str, limit: int = 20) -> list:
     """
-    ค้นหากรมธรรม์จากชื่อ (รองรับการค้นหาบางส่วน)
+    ค้นหากรมธรรม์จากชื่อ (รองรับการค้นหาบางส่วน คำนำหน้า ช่องว่างเกิน วรรณยุกต์ และพิมพ์ผิดเล็กน้อย)
 
     Args:
         name: ชื่อหรือบางส่วนของชื่อ
+        limit: จำนวนผลลัพธ์สูงสุด
 
     Returns:
-        List ของกรมธรรม์ที่ตรงกับชื่อ
+        List ของกรมธรรม์ที่ตรงกับชื่อ เรียงจากตรงที่สุด
     """
-    results = []
-    for key, policy in MOCK_POLICIES.items():
-        # สร้างชื่อเต็มจาก first_name และ last_name
-        full_name = f"{policy['first_name'].strip()} {policy['last_name']}"
-        full_name_with_title = f"{policy['title_name']}{policy['first_name'].strip()} {policy['last_name']}"
+    return [MOCK_POLICIES[key] for key in _get_name_index().search(name, limit=limit)]
 
-        # ค้นหาทั้ง first_name, last_name และ full_name
-        if (name.lower() in policy['first_name'].lower() or
-            name.lower() in policy['last_name'].lower() or
-            name.lower() in full_name.lower() or
-            name.lower() in full_name_with_title.lower()):
-            results.append(policy)
-    return results
+
+def search_name_candidates(name: str, limit: int = 20) -> Tuple[List[Dict], Optional[int]]:
+    """
+    ค้นหากรมธรรม์จากชื่อ พร้อมคะแนนของรายการแรก (เหมือน search_plate_candidates)
+
+    Args:
+        name: ชื่อหรือบางส่วนของชื่อ
+        limit: จำนวนผลลัพธ์สูงสุด
+
+    Returns:
+        (List ของกรมธรรม์เรียงจากตรงที่สุด, คะแนนของรายการแรก) คะแนนเป็น None ถ้าไม่พบ
+        คะแนนแย่กว่า name_index.SCORE_TOKEN (prefix/substring/พิมพ์ผิด) อาจเป็นชื่อของคนอื่น ต้องให้ผู้ใช้ยืนยันก่อนใช้
+    """
+    found = _get_name_index().search_scored(name, limit=limit)
+    return [MOCK_POLICIES[key] for key, _ in found], (found[0][1] if found else None)
 
 
 def search_policies_by_plate(plate: str) -> Optional[Dict]:
     """
-    ค้นหากรมธรรม์จากทะเบียนรถ
+    ค้นหากรมธรรม์จากทะเบียนรถ (ไม่สนช่องว่าง ขีด และชื่อจังหวัด)
 
     Args:
         plate: เลขทะเบียนรถ
 
     Returns:
-        Dict ข้อมูลกรมธรรม์ หรือ None ถ้าไม่พบ
+        Dict ข้อมูลกรมธรรม์ หรือ None ถ้าไม่พบทะเบียนที่ตรงตัว หรือตรงมากกว่า 1 คัน
     """
-    for policy in MOCK_POLICIES.values():
-        if policy['plate'] == plate.strip():
-            return policy
-    return None
+    candidates, score = search_plate_candidates(plate, limit=2)
+    return candidates[0] if len(candidates) == 1 and score == SCORE_EXACT else None
+
+
+def search_plate_candidates(plate: str, limit: int = 10) -> Tuple[List[Dict], Optional[int]]:
+    """
+    ค้นหากรมธรรม์จากทะเบียนรถ แบบตรงตัว, prefix หรือผิด 1 ตัวอักษร (เช่น OCR อ่าน ข เป็น ช)
+
+    Args:
+        plate: เลขทะเบียนรถ (หรือบางส่วน)
+        limit: จำนวนผลลัพธ์สูงสุด
+
+    Returns:
+        (List ของกรมธรรม์เรียงจากตรงที่สุด, คะแนนของรายการแรก) คะแนนเป็น None ถ้าไม่พบ
+        ถ้าตรงตัวจะคืนเฉพาะคันที่ตรงและคะแนนเป็น SCORE_EXACT
+        ผลที่ไม่ตรงตัว (prefix/พิมพ์ผิด/OCR อ่านผิด) อาจเป็นรถของคนอื่น ต้องให้ผู้ใช้ยืนยันก่อนใช้เสมอ
+    """
+    found = _get_plate_index().search_scored(plate, limit=limit)
+    return [MOCK_POLICIES[key] for key, _ in found], (found[0][1] if found else None)
 
 
 def search_policies_by_cid(cid: str) -> List[Dict]:
@@ -0,0 +1,405 @@
+"""
+ดัชนีค้นหาชื่อผู้เอาประกันภาษาไทยแบบยืดหยุ่น (ใช้โดย search_policies_by_name)
+
+สร้างครั้งเดียวจากชื่อที่ normalise แล้ว:
+- ตัดคำนำหน้า (นาย, นาง, นางสาว, น.ส., คุณ ...) ช่องว่างเกิน เครื่องหมายวรรณยุกต์และการันต์
+- ดัชนี token ตรงตัว + รายการ token เรียงลำดับ (bisect) สำหรับค้นหาแบบ prefix
+- ดัชนี trigram ของชื่อเต็ม (ไม่มีช่องว่าง) สำหรับค้นหาแบบ substring
+- BK-tree ของ token สำหรับพิมพ์ผิด (edit distance แบบ bit-parallel) สร้างแยกจากดัชนีอื่น
+  (build_fuzzy / build_fuzzy_in_background) เพื่อไม่ให้การสร้างดัชนีหลักรอ
+
+ผลลัพธ์เรียงตามความตรง: ชื่อเต็มตรง > token ตรง > prefix > substring > พิมพ์ผิด
+การค้นหาแบบพิมพ์ผิดใช้เมื่อไม่พบแบบตรง/บางส่วนเท่านั้น และทุกขั้นหยุดเมื่อเกิน time budget
+"""
+
+import re
+import sys
+import threading
+import time
+import unicodedata
+from array import array
+from bisect import bisect_left
+from typing import Dict, Hashable, Iterable, List, Optional, Set, Tuple
+
+# คำนำหน้าชื่อ (เรียงยาวไปสั้นเพื่อให้ "นางสาว" ถูกตัดก่อน "นาง")
+TITLE_PREFIXES = sorted([
+    "นาย", "นาง", "นางสาว", "น.ส.", "น.ส", "ด.ช.", "ด.ญ.", "เด็กชาย", "เด็กหญิง",
+    "คุณ", "mr.", "mrs.", "ms.", "miss", "mr", "mrs", "ms",
+], key=len, reverse=True)
+
+# ไม้ไต่คู้ วรรณยุกต์ทั้ง 4 และการันต์ (มักพิมพ์ผิด/ตก)
+_MARKS_RE = re.compile("[\u0e47-\u0e4c]")
+_PUNCTUATION_RE = re.compile(r"[^\w\s\u0e00-\u0e7f]")
+_WHITESPACE_RE = re.compile(r"\s+")
+
+NGRAM_SIZE = 3
+# doc ที่มี token ตรงตัวไม่เกินนี้ เทียบ token ที่พิมพ์ผิดกับ token ของ doc นั้นตรง ๆ แทนการค้น BK-tree
+FUZZY_ANCHOR_LIMIT = 2000
+
+
+def strip_title(text: str) -> str:
+    """
+    ตัดคำนำหน้าชื่อออก (ถ้าส่วนที่เหลือยังยาวพอเป็นชื่อ)
+    """
+    for title in TITLE_PREFIXES:
+        if text.startswith(title) and len(text) - len(title) >= 2:
+            return text[len(title):].lstrip()
+    return text
+
+
+def normalize_name(text: str) -> str:
+    """
+    normalise ชื่อสำหรับเปรียบเทียบ: ตัดคำนำหน้า วรรณยุกต์ การันต์ เครื่องหมาย และช่องว่างเกิน
+    """
+    text = unicodedata.normalize("NFC", text or "").lower().strip()
+    text = strip_title(text)
+    text = _MARKS_RE.sub("", text)
+    text = _PUNCTUATION_RE.sub(" ", text)
+    return _WHITESPACE_RE.sub(" ", text).strip()
+
+
+def name_tokens(text: str) -> List[str]:
+    normalized = normalize_name(text)
+    return normalized.split(" ") if normalized else []
+
+
+def levenshtein(a: str, b: str, max_distance: Optional[int] = None) -> int:
+    """
+    Edit distance (insert/delete/substitute) หยุดเร็วเมื่อเกิน max_distance
+    """
+    if a == b:
+        return 0
+    if len(a) < len(b):
+        a, b = b, a
+    if max_distance is not None and len(a) - len(b) > max_distance:
+        return max_distance + 1
+
+    previous = list(range(len(b) + 1))
+    for i, char_a in enumerate(a, 1):
+        current = [i]
+        for j, char_b in enumerate(b, 1):
+            current.append(min(
+                previous[j] + 1,
+                current[j - 1] + 1,
+                previous[j - 1] + (char_a != char_b),
+            ))
+        if max_distance is not None and min(current) > max_distance:
+            return max_distance + 1
+        previous = current
+    return previous[-1]
+
+
+def _pattern_masks(pattern: str) -> Dict[str, int]:
+    masks: Dict[str, int] = {}
+    for i, char in enumerate(pattern):
+        masks[char] = masks.get(char, 0) | (1 << i)
+    return masks
+
+
+def _bit_parallel_distance(masks: Dict[str, int], length: int, text: str) -> int:
+    """
+    Edit distance แบบ bit-parallel (Myers/Hyyrö) ระหว่าง pattern (masks จาก _pattern_masks) กับ text
+    เร็วกว่า levenshtein หลายเท่าเพราะคำนวณทั้งคอลัมน์ใน integer เดียว
+    """
+    if length == 0:
+        return len(text)
+    full = (1 << length) - 1
+    last = 1 << (length - 1)
+    positive, negative, score = full, 0, length
+    for char in text:
+        equal = masks.get(char, 0)
+        vertical = equal | negative
+        horizontal = (((equal & positive) + positive) ^ positive) | equal
+        horizontal_positive = negative | ~(horizontal | positive)
+        horizontal_negative = positive & horizontal
+        if horizontal_positive & last:
+            score += 1
+        elif horizontal_negative & last:
+            score -= 1
+        horizontal_positive = (horizontal_positive << 1) | 1
+        horizontal_negative <<= 1
+        positive = (horizontal_negative | ~(vertical | horizontal_positive)) & full
+        negative = horizontal_positive & vertical
+    return score
+
+
+class BKTree:
+    """
+    BK-tree สำหรับหาคำที่ edit distance ไม่เกินที่กำหนด โดยไม่ต้องเทียบทุกคำ
+    node = [word, {distance: child}]
+
+    add ต้องเรียกทีละ thread (NameIndex คุมด้วย lock) ส่วน search อ่านพร้อมกับ add ได้
+    """
+
+    def __init__(self):
+        self._root: Optional[list] = None
+        self.size = 0
+
+    def add(self, word: str):
+        if self._root is None:
+            self._root = [word, {}]
+            self.size = 1
+            return
+        masks, length = _pattern_masks(word), len(word)
+        node = self._root
+        while True:
+            distance = _bit_parallel_distance(masks, length, node[0])
+            if distance == 0:
+                return
+            child = node[1].get(distance)
+            if child is None:
+                node[1][distance] = [word, {}]
+                self.size += 1
+                return
+            node = child
+
+    def search(self, word: str, max_distance: int, deadline: Optional[float] = None) -> List[Tuple[int, str]]:
+        if self._root is None:
+            return []
+        masks, length = _pattern_masks(word), len(word)
+        results = []
+        stack = [self._root]
+        while stack:
+            if deadline is not None and time.perf_counter() > deadline:
+                break
+            node_word, children = stack.pop()
+            distance = _bit_parallel_distance(masks, length, node_word)
+            if distance <= max_distance:
+                results.append((distance, node_word))
+            low, high = distance - max_distance, distance + max_distance
+            # list(): snapshot กัน add จาก thread อื่นเพิ่ม child ระหว่างวน
+            for child_distance, child in list(children.items()):
+                if low <= child_distance <= high:
+                    stack.append(child)
+        return results
+
+
+# ลำดับคะแนน (น้อย = ตรงกว่า)
+SCORE_EXACT = 0
+SCORE_TOKEN = 1
+SCORE_PREFIX = 2
+SCORE_SUBSTRING = 3
+SCORE_FUZZY = 10
+
+
+class NameIndex:
+    """
+    ดัชนีชื่อ: เพิ่มด้วย add(key, first_name, last_name) แล้วค้นหาด้วย search(query)
+    key คือค่าที่ใช้อ้างอิงกรมธรรม์ (เช่น key ของ MOCK_POLICIES)
+    """
+
+    def __init__(self):
+        self._keys: List[Hashable] = []
+        self._compact: List[str] = []
+        self._doc_tokens: List[Tuple[str, ...]] = []
+        self._token_docs: Dict[str, array] = {}
+        self._grams: Dict[str, array] = {}
+        self._sorted_tokens: List[str] = []
+        self._sorted_dirty = False
+        self._bktree = BKTree()
+        # token ใหม่ที่ยังไม่ได้ใส่ BK-tree (ใส่ตอน build_fuzzy)
+        self._fuzzy_pending: List[str] = []
+        self._fuzzy_lock = threading.Lock()
+        self._fuzzy_built = threading.Event()
+
+    def __len__(self) -> int:
+        return len(self._keys)
+
+    def add(self, key: Hashable, first_name: str, last_name: str):
+        tokens = tuple(sys.intern(token) for token in name_tokens(f"{first_name} {last_name}"))
+        doc_id = len(self._keys)
+        compact = "".join(tokens)
+        self._keys.append(key)
+        self._compact.append(compact)
+        self._doc_tokens.append(tokens)
+
+        for token in set(tokens):
+            postings = self._token_docs.get(token)
+            if postings is None:
+                postings = self._token_docs[token] = array("I")
+                self._fuzzy_pending.append(token)
+                self._sorted_dirty = True
+            postings.append(doc_id)
+
+        for gram in {compact[i:i + NGRAM_SIZE] for i in range(len(compact) - NGRAM_SIZE + 1)}:
+            postings = self._grams.get(gram)
+            if postings is None:
+                postings = self._grams[gram] = array("I")
+            postings.append(doc_id)
+
+    def prepare(self):
+        """
+        เรียงรายการ token ล่วงหน้า (เรียกหลัง add ชุดใหญ่ เพื่อไม่ให้ query แรกช้า)
+        """
+        self._tokens_sorted()
+
+    def build_fuzzy(self):
+        """
+        ใส่ token ที่ค้างอยู่ลง BK-tree (ชื่อแสนรายการใช้หลายวินาที ควรเรียกผ่าน build_fuzzy_in_background)
+        """
+        with self._fuzzy_lock:
+            while self._fuzzy_pending:
+                pending, self._fuzzy_pending = self._fuzzy_pending, []
+                for token in pending:
+                    self._bktree.add(token)
+            self._fuzzy_built.set()
+
+    def build_fuzzy_in_background(self) -> threading.Thread:
+        """
+        สร้าง BK-tree ใน daemon thread ระหว่างนั้นการค้นหาแบบพิมพ์ผิดจะถูกข้าม (ขั้นอื่นใช้ได้ตามปกติ)
+        """
+        thread = threading.Thread(target=self.build_fuzzy, name="name-index-fuzzy", daemon=True)
+        thread.start()
+        return thread
+
+    @property
+    def fuzzy_ready(self) -> bool:
+        return self._fuzzy_built.is_set()
+
+    # ---------- ขั้นตอนการค้นหา ----------
+    def _tokens_sorted(self) -> List[str]:
+        if self._sorted_dirty:
+            self._sorted_tokens = sorted(self._token_docs)
+            self._sorted_dirty = False
+        return self._sorted_tokens
+
+    def _prefix_docs(self, prefix: str, deadline: float) -> Set[int]:
+        tokens = self._tokens_sorted()
+        docs: Set[int] = set()
+        index = bisect_left(tokens, prefix)
+        while index < len(tokens) and tokens[index].startswith(prefix):
+            docs.update(self._token_docs[tokens[index]])
+            index += 1
+            if time.perf_counter() > deadline:
+                break
+        return docs
+
+    def _substring_docs(self, compact: str, deadline: float) -> Set[int]:
+        if len(compact) < NGRAM_SIZE:
+            # คำค้นสั้นกว่า trigram: ไล่ทุกชื่อ (หยุดเมื่อเกิน time budget)
+            docs = set()
+            for doc, name in enumerate(self._compact):
+                if compact in name:
+                    docs.add(doc)
+                if doc % 1024 == 0 and time.perf_counter() > deadline:
+                    break
+            return docs
+
+        grams = {compact[i:i + NGRAM_SIZE] for i in range(len(compact) - NGRAM_SIZE + 1)}
+        postings = []
+        for gram in grams:
+            docs = self._grams.get(gram)
+            if docs is None:
+                return set()
+            postings.append(docs)
+        postings.sort(key=len)
+
+        candidates = set(postings[0])
+        for docs in postings[1:]:
+            if len(candidates) < 64 or time.perf_counter() > deadline:
+                break
+            candidates.intersection_update(docs)
+        return {doc for doc in candidates if compact in self._compact[doc]}
+
+    @staticmethod
+    def _max_distance(token: str) -> int:
+        return 1 if len(token) <= 4 else 2
+
+    def _fuzzy_within(self, docs: Set[int], tokens: List[str]) -> Dict[int, int]:
+        """
+        เทียบ token ที่ไม่พบในดัชนีกับ token ของ doc ที่กำหนดทีละ doc
+        (ใช้เมื่อ doc ไม่เกิน FUZZY_ANCHOR_LIMIT จึงไม่ต้องเช็ค time budget)
+        """
+        result = dict.fromkeys(docs, 0)
+        for token in tokens:
+            masks, length, max_distance = _pattern_masks(token), len(token), self._max_distance(token)
+            matched: Dict[int, int] = {}
+            for doc, total in result.items():
+                best = min(_bit_parallel_distance(masks, length, word) for word in self._doc_tokens[doc])
+                if best <= max_distance:
+                    matched[doc] = total + best
+            result = matched
+            if not result:
+                break
+        return result
+
+    def _fuzzy_docs(self, tokens: List[str], deadline: float) -> Dict[int, int]:
+        """
+        คืน {doc_id: ผลรวม distance} ของ doc ที่ทุก token ในคำค้นมี token ใกล้เคียง
+        """
+        # คำค้นที่บาง token ตรงตัว (เช่น ชื่อถูก นามสกุลพิมพ์ผิด): ใช้ doc ของ token นั้นเป็นตัวตั้ง
+        # การค้น BK-tree ระยะ 2 บน token หลายหมื่นตัวใช้หลายสิบ ms ต่อ token
+        known = [token for token in tokens if token in self._token_docs]
+        if known and len(known) < len(tokens):
+            anchor = set.intersection(*(set(self._token_docs[token]) for token in known))
+            if anchor and len(anchor) <= FUZZY_ANCHOR_LIMIT:
+                return self._fuzzy_within(anchor, [token for token in tokens if token not in known])
+
+        if self._fuzzy_lock.locked():
+            # กำลังสร้าง BK-tree อยู่ (ครั้งแรกหลัง start) ข้ามไปก่อนแทนการรอหลายวินาที
+            return {}
+        if self._fuzzy_pending:
+            # token ที่เพิ่มทีหลัง (add_policy) มีไม่กี่ตัว ใส่ได้ทันที
+            # ถ้ายังไม่เคยสร้างเลย (ไม่ได้เรียก build_fuzzy ล่วงหน้า) query นี้จะรอจนสร้างเสร็จ
+            self.build_fuzzy()
+        result: Optional[Dict[int, int]] = None
+        for token in tokens:
+            max_distance = self._max_distance(token)
+            best: Dict[int, int] = {}
+            for distance, word in self._bktree.search(token, max_distance, deadline):
+                for doc in self._token_docs[word]:
+                    if distance < best.get(doc, max_distance + 1):
+                        best[doc] = distance
+            if result is None:
+                result = best
+            else:
+                result = {doc: result[doc] + distance for doc, distance in best.items() if doc in result}
+            if not result:
+                return {}
+        return result or {}
+
+    def search(self, query: str, limit: int = 20, time_budget_ms: float = 50.0) -> List[Hashable]:
+        """
+        ค้นหาชื่อแล้วคืน key ที่เรียงตามความตรง (ไม่เกิน limit รายการ)
+        """
+        return [key for key, _ in self.search_scored(query, limit, time_budget_ms)]
+
+    def search_scored(self, query: str, limit: int = 20,
+                      time_budget_ms: float = 50.0) -> List[Tuple[Hashable, int]]:
+        """
+        เหมือน search แต่คืน (key, คะแนน) เพื่อให้ผู้เรียกแยกชื่อที่ตรง (SCORE_EXACT/SCORE_TOKEN) กับที่ใกล้เคียงได้
+        """
+        deadline = time.perf_counter() + time_budget_ms / 1000.0
+        tokens = name_tokens(query)
+        if not tokens or not self._keys:
+            return []
+        compact = "".join(tokens)
+        scores: Dict[int, int] = {}
+
+        def add(docs: Iterable[int], score: int):
+            for doc in docs:
+                if score < scores.get(doc, SCORE_FUZZY * 10):
+                    scores[doc] = score
+
+        # 1. token ตรงตัว (ทุก token ในคำค้นต้องตรง)
+        token_sets = [set(self._token_docs.get(token, ())) for token in tokens]
+        exact = set.intersection(*token_sets) if token_sets else set()
+        add((doc for doc in exact if self._compact[doc] == compact), SCORE_EXACT)
+        add(exact, SCORE_TOKEN)
+
+        # 2. prefix ของ token (ทุก token ในคำค้นต้องเป็น prefix ของ token ใดใน doc)
+        if len(scores) < limit and time.perf_counter() < deadline:
+            prefix_sets = [self._prefix_docs(token, deadline) for token in tokens]
+            add(set.intersection(*prefix_sets), SCORE_PREFIX)
+
+        # 3. substring ของชื่อเต็ม (ผ่าน trigram)
+        if len(scores) < limit and time.perf_counter() < deadline:
+            add(self._substring_docs(compact, deadline), SCORE_SUBSTRING)
+
+        # 4. พิมพ์ผิด (เฉพาะเมื่อไม่พบด้วยวิธีข้างบน)
+        if not scores and time.perf_counter() < deadline:
+            for doc, distance in self._fuzzy_docs(tokens, deadline).items():
+                scores[doc] = SCORE_FUZZY + distance
+
+        ranked = sorted(scores.items(), key=lambda item: (item[1], item[0]))[:limit]
+        return [(self._keys[doc], score) for doc, score in ranked]
@@ -0,0 +1,132 @@
+"""
+รวบรวมรูปความเสียหายหลายรูปของเคลมเดียวกันก่อนส่งวิเคราะห์ครั้งเดียว
+
+ผู้ใช้มักส่งรูปหลายมุมติดกัน (หรือเลือกหลายรูปพร้อมกันซึ่ง LINE ส่งมาเป็น image set)
+แทนที่จะวิเคราะห์ทีละรูป PhotoBatcher จะเก็บ message id ไว้ แล้วเรียก on_ready ครั้งเดียวเมื่อ:
+- ไม่มีรูปใหม่เข้ามาภายใน window_s วินาที (นับใหม่ทุกครั้งที่ได้รูป)
+- รอมาครบ max_wait_s วินาทีนับจากรูปแรก
+- ได้รูปครบ max_photos รูป หรือครบจำนวนใน image set
+
+handler ไม่ต้องรอ (ไม่ขวาง event อื่นของผู้ใช้คนเดียวกันใน KeyedSerialExecutor)
+on_ready(user_id, message_ids) ถูกเรียกจาก timer thread
+
+batch ที่ส่งไปแล้วยังค้างอยู่ (in-flight) จนงานวิเคราะห์เรียก take(user_id)
+รูปที่มาถึงระหว่างนั้นถูกรวมเข้า batch เดิม ไม่เริ่ม batch ใหม่ที่จะถูกทิ้งเมื่อเคลมจบแล้ว
+"""
+
+import threading
+import time
+from typing import Callable, Dict, List, Optional
+
+
+class _Batch:
+    def __init__(self):
+        self.message_ids: List[str] = []
+        self.started = time.monotonic()
+        self.expected_total: Optional[int] = None
+        self.timer: Optional[threading.Timer] = None
+
+
+class PhotoBatcher:
+    def __init__(self, on_ready: Callable[[str, List[str]], None], window_s: float = 4.0,
+                 max_wait_s: float = 15.0, max_photos: int = 6):
+        self.on_ready = on_ready
+        self.window_s = window_s
+        self.max_wait_s = max_wait_s
+        self.max_photos = max_photos
+        self._batches: Dict[str, _Batch] = {}
+        # batch ที่ส่ง on_ready แล้ว แต่งานวิเคราะห์ยังไม่ได้ take
+        self._in_flight: Dict[str, _Batch] = {}
+        self._lock = threading.Lock()
+
+    def add(self, user_id: str, message_id: str, expected_total: Optional[int] = None) -> int:
+        """
+        เพิ่มรูปเข้า batch ของผู้ใช้ คืนจำนวนรูปใน batch หลังเพิ่ม (1 = รูปแรกของเคลมนี้)
+        คืน 0 ถ้ารูปมาช้าเกินไป (batch ส่งวิเคราะห์แล้วและรูปเต็ม max_photos)
+        expected_total = จำนวนรูปใน image set ถ้าผู้ใช้เลือกหลายรูปพร้อมกัน
+        """
+        with self._lock:
+            in_flight = self._in_flight.get(user_id)
+            if in_flight is not None and user_id not in self._batches:
+                # batch ส่งไปแล้วแต่ยังไม่เริ่มวิเคราะห์: รวมรูปนี้ไปด้วย
+                if message_id in in_flight.message_ids:
+                    return len(in_flight.message_ids)
+                if len(in_flight.message_ids) >= self.max_photos:
+                    return 0
+                in_flight.message_ids.append(message_id)
+                return len(in_flight.message_ids)
+
+            batch = self._batches.get(user_id)
+            if batch is None:
+                batch = self._batches[user_id] = _Batch()
+            if message_id not in batch.message_ids:
+                batch.message_ids.append(message_id)
+            if expected_total:
+                batch.expected_total = max(batch.expected_total or 0, expected_total)
+            count = len(batch.message_ids)
+
+            if batch.timer is not None:
+                batch.timer.cancel()
+            full = count >= self.max_photos or (batch.expected_total is not None and count >= batch.expected_total)
+            remaining = self.max_wait_s - (time.monotonic() - batch.started)
+            delay = 0.0 if full else max(0.0, min(self.window_s, remaining))
+            batch.timer = threading.Timer(delay, self._fire, args=(user_id, batch))
+            batch.timer.daemon = True
+            batch.timer.start()
+        return count
+
+    def _fire(self, user_id: str, batch: _Batch):
+        with self._lock:
+            # timer ที่ถูกแทนที่แล้ว (มีรูปใหม่เข้ามา) หรือ batch ถูกยกเลิก
+            if self._batches.get(user_id) is not batch or threading.current_thread() is not batch.timer:
+                return
+            del self._batches[user_id]
+            self._in_flight[user_id] = batch
+            message_ids = list(batch.message_ids)
+        self._dispatch(user_id, batch, message_ids)
+
+    def _dispatch(self, user_id: str, batch: _Batch, message_ids: List[str]):
+        try:
+            self.on_ready(user_id, message_ids)
+        except Exception as e:
+            with self._lock:
+                if self._in_flight.get(user_id) is batch:
+                    del self._in_flight[user_id]
+            print(f"❌ ส่งรูปของ {user_id} ไปวิเคราะห์ไม่สำเร็จ: {e}")
+
+    def take(self, user_id: str) -> Optional[List[str]]:
+        """
+        เรียกจากงานวิเคราะห์ตอนเริ่ม: รับรูปทั้งหมดของ batch ที่ส่งไป (รวมรูปที่มาช้า) และปิด batch นั้น
+        คืน None ถ้า batch ถูกยกเลิกไปแล้ว (discard)
+        """
+        with self._lock:
+            batch = self._in_flight.pop(user_id, None)
+        return list(batch.message_ids) if batch is not None else None
+
+    def discard(self, user_id: str):
+        """
+        ยกเลิกรูปที่รออยู่ของผู้ใช้ (เช่น ผู้ใช้เริ่มเคลมใหม่)
+        """
+        with self._lock:
+            batch = self._batches.pop(user_id, None)
+            self._in_flight.pop(user_id, None)
+        if batch is not None and batch.timer is not None:
+            batch.timer.cancel()
+
+    def pending(self) -> int:
+        """จำนวนผู้ใช้ที่มีรูปรอส่งวิเคราะห์ (รวม batch ที่ส่งแล้วแต่ยังไม่เริ่มวิเคราะห์)"""
+        with self._lock:
+            return len(self._batches) + len(self._in_flight)
+
+    def flush_all(self):
+        """
+        ส่งทุก batch ที่รออยู่ไปวิเคราะห์ทันที (ใช้ตอน shutdown)
+        """
+        with self._lock:
+            batches = list(self._batches.items())
+            self._batches.clear()
+            self._in_flight.update(batches)
+        for user_id, batch in batches:
+            if batch.timer is not None:
+                batch.timer.cancel()
+            self._dispatch(user_id, batch, list(batch.message_ids))
@@ -0,0 +1,228 @@
+"""
+ดัชนีทะเบียนรถ (ใช้โดย search_policies_by_plate)
+
+ทะเบียนเข้ามาได้หลายรูปแบบ (OCR, ผู้ใช้พิมพ์เอง, มี/ไม่มีจังหวัด ช่องว่าง ขีด)
+จึงแปลงเป็นรูปแบบมาตรฐานก่อน เช่น "1 กข-1234 กรุงเทพมหานคร" -> "1กข1234"
+
+การค้นหา (เรียงตามความตรง):
+1. ตรงตัว (dict lookup)
+2. prefix (bisect บนรายการทะเบียนที่เรียงไว้) เช่น "1กข12"
+3. ต่างกัน 1 ตัวอักษร (deletion neighbourhood) โดยให้ลำดับก่อนถ้าเป็นพยัญชนะที่ OCR มักสับสน เช่น ข/ช, ด/ต
+
+deletion neighbourhood เก็บแบบ compact: แต่ละคู่ (ข้อความที่ลบไป 1 ตัว, ทะเบียน) เป็น int 64 บิต
+(hash ของข้อความ << _ID_BITS | id ของทะเบียน) ใน array ที่เรียงไว้ ค้นด้วย bisect
+hash ชนกันได้แต่ไม่ทำให้ผลผิด เพราะผู้สมัครทุกตัวผ่านการตรวจ levenshtein อีกครั้ง
+"""
+
+import re
+import threading
+import unicodedata
+from array import array
+from bisect import bisect_left
+from itertools import chain
+from typing import Dict, Hashable, Iterator, List, Optional, Set, Tuple
+
+from name_index import levenshtein
+
+# เลขนำหน้า (0-2 หลัก) + หมวดอักษร (1-3 ตัว) + เลขทะเบียน (0-4 หลัก) ส่วนที่เหลือ (จังหวัด) ตัดทิ้ง
+# ต้องมีตัวเลขอย่างน้อยหนึ่งฝั่ง (ไม่งั้นเป็นแค่ข้อความ/ชื่อ)
+_PLATE_RE = re.compile(r"^(\d{0,2})([ก-ฮ]{1,3})(\d{0,4})(.*)$")
+# ส่วนที่ตัดทิ้งได้ต้องเป็นชื่อจังหวัด (สั้นสุด เช่น "ตาก", "กทม") และไม่มีตัวเลข
+# ถ้ามีตัวเลขหรืออักษรเกินมา (เช่น OCR อ่าน "1กข12345") ไม่ใช่ทะเบียน ห้ามตัดให้กลายเป็นทะเบียนของคนอื่น
+_MIN_PROVINCE_LENGTH = 3
+_DIGIT_RE = re.compile(r"\d")
+# ทะเบียนรถตู้/รถบรรทุกที่เป็นตัวเลขล้วน เช่น "30-1234"
+_NUMERIC_PLATE_RE = re.compile(r"^(\d{2})(\d{4})$")
+_SEPARATOR_RE = re.compile(r"[\s\-.·]+")
+
+# กลุ่มพยัญชนะที่หน้าตาคล้ายกัน (OCR และคนอ่านมักสับสน)
+CONFUSABLE_GROUPS = [
+    "ขชซ", "คดตฒ", "บปษ", "ผฝ", "พฟ", "ฎฏ", "มน", "รธ", "ลส", "ศส",
+    "อฮ", "ภถก", "ทห", "ญณ", "วร", "ฆฑ",
+]
+CONFUSABLE_PAIRS: Set[frozenset] = {
+    frozenset((a, b))
+    for group in CONFUSABLE_GROUPS
+    for a in group
+    for b in group
+    if a != b
+}
+
+# ลำดับคะแนน (น้อย = ตรงกว่า)
+SCORE_EXACT = 0
+SCORE_PREFIX = 1
+SCORE_CONFUSABLE = 2
+SCORE_ONE_EDIT = 3
+
+MIN_PREFIX_LENGTH = 3
+
+# 26 บิตสำหรับ id ทะเบียน (~67 ล้านทะเบียน) ที่เหลือ 38 บิตเป็น hash
+_ID_BITS = 26
+_ID_MASK = (1 << _ID_BITS) - 1
+_HASH_MASK = (1 << (64 - _ID_BITS)) - 1
+# deletion ที่ค้างไม่เกินนี้แทรกลง array ทีละตัว มากกว่านี้ (โหลดชุดใหญ่) เรียงใหม่ทั้งหมด
+_MERGE_THRESHOLD = 4096
+
+
+def canonicalize_plate(text: str) -> Optional[str]:
+    """
+    แปลงทะเบียนเป็นรูปแบบมาตรฐาน (ไม่มีช่องว่าง ขีด จังหวัด) คืน None ถ้าไม่ใช่ทะเบียนรถ
+    """
+    text = unicodedata.normalize("NFC", text or "").strip()
+    text = _SEPARATOR_RE.sub("", text)
+    if not text:
+        return None
+    match = _PLATE_RE.match(text)
+    if match and (match.group(1) or match.group(3)):
+        prefix, letters, number, rest = match.groups()
+        if not rest:
+            return prefix + letters + number
+        if len(rest) >= _MIN_PROVINCE_LENGTH and not _DIGIT_RE.search(rest):
+            return prefix + letters + number
+        return None
+    match = _NUMERIC_PLATE_RE.match(text)
+    if match:
+        return "".join(match.groups())
+    return None
+
+
+def _deletions(plate: str) -> Set[str]:
+    return {plate[:i] + plate[i + 1:] for i in range(len(plate))}
+
+
+def _deletion_hash(text: str) -> int:
+    return hash(text) & _HASH_MASK
+
+
+def _is_confusable_substitution(a: str, b: str) -> bool:
+    if len(a) != len(b):
+        return False
+    diffs = [(x, y) for x, y in zip(a, b) if x != y]
+    return len(diffs) == 1 and frozenset(diffs[0]) in CONFUSABLE_PAIRS
+
+
+class PlateIndex:
+    """
+    ดัชนีทะเบียน: เพิ่มด้วย add(key, plate) แล้วค้นหาด้วย search(text)
+    key คือค่าที่ใช้อ้างอิงกรมธรรม์ (เช่น key ของ MOCK_POLICIES)
+    """
+
+    def __init__(self):
+        self._exact: Dict[str, List[Hashable]] = {}
+        self._plates: List[str] = []  # id -> ทะเบียน
+        self._deletion_keys = array("Q")  # (hash << _ID_BITS | id) เรียงจากน้อยไปมาก
+        self._pending_deletions: List[int] = []
+        self._deletion_lock = threading.Lock()
+        self._sorted_plates: List[str] = []
+        self._sorted_dirty = False
+
+    def __len__(self) -> int:
+        return sum(len(keys) for keys in self._exact.values())
+
+    def add(self, key: Hashable, plate: str):
+        canonical = canonicalize_plate(plate)
+        if canonical is None:
+            return
+        keys = self._exact.get(canonical)
+        if keys is None:
+            plate_id = len(self._plates)
+            if plate_id > _ID_MASK:
+                raise ValueError(f"ทะเบียนเกิน {_ID_MASK + 1:,} รายการ")
+            keys = self._exact[canonical] = []
+            self._plates.append(canonical)
+            self._pending_deletions.extend(
+                (_deletion_hash(deleted) << _ID_BITS) | plate_id for deleted in _deletions(canonical)
+            )
+            self._sorted_dirty = True
+        keys.append(key)
+
+    def prepare(self):
+        """
+        เรียงรายการทะเบียนและ deletion neighbourhood ล่วงหน้า (เรียกหลัง add ชุดใหญ่ เพื่อไม่ให้ query แรกช้า)
+        """
+        self._plates_sorted()
+        self._deletions_sorted()
+
+    def _plates_sorted(self) -> List[str]:
+        if self._sorted_dirty:
+            self._sorted_plates = sorted(self._exact)
+            self._sorted_dirty = False
+        return self._sorted_plates
+
+    def _deletions_sorted(self) -> array:
+        if self._pending_deletions:
+            with self._deletion_lock:
+                pending, self._pending_deletions = self._pending_deletions, []
+                if len(pending) > _MERGE_THRESHOLD:
+                    self._deletion_keys = array("Q", sorted(chain(self._deletion_keys, pending)))
+                else:
+                    for packed in pending:
+                        self._deletion_keys.insert(bisect_left(self._deletion_keys, packed), packed)
+        return self._deletion_keys
+
+    def _plates_with_deletion(self, text: str) -> Iterator[str]:
+        """
+        ทะเบียนที่ลบตัวอักษร 1 ตัวแล้วได้ text (อาจมีทะเบียนเกินมาจาก hash ชน)
+        """
+        keys = self._deletions_sorted()
+        low = _deletion_hash(text) << _ID_BITS
+        high = low + _ID_MASK
+        index = bisect_left(keys, low)
+        while index < len(keys) and keys[index] <= high:
+            yield self._plates[keys[index] & _ID_MASK]
+            index += 1
+
+    def _prefix_plates(self, prefix: str, limit: int) -> List[str]:
+        plates = self._plates_sorted()
+        index = bisect_left(plates, prefix)
+        found = []
+        while index < len(plates) and plates[index].startswith(prefix) and len(found) < limit:
+            found.append(plates[index])
+            index += 1
+        return found
+
+    def _one_edit_plates(self, plate: str) -> Set[str]:
+        """
+        ทะเบียนที่ต่างกัน 1 ตัว (แทนที่/เพิ่ม/ลบ) โดยเทียบ deletion neighbourhood ของทั้งสองฝั่ง
+        """
+        candidates = set(self._plates_with_deletion(plate))
+        for deleted in _deletions(plate):
+            if deleted in self._exact:
+                candidates.add(deleted)
+            candidates.update(self._plates_with_deletion(deleted))
+        candidates.discard(plate)
+        return {candidate for candidate in candidates if levenshtein(plate, candidate, 1) <= 1}
+
+    def search(self, text: str, limit: int = 10, fuzzy: bool = True) -> List[Hashable]:
+        """
+        ค้นหาทะเบียนแล้วคืน key ที่เรียงตามความตรง (ไม่เกิน limit รายการ)
+        """
+        return [key for key, _ in self.search_scored(text, limit, fuzzy)]
+
+    def search_scored(self, text: str, limit: int = 10, fuzzy: bool = True) -> List[Tuple[Hashable, int]]:
+        """
+        เหมือน search แต่คืน (key, คะแนน) เพื่อให้ผู้เรียกแยกทะเบียนที่ตรงตัว (SCORE_EXACT) กับที่ใกล้เคียงได้
+        """
+        plate = canonicalize_plate(text)
+        if plate is None:
+            return []
+
+        if plate in self._exact:
+            return [(key, SCORE_EXACT) for key in self._exact[plate][:limit]]
+
+        scores: Dict[str, int] = {}
+        if len(plate) >= MIN_PREFIX_LENGTH:
+            for candidate in self._prefix_plates(plate, limit):
+                scores[candidate] = SCORE_PREFIX
+        if fuzzy:
+            for candidate in self._one_edit_plates(plate):
+                score = SCORE_CONFUSABLE if _is_confusable_substitution(plate, candidate) else SCORE_ONE_EDIT
+                if score < scores.get(candidate, SCORE_ONE_EDIT + 1):
+                    scores[candidate] = score
+
+        found: List[Tuple[Hashable, int]] = []
+        for candidate, score in sorted(scores.items(), key=lambda item: (item[1], item[0])):
+            found.extend((key, score) for key in self._exact[candidate])
+            if len(found) >= limit:
+                break
+        return found[:limit]
@@ -0,0 +1,144 @@
+"""
+ข้อเท็จจริงหลักของกรมธรรม์ (ประเภทประกัน, ค่าเสียหายส่วนแรก, เบอร์แจ้งเหตุ) ที่ดึงจากเอกสารล่วงหน้า
+
+ดึงจากข้อความแยกหน้าของ policy_text.py ครั้งเดียวต่อ (เลขกรมธรรม์, version ของเอกสาร)
+แล้วเก็บไว้กับข้อมูลกรมธรรม์ใน policy_info["policy_facts"]:
+
+    {
+        "version": "<version ของเอกสาร>",
+        "insurance_class": "2+",      # None ถ้าหาไม่เจอ
+        "excess_baht": 0,
+        "hotline": "1557",
+        "pages": {"insurance_class": 1, "excess_baht": 1, "hotline": 1},
+    }
+
+prompt วิเคราะห์ใช้ค่าเหล่านี้โดยตรง และปุ่มโทรใช้ hotline แทนการหาเบอร์จากคำตอบของ AI
+"""
+
+import re
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+_PAGE_RE = re.compile(r"^\[หน้า (\d+)\]$", re.MULTILINE)
+_CLASS_RE = re.compile(r"ประกัน(?:ภัย)?\s*ชั้น\s*([123]\+?)")
+# pypdf มักทำสระอุหายจาก "แจ้งเหตุ" จึงรับ "แจ้งเหต" ด้วย
+_HOTLINE_RE = re.compile(r"แจ้งเห(?:ตุ|ต)?\s*[:：]?\s*(\d[\d\- ]{2,11}\d)")
+# ส่วนแรกของ "ความเสียหายต่อตัวรถ" (2.1) มาก่อน "บุคคลภายนอก" (1.1)
+_EXCESS_HEADINGS = ("2.1 ความเสียหายส่วนแรก", "ความเสียหายส่วนแรก")
+_EXCESS_AMOUNT_RE = re.compile(r"([\d,]+)\s*บาท\s*/\s*ครั้ง")
+# ค่า excess มักอยู่คนละบรรทัดกับหัวข้อ (PDF หลายคอลัมน์) ดูต่อได้ไม่เกินกี่บรรทัด
+_EXCESS_LOOKAHEAD_LINES = 3
+
+
+def _split_pages(policy_text: str) -> List[Tuple[int, str]]:
+    matches = list(_PAGE_RE.finditer(policy_text))
+    if not matches:
+        return [(1, policy_text)]
+    pages = []
+    for index, match in enumerate(matches):
+        end = matches[index + 1].start() if index + 1 < len(matches) else len(policy_text)
+        pages.append((int(match.group(1)), policy_text[match.end():end]))
+    return pages
+
+
+def _find_excess(lines: List[str]) -> Optional[int]:
+    for heading in _EXCESS_HEADINGS:
+        for index, line in enumerate(lines):
+            if heading not in line:
+                continue
+            window = lines[index:index + 1 + _EXCESS_LOOKAHEAD_LINES]
+            for candidate in window:
+                match = _EXCESS_AMOUNT_RE.search(candidate)
+                if match:
+                    return int(match.group(1).replace(",", ""))
+    return None
+
+
+def extract_policy_facts(policy_text: str) -> Dict:
+    """
+    ดึงประเภทประกัน ค่าเสียหายส่วนแรก และเบอร์แจ้งเหตุ (พร้อมเลขหน้า) จากข้อความแยกหน้า
+    """
+    facts: Dict = {"insurance_class": None, "excess_baht": None, "hotline": None, "pages": {}}
+    for page_number, page_text in _split_pages(policy_text):
+        if facts["insurance_class"] is None:
+            match = _CLASS_RE.search(page_text)
+            if match:
+                facts["insurance_class"] = match.group(1)
+                facts["pages"]["insurance_class"] = page_number
+
+        if facts["hotline"] is None:
+            match = _HOTLINE_RE.search(page_text)
+            if match:
+                facts["hotline"] = re.sub(r"[\- ]", "", match.group(1))
+                facts["pages"]["hotline"] = page_number
+
+        if facts["excess_baht"] is None:
+            excess = _find_excess(page_text.splitlines())
+            if excess is not None:
+                facts["excess_baht"] = excess
+                facts["pages"]["excess_baht"] = page_number
+    return facts
+
+
+class PolicyFactsEnricher:
+    """
+    งานเบื้องหลังที่ดึง facts ของกรมธรรม์ (1 thread เพื่อไม่แย่ง CPU กับ webhook)
+
+    load_text(policy_info) -> ข้อความแยกหน้า หรือ None
+    document_version(policy_info) -> version ของเอกสาร
+    """
+
+    def __init__(self, load_text: Callable[[Dict], Optional[str]], document_version: Callable[[Dict], str]):
+        self.load_text = load_text
+        self.document_version = document_version
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="policy-facts")
+        self._scheduled = set()
+
+    def current(self, policy_info: Dict) -> Optional[Dict]:
+        """
+        facts ที่ตรงกับ version ของเอกสารปัจจุบัน หรือ None (และสั่งดึงใหม่ในเบื้องหลัง)
+        """
+        facts = policy_info.get("policy_facts")
+        if facts and facts.get("version") == self.document_version(policy_info):
+            return facts
+        self.schedule(policy_info)
+        return None
+
+    def schedule(self, policy_info: Dict):
+        key = (policy_info["policy_number"], self.document_version(policy_info))
+        if key in self._scheduled:
+            return
+        self._scheduled.add(key)
+        self._executor.submit(self._enrich_logged, policy_info)
+
+    def enrich(self, policy_info: Dict) -> Optional[Dict]:
+        """
+        ดึง facts และเก็บลง policy_info["policy_facts"] (ข้ามถ้ามีของ version นี้แล้ว)
+        """
+        version = self.document_version(policy_info)
+        facts = policy_info.get("policy_facts")
+        if facts and facts.get("version") == version:
+            return facts
+
+        policy_text = self.load_text(policy_info)
+        if not policy_text:
+            return None
+        facts = {"version": version, **extract_policy_facts(policy_text)}
+        policy_info["policy_facts"] = facts
+        print(f"🧾 facts ของกรมธรรม์ {policy_info['policy_number']}: ชั้น {facts['insurance_class']}, "
+              f"excess {facts['excess_baht']}, แจ้งเหตุ {facts['hotline']}")
+        return facts
+
+    def _enrich_logged(self, policy_info: Dict):
+        try:
+            self.enrich(policy_info)
+        except Exception as e:
+            print(f"⚠️ ดึง facts ของกรมธรรม์ {policy_info.get('policy_number')} ไม่สำเร็จ: {e}")
+
+    def enrich_all(self, policies: Iterable[Dict]):
+        for policy_info in policies:
+            if policy_info.get("policy_document_base64"):
+                self._enrich_logged(policy_info)
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
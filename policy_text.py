@@ -0,0 +1,144 @@
+"""
+แปลงเอกสารกรมธรรม์ (PDF) เป็นข้อความแยกตามหน้า สำหรับส่งให้ Gemini แทนไฟล์ PDF
+
+ข้อความแต่ละหน้าขึ้นต้นด้วย "[หน้า N]" เพื่อให้ AI อ้างอิงหน้าได้ตามที่ prompt กำหนด
+ผลลัพธ์ถูก cache ตาม (เลขกรมธรรม์, version ของเอกสาร) ทั้งในหน่วยความจำและบนดิสก์
+จึงแปลงแค่ครั้งเดียวต่อเอกสารหนึ่งฉบับ (แม้ restart)
+
+ต้องติดตั้ง pypdf ถ้าไม่มี (หรือ PDF เป็นภาพสแกนที่ไม่มีข้อความ) จะคืน None ให้ผู้เรียกส่ง PDF แทน
+
+pypdf ทำสระ/วรรณยุกต์ไทยบางตัวหาย (เช่น "สิ้นสุด" -> "สิ้นสด") และสลับลำดับข้อความของ PDF หลายคอลัมน์
+ผู้เรียกจึงส่งค่าที่รู้อยู่แล้วของกรมธรรม์ (expected_values เช่น ทะเบียน ประเภทประกัน) มาตรวจ
+ถ้าข้อความที่แปลงได้ไม่มีค่าใดค่าหนึ่ง ถือว่าไม่น่าเชื่อถือและคืน None เช่นกัน
+"""
+
+import base64
+import io
+import os
+import re
+import threading
+import unicodedata
+from typing import Dict, Iterable, List, Optional
+
+# ข้อความสั้นกว่านี้ถือว่าแปลงไม่สำเร็จ (เช่น PDF ที่เป็นภาพสแกน)
+MIN_TEXT_CHARS = 200
+
+_SPACES_RE = re.compile(r"[ \t ]+")
+_SAFE_NAME_RE = re.compile(r"[^\w\-]")
+
+
+def extract_pdf_pages(pdf_bytes: bytes) -> List[str]:
+    """
+    ดึงข้อความของแต่ละหน้าจาก PDF (ต้องมี pypdf)
+    """
+    from pypdf import PdfReader
+
+    reader = PdfReader(io.BytesIO(pdf_bytes))
+    return [page.extract_text() or "" for page in reader.pages]
+
+
+def format_page_tagged(pages: List[str]) -> str:
+    """
+    รวมข้อความทุกหน้าเป็นข้อความเดียว ขึ้นต้นแต่ละหน้าด้วย [หน้า N] และตัดช่องว่าง/บรรทัดว่างที่เกิน
+    """
+    sections = []
+    for number, text in enumerate(pages, 1):
+        lines = (_SPACES_RE.sub(" ", line).strip() for line in text.splitlines())
+        body = "\n".join(line for line in lines if line)
+        sections.append(f"[หน้า {number}]\n{body}")
+    return "\n\n".join(sections)
+
+
+def missing_values(text: str, expected_values: Iterable[str]) -> List[str]:
+    """
+    ค่าที่ควรมีในเอกสารแต่หาไม่เจอในข้อความ (เทียบแบบไม่สนช่องว่าง)
+    """
+    compact = "".join(unicodedata.normalize("NFC", text).split())
+    return [value for value in expected_values
+            if value and "".join(unicodedata.normalize("NFC", value).split()) not in compact]
+
+
+class PolicyTextCache:
+    """
+    Cache ข้อความของเอกสารกรมธรรม์ (หน่วยความจำ + ดิสก์)
+
+    directory=None หรือ "" = cache ในหน่วยความจำอย่างเดียว
+    ค่า None ใน cache หมายถึงแปลงไม่ได้ (ไม่ลองซ้ำจนกว่า version จะเปลี่ยน)
+    """
+
+    def __init__(self, directory: Optional[str] = None):
+        self.directory = directory or None
+        self._memory: Dict[str, Optional[str]] = {}
+        self._locks: Dict[str, threading.Lock] = {}
+        self._lock = threading.Lock()
+
+    def _key(self, policy_number: str, version: str) -> str:
+        return _SAFE_NAME_RE.sub("_", f"{policy_number}-{version}")
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, f"{key}.txt")
+
+    def _read_disk(self, key: str) -> Optional[str]:
+        if not self.directory:
+            return None
+        try:
+            with open(self._path(key), encoding="utf-8") as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def _write_disk(self, key: str, text: str):
+        if not self.directory:
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        temp_path = self._path(key) + ".tmp"
+        with open(temp_path, "w", encoding="utf-8") as f:
+            f.write(text)
+        os.replace(temp_path, self._path(key))
+
+    def get(self, policy_number: str, version: str, document_base64: str,
+            expected_values: Iterable[str] = ()) -> Optional[str]:
+        """
+        คืนข้อความแยกหน้าของเอกสาร (แปลงครั้งแรกแล้ว cache) หรือ None ถ้าแปลงไม่ได้/ไม่ผ่านการตรวจ expected_values
+        """
+        key = self._key(policy_number, version)
+        if key in self._memory:
+            return self._memory[key]
+
+        # ล็อกต่อเอกสาร: ผู้ใช้หลายคนที่ขอเอกสารเดียวกันพร้อมกันจะแปลงแค่ครั้งเดียว
+        with self._lock:
+            key_lock = self._locks.setdefault(key, threading.Lock())
+        with key_lock:
+            if key in self._memory:
+                return self._memory[key]
+
+            text = self._read_disk(key)
+            if text is None:
+                text = self._extract(policy_number, document_base64)
+                if text is not None:
+                    self._write_disk(key, text)
+            if text is not None:
+                missing = missing_values(text, expected_values)
+                if missing:
+                    print(f"⚠️ ข้อความจาก PDF ของกรมธรรม์ {policy_number} ไม่มี {', '.join(missing)} "
+                          f"(สระหาย/ลำดับคอลัมน์ผิด) ใช้การส่ง PDF แทน")
+                    text = None
+            self._memory[key] = text
+            return text
+
+    def _extract(self, policy_number: str, document_base64: str) -> Optional[str]:
+        try:
+            pages = extract_pdf_pages(base64.b64decode(document_base64))
+        except ImportError:
+            print("⚠️ ไม่ได้ติดตั้ง pypdf ใช้การส่ง PDF ให้ Gemini แทน")
+            return None
+        except Exception as e:
+            print(f"⚠️ แปลง PDF ของกรมธรรม์ {policy_number} เป็นข้อความไม่สำเร็จ: {e}")
+            return None
+
+        text = format_page_tagged(pages)
+        if sum(len(page.strip()) for page in pages) < MIN_TEXT_CHARS:
+            print(f"⚠️ PDF ของกรมธรรม์ {policy_number} แทบไม่มีข้อความ (อาจเป็นภาพสแกน) ใช้การส่ง PDF แทน")
+            return None
+        print(f"📄 แปลง PDF ของกรมธรรม์ {policy_number} เป็นข้อความ {len(pages)} หน้า ({len(text)} ตัวอักษร)")
+        return text
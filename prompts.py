@@ -0,0 +1,463 @@
+"""
+คลัง prompt ของ Gemini แบบมีเวอร์ชันและหลาย variant (ทดลอง A/B)
+
+prompt แต่ละชุด (เช่น damage_analysis) มีได้หลาย variant:
+- default : prompt ที่ใช้งานจริงอยู่
+- compact : prompt แบบกระชับ (ไม่มีเส้นคั่น/emoji ตกแต่ง ไม่ย่อหน้า ไม่พูดคำสั่งซ้ำ)
+แต่ละ variant แบ่งเป็นส่วน (section) ที่ compile ไว้ตอน register ตอน render แค่ต่อ string
+เปลี่ยนเนื้อหา variant เมื่อไหร่ให้เพิ่ม version เพื่อไม่ให้สถิติของเนื้อหาเก่าปนกับเนื้อหาใหม่
+
+แบ่ง traffic ด้วย PromptRegistry.configure({"damage_analysis": {"compact": 20}}) = 20% ใช้ compact
+ที่เหลือใช้ default ผู้ใช้คนเดิมได้ variant เดิมเสมอ (hash จาก user_id)
+PromptRegistry.record() เก็บ token และ latency ต่อ variant เพื่อเทียบกันที่ /metrics
+(ลง usage_store ตัวเดียวกับ usage_meter ผ่าน use_store เมื่อ web และ worker ต้องเห็นยอดเดียวกัน)
+"""
+
+import hashlib
+import random
+import string
+from collections import defaultdict
+from typing import Dict, List, Optional, Tuple
+
+from usage_store import MemoryUsageStore
+
+DEFAULT_VARIANT = "default"
+
+
+def _percentile(values, pct: float) -> float:
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, int(round(pct / 100 * len(ordered))) - 1))
+    return ordered[index]
+
+
+def _escape_label(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", " ")
+
+
+class _Section:
+    """
+    template ของ str.format ที่แยกเป็น (ข้อความ, ชื่อ field) ไว้ล่วงหน้า (รองรับแค่ {ชื่อ} ไม่มี format spec)
+    """
+
+    __slots__ = ("_parts", "fields")
+
+    def __init__(self, text: str):
+        self._parts: List[Tuple[str, Optional[str]]] = []
+        for literal, field, spec, conversion in string.Formatter().parse(text):
+            if spec or conversion:
+                raise ValueError(f"prompt template ไม่รองรับ format spec: {{{field}:{spec}}}")
+            self._parts.append((literal, field))
+        self.fields = frozenset(field for _, field in self._parts if field)
+
+    def render(self, values: Dict) -> str:
+        return "".join(literal + (str(values[field]) if field else "") for literal, field in self._parts)
+
+
+class PromptTemplate:
+    """
+    prompt หนึ่ง variant (name/variant@version) ประกอบด้วยหลายส่วนที่ compile แล้ว
+    """
+
+    def __init__(self, name: str, variant: str, version: int, sections: Dict[str, str]):
+        self.name = name
+        self.variant = variant
+        self.version = version
+        self._sections = {key: _Section(text) for key, text in sections.items()}
+
+    @property
+    def key(self) -> str:
+        return f"{self.name}/{self.variant}@v{self.version}"
+
+    def has(self, section: str) -> bool:
+        return section in self._sections
+
+    def render(self, section: str, **values) -> str:
+        return self._sections[section].render(values)
+
+
+# scope ของตัวนับใน usage_store และ prefix ของ series latency
+_PROMPT_SCOPE = "prompt"
+_STAT_FIELDS = ("calls", "prompt_tokens", "output_tokens", "total_tokens", "latency_s_total")
+
+
+class PromptRegistry:
+    """
+    เก็บ template ทุก variant เลือก variant ตามสัดส่วน traffic และเก็บสถิติต่อ variant (thread-safe)
+
+    window = จำนวน latency ล่าสุดต่อ variant ที่ใช้คำนวณ p50/p95
+    """
+
+    def __init__(self, window: int = 500):
+        self._templates: Dict[str, Dict[str, PromptTemplate]] = defaultdict(dict)
+        # name -> [(variant, เปอร์เซ็นต์)] ส่วนที่เหลือใช้ default
+        self._splits: Dict[str, List[Tuple[str, float]]] = {}
+        self._window = window
+        self._store = MemoryUsageStore()
+
+    def use_store(self, store):
+        """
+        เก็บสถิติลง usage_store ที่กำหนด (เช่น SQLite ที่ web และ worker ใช้ร่วมกัน)
+        """
+        self._store = store
+
+    def register(self, template: PromptTemplate) -> PromptTemplate:
+        self._templates[template.name][template.variant] = template
+        return template
+
+    def get(self, name: str, variant: str = DEFAULT_VARIANT) -> PromptTemplate:
+        return self._templates[name][variant]
+
+    def variants(self, name: str) -> List[str]:
+        return list(self._templates[name])
+
+    def configure(self, splits: Dict[str, Dict[str, float]]):
+        """
+        splits = {name: {variant: เปอร์เซ็นต์}} (รวมกันไม่เกิน 100, variant ต้อง register ไว้แล้ว)
+        """
+        configured = {}
+        for name, shares in splits.items():
+            for variant in shares:
+                if variant not in self._templates.get(name, {}):
+                    raise ValueError(f"ไม่มี prompt variant {name}/{variant}")
+            if sum(shares.values()) > 100:
+                raise ValueError(f"สัดส่วน variant ของ {name} รวมเกิน 100%: {shares}")
+            configured[name] = [(variant, float(share)) for variant, share in shares.items() if share > 0]
+        self._splits = configured
+
+    def choose(self, name: str, subject: Optional[str] = None) -> PromptTemplate:
+        """
+        เลือก variant ของ name ให้ subject (เช่น user_id) ตามสัดส่วนที่ configure ไว้
+        subject เดิมได้ variant เดิม (ไม่มี subject = สุ่ม)
+        """
+        shares = self._splits.get(name)
+        if shares:
+            if subject:
+                digest = hashlib.sha1(f"{name}:{subject}".encode("utf-8")).digest()
+                point = int.from_bytes(digest[:4], "big") / 2**32 * 100
+            else:
+                point = random.random() * 100
+            for variant, share in shares:
+                if point < share:
+                    return self.get(name, variant)
+                point -= share
+        return self.get(name)
+
+    def splits(self) -> Dict[str, Dict[str, float]]:
+        return {name: dict(shares) for name, shares in self._splits.items()}
+
+    def record(self, template: PromptTemplate, latency_s: float, usage: Dict[str, int]):
+        """
+        บันทึกผลการเรียก Gemini หนึ่งครั้งที่ใช้ template นี้ (usage จาก usage_to_dict)
+        """
+        self._store.increment([(_PROMPT_SCOPE, "", template.key)], {
+            "calls": 1,
+            "prompt_tokens": usage.get("prompt_token_count", 0),
+            "output_tokens": usage.get("candidates_token_count", 0),
+            "total_tokens": usage.get("total_token_count", 0),
+            "latency_s_total": latency_s,
+        })
+        self._store.add_sample(f"{_PROMPT_SCOPE}:{template.key}", latency_s, self._window)
+
+    def snapshot(self) -> Dict:
+        rows = []
+        for key, counters in self._store.rows(_PROMPT_SCOPE, ""):
+            name, _, rest = key.partition("/")
+            variant, _, version = rest.partition("@")
+            stats = {field: counters[field] for field in _STAT_FIELDS}
+            calls = stats["calls"] or 1
+            latencies = self._store.samples(f"{_PROMPT_SCOPE}:{key}")
+            rows.append({
+                "prompt": name,
+                "variant": variant,
+                "version": version,
+                **stats,
+                "avg_prompt_tokens": stats["prompt_tokens"] / calls,
+                "avg_output_tokens": stats["output_tokens"] / calls,
+                "latency_p50_s": _percentile(latencies, 50) if latencies else None,
+                "latency_p95_s": _percentile(latencies, 95) if latencies else None,
+            })
+        rows.sort(key=lambda row: (row["prompt"], row["variant"], row["version"]))
+        return {"splits": self.splits(), "variants": rows}
+
+    def prometheus(self) -> str:
+        lines = []
+        rows = self.snapshot()["variants"]
+        for metric, field, help_text, kind in (
+            ("gemini_prompt_calls_total", "calls", "จำนวนการเรียกต่อ prompt variant", "counter"),
+            ("gemini_prompt_tokens_total", None, "token ต่อ prompt variant แยกตามชนิด", "counter"),
+            ("gemini_prompt_latency_seconds_sum", "latency_s_total", "เวลารวมของ generate_content ต่อ prompt variant",
+             "counter"),
+        ):
+            lines += [f"# HELP {metric} {help_text}", f"# TYPE {metric} {kind}"]
+            for row in rows:
+                labels = (f'prompt="{_escape_label(row["prompt"])}",variant="{_escape_label(row["variant"])}",'
+                          f'version="{_escape_label(row["version"])}"')
+                if field is None:
+                    for token_kind in ("prompt", "output", "total"):
+                        lines.append(f'{metric}{{{labels},kind="{token_kind}"}} {row[f"{token_kind}_tokens"]}')
+                else:
+                    lines.append(f"{metric}{{{labels}}} {row[field]}")
+        return "\n".join(lines) + "\n"
+
+
+def parse_splits(text: Optional[str]) -> Dict[str, Dict[str, float]]:
+    """
+    แปลงค่า env เช่น "damage_analysis:compact=20,policy_ocr:compact=50" เป็น {name: {variant: เปอร์เซ็นต์}}
+    """
+    splits: Dict[str, Dict[str, float]] = defaultdict(dict)
+    for item in (text or "").split(","):
+        item = item.strip()
+        if not item:
+            continue
+        name, _, share = item.partition(":")
+        variant, _, percent = share.partition("=")
+        if not variant or not percent:
+            raise ValueError(f"รูปแบบ prompt split ไม่ถูกต้อง: {item!r} (ต้องเป็น name:variant=percent)")
+        splits[name.strip()][variant.strip()] = float(percent)
+    return dict(splits)
+
+
+# ---------------------------------------------------------------------------
+# prompt อ่านบัตรประชาชน/ทะเบียนรถ
+# ---------------------------------------------------------------------------
+
+POLICY_OCR = "policy_ocr"
+
+prompt_registry = PromptRegistry()
+
+prompt_registry.register(PromptTemplate(POLICY_OCR, DEFAULT_VARIANT, 1, {
+    "main": """
+        วิเคราะห์รูปภาพนี้ว่าเป็น "บัตรประชาชน" หรือ "ทะเบียนรถ"
+        แล้วสกัดข้อมูลที่สำคัญออกมาในรูปแบบ JSON ดังนี้:
+        {{
+          "type": "id_card" หรือ "license_plate" หรือ "unknown",
+          "value": "เลขบัตรประชาชน 13 หลัก" หรือ "เลขทะเบียนรถ (เช่น 1กข1234)" หรือ null
+        }}
+
+        กฎ:
+        1. ถ้าเป็นบัตรประชาชน ให้สกัดเลขบัตร 13 หลัก (เอาแค่ตัวเลข)
+        2. ถ้าเป็นทะเบียนรถ ให้สกัดหมวดอักษรและตัวเลข (เช่น 1กข1234, ฌห55) ไม่ต้องเอาชื่อจังหวัด
+        3. ถ้าไม่แน่ใจให้ตอบ unknown
+        """,
+}))
+
+prompt_registry.register(PromptTemplate(POLICY_OCR, "compact", 1, {
+    "main": """รูปนี้เป็นบัตรประชาชนหรือทะเบียนรถ ตอบเป็น JSON อย่างเดียว:
+{{"type": "id_card" | "license_plate" | "unknown", "value": "..." | null}}
+- id_card: เลขบัตร 13 หลัก (ตัวเลขล้วน)
+- license_plate: หมวดอักษร+ตัวเลข เช่น 1กข1234, ฌห55 (ไม่เอาจังหวัด)
+- ไม่แน่ใจ: unknown""",
+}))
+
+
+def render_ocr_prompt(template: PromptTemplate) -> str:
+    return template.render("main")
+
+
+# ---------------------------------------------------------------------------
+# prompt วิเคราะห์ความเสียหายเทียบกับเอกสารกรมธรรม์
+#
+# ส่วนของ template (ต่อกันตามลำดับนี้ ส่วนที่ไม่มีข้อมูลจะถูกข้าม):
+#   header         ข้อมูลลูกค้า
+#   multi_image    มีรูปความเสียหายมากกว่าหนึ่งรูป
+#   facts          ข้อมูลที่ดึงจากเอกสารไว้แล้ว (แต่ละบรรทัดใช้ fact_line)
+#   counterpart:<สถานะ>  สถานะคู่กรณีที่ลูกค้ายืนยัน ("มีคู่กรณี" / "ไม่มีคู่กรณี")
+#   additional_info รายละเอียดจากลูกค้า
+#   rules          กฎการวิเคราะห์และรูปแบบคำตอบ
+# ---------------------------------------------------------------------------
+
+DAMAGE_ANALYSIS = "damage_analysis"
+
+prompt_registry.register(PromptTemplate(DAMAGE_ANALYSIS, DEFAULT_VARIANT, 1, {
+    "header": """
+          คุณคือ "AI ผู้เชี่ยวชาญด้านประกันรถยนต์และประเมินสินไหม" สำหรับบริการ "เช็คสิทธิ์เคลมด่วน"
+          วิเคราะห์ด้วยมาตรฐานระดับมืออาชีพ แม่นยำตามเงื่อนไขกรมธรรม์ และสื่อสารอย่างรวดเร็วเป็นกันเอง
+
+          **ภารกิจของคุณ:**
+          วิเคราะห์ภาพความเสียหาย (ภาพที่ 1) เปรียบเทียบกับเอกสารกรมธรรม์ (ภาพที่ 2/PDF) อย่างละเอียดและรวดเร็ว เพื่อให้คำแนะนำที่ถูกต้องที่สุดแก่ผู้เอาประกันภัย
+
+          **ข้อมูลพื้นฐานลูกค้า:**
+          - ผู้เอาประกัน: คุณ {first_name} {last_name}
+          - รถยนต์: {car_model} ({car_year}) ทะเบียน {plate}
+          - บริษัทประกัน: {insurance_company}""",
+    "multi_image": """
+          - ภาพความเสียหาย: {count} ภาพ (ภาพที่ 1-{count}) เป็นรถคันเดียวกันคนละมุม ให้วิเคราะห์รวมกันและตอบสรุปเพียงครั้งเดียว""",
+    "facts": """
+          - ข้อมูลที่ยืนยันแล้วจากเอกสารกรมธรรม์ (ใช้ค่านี้ได้ทันที ไม่ต้องค้นหาในเอกสารซ้ำ):
+{lines}""",
+    "fact_line": "            • {label}: {value} [หน้า {page}]",
+    "counterpart:มีคู่กรณี": """
+          - สถานะคู่กรณี: ✅ **มีคู่กรณี** (ลูกค้ายืนยัน)
+
+          ⚠️ **คำแนะนำสำหรับ AI:**
+          - ลูกค้ายืนยันว่า "มีคู่กรณี"
+          - ให้ตรวจสอบในรูปภาพว่ามีหลักฐานรถคู่กรณีหรือไม่
+          - ถ้าในรูปไม่เห็นคู่กรณีชัดเจน → แนะนำให้ลูกค้าถ่ายรูปคู่กรณีเพิ่ม
+          - ถ้ามีคู่กรณีจริง → ประกันชั้น 2+/2/3+/3 สามารถเคลมได้
+          - ชั้น 1 → เคลมได้ทุกกรณี (ไม่ว่าจะมีคู่กรณีหรือไม่)""",
+    "counterpart:ไม่มีคู่กรณี": """
+          - สถานะคู่กรณี: ❌ **ไม่มีคู่กรณี** (ลูกค้ายืนยัน - ชนเสา/เฉี่ยวชนเอง)
+
+          ⚠️ **คำแนะนำสำหรับ AI:**
+          - ลูกค้ายืนยันว่า "ไม่มีคู่กรณี" (ชนเสา, เฉี่ยวชนวัตถุ, ชนกำแพง)
+          - ตรวจสอบประเภทประกันจากเอกสาร:
+            • ชั้น 1 → ✅ เคลมได้ (ไม่ต้องมีคู่กรณี)
+            • ชั้น 2+/2/3+/3 → ❌ เคลมไม่ได้ (ต้องมีคู่กรณีเป็นยานพาหนะ)
+          - ถ้าเป็นชั้น 2+ → แจ้งชัดเจนว่า "ไม่มีสิทธิ์เคลม" พร้อมอ้างอิงเงื่อนไขจากเอกสาร""",
+    "additional_info": """
+          - รายละเอียดจากลูกค้า: "{additional_info}"
+
+          ⚠️ **หมายเหตุ:** ใช้ข้อมูลนี้ประกอบการพิจารณา แต่ยึดรูปภาพและเอกสารกรมธรรม์เป็นหลัก""",
+    # ส่วนนี้เดิมไม่ใช่ f-string จึงส่งข้อความ {policy_info['first_name'].strip()} ไปตรง ๆ
+    # default@v1 คงข้อความเดิมทุกตัวอักษร (ใช้เทียบกับ variant อื่น) ส่วน compact ใส่ชื่อลูกค้าจริง
+    "rules": """
+
+          ━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━
+          **🎯 กฎการวิเคราะห์เชิงลึก (CRITICAL RULES):**
+          ━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━
+          1. **CITATION (ต้องทำ):** ทุกครั้งที่ระบุเงื่อนไขประกัน ต้องใส่เลขบรรทัดหรือส่วนที่อ้างอิงจากเอกสาร เช่น [หน้า 1: ประเภทประกัน], [หน้า 1: ค่าเสียหายส่วนแรก]
+          2. **AI LOGIC:** - ถ้าเป็นชั้น 2+ หรือ 3+: ตรวจสอบอย่างเข้มงวดว่ารอยในภาพ "เป็นการชนกับยานพาหนะ" หรือไม่
+            - การคำนวณ: เปรียบเทียบ "ค่าซ่อมประเมิน" vs "ค่า Excess" ในเอกสารจริงเสมอ
+
+          ━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━
+          **📦 รูปแบบการตอบ (สำหรับ "เช็คสิทธิ์เคลมด่วน"):**
+          ━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━
+
+          สวัสดีครับ คุณ {{policy_info['first_name'].strip()}} สรุปผลการเช็คสิทธิ์เคลมด่วนดังนี้ครับ:
+
+          📄 **ข้อมูลกรมธรรม์จากเอกสาร**
+          • ประเภท: [ระบุ เช่น ประกันชั้น 2+] [หน้า 1]
+          • ค่าเสียหายส่วนแรก (Excess): [ระบุ] บาท [หน้า 1]
+          • เบอร์แจ้งเหตุ: [ระบุเบอร์ที่เจอในเอกสาร เช่น 1557] [หน้า 1]
+
+          🔍 **วิเคราะห์ความเสียหายจากภาพ**
+          • พบรอยที่: [ระบุตำแหน่ง เช่น ประตูซ้าย]
+          • ลักษณะ: [เช่น รอยขูดลึกจากการเบียดวัตถุ]
+          • สาเหตุ: [เช่น เฉี่ยวชนไม่มีคู่กรณีเป็นยานพาหนะ]
+
+          ⚖️ **ผลการพิจารณาสินไหม**
+          [เลือกแสดงผลเพียง 1 ข้อความ:]
+
+          • 🟢 **ได้รับสิทธิ์เคลม (แนะนำ)** - อยู่ในเงื่อนไขและค่าซ่อมสูงกว่าค่า Excess
+          • 🟡 **ได้รับสิทธิ์เคลม (มีค่าใช้จ่าย)** - เคลมได้ตามสิทธิ์ แต่ค่าซ่อมประเมินต่ำกว่าค่า Excess ท่านต้องรับผิดชอบเอง
+          • 🔴 **ไม่สามารถเคลมได้** - รอยเสียหายไม่ตรงเงื่อนไข (เช่น ชั้น 2+ ต้องมีคู่กรณีเป็นยานพาหนะ)
+
+          • **เหตุผล:** [อธิบายสั้นๆ โดยอ้างอิงประเภทประกัน [หน้า 1] เทียบกับลักษณะรอยในภาพ]
+
+          💰 **สรุปค่าใช้จ่ายเบื้องต้น**
+          • ประเมินค่าซ่อม: [ช่วงราคา] บาท
+          • คุณจ่ายเอง (Excess): [ระบุ] บาท [หน้า 1]
+          • ประกันรับผิดชอบ: [ระบุ] บาท
+
+          📋 **3 ขั้นตอนดำเนินการด่วน**
+          1. **แจ้งเหตุทันที:** โทร [เบอร์จากเอกสาร]
+          2. **นัดตรวจสภาพ:** เตรียมใบขับขี่และภาพถ่ายนี้ไว้ให้เจ้าหน้าที่
+          3. **เข้าซ่อม:** นำรถเข้าอู่เครือ [ระบุชื่อบริษัทประกัน]
+
+          ⚠️ **ข้อแนะนำเพิ่มเติม:** [เช่น กรณีค่าซ่อมใกล้เคียง Excess แนะนำให้ซ่อมเองเพื่อรักษาประวัติลดเบี้ยปีหน้า]
+
+          *หมายเหตุ: เป็นการประเมินเบื้องต้นโดย AI จากเอกสารที่ระบุ โปรดตรวจสอบกับบริษัทประกันอีกครั้ง*
+          """,
+}))
+
+# เนื้อหาเดียวกับ default แต่ไม่มีเส้นคั่น ย่อหน้า และคำสั่งที่ซ้ำกัน (รูปแบบคำตอบที่ผู้ใช้เห็นเหมือนเดิม)
+prompt_registry.register(PromptTemplate(DAMAGE_ANALYSIS, "compact", 1, {
+    "header": """คุณเป็นผู้เชี่ยวชาญประกันรถยนต์ของบริการ "เช็คสิทธิ์เคลมด่วน"
+วิเคราะห์รูปความเสียหายเทียบกับเอกสารกรมธรรม์ที่แนบมา แล้วสรุปสิทธิ์เคลมให้ลูกค้าอย่างแม่นยำและเป็นกันเอง
+
+ลูกค้า: คุณ {first_name} {last_name}
+รถ: {car_model} ({car_year}) ทะเบียน {plate}
+บริษัทประกัน: {insurance_company}""",
+    "multi_image": """
+รูปความเสียหาย {count} รูปเป็นรถคันเดียวกันคนละมุม ให้วิเคราะห์รวมและสรุปครั้งเดียว""",
+    "facts": """
+ข้อมูลจากเอกสารที่ยืนยันแล้ว (ใช้ได้เลย):
+{lines}""",
+    "fact_line": "- {label}: {value} [หน้า {page}]",
+    "counterpart:มีคู่กรณี": """
+ลูกค้ายืนยันว่ามีคู่กรณี: ถ้ารูปไม่เห็นคู่กรณีชัดเจนให้แนะนำถ่ายรูปคู่กรณีเพิ่ม""",
+    "counterpart:ไม่มีคู่กรณี": """
+ลูกค้ายืนยันว่าไม่มีคู่กรณี (ชนเสา/วัตถุ/กำแพง): ชั้น 2+/2/3+/3 เคลมไม่ได้ ให้แจ้งชัดเจนพร้อมอ้างอิงเงื่อนไขในเอกสาร""",
+    "additional_info": """
+รายละเอียดจากลูกค้า (ใช้ประกอบ แต่ยึดรูปและเอกสารเป็นหลัก): "{additional_info}\"""",
+    "rules": """
+
+กฎ:
+1. อ้างอิงหน้าเอกสารทุกครั้งที่ระบุเงื่อนไข เช่น [หน้า 1]
+2. ชั้น 1 เคลมได้ทุกกรณี ชั้น 2+/2/3+/3 ต้องชนกับยานพาหนะ (ตรวจรอยในรูปอย่างเข้มงวด)
+3. เทียบค่าซ่อมประเมินกับค่า Excess ในเอกสารเสมอ
+
+ตอบตามรูปแบบนี้:
+สวัสดีครับ คุณ {first_name} สรุปผลการเช็คสิทธิ์เคลมด่วนดังนี้ครับ:
+
+📄 **ข้อมูลกรมธรรม์จากเอกสาร**
+• ประเภท / ค่าเสียหายส่วนแรก (Excess) / เบอร์แจ้งเหตุ พร้อม [หน้า N]
+
+🔍 **วิเคราะห์ความเสียหายจากภาพ**
+• พบรอยที่ / ลักษณะ / สาเหตุ
+
+⚖️ **ผลการพิจารณาสินไหม** (เลือก 1)
+🟢 ได้รับสิทธิ์เคลม (แนะนำ) | 🟡 ได้รับสิทธิ์เคลม (มีค่าใช้จ่าย: ค่าซ่อมต่ำกว่า Excess) | 🔴 ไม่สามารถเคลมได้
+• **เหตุผล:** สั้นๆ อ้างอิงประเภทประกัน [หน้า N]
+
+💰 **สรุปค่าใช้จ่ายเบื้องต้น**
+• ประเมินค่าซ่อม / คุณจ่ายเอง (Excess) / ประกันรับผิดชอบ (บาท)
+
+📋 **3 ขั้นตอนดำเนินการด่วน**
+1. แจ้งเหตุ โทร [เบอร์จากเอกสาร] 2. นัดตรวจสภาพ 3. เข้าอู่เครือบริษัทประกัน
+
+⚠️ **ข้อแนะนำเพิ่มเติม:** (ถ้ามี)
+
+*หมายเหตุ: เป็นการประเมินเบื้องต้นโดย AI จากเอกสารที่ระบุ โปรดตรวจสอบกับบริษัทประกันอีกครั้ง*""",
+}))
+
+
+def render_damage_prompt(template: PromptTemplate, policy_info: Dict, image_count: int,
+                         facts: Optional[Dict] = None, has_counterpart: Optional[str] = None,
+                         additional_info: Optional[str] = None) -> str:
+    """
+    ต่อส่วนของ prompt วิเคราะห์ความเสียหายตามข้อมูลที่มี
+
+    facts: ผลของ PolicyFactsEnricher.current() (ข้อมูลที่ดึงจากเอกสารไว้ล่วงหน้า)
+    """
+    first_name = policy_info["first_name"].strip()
+    parts = [template.render(
+        "header",
+        first_name=first_name,
+        last_name=policy_info["last_name"],
+        car_model=policy_info["car_model"],
+        car_year=policy_info["car_year"],
+        plate=policy_info["plate"],
+        insurance_company=policy_info["insurance_company"],
+    )]
+
+    # หลายรูป = รถคันเดียวกันคนละมุม
+    if image_count > 1:
+        parts.append(template.render("multi_image", count=image_count))
+
+    # ข้อมูลที่ดึงจากเอกสารไว้ล่วงหน้า (AI ไม่ต้องค้นหาเองในเอกสาร)
+    if facts:
+        pages = facts["pages"]
+        excess = facts["excess_baht"]
+        known_facts = [
+            ("ประเภท", facts["insurance_class"] and f"ประกันชั้น {facts['insurance_class']}", "insurance_class"),
+            ("ค่าเสียหายส่วนแรก (Excess)", excess is not None and f"{excess:,} บาท", "excess_baht"),
+            ("เบอร์แจ้งเหตุ", facts["hotline"], "hotline"),
+        ]
+        lines = [
+            template.render("fact_line", label=label, value=value, page=pages[key])
+            for label, value, key in known_facts
+            if value
+        ]
+        if lines:
+            parts.append(template.render("facts", lines="\n".join(lines)))
+
+    counterpart_section = f"counterpart:{has_counterpart}"
+    if has_counterpart and template.has(counterpart_section):
+        parts.append(template.render(counterpart_section))
+
+    if additional_info:
+        parts.append(template.render("additional_info", additional_info=additional_info))
+
+    parts.append(template.render("rules", first_name=first_name))
+    return "".join(parts)
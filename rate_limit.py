@@ -0,0 +1,124 @@
+"""
+จำกัดความถี่ของงานที่แพงต่อผู้ใช้ด้วย token bucket (แยก budget ตามชนิดงาน)
+
+ผู้ใช้คนเดียวที่ส่งรูปหรือข้อความรัว ๆ ไม่ควรกิน quota ของ Gemini และ thread ของ executor จนผู้ใช้คนอื่นช้า
+แต่ละชนิดงาน (ocr, analysis, lookup) มี bucket ต่อผู้ใช้:
+- เติม token ต่อเนื่องตาม per_minute
+- สะสมได้สูงสุด burst (ส่งติดกันได้ burst ครั้งก่อนโดนจำกัด)
+
+bucket ที่เติมเต็มแล้ว (ผู้ใช้ไม่ได้ใช้งานนานพอ) ถูกลบทิ้งเป็นระยะ หน่วยความจำจึงโตตามผู้ใช้ที่ active เท่านั้น
+"""
+
+import threading
+import time
+from collections import defaultdict
+from typing import Callable, Dict, NamedTuple, Optional, Tuple
+
+
+class Limit(NamedTuple):
+    per_minute: float
+    burst: float
+
+
+# ค่าเริ่มต้น: การใช้งานปกติ (OCR 1 รูป, วิเคราะห์ 1 เคลม, พิมพ์ค้นหา 2-3 ครั้ง) ไม่โดนจำกัด
+DEFAULT_LIMITS: Dict[str, Limit] = {
+    "ocr": Limit(per_minute=6, burst=3),
+    "analysis": Limit(per_minute=2, burst=2),
+    "lookup": Limit(per_minute=20, burst=10),
+}
+
+
+def parse_limits(text: Optional[str]) -> Dict[str, Limit]:
+    """
+    แปลงค่า env เช่น "ocr=6:3,analysis=2:2" (ครั้งต่อนาที:burst) ทับค่าใน DEFAULT_LIMITS
+    ครั้งต่อนาที = 0 คือไม่จำกัดงานชนิดนั้น
+    """
+    limits = dict(DEFAULT_LIMITS)
+    for item in (text or "").split(","):
+        item = item.strip()
+        if not item:
+            continue
+        kind, _, spec = item.partition("=")
+        per_minute, _, burst = spec.partition(":")
+        if not kind or not per_minute:
+            raise ValueError(f"รูปแบบ rate limit ไม่ถูกต้อง: {item!r} (ต้องเป็น kind=ครั้งต่อนาที:burst)")
+        per_minute = float(per_minute)
+        limits[kind.strip()] = Limit(per_minute, float(burst) if burst else max(1.0, per_minute))
+    return limits
+
+
+class UserRateLimiter:
+    """
+    token bucket ต่อ (ชนิดงาน, ผู้ใช้) (thread-safe)
+    """
+
+    def __init__(self, limits: Dict[str, Limit], clock: Callable[[], float] = time.monotonic,
+                 sweep_every: int = 1024):
+        self.limits = {kind: limit for kind, limit in limits.items() if limit.per_minute > 0}
+        self._clock = clock
+        self._sweep_every = sweep_every
+        # (kind, user_id) -> [token ที่เหลือ, เวลาที่คำนวณล่าสุด]
+        self._buckets: Dict[Tuple[str, str], list] = {}
+        self._counts: Dict[str, Dict[str, int]] = defaultdict(lambda: {"allowed": 0, "rejected": 0})
+        self._calls = 0
+        self._lock = threading.Lock()
+
+    def allow(self, kind: str, user_id: str, cost: float = 1.0) -> bool:
+        """
+        ใช้ token ของผู้ใช้สำหรับงานชนิดนี้ คืน False ถ้าเกิน limit (ผู้เรียกต้องข้ามงานนั้น)
+        """
+        limit = self.limits.get(kind)
+        if limit is None:
+            return True
+        now = self._clock()
+        with self._lock:
+            bucket = self._buckets.get((kind, user_id))
+            if bucket is None:
+                bucket = self._buckets[(kind, user_id)] = [limit.burst, now]
+            else:
+                bucket[0] = min(limit.burst, bucket[0] + (now - bucket[1]) * limit.per_minute / 60.0)
+                bucket[1] = now
+            allowed = bucket[0] >= cost
+            if allowed:
+                bucket[0] -= cost
+            self._counts[kind]["allowed" if allowed else "rejected"] += 1
+
+            self._calls += 1
+            if self._calls % self._sweep_every == 0:
+                self._sweep(now)
+        return allowed
+
+    def _sweep(self, now: float):
+        # bucket ที่เติมเต็มแล้ว = เหมือนผู้ใช้ใหม่ ลบได้โดยไม่เปลี่ยนผล
+        full = [
+            key for key, (tokens, updated) in self._buckets.items()
+            if tokens + (now - updated) * self.limits[key[0]].per_minute / 60.0 >= self.limits[key[0]].burst
+        ]
+        for key in full:
+            del self._buckets[key]
+
+    def snapshot(self) -> Dict[str, Dict]:
+        with self._lock:
+            return {
+                "limits": {
+                    kind: {"per_minute": limit.per_minute, "burst": limit.burst, **self._counts[kind]}
+                    for kind, limit in self.limits.items()
+                },
+                "tracked_buckets": len(self._buckets),
+            }
+
+    def prometheus(self) -> str:
+        """
+        metrics รูปแบบ Prometheus text (ไม่แยกรายผู้ใช้)
+        """
+        snapshot = self.snapshot()
+        lines = ["# HELP user_rate_limit_requests_total งานที่ผ่าน/ถูกปฏิเสธโดย rate limit ต่อผู้ใช้",
+                 "# TYPE user_rate_limit_requests_total counter"]
+        for kind in self.limits:
+            for result in ("allowed", "rejected"):
+                lines.append(f'user_rate_limit_requests_total{{kind="{kind}",result="{result}"}} '
+                             f'{snapshot["limits"][kind][result]}')
+        lines += ["# HELP user_rate_limit_buckets bucket ที่ติดตามอยู่ (ผู้ใช้ที่เพิ่งใช้งาน)",
+                  "# TYPE user_rate_limit_buckets gauge",
+                  f"user_rate_limit_buckets {snapshot['tracked_buckets']}"]
+        return "\n".join(lines) + "\n"
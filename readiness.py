@@ -0,0 +1,64 @@
+"""
+ติดตามสถานะการ warm-up ตอนเริ่มระบบ (สำหรับ /ready)
+
+/health บอกแค่ว่า process ทำงานอยู่ ส่วน /ready จะบอกว่า import ที่หนัก,
+ข้อมูลกรมธรรม์ และ connection ไปยัง upstream ถูกเตรียมไว้ครบแล้วหรือยัง
+พร้อมรายงานเวลาที่ใช้ในแต่ละขั้น (import-time profile)
+"""
+
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, Iterable, Optional
+
+
+class Readiness:
+    """
+    เก็บผลของแต่ละ component ที่ต้อง warm-up
+
+    component ที่อยู่ใน required ต้องสำเร็จครบก่อน ready จะเป็น True
+    component อื่น (เช่น connectivity check) รายงานผลอย่างเดียว ไม่ขวาง readiness
+    """
+
+    def __init__(self, required: Iterable[str]):
+        self.required = list(required)
+        self.started_at = time.time()
+        self._components: Dict[str, Dict] = {}
+        self._lock = threading.Lock()
+
+    def mark(self, name: str, ok: bool, duration_ms: float, detail: Optional[str] = None):
+        with self._lock:
+            self._components[name] = {
+                "ok": ok,
+                "duration_ms": round(duration_ms, 1),
+                "detail": detail,
+            }
+
+    @contextmanager
+    def track(self, name: str):
+        """
+        จับเวลาและบันทึกผลของ block (exception จะถูกบันทึกแล้วส่งต่อ)
+        """
+        started = time.perf_counter()
+        try:
+            yield
+        except Exception as e:
+            self.mark(name, False, (time.perf_counter() - started) * 1000, str(e))
+            raise
+        self.mark(name, True, (time.perf_counter() - started) * 1000)
+
+    @property
+    def ready(self) -> bool:
+        with self._lock:
+            return all(self._components.get(name, {}).get("ok") for name in self.required)
+
+    def report(self) -> Dict:
+        with self._lock:
+            components = {name: dict(value) for name, value in self._components.items()}
+        return {
+            "ready": all(components.get(name, {}).get("ok") for name in self.required),
+            "pending": [name for name in self.required if name not in components],
+            "uptime_s": round(time.time() - self.started_at, 1),
+            "components": components,
+        }
+
@@ -0,0 +1,184 @@
+"""
+Timeout และ circuit breaker สำหรับการเรียก upstream (Gemini, LINE)
+
+ถ้า upstream ค้างหรือล่ม ทุก thread ของเราจะไปรอ upstream นั้นจนไม่เหลือกำลังให้ผู้ใช้คนอื่น
+CircuitBreaker จึงนับผลของการเรียกล่าสุด (window) ต่อ upstream:
+- closed    : เรียกได้ตามปกติ
+- open      : error หรือเรียกช้าเกิน slow_call_s รวมกันเกิน failure_rate ของ window
+              -> ปฏิเสธทันทีด้วย CircuitOpenError เป็นเวลา open_s วินาที (ไม่เสีย thread ไปรอ)
+- half_open : ครบเวลาแล้ว ปล่อยให้ลอง 1 request ถ้าสำเร็จกลับเป็น closed ถ้าไม่สำเร็จ open ต่อ
+
+is_failure(error) ใช้แยก error ที่เป็นปัญหาของ upstream (timeout, 5xx) ออกจาก error ของ request เอง
+(เช่น 400 reply token หมดอายุ) ซึ่งไม่ควรทำให้ breaker เปิด
+"""
+
+import asyncio
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from typing import Callable, Deque, Dict, Optional
+
+
+class CircuitOpenError(RuntimeError):
+    """upstream ถูกตัดชั่วคราว (breaker เปิดอยู่)"""
+
+    def __init__(self, name: str, retry_after: float):
+        super().__init__(f"{name} ไม่พร้อมใช้งานชั่วคราว (ลองใหม่ในอีก {retry_after:.0f} วินาที)")
+        self.name = name
+        self.retry_after = retry_after
+
+
+class UpstreamTimeoutError(TimeoutError):
+    """เรียก upstream เกินเวลาที่กำหนด"""
+
+
+# thread สำหรับเรียก SDK ที่ไม่มี timeout ของตัวเอง (เช่น genai.upload_file)
+# ถ้าเกินเวลา ผู้เรียกได้ thread คืนทันที ส่วน call ที่ค้างจะจบเองใน pool นี้
+_timeout_pool = ThreadPoolExecutor(max_workers=8, thread_name_prefix="upstream-timeout")
+
+
+def call_with_timeout(fn: Callable, timeout: Optional[float], *args, **kwargs):
+    """
+    เรียก fn โดยรอไม่เกิน timeout วินาที (None = รอจนเสร็จ)
+    """
+    if timeout is None:
+        return fn(*args, **kwargs)
+    future = _timeout_pool.submit(fn, *args, **kwargs)
+    try:
+        return future.result(timeout=timeout)
+    except FutureTimeoutError:
+        future.cancel()
+        raise UpstreamTimeoutError(f"{getattr(fn, '__name__', 'call')} เกิน {timeout:g} วินาที") from None
+
+
+async def call_with_timeout_async(fn: Callable, timeout: Optional[float], *args, **kwargs):
+    """
+    เรียก fn แบบ blocking ใน thread (asyncio.to_thread) โดยไม่บล็อก event loop และรอไม่เกิน timeout วินาที
+    """
+    try:
+        return await asyncio.wait_for(asyncio.to_thread(fn, *args, **kwargs), timeout)
+    except asyncio.TimeoutError:
+        raise UpstreamTimeoutError(f"{getattr(fn, '__name__', 'call')} เกิน {timeout:g} วินาที") from None
+
+
+class CircuitBreaker:
+    """
+    Circuit breaker ของ upstream หนึ่งตัว (thread-safe)
+    """
+
+    def __init__(self, name: str, window: int = 20, min_calls: int = 5, failure_rate: float = 0.5,
+                 slow_call_s: Optional[float] = None, open_s: float = 30.0,
+                 is_failure: Optional[Callable[[BaseException], bool]] = None):
+        self.name = name
+        self.min_calls = min_calls
+        self.failure_rate = failure_rate
+        self.slow_call_s = slow_call_s
+        self.open_s = open_s
+        self.is_failure = is_failure or (lambda error: True)
+        # True = ล้มเหลว (error หรือช้าเกิน)
+        self._outcomes: Deque[bool] = deque(maxlen=window)
+        self._state = "closed"
+        self._opened_at = 0.0
+        self._probe_in_flight = False
+        self._rejected = 0
+        self._lock = threading.Lock()
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            return self._current_state()
+
+    def _current_state(self) -> str:
+        # เรียกภายใต้ self._lock
+        if self._state == "open" and time.monotonic() - self._opened_at >= self.open_s:
+            self._state = "half_open"
+        return self._state
+
+    def allow(self):
+        """
+        ตรวจว่าเรียก upstream ได้หรือไม่ ถ้าไม่ได้ raise CircuitOpenError
+        """
+        with self._lock:
+            state = self._current_state()
+            if state == "closed":
+                return
+            if state == "half_open" and not self._probe_in_flight:
+                self._probe_in_flight = True
+                return
+            self._rejected += 1
+            retry_after = max(0.0, self.open_s - (time.monotonic() - self._opened_at))
+        raise CircuitOpenError(self.name, retry_after)
+
+    def record(self, failed: bool):
+        with self._lock:
+            if self._state == "half_open":
+                self._probe_in_flight = False
+                if failed:
+                    self._trip()
+                else:
+                    print(f"✅ circuit {self.name}: กลับมาใช้งานได้")
+                    self._state = "closed"
+                    self._outcomes.clear()
+                return
+
+            self._outcomes.append(failed)
+            failures = sum(self._outcomes)
+            if (self._state == "closed" and len(self._outcomes) >= self.min_calls
+                    and failures / len(self._outcomes) >= self.failure_rate):
+                self._trip()
+
+    def _trip(self):
+        # เรียกภายใต้ self._lock
+        self._state = "open"
+        self._opened_at = time.monotonic()
+        self._outcomes.clear()
+        print(f"🔌 circuit {self.name}: เปิด (ตัด upstream {self.open_s:g} วินาที)")
+
+    def call(self, fn: Callable, *args, **kwargs):
+        """
+        เรียก fn ผ่าน breaker: ปฏิเสธทันทีถ้าเปิดอยู่ และบันทึกผล/ความช้าของการเรียก
+        """
+        self.allow()
+        started = time.monotonic()
+        try:
+            result = fn(*args, **kwargs)
+        except BaseException as e:
+            self.record(self.is_failure(e))
+            raise
+        slow = self.slow_call_s is not None and time.monotonic() - started > self.slow_call_s
+        self.record(slow)
+        return result
+
+    async def call_async(self, fn: Callable, *args, **kwargs):
+        """
+        แบบเดียวกับ call() สำหรับ coroutine function (breaker ตัวเดียวกันใช้ได้ทั้ง thread และ event loop)
+        """
+        self.allow()
+        started = time.monotonic()
+        try:
+            result = await fn(*args, **kwargs)
+        except asyncio.CancelledError:
+            # ผู้เรียกยกเลิกเอง ไม่นับเป็นผลของ upstream แต่ต้องคืนสิทธิ์ probe ของ half_open
+            with self._lock:
+                self._probe_in_flight = False
+            raise
+        except BaseException as e:
+            self.record(self.is_failure(e))
+            raise
+        slow = self.slow_call_s is not None and time.monotonic() - started > self.slow_call_s
+        self.record(slow)
+        return result
+
+    def snapshot(self) -> Dict:
+        with self._lock:
+            state = self._current_state()
+            return {
+                "state": state,
+                "recent_calls": len(self._outcomes),
+                "recent_failures": sum(self._outcomes),
+                "rejected": self._rejected,
+                "retry_after_s": round(max(0.0, self.open_s - (time.monotonic() - self._opened_at)), 1)
+                if state == "open" else 0.0,
+            }
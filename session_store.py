@@ -0,0 +1,256 @@
+"""
+เก็บ user_sessions ลงดิสก์ให้รอด restart/deploy (docker-compose down แล้ว up ใหม่)
+
+รูปแบบบนดิสก์ (ในโฟลเดอร์ SESSION_STORE_DIR):
+- snapshot.json      : {"generation": N, "sessions": {...}, "touched": {user_id: epoch}} สถานะทั้งหมดตอน compact ล่าสุด
+- log-<N>.jsonl      : transition ที่เกิดหลัง snapshot ทีละบรรทัด {"u": user_id, "s": session หรือ null, "t": epoch}
+
+ทางร้อน (save) แค่เขียนบรรทัดลง buffer ของไฟล์ ส่วน flush + fsync ทำใน background thread ทุก
+fsync_interval วินาที (ข้อมูลที่อาจหายตอนเครื่องดับคือไม่เกินช่วงนั้น)
+เมื่อ log ยาวเกิน compact_after บรรทัดจะเขียน snapshot ใหม่แล้วเริ่ม log generation ถัดไป
+
+เวลาที่ผู้ใช้มีความเคลื่อนไหวล่าสุด (touched) เก็บไว้ด้วย ผู้เรียกใช้ idle_users() หา session ที่ค้างนาน
+แล้ว save(user_id, None) เพื่อลบ (ทั้งในหน่วยความจำและ snapshot ถัดไป) ทำงานแม้ปิดการเก็บลงดิสก์
+"""
+
+import glob
+import json
+import os
+import threading
+import time
+from typing import Dict, List, Optional, TextIO
+
+
+class SessionStore:
+    """
+    Snapshot + append-only log ของ session ผู้ใช้
+
+    directory=None หรือ "" = ปิดการเก็บลงดิสก์ (save/load/close ไม่ทำอะไร)
+    """
+
+    def __init__(self, directory: Optional[str], fsync_interval: float = 1.0, compact_after: int = 5000):
+        self.directory = directory or None
+        self.fsync_interval = fsync_interval
+        self.compact_after = compact_after
+        # user_id -> session ที่ encode เป็น JSON แล้ว (ใช้เทียบว่าเปลี่ยนหรือไม่ และเขียน snapshot)
+        self._encoded: Dict[str, str] = {}
+        # user_id -> เวลา (epoch) ที่ save ล่าสุด ใช้หา session ที่ไม่มีความเคลื่อนไหว
+        self._touched: Dict[str, float] = {}
+        self._generation = 0
+        self._log: Optional[TextIO] = None
+        self._log_lines = 0
+        self._dirty = False
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._flusher: Optional[threading.Thread] = None
+
+    @property
+    def enabled(self) -> bool:
+        return self.directory is not None
+
+    # ---------- path ----------
+    def _snapshot_path(self) -> str:
+        return os.path.join(self.directory, "snapshot.json")
+
+    def _log_path(self, generation: int) -> str:
+        return os.path.join(self.directory, f"log-{generation}.jsonl")
+
+    def _log_generations(self):
+        generations = []
+        for path in glob.glob(os.path.join(self.directory, "log-*.jsonl")):
+            try:
+                generations.append(int(os.path.basename(path)[4:-6]))
+            except ValueError:
+                continue
+        return sorted(generations)
+
+    # ---------- โหลดตอนเริ่มระบบ ----------
+    def load(self) -> Dict[str, Dict]:
+        """
+        อ่าน snapshot แล้ว replay log ทุก generation ที่ใหม่กว่า คืน {user_id: session}
+        (บรรทัดสุดท้ายที่เขียนไม่ครบเพราะเครื่องดับจะถูกข้าม)
+        """
+        if not self.enabled:
+            return {}
+        os.makedirs(self.directory, exist_ok=True)
+
+        sessions: Dict[str, Dict] = {}
+        touched: Dict[str, float] = {}
+        generation = 0
+        try:
+            with open(self._snapshot_path(), encoding="utf-8") as f:
+                snapshot = json.load(f)
+            sessions = snapshot["sessions"]
+            touched = snapshot.get("touched", {})
+            generation = snapshot["generation"]
+        except FileNotFoundError:
+            pass
+
+        replayed = 0
+        generations = [g for g in self._log_generations() if g >= generation]
+        for log_generation in generations:
+            with open(self._log_path(log_generation), encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue
+                    if entry["s"] is None:
+                        sessions.pop(entry["u"], None)
+                        touched.pop(entry["u"], None)
+                    else:
+                        sessions[entry["u"]] = entry["s"]
+                        if "t" in entry:
+                            touched[entry["u"]] = entry["t"]
+                    replayed += 1
+
+        # session จากไฟล์รุ่นเก่าที่ไม่มีเวลา นับว่าเพิ่งใช้งานตอนโหลด
+        now = time.time()
+        with self._lock:
+            self._encoded = {
+                user_id: json.dumps(session, ensure_ascii=False, sort_keys=True)
+                for user_id, session in sessions.items()
+            }
+            self._touched = {user_id: touched.get(user_id, now) for user_id in sessions}
+            self._generation = max([generation] + generations)
+            self._log_lines = replayed
+        return sessions
+
+    # ---------- ทางร้อน ----------
+    def save(self, user_id: str, session: Optional[Dict]):
+        """
+        บันทึก session ล่าสุดของผู้ใช้ (None = ลบ) ข้ามถ้าไม่เปลี่ยนจากที่บันทึกไว้
+        """
+        now = time.time()
+        if not self.enabled:
+            with self._lock:
+                if session is None:
+                    self._touched.pop(user_id, None)
+                else:
+                    self._touched[user_id] = now
+            return
+        encoded = json.dumps(session, ensure_ascii=False, sort_keys=True) if session is not None else None
+        with self._lock:
+            if encoded is None:
+                self._touched.pop(user_id, None)
+            else:
+                self._touched[user_id] = now
+            if self._encoded.get(user_id) == encoded:
+                return
+            if encoded is None:
+                self._encoded.pop(user_id, None)
+            else:
+                self._encoded[user_id] = encoded
+            self._open_log()
+            self._log.write(f'{{"u": {json.dumps(user_id)}, "s": {encoded or "null"}, "t": {now:.3f}}}\n')
+            self._log_lines += 1
+            self._dirty = True
+        self._ensure_flusher()
+
+    def last_active(self, user_id: str) -> Optional[float]:
+        """
+        เวลา (epoch) ที่บันทึก session ของผู้ใช้ล่าสุด (None = ไม่มี session)
+        """
+        with self._lock:
+            return self._touched.get(user_id)
+
+    def idle_users(self, before: float) -> List[str]:
+        """
+        ผู้ใช้ที่ไม่มีการบันทึก session ตั้งแต่เวลา before (epoch) เป็นต้นมา
+        """
+        with self._lock:
+            return [user_id for user_id, touched in self._touched.items() if touched < before]
+
+    def _open_log(self):
+        # เรียกภายใต้ self._lock
+        if self._log is None:
+            os.makedirs(self.directory, exist_ok=True)
+            path = self._log_path(self._generation)
+            self._log = open(path, "a", encoding="utf-8")
+            # บรรทัดสุดท้ายอาจเขียนไม่ครบ (เครื่องดับ) ขึ้นบรรทัดใหม่ก่อนไม่ให้ต่อกับบรรทัดที่เสีย
+            if self._log.tell() > 0:
+                with open(path, "rb") as f:
+                    f.seek(-1, os.SEEK_END)
+                    if f.read(1) != b"\n":
+                        self._log.write("\n")
+
+    # ---------- background flush / compact ----------
+    def _ensure_flusher(self):
+        if self._flusher is None:
+            with self._lock:
+                if self._flusher is None and not self._stop.is_set():
+                    self._flusher = threading.Thread(target=self._flush_loop, name="session-store", daemon=True)
+                    self._flusher.start()
+
+    def _flush_loop(self):
+        while not self._stop.wait(self.fsync_interval):
+            try:
+                self.flush()
+                if self._log_lines >= self.compact_after:
+                    self.compact()
+            except Exception as e:
+                print(f"⚠️ บันทึก session ลงดิสก์ไม่สำเร็จ: {e}")
+
+    def flush(self):
+        """
+        เขียน buffer ลงไฟล์และ fsync
+        """
+        with self._lock:
+            if not self._dirty or self._log is None:
+                return
+            self._log.flush()
+            fileno = self._log.fileno()
+            self._dirty = False
+        os.fsync(fileno)
+
+    def compact(self):
+        """
+        เขียน snapshot ของสถานะปัจจุบัน แล้วลบ log เก่าที่ snapshot ครอบคลุมแล้ว
+        """
+        if not self.enabled:
+            return
+        started = time.perf_counter()
+        with self._lock:
+            # เริ่ม log generation ใหม่ก่อน เพื่อให้ save ระหว่าง compact ไปลงไฟล์ใหม่
+            if self._log is not None:
+                self._log.flush()
+                os.fsync(self._log.fileno())
+                self._log.close()
+                self._log = None
+            self._generation += 1
+            generation = self._generation
+            encoded = dict(self._encoded)
+            touched = {user_id: round(self._touched.get(user_id, 0.0), 3) for user_id in encoded}
+            self._log_lines = 0
+            self._dirty = False
+
+        os.makedirs(self.directory, exist_ok=True)
+        temp_path = self._snapshot_path() + ".tmp"
+        with open(temp_path, "w", encoding="utf-8") as f:
+            # ต่อ JSON ที่ encode ไว้แล้วโดยตรง ไม่ต้อง decode/encode session ทั้งหมดใหม่
+            f.write(f'{{"generation": {generation}, "sessions": {{')
+            f.write(", ".join(f"{json.dumps(user_id)}: {session}" for user_id, session in encoded.items()))
+            f.write(f'}}, "touched": {json.dumps(touched)}}}')
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, self._snapshot_path())
+
+        for old_generation in self._log_generations():
+            if old_generation < generation:
+                os.remove(self._log_path(old_generation))
+        print(f"💾 compact session {len(encoded)} รายการ ({(time.perf_counter() - started) * 1000:.0f} ms)")
+
+    def close(self):
+        """
+        หยุด background thread และเขียนทุกอย่างลงดิสก์ (เรียกตอน shutdown)
+        """
+        if not self.enabled:
+            return
+        self._stop.set()
+        if self._flusher is not None:
+            self._flusher.join()
+        self.flush()
+        with self._lock:
+            if self._log is not None:
+                self._log.close()
+                self._log = None
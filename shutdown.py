@@ -0,0 +1,167 @@
+"""
+ปิด process แบบไม่ทิ้งงานของผู้ใช้ (SIGTERM ตอน deploy / docker-compose down)
+
+ระหว่างทำงานปกติ ติดตามสิ่งที่ต้องเก็บกวาดถ้า process ถูกปิดกลางคัน:
+- เคลมที่กำลังวิเคราะห์อยู่ (ผู้ใช้ที่ยังรอผล)
+- ไฟล์ PDF ชั่วคราวบนดิสก์
+- ไฟล์ที่อัพโหลดไป Gemini แล้วยังไม่ได้ลบ
+
+เมื่อเริ่มปิด (begin_drain) web จะหยุดรับงานใหม่ รองานที่ค้างจนถึง deadline
+งานที่ไม่เสร็จในเวลาถูกทิ้ง (abandon_claims) เพื่อแจ้งผู้ใช้ แล้วลบไฟล์ที่ยังค้างด้วย cleanup()
+"""
+
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+from contextlib import contextmanager
+from typing import Callable, Dict, List, Optional, Set
+
+
+class ShutdownCoordinator:
+    """
+    สถานะการปิดระบบและรายการงาน/ไฟล์ที่ยังค้าง (thread-safe)
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._drain_started: Optional[float] = None
+        self._claims: Dict[str, int] = {}
+        self._abandoned: Set[str] = set()
+        self._temp_files: Set[str] = set()
+        self._uploads: Set[str] = set()
+
+    # ---------- drain ----------
+    def begin_drain(self) -> float:
+        """
+        เริ่มปิดระบบ (เรียกซ้ำได้) คืนเวลาที่เริ่ม (time.monotonic) ใช้นับ deadline ร่วมกันทุกขั้น
+        """
+        with self._lock:
+            if self._drain_started is None:
+                self._drain_started = time.monotonic()
+                print("🛑 เริ่มปิดระบบ: หยุดรับงานใหม่")
+            return self._drain_started
+
+    @property
+    def draining(self) -> bool:
+        return self._drain_started is not None
+
+    @staticmethod
+    def wait_until(done: Callable[[], bool], deadline: float, poll_interval: float = 0.05) -> bool:
+        """
+        รอจน done() เป็น True หรือถึง deadline (time.monotonic) คืน True ถ้าเสร็จทันเวลา
+        """
+        while not done():
+            if time.monotonic() >= deadline:
+                return False
+            time.sleep(poll_interval)
+        return True
+
+    # ---------- เคลมที่กำลังวิเคราะห์ ----------
+    @contextmanager
+    def claim(self, user_id: str):
+        """
+        ครอบช่วงที่ผู้ใช้รอผลวิเคราะห์อยู่
+        """
+        with self._lock:
+            self._claims[user_id] = self._claims.get(user_id, 0) + 1
+        try:
+            yield
+        finally:
+            with self._lock:
+                remaining = self._claims.pop(user_id) - 1
+                if remaining:
+                    self._claims[user_id] = remaining
+
+    def abandon_claims(self) -> List[str]:
+        """
+        ผู้ใช้ที่เคลมยังไม่เสร็จตอนหมดเวลา (ถูกบันทึกไว้ ผลที่เสร็จภายหลังจะไม่ถูกส่งซ้ำหลังแจ้งผู้ใช้แล้ว)
+        """
+        with self._lock:
+            users = list(self._claims)
+            self._abandoned.update(users)
+            return users
+
+    def is_abandoned(self, user_id: str) -> bool:
+        with self._lock:
+            return user_id in self._abandoned
+
+    # ---------- ไฟล์ที่ต้องลบ ----------
+    def track_temp_file(self, path: str):
+        with self._lock:
+            self._temp_files.add(path)
+
+    def release_temp_file(self, path: str):
+        with self._lock:
+            self._temp_files.discard(path)
+
+    def track_upload(self, name: str):
+        with self._lock:
+            self._uploads.add(name)
+
+    def release_upload(self, name: str):
+        with self._lock:
+            self._uploads.discard(name)
+
+    def cleanup(self, delete_upload: Callable[[str], None], timeout: float = 10.0) -> Dict[str, int]:
+        """
+        ลบไฟล์ชั่วคราวและไฟล์ที่อัพโหลดที่ยังค้างอยู่ (error ของแต่ละไฟล์ log แล้วข้าม)
+        ไฟล์ที่อัพโหลดลบพร้อมกันหลาย thread และรอไม่เกิน timeout วินาที
+        """
+        with self._lock:
+            temp_files, self._temp_files = self._temp_files, set()
+            uploads, self._uploads = self._uploads, set()
+
+        removed = deleted = 0
+        for path in temp_files:
+            try:
+                os.unlink(path)
+                removed += 1
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                print(f"⚠️ ลบไฟล์ชั่วคราว {path} ไม่สำเร็จ: {e}")
+        if uploads:
+            pool = ThreadPoolExecutor(max_workers=min(len(uploads), 8), thread_name_prefix="cleanup")
+            futures = {pool.submit(delete_upload, name): name for name in uploads}
+            done, _ = wait(futures, timeout=timeout)
+            pool.shutdown(wait=False, cancel_futures=True)
+            for future in done:
+                if future.exception() is None:
+                    deleted += 1
+                else:
+                    print(f"⚠️ ลบไฟล์ {futures[future]} จาก Gemini ไม่สำเร็จ: {future.exception()}")
+            if len(done) < len(futures):
+                print(f"⚠️ ลบไฟล์จาก Gemini ไม่ทันเวลา {len(futures) - len(done)} ไฟล์ (หมดอายุเองใน 48 ชั่วโมง)")
+        return {"temp_files_removed": removed, "uploads_deleted": deleted}
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {
+                "draining": self._drain_started is not None,
+                "claims_in_flight": sum(self._claims.values()),
+                "temp_files": len(self._temp_files),
+                "uploads": len(self._uploads),
+            }
+
+
+def sweep_stale_files(directory: str, prefix: str, max_age_s: float) -> int:
+    """
+    ลบไฟล์ชั่วคราวที่ค้างจาก process ก่อนหน้าที่ถูก kill (ชื่อขึ้นต้นด้วย prefix และเก่ากว่า max_age_s)
+    """
+    removed = 0
+    cutoff = time.time() - max_age_s
+    try:
+        entries = list(os.scandir(directory))
+    except OSError:
+        return 0
+    for entry in entries:
+        if not entry.name.startswith(prefix) or not entry.is_file():
+            continue
+        try:
+            if entry.stat().st_mtime < cutoff:
+                os.unlink(entry.path)
+                removed += 1
+        except OSError:
+            pass
+    return removed
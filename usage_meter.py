@@ -0,0 +1,176 @@
+"""
+นับ token และค่าใช้จ่ายของทุกการเรียก Gemini (จาก usage_metadata ของ response)
+
+รวมตาม:
+- งาน (task: ocr / analysis) และโมเดล (ยอดสะสม)
+- เลขกรมธรรม์ต่อวัน (ดูว่าเอกสารฉบับไหนแพง แสดงเฉพาะ top N ใน snapshot)
+- ผู้ใช้ต่อวัน (ใช้คุม budget รายวัน)
+ตัวนับอยู่ใน usage_store.py (หน่วยความจำ หรือ SQLite ที่ web และ worker ใช้ร่วมกัน)
+ยอดรายวันของวันก่อน ๆ ถูกลบเมื่อขึ้นวันใหม่
+
+ค่าเริ่มต้นของราคาเป็นของ gemini-2.5-flash (USD ต่อ 1M token) ปรับได้ผ่าน env ใน main.py
+token ที่ถูก cache คิดราคา cached_price ส่วน output นับรวม thinking token (total - prompt)
+"""
+
+import threading
+import time
+from typing import Dict, Optional
+
+from llm_provider import usage_to_dict
+from usage_store import MemoryUsageStore
+
+
+class BudgetExceededError(RuntimeError):
+    """ผู้ใช้ใช้ token ครบ budget ของวันนี้แล้ว"""
+
+    def __init__(self, user_id: str, used: int, budget: int):
+        super().__init__(f"ผู้ใช้ {user_id} ใช้ token วันนี้ {used:,}/{budget:,} แล้ว")
+        self.user_id = user_id
+        self.used = used
+        self.budget = budget
+
+
+# ชื่อ scope ของตัวนับใน usage_store
+_TASK = "task"
+_POLICY = "policy"
+_USER = "user"
+_BUDGET = "budget"
+_COUNTER_FIELDS = ("calls", "prompt_tokens", "cached_tokens", "output_tokens", "total_tokens", "cost_usd")
+
+
+def _escape_label(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", " ")
+
+
+class UsageMeter:
+    """
+    ตัวนับ token/ค่าใช้จ่ายของ Gemini (thread-safe)
+
+    daily_token_budget = token สูงสุดต่อผู้ใช้ต่อวัน (None = ไม่จำกัด) ตรวจกับยอดใน store
+    store = usage_store (None = นับในหน่วยความจำของ process นี้)
+    """
+
+    def __init__(self, input_price: float = 0.30, output_price: float = 2.50, cached_price: float = 0.075,
+                 daily_token_budget: Optional[int] = None, store=None):
+        self.input_price = input_price
+        self.output_price = output_price
+        self.cached_price = cached_price
+        self.daily_token_budget = daily_token_budget
+        self.store = store if store is not None else MemoryUsageStore()
+        self._current_day: Optional[str] = None
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _today() -> str:
+        return time.strftime("%Y-%m-%d")
+
+    def _day(self) -> str:
+        # ขึ้นวันใหม่: ลบยอดรายวันของวันก่อน ๆ (ต่อผู้ใช้/ต่อกรมธรรม์) ไม่ให้โตไปเรื่อย ๆ
+        today = self._today()
+        if today != self._current_day:
+            with self._lock:
+                if today != self._current_day:
+                    self.store.evict_before(today)
+                    self._current_day = today
+        return today
+
+    def cost(self, usage: Dict[str, int]) -> float:
+        prompt = usage.get("prompt_token_count", 0)
+        cached = usage.get("cached_content_token_count", 0)
+        output = max(0, usage.get("total_token_count", 0) - prompt)
+        return ((prompt - cached) * self.input_price + cached * self.cached_price
+                + output * self.output_price) / 1_000_000
+
+    def record(self, task: str, model: str, response, user_id: Optional[str] = None,
+               policy_number: Optional[str] = None) -> Dict[str, int]:
+        """
+        บันทึก usage_metadata ของ response หนึ่งครั้ง คืน usage ที่อ่านได้
+        """
+        usage = usage_to_dict(getattr(response, "usage_metadata", None))
+        increments = {
+            "calls": 1,
+            "prompt_tokens": usage.get("prompt_token_count", 0),
+            "cached_tokens": usage.get("cached_content_token_count", 0),
+            "output_tokens": usage.get("candidates_token_count", 0),
+            "total_tokens": usage.get("total_token_count", 0),
+            "cost_usd": self.cost(usage),
+        }
+        today = self._day()
+        keys = [(_TASK, "", f"{task}|{model}")]
+        if policy_number:
+            keys.append((_POLICY, today, policy_number))
+        if user_id:
+            keys.append((_USER, today, user_id))
+        self.store.increment(keys, increments)
+        return usage
+
+    def used_today(self, user_id: str) -> int:
+        return int(self.store.get(_USER, self._day(), user_id)["total_tokens"])
+
+    def check_budget(self, user_id: Optional[str]):
+        """
+        raise BudgetExceededError ถ้าผู้ใช้ใช้ token วันนี้ครบ budget แล้ว (รวมทุก process ถ้า store ใช้ร่วมกัน)
+        """
+        if not user_id or self.daily_token_budget is None:
+            return
+        used = self.used_today(user_id)
+        if used >= self.daily_token_budget:
+            self.store.increment([(_BUDGET, "", "rejections")], {"calls": 1})
+            raise BudgetExceededError(user_id, used, self.daily_token_budget)
+
+    def snapshot(self, top_users: int = 20, top_policies: int = 20) -> Dict:
+        today = self._day()
+
+        def counters(row: Dict[str, float]) -> Dict[str, float]:
+            return {field: row[field] for field in _COUNTER_FIELDS}
+
+        by_task = []
+        for name, row in self.store.rows(_TASK, ""):
+            task, _, model = name.partition("|")
+            by_task.append({"task": task, "model": model, **counters(row)})
+        return {
+            "shared": self.store.shared,
+            "by_task": by_task,
+            "top_policies_today": [{"policy_number": policy, **counters(row)}
+                                   for policy, row in self.store.rows(_POLICY, today, top_policies)],
+            "policies_today": self.store.count(_POLICY, today),
+            "top_users_today": [{"user_id": user_id, **counters(row)}
+                                for user_id, row in self.store.rows(_USER, today, top_users)],
+            "users_today": self.store.count(_USER, today),
+            "daily_token_budget": self.daily_token_budget,
+            "budget_rejections": int(self.store.get(_BUDGET, "", "rejections")["calls"]),
+        }
+
+    def prometheus(self) -> str:
+        """
+        metrics รูปแบบ Prometheus text (ไม่มี label รายผู้ใช้/รายกรมธรรม์เพื่อไม่ให้ series บาน ดูได้ที่ snapshot)
+        """
+        snapshot = self.snapshot(top_users=0, top_policies=0)
+        lines = [
+            "# HELP gemini_calls_total จำนวนการเรียก generate_content",
+            "# TYPE gemini_calls_total counter",
+        ]
+        for row in snapshot["by_task"]:
+            lines.append(f'gemini_calls_total{{task="{_escape_label(row["task"])}",'
+                         f'model="{_escape_label(row["model"])}"}} {row["calls"]}')
+        lines += ["# HELP gemini_tokens_total token ที่ใช้ แยกตามชนิด",
+                  "# TYPE gemini_tokens_total counter"]
+        for row in snapshot["by_task"]:
+            for kind in ("prompt", "cached", "output", "total"):
+                lines.append(f'gemini_tokens_total{{task="{_escape_label(row["task"])}",'
+                             f'model="{_escape_label(row["model"])}",kind="{kind}"}} {row[f"{kind}_tokens"]}')
+        lines += ["# HELP gemini_cost_usd_total ค่าใช้จ่ายโดยประมาณ (USD)",
+                  "# TYPE gemini_cost_usd_total counter"]
+        for row in snapshot["by_task"]:
+            lines.append(f'gemini_cost_usd_total{{task="{_escape_label(row["task"])}",'
+                         f'model="{_escape_label(row["model"])}"}} {row["cost_usd"]:.6f}')
+        lines += ["# HELP gemini_policies_today กรมธรรม์ที่ถูกวิเคราะห์วันนี้",
+                  "# TYPE gemini_policies_today gauge",
+                  f"gemini_policies_today {snapshot['policies_today']}",
+                  "# HELP gemini_users_today ผู้ใช้ที่เรียก Gemini วันนี้",
+                  "# TYPE gemini_users_today gauge",
+                  f"gemini_users_today {snapshot['users_today']}",
+                  "# HELP gemini_budget_rejections_total request ที่ถูกปฏิเสธเพราะเกิน budget รายวัน",
+                  "# TYPE gemini_budget_rejections_total counter",
+                  f"gemini_budget_rejections_total {snapshot['budget_rejections']}"]
+        return "\n".join(lines) + "\n"
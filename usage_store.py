@@ -0,0 +1,204 @@
+"""
+ที่เก็บตัวนับของ usage_meter.py (token/ค่าใช้จ่าย/budget) และ prompts.PromptRegistry (สถิติ prompt variant)
+
+- MemoryUsageStore: นับในหน่วยความจำของ process (ค่าเริ่มต้นเมื่อไม่ใช้ job queue)
+- SqliteUsageStore: นับลงไฟล์ SQLite (ไฟล์เดียวกับ job queue ได้) web และ worker ทุกตัวนับลงที่เดียวกัน
+  /metrics ของ web จึงเห็นการเรียก Gemini ที่ worker ทำ และ budget รายวันถูกตรวจกับยอดรวมของทุก process
+
+ตัวนับระบุด้วย (scope, day, name) เช่น ("user", "2024-01-31", user_id)
+day = "" คือยอดสะสม ส่วนยอดรายวันถูกลบด้วย evict_before เมื่อขึ้นวันใหม่
+"""
+
+import os
+import sqlite3
+import threading
+from collections import deque
+from contextlib import contextmanager
+from typing import Deque, Dict, Iterable, List, Optional, Tuple
+
+COUNTER_FIELDS = ("calls", "prompt_tokens", "cached_tokens", "output_tokens", "total_tokens", "cost_usd",
+                  "latency_s_total")
+
+CounterKey = Tuple[str, str, str]
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS usage_counters (
+    scope TEXT NOT NULL,
+    day TEXT NOT NULL,
+    name TEXT NOT NULL,
+    calls INTEGER NOT NULL DEFAULT 0,
+    prompt_tokens INTEGER NOT NULL DEFAULT 0,
+    cached_tokens INTEGER NOT NULL DEFAULT 0,
+    output_tokens INTEGER NOT NULL DEFAULT 0,
+    total_tokens INTEGER NOT NULL DEFAULT 0,
+    cost_usd REAL NOT NULL DEFAULT 0,
+    latency_s_total REAL NOT NULL DEFAULT 0,
+    PRIMARY KEY (scope, day, name)
+);
+CREATE INDEX IF NOT EXISTS usage_counters_tokens ON usage_counters (scope, day, total_tokens);
+CREATE TABLE IF NOT EXISTS usage_samples (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    series TEXT NOT NULL,
+    value REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS usage_samples_series ON usage_samples (series, id);
+"""
+
+
+def empty_counters() -> Dict[str, float]:
+    return {field: 0.0 if field in ("cost_usd", "latency_s_total") else 0 for field in COUNTER_FIELDS}
+
+
+class MemoryUsageStore:
+    """
+    ตัวนับในหน่วยความจำ (thread-safe) ใช้ได้แค่ใน process เดียว
+    """
+
+    shared = False
+
+    def __init__(self):
+        self._counters: Dict[CounterKey, Dict[str, float]] = {}
+        self._samples: Dict[str, Deque[float]] = {}
+        self._lock = threading.Lock()
+
+    def increment(self, keys: Iterable[CounterKey], increments: Dict[str, float]):
+        with self._lock:
+            for key in keys:
+                counters = self._counters.get(key)
+                if counters is None:
+                    counters = self._counters[key] = empty_counters()
+                for field, value in increments.items():
+                    counters[field] += value
+
+    def get(self, scope: str, day: str, name: str) -> Dict[str, float]:
+        with self._lock:
+            return dict(self._counters.get((scope, day, name)) or empty_counters())
+
+    def rows(self, scope: str, day: str, limit: Optional[int] = None) -> List[Tuple[str, Dict[str, float]]]:
+        """
+        ตัวนับของ scope/day เรียงตาม total_tokens มากไปน้อย (limit=None = ทั้งหมด)
+        """
+        with self._lock:
+            rows = [(name, dict(counters)) for (row_scope, row_day, name), counters in self._counters.items()
+                    if row_scope == scope and row_day == day]
+        rows.sort(key=lambda row: row[1]["total_tokens"], reverse=True)
+        return rows if limit is None else rows[:limit]
+
+    def count(self, scope: str, day: str) -> int:
+        with self._lock:
+            return sum(1 for row_scope, row_day, _ in self._counters if row_scope == scope and row_day == day)
+
+    def evict_before(self, day: str):
+        """
+        ลบตัวนับรายวันของวันก่อน day (ยอดสะสม day="" ไม่ถูกลบ)
+        """
+        with self._lock:
+            for key in [key for key in self._counters if key[1] and key[1] < day]:
+                del self._counters[key]
+
+    def add_sample(self, series: str, value: float, keep: int):
+        with self._lock:
+            samples = self._samples.get(series)
+            if samples is None or samples.maxlen != keep:
+                samples = self._samples[series] = deque(samples or (), maxlen=keep)
+            samples.append(value)
+
+    def samples(self, series: str) -> List[float]:
+        with self._lock:
+            return list(self._samples.get(series, ()))
+
+
+class SqliteUsageStore:
+    """
+    ตัวนับบนไฟล์ SQLite (WAL) ใช้ร่วมกันได้หลาย process บนเครื่องเดียวกัน
+    """
+
+    shared = True
+
+    def __init__(self, path: str):
+        self.path = path
+        # sqlite3 connection ใช้ข้าม thread ไม่ได้ จึงเปิดแยกต่อ thread
+        self._local = threading.local()
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._connection().executescript(_SCHEMA)
+
+    def _connection(self) -> sqlite3.Connection:
+        db = getattr(self._local, "db", None)
+        if db is None:
+            db = sqlite3.connect(self.path, timeout=30.0, isolation_level=None)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            self._local.db = db
+        return db
+
+    @contextmanager
+    def _transaction(self):
+        db = self._connection()
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            yield db
+        except BaseException:
+            db.execute("ROLLBACK")
+            raise
+        db.execute("COMMIT")
+
+    def increment(self, keys: Iterable[CounterKey], increments: Dict[str, float]):
+        fields = [field for field in COUNTER_FIELDS if field in increments]
+        columns = ", ".join(fields)
+        placeholders = ", ".join("?" for _ in fields)
+        updates = ", ".join(f"{field} = {field} + excluded.{field}" for field in fields)
+        values = [increments[field] for field in fields]
+        with self._transaction() as db:
+            db.executemany(
+                f"INSERT INTO usage_counters (scope, day, name, {columns}) VALUES (?, ?, ?, {placeholders}) "
+                f"ON CONFLICT (scope, day, name) DO UPDATE SET {updates}",
+                [(*key, *values) for key in keys],
+            )
+
+    def get(self, scope: str, day: str, name: str) -> Dict[str, float]:
+        row = self._connection().execute(
+            f"SELECT {', '.join(COUNTER_FIELDS)} FROM usage_counters WHERE scope = ? AND day = ? AND name = ?",
+            (scope, day, name),
+        ).fetchone()
+        return dict(zip(COUNTER_FIELDS, row)) if row else empty_counters()
+
+    def rows(self, scope: str, day: str, limit: Optional[int] = None) -> List[Tuple[str, Dict[str, float]]]:
+        rows = self._connection().execute(
+            f"SELECT name, {', '.join(COUNTER_FIELDS)} FROM usage_counters WHERE scope = ? AND day = ? "
+            f"ORDER BY total_tokens DESC LIMIT ?",
+            (scope, day, -1 if limit is None else limit),
+        ).fetchall()
+        return [(row[0], dict(zip(COUNTER_FIELDS, row[1:]))) for row in rows]
+
+    def count(self, scope: str, day: str) -> int:
+        return self._connection().execute(
+            "SELECT COUNT(*) FROM usage_counters WHERE scope = ? AND day = ?", (scope, day),
+        ).fetchone()[0]
+
+    def evict_before(self, day: str):
+        with self._transaction() as db:
+            db.execute("DELETE FROM usage_counters WHERE day != '' AND day < ?", (day,))
+
+    def add_sample(self, series: str, value: float, keep: int):
+        with self._transaction() as db:
+            db.execute("INSERT INTO usage_samples (series, value) VALUES (?, ?)", (series, value))
+            # เก็บแค่ keep ค่าล่าสุดต่อ series
+            db.execute(
+                "DELETE FROM usage_samples WHERE series = ? AND id <= "
+                "(SELECT id FROM usage_samples WHERE series = ? ORDER BY id DESC LIMIT 1 OFFSET ?)",
+                (series, series, keep),
+            )
+
+    def samples(self, series: str) -> List[float]:
+        return [row[0] for row in self._connection().execute(
+            "SELECT value FROM usage_samples WHERE series = ? ORDER BY id", (series,),
+        )]
+
+
+def open_usage_store(path: Optional[str]):
+    """
+    path = ไฟล์ SQLite ที่ทุก process ใช้ร่วมกัน, None หรือ "" = นับในหน่วยความจำของ process นี้
+    """
+    return SqliteUsageStore(path) if path else MemoryUsageStore()
@@ -0,0 +1,159 @@
+"""
+บันทึก webhook จาก LINE ลงไฟล์ JSONL เพื่อนำ traffic จริงไป replay บนเครื่อง (benchmarks/replay_webhooks.py)
+
+แต่ละบรรทัดคือ webhook หนึ่ง request ที่ผ่านการตรวจ signature แล้ว:
+    {"received_at": <epoch วินาที>, "duration_ms": <เวลาที่ใช้ตอบ>, "status": <HTTP status>,
+     "headers": {...}, "body": "<body เดิมทุก byte (UTF-8)>"}
+ไม่เก็บ X-Line-Signature (ตัว replay เซ็นใหม่ด้วย channel secret ของเครื่องที่ replay)
+
+ทางร้อน (record) แค่ใส่ลงคิวแล้วคืนทันที การเขียนไฟล์ทำใน background thread
+ถ้าคิวเต็ม (ดิสก์ช้า) จะทิ้งรายการนั้นแล้วนับไว้ใน stats แทนการหน่วง webhook
+ไฟล์หมุนเมื่อใหญ่เกิน max_bytes และเก็บไว้ไม่เกิน keep_files ไฟล์ล่าสุด
+
+body มีข้อมูลส่วนบุคคลของผู้ใช้ (user id, ข้อความ เช่น เลขบัตรประชาชน) เปิดเฉพาะช่วงที่ต้องเก็บ traffic
+"""
+
+import glob
+import json
+import os
+import queue
+import threading
+import time
+from typing import Dict, List, Mapping, Optional, TextIO
+
+# header ที่ไม่เก็บ (เซ็นใหม่ตอน replay / ไม่เกี่ยวกับเนื้อหา)
+_SKIPPED_HEADERS = {"x-line-signature", "authorization", "cookie", "content-length"}
+_FILE_PREFIX = "webhooks-"
+
+
+class WebhookCapture:
+    """
+    ตัวเขียน webhook ลงไฟล์ JSONL แบบไม่บล็อก (thread-safe)
+
+    directory=None หรือ "" = ปิดการบันทึก (record/close ไม่ทำอะไร)
+    """
+
+    def __init__(self, directory: Optional[str], max_bytes: int = 64 * 1024 * 1024, keep_files: int = 20,
+                 queue_size: int = 10000):
+        self.directory = directory or None
+        self.max_bytes = max_bytes
+        self.keep_files = keep_files
+        self._queue: "queue.Queue[Optional[str]]" = queue.Queue(maxsize=queue_size)
+        self._file: Optional[TextIO] = None
+        self._file_bytes = 0
+        self._sequence = 0
+        self._written = 0
+        self._dropped = 0
+        self._lock = threading.Lock()
+        self._writer: Optional[threading.Thread] = None
+
+    @property
+    def enabled(self) -> bool:
+        return self.directory is not None
+
+    def record(self, body: bytes, headers: Mapping[str, str], received_at: float, duration_s: float, status: int):
+        """
+        บันทึก webhook หนึ่ง request (เรียกหลังตอบ/ประมวลผลแล้ว ไม่ raise)
+        """
+        if not self.enabled:
+            return
+        try:
+            line = json.dumps({
+                "received_at": round(received_at, 6),
+                "duration_ms": round(duration_s * 1000, 3),
+                "status": status,
+                "headers": {name.lower(): value for name, value in headers.items()
+                            if name.lower() not in _SKIPPED_HEADERS},
+                "body": body.decode("utf-8"),
+            }, ensure_ascii=False)
+        except (UnicodeDecodeError, TypeError, ValueError):
+            self._count_dropped()
+            return
+        self._ensure_writer()
+        try:
+            self._queue.put_nowait(line)
+        except queue.Full:
+            self._count_dropped()
+
+    def _count_dropped(self):
+        with self._lock:
+            self._dropped += 1
+
+    def _ensure_writer(self):
+        if self._writer is None:
+            with self._lock:
+                if self._writer is None:
+                    os.makedirs(self.directory, exist_ok=True)
+                    self._writer = threading.Thread(target=self._write_loop, name="webhook-capture", daemon=True)
+                    self._writer.start()
+
+    # ---------- background writer ----------
+    def _write_loop(self):
+        while True:
+            line = self._queue.get()
+            if line is None:
+                break
+            try:
+                self._write(line)
+                # flush เมื่อคิวว่าง: traffic หนาแน่นเขียนเป็นก้อน ช่วงเงียบข้อมูลลงไฟล์ทันที
+                if self._queue.empty():
+                    self._file.flush()
+            except OSError as e:
+                self._count_dropped()
+                print(f"⚠️ บันทึก webhook ลงไฟล์ไม่สำเร็จ: {e}")
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def _write(self, line: str):
+        data = line + "\n"
+        size = len(data.encode("utf-8"))
+        if self._file is None or self._file_bytes + size > self.max_bytes:
+            self._rotate()
+        self._file.write(data)
+        self._file_bytes += size
+        with self._lock:
+            self._written += 1
+
+    def _rotate(self):
+        if self._file is not None:
+            self._file.close()
+        # ชื่อไฟล์เรียงตามเวลาที่เปิด (sequence กันชื่อซ้ำเมื่อหมุนหลายครั้งในวินาทีเดียว)
+        self._sequence += 1
+        name = f"{_FILE_PREFIX}{time.strftime('%Y%m%d-%H%M%S')}-{os.getpid()}-{self._sequence:04d}.jsonl"
+        self._file = open(os.path.join(self.directory, name), "a", encoding="utf-8")
+        self._file_bytes = 0
+        for old in capture_files(self.directory)[:-self.keep_files]:
+            try:
+                os.unlink(old)
+            except OSError:
+                pass
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {
+                "directory": self.directory,
+                "written": self._written,
+                "dropped": self._dropped,
+                "queued": self._queue.qsize(),
+            }
+
+    def close(self, timeout: float = 5.0):
+        """
+        เขียนรายการที่ค้างในคิวให้หมดแล้วปิดไฟล์ (ไม่เกิน timeout วินาที)
+        """
+        if self._writer is None:
+            return
+        try:
+            self._queue.put(None, timeout=timeout)
+        except queue.Full:
+            return
+        self._writer.join(timeout)
+        self._writer = None
+
+
+def capture_files(directory: str) -> List[str]:
+    """
+    ไฟล์ที่บันทึกไว้ในโฟลเดอร์ เรียงจากเก่าไปใหม่
+    """
+    return sorted(glob.glob(os.path.join(directory, f"{_FILE_PREFIX}*.jsonl")))
@@ -0,0 +1,32 @@
+"""
+class ความเร่งด่วนของงานที่แบ่ง thread กัน (event_executor ของ web และ thread ของ worker.py)
+
+- interactive: งานที่ผู้ใช้รอคำตอบอยู่ตรงหน้า (ค้นหากรมธรรม์, OCR บัตร/ทะเบียนรถ, ตอบ Flex) ใช้เวลาไม่ถึงวินาที-ไม่กี่วินาที
+- bulk: วิเคราะห์ความเสียหายด้วย Gemini (10-30 วินาทีต่องาน) ผู้ใช้รอผลเป็น push อยู่แล้ว
+
+แต่ละ class กัน thread ไว้ได้ (reserved) class อื่นจะใช้ thread ส่วนนั้นไม่ได้:
+เมื่อ bulk ค้างเต็มคิว ยังเหลือ thread ให้ interactive ตอบทันที และ interactive ที่เข้ามารัว ๆ ก็ไม่ทำให้ bulk หยุดเดิน
+"""
+
+from typing import Dict, Optional, Tuple
+
+INTERACTIVE = "interactive"
+BULK = "bulk"
+# เรียงจากเร่งด่วนมากไปน้อย (ลำดับที่ scheduler เลือกเมื่อ thread ว่าง)
+PRIORITY_CLASSES: Tuple[str, ...] = (INTERACTIVE, BULK)
+
+
+def class_limits(max_workers: int, reserved: Optional[Dict[str, int]] = None) -> Dict[str, int]:
+    """
+    จำนวน thread สูงสุดที่แต่ละ class ใช้ได้พร้อมกัน = ทั้งหมด ลบส่วนที่กันไว้ให้ class อื่น
+    """
+    reserved = {name: count for name, count in (reserved or {}).items() if count}
+    unknown = set(reserved) - set(PRIORITY_CLASSES)
+    if unknown:
+        raise ValueError(f"ไม่รู้จัก priority class: {', '.join(sorted(unknown))}")
+    if sum(reserved.values()) >= max_workers:
+        raise ValueError(f"thread ที่กันไว้ ({sum(reserved.values())}) ต้องน้อยกว่าจำนวน thread ทั้งหมด ({max_workers})")
+    return {
+        name: max_workers - sum(count for other, count in reserved.items() if other != name)
+        for name in PRIORITY_CLASSES
+    }
@@ -0,0 +1,216 @@
+"""
+Worker สำหรับงานใน job_queue (วิเคราะห์ความเสียหาย, OCR) แยกจาก web process
+
+รัน:
+    JOB_QUEUE_PATH=data/jobs/jobs.db python worker.py
+
+ใช้ .env และ handler ชุดเดียวกับ main.py (JOB_HANDLERS) เพิ่มจำนวน worker ได้ทั้งด้วย
+WORKER_CONCURRENCY (thread ต่อ process) และ docker-compose up --scale worker=N
+เมื่อได้ SIGTERM จะหยุดหยิบงานใหม่และทำงานที่ค้างอยู่ให้เสร็จก่อนออก (ไม่เกิน SHUTDOWN_GRACE_S วินาที)
+แล้วลบ PDF ชั่วคราวและไฟล์ที่อัพโหลดไป Gemini ของงานที่ยังไม่จบ
+
+งานที่ล้มเหลวจนเข้า dead letter (จำนวนดูได้ที่ /health) ดูรายละเอียดและนำกลับเข้าคิวด้วย
+    python job_queue.py dead
+    python job_queue.py requeue <id>
+"""
+
+import os
+import signal
+import socket
+import threading
+import time
+from typing import Callable, Dict, Optional, Tuple
+
+import httpx
+
+from job_queue import JobQueue
+from usage_meter import BudgetExceededError
+from work_priority import BULK, INTERACTIVE, PRIORITY_CLASSES, class_limits
+
+
+def is_retryable(error: Exception) -> bool:
+    """
+    error ที่ลองใหม่แล้วไม่ช่วย (เช่น รูปใน LINE หมดอายุ 404, ผู้ใช้ครบ budget วันนี้) ให้เข้า dead letter ทันที
+    """
+    if isinstance(error, httpx.HTTPStatusError):
+        status = error.response.status_code
+        return status >= 500 or status == 429
+    return not isinstance(error, (LookupError, BudgetExceededError))
+
+
+class Worker:
+    """
+    thread ที่หยิบงานจากคิวมาทำ พร้อมต่อ lease ระหว่างทำ (heartbeat)
+
+    handlers: kind -> fn(job) คืนผลลัพธ์ (dict) หรือ None
+    on_dead: fn(job) เรียกเมื่องานเข้า dead letter (เช่น แจ้งผู้ใช้)
+    priorities: kind -> priority class (work_priority.py) kind ที่ไม่ได้ระบุเป็น bulk
+    reserved: thread ที่กันไว้ให้แต่ละ class thread ว่างหยิบงาน class ที่เร่งด่วนกว่าก่อน
+    """
+
+    def __init__(self, queue: JobQueue, handlers: Dict[str, Callable], on_dead: Optional[Callable] = None,
+                 concurrency: int = 2, poll_interval: float = 0.5, priorities: Optional[Dict[str, str]] = None,
+                 reserved: Optional[Dict[str, int]] = None):
+        self.queue = queue
+        self.handlers = handlers
+        self.on_dead = on_dead
+        self.concurrency = concurrency
+        self.poll_interval = poll_interval
+        self.name = f"{socket.gethostname()}-{os.getpid()}"
+        self._kinds = {
+            name: [kind for kind in handlers if (priorities or {}).get(kind, BULK) == name] for name in PRIORITY_CLASSES
+        }
+        self._limits = class_limits(concurrency, reserved)
+        self._running = dict.fromkeys(PRIORITY_CLASSES, 0)
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._threads = []
+
+    def start(self) -> "Worker":
+        for index in range(self.concurrency):
+            thread = threading.Thread(target=self._loop, args=(f"{self.name}-{index}",),
+                                      name=f"job-worker-{index}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        return self
+
+    def stop(self, wait: bool = True, timeout: Optional[float] = None) -> bool:
+        """
+        หยุดหยิบงานใหม่ และรองานที่กำลังทำ (ไม่เกิน timeout วินาทีรวมทุก thread) คืน True ถ้าทุก thread จบ
+        """
+        self._stop.set()
+        if wait:
+            deadline = None if timeout is None else time.monotonic() + timeout
+            for thread in self._threads:
+                thread.join(None if deadline is None else max(0.0, deadline - time.monotonic()))
+        return not any(thread.is_alive() for thread in self._threads)
+
+    def _loop(self, worker_name: str):
+        while not self._stop.is_set():
+            try:
+                claimed = self._claim(worker_name)
+            except Exception as e:
+                print(f"⚠️ หยิบงานจากคิวไม่สำเร็จ: {e}")
+                claimed = None
+            if claimed is None:
+                self._stop.wait(self.poll_interval)
+                continue
+            priority, job = claimed
+            try:
+                self._run(worker_name, job)
+            finally:
+                with self._lock:
+                    self._running[priority] -= 1
+
+    def _claim(self, worker_name: str) -> Optional[Tuple[str, Dict]]:
+        """
+        หยิบงานของ class ที่เร่งด่วนที่สุดที่ยังมี thread เหลือ คืน (class, งาน) หรือ None ถ้าไม่มีงานที่หยิบได้
+        """
+        for priority in PRIORITY_CLASSES:
+            if not self._kinds[priority]:
+                continue
+            # จอง thread ของ class ก่อนหยิบ ไม่ให้หลาย thread หยิบงาน class เดียวกันเกิน limit พร้อมกัน
+            with self._lock:
+                if self._running[priority] >= self._limits[priority]:
+                    continue
+                self._running[priority] += 1
+            job = None
+            try:
+                job = self.queue.claim(worker_name, kinds=self._kinds[priority])
+            finally:
+                if job is None:
+                    with self._lock:
+                        self._running[priority] -= 1
+            if job is not None:
+                return priority, job
+        return None
+
+    def _run(self, worker_name: str, job: Dict):
+        started = time.perf_counter()
+        print(f"🛠️ เริ่มงาน {job['id']} ({job['kind']}) ครั้งที่ {job['attempts']} [{worker_name}]")
+
+        # ต่อ lease ทุก 1/3 ของ visibility timeout ระหว่างที่ handler ยังทำงานอยู่
+        done = threading.Event()
+
+        def heartbeat():
+            while not done.wait(self.queue.visibility_timeout / 3):
+                if not self.queue.extend_lease(job["id"], worker_name):
+                    print(f"⚠️ lease ของงาน {job['id']} หลุดไปแล้ว")
+                    return
+
+        threading.Thread(target=heartbeat, name=f"lease-{job['id']}", daemon=True).start()
+        try:
+            result = self.handlers[job["kind"]](job)
+        except Exception as e:
+            done.set()
+            status = self.queue.fail(job["id"], worker_name, f"{type(e).__name__}: {e}", is_retryable(e))
+            print(f"❌ งาน {job['id']} ({job['kind']}) ล้มเหลว -> {status}: {e}")
+            if status == "dead" and self.on_dead is not None:
+                try:
+                    self.on_dead(job)
+                except Exception as notify_error:
+                    print(f"⚠️ แจ้งผู้ใช้ว่างาน {job['id']} ล้มเหลวไม่สำเร็จ: {notify_error}")
+            return
+        done.set()
+        self.queue.complete(job["id"], worker_name, result)
+        print(f"✅ งาน {job['id']} ({job['kind']}) เสร็จใน {time.perf_counter() - started:.1f}s")
+
+
+def reserved_threads(concurrency: int) -> Dict[str, int]:
+    """
+    thread ที่กันไว้ให้ OCR (ผู้ใช้รอคำตอบอยู่) และให้งานวิเคราะห์ความเสียหาย ค่าเริ่มต้น class ละ 1 เมื่อมีมากกว่า 2 thread
+    """
+    default = "1" if concurrency > 2 else "0"
+    return {
+        INTERACTIVE: int(os.getenv("WORKER_RESERVED_INTERACTIVE", default)),
+        BULK: int(os.getenv("WORKER_RESERVED_BULK", default)),
+    }
+
+
+def main():
+    # import main เพื่อใช้ handler, LINE config และ Gemini provider ชุดเดียวกับ web
+    import main as app_module
+
+    if app_module.job_queue is None:
+        raise SystemExit("กรุณาตั้งค่า JOB_QUEUE_PATH ให้ตรงกับ web")
+
+    concurrency = int(os.getenv("WORKER_CONCURRENCY", "4"))
+    worker = Worker(
+        app_module.job_queue,
+        app_module.JOB_HANDLERS,
+        on_dead=app_module.notify_job_failed,
+        concurrency=concurrency,
+        poll_interval=float(os.getenv("WORKER_POLL_INTERVAL_S", "0.5")),
+        priorities=app_module.JOB_PRIORITIES,
+        reserved=reserved_threads(concurrency),
+    )
+
+    stopping = threading.Event()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        signal.signal(sig, lambda *_: stopping.set())
+
+    print("=" * 60)
+    print(f"🛠️ Job worker {worker.name} ({worker.concurrency} threads)")
+    print(f"📦 Queue: {app_module.JOB_QUEUE_PATH} {app_module.job_queue.stats()}")
+    print("=" * 60)
+    worker.start()
+
+    # ลบงานเก่าที่จบแล้วเป็นระยะ
+    while not stopping.wait(3600):
+        removed = app_module.job_queue.purge()
+        if removed:
+            print(f"🧹 ลบงานเก่า {removed} รายการ")
+
+    print("🛑 หยุดรับงานใหม่ รอให้งานที่ค้างเสร็จ...")
+    if not worker.stop(wait=True, timeout=app_module.SHUTDOWN_GRACE_S):
+        # งานที่ยังไม่เสร็จถูก worker อื่นหยิบต่อหลัง lease หมดอายุ (retry key กันข้อความซ้ำ)
+        print(f"⏰ งานบางส่วนไม่เสร็จใน {app_module.SHUTDOWN_GRACE_S:.0f}s ปล่อยให้ลองใหม่จากคิว")
+    cleaned = app_module.shutdown_coordinator.cleanup(lambda name: app_module.get_llm_provider().delete_file(name))
+    print(f"🧹 เก็บกวาดไฟล์ที่ค้าง: {cleaned}")
+    app_module.line_data_client.close()
+    if app_module.fast_line_sender is not None:
+        app_module.fast_line_sender.close()
+
+
+if __name__ == "__main__":
+    main()